@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic but realistically-shaped control-port data for the
+benchmarks in this directory. Everything is generated from a seeded
+PRNG so runs are comparable with each other.
+"""
+
+import random
+from base64 import b64encode
+
+
+FLAG_SETS = [
+    'Fast Running Stable V2Dir Valid',
+    'Fast Guard HSDir Running Stable V2Dir Valid',
+    'Exit Fast Guard HSDir Running Stable V2Dir Valid',
+    'Exit Fast Running V2Dir Valid',
+    'Running Valid',
+    'Authority Fast Running Stable V2Dir Valid',
+]
+
+POLICIES = [
+    'p reject 1-65535',
+    'p accept 80,443',
+    'p accept 20-23,43,53,79-81,88,110,143,194,220,389,443,464-465,531,543-544,554,563,587,636,706,749,853,873,902-904,981,989-995,1194,1220,1293,1500,1533,1677,1723,1755,1863,2082-2083,2086-2087,2095-2096,2102-2104,3128,3389,3690,4321,4643,5050,5190,5222-5223,5228,5900,6660-6669,6679,6697,8000,8008,8074,8080,8082,8087-8088,8232-8233,8332-8333,8443,8888,9418,9999-10000,11371,19294,19638,50002,64738',
+    'p reject 25,119,135-139,445,563,1214,4661-4666,6346-6429,6699,6881-6999',
+]
+
+
+def _b64hash(rand):
+    raw = bytes(rand.getrandbits(8) for _ in range(20))
+    return b64encode(raw).decode('ascii').rstrip('=')
+
+
+def ns_all_lines(relays=7000, seed=1234):
+    """
+    Returns a list of str lines making up the body of a ``GETINFO
+    ns/all`` reply (without the "250+ns/all=" header or the
+    trailing "." / "250 OK").
+    """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(relays):
+        lines.append(
+            'r relay{} {} {} 2024-01-{:02d} {:02d}:{:02d}:{:02d} '
+            '{}.{}.{}.{} {} {}'.format(
+                i % 5000,
+                _b64hash(rand), _b64hash(rand),
+                rand.randint(1, 28), rand.randint(0, 23),
+                rand.randint(0, 59), rand.randint(0, 59),
+                rand.randint(1, 223), rand.randint(0, 255),
+                rand.randint(0, 255), rand.randint(1, 254),
+                rand.choice([443, 9001, 9050]), rand.choice([0, 80, 9030]),
+            )
+        )
+        if rand.random() < 0.3:
+            lines.append('a [2001:db8::{:x}]:9001'.format(i))
+        flags = rand.choice(FLAG_SETS)
+        lines.append('s ' + flags)
+        lines.append('w Bandwidth={}'.format(rand.randint(1, 200000)))
+        if 'Exit' in flags:
+            lines.append(rand.choice(POLICIES[1:]))
+        else:
+            lines.append(POLICIES[0])
+    return lines
+
+
+def _relay_groups(lines):
+    groups = []
+    for line in lines:
+        if line.startswith('r '):
+            groups.append([])
+        groups[-1].append(line)
+    return groups
+
+
+def next_consensus_lines(lines, changed=0.1, churn=0.01, seed=4321):
+    """
+    Given the lines from ns_all_lines, returns those of a plausible
+    next consensus: ``changed`` of the relays get a new bandwidth
+    weight, and ``churn`` of them leave while as many new ones join.
+    """
+    rand = random.Random(seed)
+    relays = _relay_groups(lines)
+    for relay in relays:
+        if rand.random() < changed:
+            relay[-2] = 'w Bandwidth={}'.format(rand.randint(1, 200000))
+    gone = int(len(relays) * churn)
+    relays = relays[gone:] + _relay_groups(ns_all_lines(gone, seed))
+    return [line for relay in relays for line in relay]
+
+
+def ns_all_reply(relays=7000, seed=1234):
+    """
+    The complete wire reply to ``GETINFO ns/all`` as a list of bytes
+    lines (no line-endings).
+    """
+    lines = [b'250+ns/all=']
+    lines.extend(line.encode('ascii') for line in ns_all_lines(relays, seed))
+    lines.append(b'.')
+    lines.append(b'250 OK')
+    return lines
+
+
+CONFIG_TYPES = ['Boolean', 'Integer', 'Interval', 'DataSize', 'String',
+                'LineList', 'Filename', 'CommaList', 'Port', 'Dependent']
+
+
+def _option_name(rand, i):
+    parts = ['Circuit', 'Stream', 'Client', 'Exit', 'Socks', 'Control',
+             'Bandwidth', 'Guard', 'Hidden', 'Service', 'Dir', 'Max', 'Min',
+             'Timeout', 'Policy', 'Port', 'Use', 'Accept', 'Rate', 'Burst']
+    return ''.join(rand.choice(parts) for _ in range(rand.randint(2, 4))) + str(i)
+
+
+def config_names_text(options=400, seed=1234):
+    """
+    The text of a ``GETINFO config/names`` reply (as
+    :func:`txtorcon.torcontrolprotocol.parse_keywords` gets it): one
+    "Name Type" line per option. Current Tor has about 400 options.
+    """
+    rand = random.Random(seed)
+    lines = ['config/names=']
+    for i in range(options):
+        lines.append('{} {}'.format(_option_name(rand, i), rand.choice(CONFIG_TYPES)))
+    return '\n'.join(lines)
+
+
+def config_defaults_text(options=400, seed=1234):
+    """
+    The text of a ``GETINFO config/defaults`` reply: "Name value"
+    lines, some values with "=" signs or quotes in them.
+    """
+    rand = random.Random(seed)
+    lines = ['config/defaults=']
+    for i in range(options):
+        value = rand.choice([
+            '0', '1', 'auto', '30 minutes', '1 GB',
+            'reject *:25,reject *:119,accept *:*',
+            'moria1 orport=9101 v3ident=D586D18309DED4CD6D57C18FDB97EFA96D330566 128.31.0.39:9131',
+            '"/var/lib/tor"',
+        ])
+        lines.append('{} {}'.format(_option_name(rand, i), value))
+    return '\n'.join(lines)
+
+
+def entry_guards_text(guards=60, seed=1234):
+    """
+    The text of a ``GETINFO entry-guards`` reply.
+    """
+    rand = random.Random(seed)
+    lines = ['entry-guards=']
+    for i in range(guards):
+        lines.append('${}~guard{} {}'.format(
+            ''.join(rand.choice('0123456789ABCDEF') for _ in range(40)), i,
+            rand.choice(['up', 'up', 'down', 'never-connected', 'unusable']),
+        ))
+    return '\n'.join(lines)
+
+
+def circuit_status_text(circuits=300, seed=1234):
+    """
+    The text of a ``GETINFO circuit-status`` reply from a busy client,
+    with quoted SOCKS_USERNAME values.
+    """
+    rand = random.Random(seed)
+
+    def hop():
+        return '${}~relay{}'.format(
+            ''.join(rand.choice('0123456789ABCDEF') for _ in range(40)),
+            rand.randint(0, 5000),
+        )
+
+    lines = ['circuit-status=']
+    for i in range(circuits):
+        lines.append(
+            '{} BUILT {} BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL '
+            'TIME_CREATED=2024-01-01T12:{:02d}:{:02d}.000000 '
+            'SOCKS_USERNAME="user \\"{}\\"" SOCKS_PASSWORD="pw"'.format(
+                i + 1, ','.join(hop() for _ in range(3)),
+                rand.randint(0, 59), rand.randint(0, 59), i,
+            )
+        )
+    return '\n'.join(lines)
+
+
+def conf_changed_text(options=200, seed=1234):
+    """
+    The text of a large ``CONF_CHANGED`` event (as after a RELOAD):
+    "Name=value" lines, some quoted and some bare (back to default).
+    """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(options):
+        name = _option_name(rand, i)
+        choice = rand.randint(0, 3)
+        if choice == 0:
+            lines.append(name)
+        elif choice == 1:
+            lines.append('{}="/var/lib/tor/dir {}"'.format(name, i))
+        else:
+            lines.append('{}={}'.format(name, rand.randint(0, 10000)))
+    return '\n'.join(lines)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+"""
+Building 5000 circuits against a simulated Tor in which each hop
+takes a random 0.1 to 0.5 seconds (of simulated time) to extend and
+5% of circuits fail: one at a time with build_timeout_circuit (the
+way a measurement script would without TorState.build_circuits), and
+with build_circuits keeping 8 and 32 in flight. Reports the
+simulated time taken and the summary build_circuits gives.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/batch_build.py
+"""
+
+import random
+
+from twisted.internet import defer, task
+
+from txtorcon import TorState, build_timeout_circuit
+from txtorcon.testutil import FakeControlProtocol
+
+CIRCUITS = 5000
+HOPS = ['$%040X=relay%d' % (n, n) for n in range(1, 4)]
+
+
+class SimulatedTor(FakeControlProtocol):
+    """
+    Answers EXTENDCIRCUIT at once, then sends a CIRC EXTENDED event
+    for each hop and BUILT (or, sometimes, FAILED).
+    """
+
+    def __init__(self, clock, rand):
+        super(SimulatedTor, self).__init__([])
+        self.clock = clock
+        self.rand = rand
+        self.state = None
+        self.next_id = 1
+
+    def queue_command(self, cmd):
+        if cmd.startswith('EXTENDCIRCUIT'):
+            circid = self.next_id
+            self.next_id += 1
+            at = 0.0
+            for count in range(1, len(HOPS) + 1):
+                at += self.rand.uniform(0.1, 0.5)
+                if count == len(HOPS):
+                    status = 'FAILED' if self.rand.random() < 0.05 else 'BUILT'
+                else:
+                    status = 'EXTENDED'
+                self.clock.callLater(
+                    at, self.state._circuit_update,
+                    '%d %s %s PURPOSE=GENERAL' % (circid, status, ','.join(HOPS[:count])),
+                )
+            return defer.succeed('EXTENDED %d' % circid)
+        return defer.succeed('OK')
+
+
+def simulated():
+    clock = task.Clock()
+    tor = SimulatedTor(clock, random.Random(1234))
+    state = TorState(tor, bootstrap=False, reactor=clock)
+    tor.state = state
+    return clock, state
+
+
+def run(clock, d):
+    """
+    Advances the clock until ``d`` fires, returning its result and
+    the simulated seconds that took.
+    """
+    done = []
+    d.addBoth(done.append)
+    start = clock.seconds()
+    while not done:
+        soonest = min(call.getTime() for call in clock.getDelayedCalls())
+        clock.advance(soonest - clock.seconds())
+    return done[0], clock.seconds() - start
+
+
+def one_at_a_time(state, clock):
+    built = []
+
+    @defer.inlineCallbacks
+    def build_all():
+        for _ in range(CIRCUITS):
+            try:
+                circuit = yield build_timeout_circuit(state, clock, None, 60)
+            except Exception:
+                continue
+            built.append(circuit)
+    return build_all()
+
+
+def main():
+    clock, state = simulated()
+    _, simulated_time = run(clock, one_at_a_time(state, clock))
+    print("{} circuits, one at a time:  {:5.0f} s".format(CIRCUITS, simulated_time))
+
+    for concurrency in (8, 32):
+        clock, state = simulated()
+        summary, simulated_time = run(
+            clock, state.build_circuits([None] * CIRCUITS, concurrency=concurrency, timeout=60),
+        )
+        print("build_circuits, {:2d} in flight: {:5.0f} s".format(concurrency, simulated_time))
+        print("  built {:.1%}, p50 {:.2f} s, p95 {:.2f} s".format(
+            summary.success_rate, summary.p50, summary.p95))
+
+
+if __name__ == '__main__':
+    main()
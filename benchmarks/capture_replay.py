@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cost of recording control traffic: nothing, the bounded in-memory
+capture, and start_debug()'s per-line log file. Then replays the
+captured event storm at full speed.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/capture_replay.py
+"""
+
+import os
+import tempfile
+import time
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.capture import parse_capture, replay
+
+
+def _lines(count):
+    return [
+        b'650 CIRC %d EXTENDED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0~eris '
+        b'BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL' % (x % 1000)
+        for x in range(count)
+    ]
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto._set_valid_events('CIRC')
+    proto.add_event_listener('CIRC', lambda data: None)
+    proto.lineReceived(b'250 OK')
+    return proto
+
+
+def run(lines, mode):
+    proto = _protocol()
+    if mode == 'capture':
+        proto.start_capture(max_bytes=4 * 1024 * 1024)
+    elif mode == 'debug':
+        proto.start_debug()
+    start = time.perf_counter()
+    for line in lines:
+        proto.lineReceived(line)
+    elapsed = time.perf_counter() - start
+    if mode == 'debug':
+        proto.debuglog.close()
+    return elapsed, proto
+
+
+def main():
+    lines = _lines(100000)
+    here = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)  # start_debug() writes to the current directory
+        try:
+            for mode in ('off', 'capture', 'debug'):
+                elapsed, proto = run(lines, mode)
+                print("{:8s} {:.2f} us/line".format(mode, elapsed / len(lines) * 1e6))
+                if mode == 'capture':
+                    dump = proto.capture.dumps()
+                    print("         capture: {} lines kept ({} dropped), {} bytes dumped".format(
+                        len(proto.capture), proto.capture.dropped, len(dump)))
+        finally:
+            os.chdir(here)
+
+    captured = parse_capture(dump)
+    target = _protocol()
+    start = time.perf_counter()
+    replay(captured, target)
+    elapsed = time.perf_counter() - start
+    print("replay   {} lines in {:.0f} ms".format(len(captured), elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
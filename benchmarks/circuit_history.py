@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Launching, building and closing 20000 3-hop circuits (each carrying
+one stream) through TorState's event handlers: the time per circuit,
+and the memory TorState holds afterwards, which stays the same
+however many circuits have come and gone because its history keeps
+only the most recent history_size records of each kind.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/circuit_history.py
+"""
+
+import gc
+import time
+import tracemalloc
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+
+CIRCUITS = 20000
+PATH = ','.join(
+    '$%040X=relay%d' % (n, n) for n in range(1, 4)
+)
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def churn(state, first, count):
+    for circid in range(first, first + count):
+        state._circuit_update('%d LAUNCHED PURPOSE=GENERAL' % circid)
+        state._circuit_update('%d BUILT %s PURPOSE=GENERAL' % (circid, PATH))
+        state._stream_update('%d NEW 0 www.example.com:443' % circid)
+        state._stream_update('%d SUCCEEDED %d 1.2.3.4:443' % (circid, circid))
+        state._stream_update('%d CLOSED %d 1.2.3.4:443 REASON=DONE' % (circid, circid))
+        state._circuit_update('%d CLOSED %s PURPOSE=GENERAL REASON=FINISHED' % (circid, PATH))
+
+
+def retained(history_size):
+    gc.collect()
+    tracemalloc.start()
+    state = TorState(FakeControlProtocol([]), bootstrap=False, history_size=history_size)
+    churn(state, 1, 1000)
+    gc.collect()
+    after_1k = tracemalloc.get_traced_memory()[0]
+    churn(state, 1001, CIRCUITS - 1000)
+    gc.collect()
+    after_all = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after_1k, after_all, state
+
+
+def main():
+    state = TorState(FakeControlProtocol([]), bootstrap=False)
+    elapsed = best_of(3, lambda: churn(state, 1, 10000))
+    print("one circuit and stream, launched to closed: {:6.1f} us".format(elapsed / 10000 * 1e6))
+    for history_size in (1000, 0):
+        after_1k, after_all, state = retained(history_size)
+        print("history_size={}: {:7.0f} KiB after 1000 circuits, {:7.0f} KiB after {} ({} records kept)".format(
+            history_size, after_1k / 1024.0, after_all / 1024.0, CIRCUITS,
+            len(state.history.circuits) + len(state.history.streams)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""
+How long a request waits for a circuit of its own: building one per
+request (TorState.build_circuit, then when_built) and taking one
+from a CircuitPool that keeps two (or ten) ready. Tor is simulated: each
+circuit is BUILT a random 0.3 to 1.5 seconds (of simulated time)
+after its EXTENDCIRCUIT. Requests arrive one every 2 seconds, and in
+bursts of 10 every 20 seconds. Also times the CPU a get() from the
+pool costs, including building its replacement through TorState.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/circuit_pool.py
+"""
+
+import random
+import time
+
+from twisted.internet import defer, task
+
+from txtorcon import TorState, CircuitPool, CircuitClass
+from txtorcon.testutil import FakeControlProtocol
+
+REQUESTS = 1000
+PATH = ','.join('$%040X=relay%d' % (n, n) for n in range(1, 4))
+
+
+class SimulatedTor(FakeControlProtocol):
+    """
+    Answers EXTENDCIRCUIT at once and (while ``building``) sends the
+    circuit's BUILT event after a random delay; CLOSECIRCUIT closes
+    it on the next turn.
+    """
+
+    def __init__(self, clock, rand):
+        super(SimulatedTor, self).__init__([])
+        self.clock = clock
+        self.rand = rand
+        self.state = None
+        self.next_id = 1
+        self.building = True
+
+    def queue_command(self, cmd):
+        if cmd.startswith('EXTENDCIRCUIT'):
+            circid = self.next_id
+            self.next_id += 1
+            if self.building:
+                self.clock.callLater(
+                    self.rand.uniform(0.3, 1.5), self.state._circuit_update,
+                    '%d BUILT %s PURPOSE=GENERAL' % (circid, PATH),
+                )
+            return defer.succeed('EXTENDED %d' % circid)
+        if cmd.startswith('CLOSECIRCUIT'):
+            circid = cmd.split()[1]
+            self.clock.callLater(
+                0, self.state._circuit_update,
+                '%s CLOSED %s PURPOSE=GENERAL REASON=REQUESTED' % (circid, PATH),
+            )
+        return defer.succeed('OK')
+
+
+def simulated():
+    clock = task.Clock()
+    tor = SimulatedTor(clock, random.Random(1234))
+    state = TorState(tor, bootstrap=False, reactor=clock)
+    tor.state = state
+    return clock, state, tor
+
+
+def waits(get, clock, arrivals):
+    """
+    The simulated seconds each request (arriving at the given times)
+    waits for its circuit from ``get()``.
+    """
+    waited = []
+
+    def request():
+        start = clock.seconds()
+
+        def got(circuit):
+            waited.append(clock.seconds() - start)
+            return circuit.close()
+        get().addCallback(got)
+    for at in arrivals:
+        clock.callLater(at, request)
+    clock.pump([0.01] * int((max(arrivals) + 5) * 100))
+    return waited
+
+
+def report(name, arrivals, size):
+    clock, state, _ = simulated()
+
+    def build():
+        d = state.build_circuit(using_guards=False)
+        d.addCallback(lambda circuit: circuit.when_built())
+        return d
+    fresh = waits(build, clock, arrivals)
+
+    clock, state, _ = simulated()
+    pool = CircuitPool(clock, state, {CircuitClass(): size})
+    pool.start()
+    clock.advance(2)
+    pooled = waits(pool.get, clock, arrivals)
+
+    print(name)
+    for label, waited in (("build per request", fresh), ("CircuitPool({})".format(size), pooled)):
+        waited.sort()
+        print("  {:18s} mean {:5.0f} ms, median {:5.0f} ms, p90 {:5.0f} ms".format(
+            label, sum(waited) / len(waited) * 1e3,
+            waited[len(waited) // 2] * 1e3, waited[len(waited) * 9 // 10] * 1e3))
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    report("one request every 2s:", [2.0 * n for n in range(REQUESTS)], 2)
+    bursts = [20.0 * (n // 10) for n in range(REQUESTS)]
+    report("bursts of 10 every 20s:", bursts, 2)
+    report("bursts of 10 every 20s:", bursts, 10)
+
+    # task.Clock sorts its calls on every callLater, so the pool's
+    # timeouts and expiries use the (not running) real reactor here
+    from twisted.internet import reactor
+    clock, state, tor = simulated()
+    pool = CircuitPool(reactor, state, {CircuitClass(): REQUESTS})
+    pool.start()
+    clock.advance(2)
+    tor.building = False
+
+    def take():
+        for _ in range(REQUESTS):
+            pool.get()
+    print("CPU per get() from a ready pool (replacement included): {:.1f} us".format(
+        best_of(1, take) / REQUESTS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
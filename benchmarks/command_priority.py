@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+Simulated ATTACHSTREAM latency while TorConfig-style GETCONF sweeps
+and a GETINFO ns/all are queued ahead of it: everything in one FIFO
+lane (the default) versus the bulk work queued at PRIORITY_BULK and
+the ATTACHSTREAMs at PRIORITY_HIGH.
+
+Tor is simulated by answering each written command after a fixed
+service time (``ns/all`` takes much longer than anything else), so
+the numbers are in simulated seconds.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/command_priority.py
+"""
+
+from twisted.internet.task import Clock
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.torcontrolprotocol import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
+
+SERVICE_TIME = {
+    b'GETINFO ns/all': 0.400,
+}
+DEFAULT_SERVICE_TIME = 0.002
+
+
+class SimulatedTor(proto_helpers.StringTransport):
+    """
+    Answers each command (in order) once its service time has passed.
+    """
+
+    def __init__(self, clock):
+        super(SimulatedTor, self).__init__()
+        self.clock = clock
+        self.protocol = None
+        self.busy_until = 0.0
+
+    def write(self, data):
+        for cmd in data.split(b'\r\n'):
+            if not cmd:
+                continue
+            start = max(self.clock.seconds(), self.busy_until)
+            self.busy_until = start + SERVICE_TIME.get(cmd, DEFAULT_SERVICE_TIME)
+            self.clock.callLater(
+                self.busy_until - self.clock.seconds(),
+                self.protocol.dataReceived, b'250 OK\r\n',
+            )
+
+
+def run(fifo, attaches=20, getconfs=200):
+    clock = Clock()
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto._now = clock.seconds
+    tor = SimulatedTor(clock)
+    tor.protocol = proto
+    proto.makeConnection(tor)
+
+    bulk = PRIORITY_NORMAL if fifo else PRIORITY_BULK
+    urgent = PRIORITY_NORMAL if fifo else PRIORITY_HIGH
+    proto.queue_command('GETINFO ns/all', priority=bulk)
+    for x in range(getconfs):
+        proto.queue_command('GETCONF Option{}'.format(x), priority=bulk)
+
+    latencies = []
+
+    def attach(stream_id):
+        issued = clock.seconds()
+        d = proto.queue_command('ATTACHSTREAM {} 0'.format(stream_id), priority=urgent)
+        d.addCallback(lambda _: latencies.append(clock.seconds() - issued))
+
+    # streams arrive every 10ms while the bulk work is going on
+    for x in range(attaches):
+        clock.callLater(0.010 * x, attach, x)
+    while clock.getDelayedCalls():
+        clock.advance(0.001)
+    return latencies
+
+
+def main():
+    for fifo in (True, False):
+        latencies = sorted(run(fifo))
+        print("{}: ATTACHSTREAM latency median {:.0f} ms, max {:.0f} ms".format(
+            'single FIFO' if fifo else 'priorities ',
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[-1] * 1e3,
+        ))
+
+
+if __name__ == '__main__':
+    main()
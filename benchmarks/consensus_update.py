@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+How long the reactor is held up when a 7000-relay NEWCONSENSUS
+arrives (for a TorState that already has the previous consensus,
+which is either entirely different or differs in the way an hour
+usually makes: 10% new bandwidth weights, 1% churn): a
+LoopingCall ticks every millisecond while the update runs, and the
+longest gap between ticks is reported along with the time until the
+new routers are in place. The update is done both synchronously
+(TorState._update_network_status, which is what NEWCONSENSUS used to
+do) and the way NEWCONSENSUS events are handled now, parsing in a
+thread from the reactor's pool.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/consensus_update.py
+"""
+
+import time
+
+from twisted.internet import defer, task
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+from _corpus import ns_all_lines, next_consensus_lines
+
+ROUNDS = 7
+
+
+def _consensus(lines):
+    return '\n'.join(['ns/all='] + lines + ['.'])
+
+
+@defer.inlineCallbacks
+def measure(reactor, update, state, data):
+    gaps = [0.0]
+    last = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        gaps.append(now - last[0])
+        last[0] = now
+    ticker = task.LoopingCall(tick)
+    ticker.clock = reactor
+    ticker.start(0.001)
+
+    old = state.routers_by_hash
+    start = time.perf_counter()
+    update(state, data)
+    while state.routers_by_hash is old:
+        yield task.deferLater(reactor, 0.001, lambda: None)
+    elapsed = time.perf_counter() - start
+    yield task.deferLater(reactor, 0.005, lambda: None)
+    ticker.stop()
+    return max(gaps), elapsed
+
+
+@defer.inlineCallbacks
+def run(reactor, name, update, consensuses):
+    state = TorState(FakeControlProtocol([]), bootstrap=False, reactor=reactor)
+    state._update_network_status(consensuses[0])
+    best_gap = best_total = None
+    for i in range(ROUNDS):
+        gap, total = yield measure(reactor, update, state, consensuses[(i + 1) % 2])
+        best_gap = gap if best_gap is None else min(best_gap, gap)
+        best_total = total if best_total is None else min(best_total, total)
+    print("  {}: longest stall {:6.1f} ms, routers replaced after {:6.1f} ms".format(
+        name, best_gap * 1e3, best_total * 1e3))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    lines = ns_all_lines(seed=1234)
+    cases = [
+        ("all-new", [_consensus(lines), _consensus(ns_all_lines(seed=4321))]),
+        ("next hour's", [_consensus(lines), _consensus(next_consensus_lines(lines))]),
+    ]
+    for (name, consensuses) in cases:
+        print("{} NEWCONSENSUS with 7000 relays (best of {}):".format(name, ROUNDS))
+        yield run(reactor, "synchronous", lambda state, data: state._update_network_status(data), consensuses)
+        yield run(reactor, "threaded   ", lambda state, data: state._network_status_event(data), consensuses)
+
+
+if __name__ == '__main__':
+    task.react(main)
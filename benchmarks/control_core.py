@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+The reply framer on its own, with no reactor or event loop: feeds a
+``GETINFO ns/all`` reply for a 7000-relay consensus and a burst of
+650 events to txtorcon.controlcore.ControlCore in 16 KiB chunks, and
+the same bytes to TorControlProtocol.dataReceived (Twisted's line
+splitting plus the same core) for comparison.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/control_core.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.controlcore import ControlCore
+from _corpus import ns_all_reply
+
+CHUNK = 16 * 1024
+EVENT = b'650 CIRC 1000 EXTENDED $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~a PURPOSE=GENERAL'
+
+
+def chunks(data):
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def best_of(rounds, func):
+    best = None
+    for _ in range(rounds):
+        elapsed = func()
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def core_reply(pieces):
+    replies = []
+    core = ControlCore(on_reply=lambda code, text: replies.append(text),
+                       on_event=lambda name, text: None)
+    core.send_command('GETINFO ns/all')
+    start = time.perf_counter()
+    for piece in pieces:
+        core.receive_data(piece)
+    elapsed = time.perf_counter() - start
+    assert replies
+    return elapsed
+
+
+def core_events(pieces):
+    core = ControlCore(on_reply=None, on_event=lambda name, text: None)
+    start = time.perf_counter()
+    for piece in pieces:
+        core.receive_data(piece)
+    return time.perf_counter() - start
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    return proto
+
+
+def twisted_reply(pieces):
+    proto = _protocol()
+    replies = []
+    proto.get_info_raw('ns/all').addCallback(replies.append)
+    start = time.perf_counter()
+    for piece in pieces:
+        proto.dataReceived(piece)
+    elapsed = time.perf_counter() - start
+    assert replies
+    return elapsed
+
+
+def twisted_events(pieces):
+    proto = _protocol()
+    proto._set_valid_events('CIRC')
+    proto.add_event_listener('CIRC', lambda data: None)
+    proto.lineReceived(b'250 OK')
+    start = time.perf_counter()
+    for piece in pieces:
+        proto.dataReceived(piece)
+    return time.perf_counter() - start
+
+
+def main():
+    reply = chunks(b''.join(line + b'\r\n' for line in ns_all_reply(7000)))
+    events = chunks((EVENT + b'\r\n') * 100000)
+    print("GETINFO ns/all ({} KiB):".format(sum(len(p) for p in reply) // 1024))
+    print("  ControlCore.receive_data:          {:6.1f} ms".format(best_of(5, lambda: core_reply(reply)) * 1e3))
+    print("  TorControlProtocol.dataReceived:   {:6.1f} ms".format(best_of(5, lambda: twisted_reply(reply)) * 1e3))
+    print("100000 single-line 650 events:")
+    print("  ControlCore.receive_data:          {:6.1f} ms".format(best_of(5, lambda: core_events(events)) * 1e3))
+    print("  TorControlProtocol.dataReceived:   {:6.1f} ms".format(best_of(5, lambda: twisted_events(events)) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+How long a GETINFO reply waits behind a burst of events that arrived
+just before it: on a single control connection the burst has to be
+parsed (and its listeners run) first, while with a TorControlPool the
+events arrive on their own connection and the reply can be handled as
+soon as its connection is readable.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/control_pool.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol, TorControlPool
+
+
+BURST = b''.join(
+    b'650 CIRC_BW ID=%d READ=%d WRITTEN=%d TIME=2024-01-01T00:00:00.000000\r\n' % (x, x, x)
+    for x in range(5000)
+)
+REPLY = b'250 version=0.4.8.9\r\n'
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto._set_valid_events('CIRC_BW')
+    proto.post_bootstrap.callback(proto)
+    return proto
+
+
+def _listener(data):
+    data.split()
+
+
+def single(rounds=20):
+    proto = _protocol()
+    proto.add_event_listener('CIRC_BW', _listener)
+    proto.dataReceived(b'250 OK\r\n')
+    waits = []
+    for _ in range(rounds):
+        got = []
+        proto.get_info_raw('version').addCallback(got.append)
+        start = time.perf_counter()
+        # the reply is read in the same chunk, after the events
+        proto.dataReceived(BURST + REPLY)
+        assert got
+        waits.append(time.perf_counter() - start)
+    return waits
+
+
+def pooled(rounds=20):
+    events = _protocol()
+    commands = [_protocol(), _protocol()]
+    pool = TorControlPool(events, commands)
+    pool.add_event_listener('CIRC_BW', _listener)
+    events.dataReceived(b'250 OK\r\n')
+    waits = []
+    for _ in range(rounds):
+        got = []
+        pool.get_info_raw('version').addCallback(got.append)
+        start = time.perf_counter()
+        # the reply's connection is readable on its own
+        for proto in commands:
+            if proto.outstanding:
+                proto.dataReceived(REPLY)
+        assert got
+        waits.append(time.perf_counter() - start)
+        events.dataReceived(BURST)
+    return waits
+
+
+def main():
+    for name, run in (('single connection', single), ('pool', pooled)):
+        waits = sorted(run())
+        print("{:18s} reply handled after {:.3f} ms (median)".format(
+            name, waits[len(waits) // 2] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+A metrics consumer totalling CIRC_BW bytes per circuit: one callback
+per event, versus batches delivered once per (simulated) second with
+the per-circuit sums already done.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/event_coalescing.py
+"""
+
+import time
+
+from twisted.internet.task import Clock
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.util import find_keywords
+
+
+def _lines(count, circuits=500):
+    return [
+        '650 CIRC_BW ID={} READ={} WRITTEN={} TIME=2024-01-01T00:00:00.000000'.format(
+            x % circuits, x % 4096, (x * 7) % 4096,
+        ).encode('ascii')
+        for x in range(count)
+    ]
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto._set_valid_events('CIRC_BW')
+    return proto
+
+
+def run(lines, window, rate=1000.0, chunk=100):
+    """
+    ``rate`` events per second of simulated time arrive, ``chunk`` at
+    a time; ``window`` None means a plain per-event listener.
+    """
+    totals = {}
+    calls = [0]
+
+    def per_event(data):
+        calls[0] += 1
+        kw = find_keywords(data.split())
+        circ_id = int(kw['ID'])
+        read, written = totals.get(circ_id, (0, 0))
+        totals[circ_id] = (read + int(kw['READ']), written + int(kw['WRITTEN']))
+
+    def per_batch(batch):
+        calls[0] += 1
+        for circ_id, (read, written) in batch.circuit_bytes.items():
+            prev_read, prev_written = totals.get(circ_id, (0, 0))
+            totals[circ_id] = (prev_read + read, prev_written + written)
+
+    clock = Clock()
+    proto = _protocol()
+    if window is None:
+        proto.add_event_listener('CIRC_BW', per_event)
+    else:
+        proto.add_event_listener('CIRC_BW', per_batch, window=window, reactor=clock)
+    proto.lineReceived(b'250 OK')
+
+    step = chunk / rate
+    start = time.perf_counter()
+    for offset in range(0, len(lines), chunk):
+        for line in lines[offset:offset + chunk]:
+            proto.lineReceived(line)
+        clock.advance(step)
+    proto.remove_event_listener('CIRC_BW', per_batch if window else per_event)
+    elapsed = time.perf_counter() - start
+    return elapsed, calls[0], totals
+
+
+def main():
+    lines = _lines(100000)
+    baseline = None
+    for window in (None, 0.1, 1.0):
+        elapsed, calls, totals = run(lines, window)
+        if baseline is None:
+            baseline = totals
+        assert totals == baseline
+        print("window {}: {:.0f} ms, {} callbacks".format(
+            window or 'off', elapsed * 1e3, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+The keyword arguments of 100000 CIRC events: building them from the
+already-split arguments (as Circuit.update does), and splitting each
+line and
+building its keywords the old way (``line.split()`` plus
+``util.find_keywords``) versus ``util.split_event_args`` plus
+``util.KeywordMap.from_args``, with the transient memory allocated
+per event (the tracemalloc peak above what is retained). Then the
+same events through ``TorState._circuit_update``, which now uses the
+latter.
+
+Events from a Tor Browser (IsolateSOCKSAuth) carry quoted
+``SOCKS_USERNAME`` / ``SOCKS_PASSWORD`` values, which the old way
+split apart, so those are timed separately.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/event_keywords.py
+"""
+
+import time
+import tracemalloc
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+from txtorcon.util import find_keywords, split_event_args, KeywordMap
+
+COUNT = 100000
+PATH = ('$E11D2B2269CC25E67CA6C9FB5843497539A74FD0~eris,'
+        '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5~venus,'
+        '$253DFF1838A2B7782BE7735F74E50090D46CA1BC~chomsky')
+
+
+def events(quoted):
+    lines = []
+    for i in range(COUNT):
+        socks = ' SOCKS_USERNAME="user {}" SOCKS_PASSWORD="x"'.format(i % 50) if quoted else ''
+        lines.append(
+            '{} EXTENDED {} BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL '
+            'TIME_CREATED=2024-01-01T00:00:00.000000{}'.format(i % 500 + 1, PATH, socks)
+        )
+    return lines
+
+
+def old_way(line):
+    return find_keywords(line.split())
+
+
+def new_way(line):
+    return KeywordMap.from_args(split_event_args(line))
+
+
+def old_keywords(args):
+    return find_keywords(args)
+
+
+def new_keywords(args):
+    return KeywordMap.from_args(args)
+
+
+def timed(func, lines):
+    best = None
+    for _ in range(5):
+        start = time.perf_counter()
+        for line in lines:
+            func(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def transient(func, lines):
+    total = 0
+    tracemalloc.start()
+    for line in lines:
+        tracemalloc.reset_peak()
+        kw = func(line)
+        current, peak = tracemalloc.get_traced_memory()
+        total += peak - current
+        del kw
+    tracemalloc.stop()
+    return total / float(len(lines))
+
+
+def main():
+    args = [line.split() for line in events(False)]
+    print("keywords of already-split events:")
+    for name, func in (('find_keywords', old_keywords),
+                       ('KeywordMap.from_args', new_keywords)):
+        print("  {:30s} {:7.1f} ms {:5.0f} bytes/event transient".format(
+            name, timed(func, args) * 1e3, transient(func, args[:10000])))
+
+    for quoted in (False, True):
+        lines = events(quoted)
+        print("{} events, from the line:".format("quoted" if quoted else "unquoted"))
+        for name, func in (('split + find_keywords', old_way),
+                           ('split_event_args + KeywordMap', new_way)):
+            print("  {:30s} {:7.1f} ms {:5.0f} bytes/event transient".format(
+                name, timed(func, lines) * 1e3, transient(func, lines[:10000])))
+        state = TorState(FakeControlProtocol([]), bootstrap=False)
+        print("  TorState._circuit_update       {:7.1f} ms".format(
+            timed(state._circuit_update, lines) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Finding the routers whose exit policies accept a port, among 7000
+routers of which about a third are exits with (mostly distinct)
+"accept" or "reject" summaries: by calling Router.accepts_port on
+every router, and through an ExitPolicyIndex (also timing building
+the index, which TorState does once per consensus).
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/exit_index.py
+"""
+
+import random
+import time
+
+from txtorcon.router import Router, ExitPolicyIndex
+
+PORTS = [21, 22, 25, 53, 80, 110, 143, 443, 465, 587, 993, 995, 1194,
+         3128, 5222, 6667, 6697, 8080, 8333, 8443, 9418, 11371, 50002]
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def routers(count=7000, seed=1234):
+    rand = random.Random(seed)
+    found = []
+    for _ in range(count):
+        router = Router(None)
+        if rand.random() < 0.35:
+            ports = sorted(rand.sample(PORTS, rand.randint(2, 15)))
+            spec = ','.join(
+                '{}-{}'.format(port, port + 2) if rand.random() < 0.2 else str(port)
+                for port in ports
+            )
+            router.policy = [rand.choice(['accept', 'accept', 'reject']), spec]
+        else:
+            router.policy = ['reject', '1-65535']
+        found.append(router)
+    return found
+
+
+def main():
+    relays = routers()
+    queries = [random.Random(4321).choice(PORTS + [1, 8000, 60000]) for _ in range(200)]
+
+    def scan():
+        for port in queries:
+            [router for router in relays if router.accepts_port(port)]
+
+    index = ExitPolicyIndex(relays)
+
+    def lookup():
+        for port in queries:
+            index.routers_accepting(port)
+
+    def lookup_two():
+        for port in queries:
+            index.routers_accepting(port, 443)
+
+    print("7000 routers, {} queries:".format(len(queries)))
+    print("  accepts_port on every router:   {:7.2f} ms/query".format(best_of(3, scan) / len(queries) * 1e3))
+    print("  ExitPolicyIndex (one port):     {:7.3f} ms/query".format(best_of(5, lookup) / len(queries) * 1e3))
+    print("  ExitPolicyIndex (port and 443): {:7.3f} ms/query".format(best_of(5, lookup_two) / len(queries) * 1e3))
+    print("  building the index:             {:7.2f} ms".format(best_of(5, lambda: ExitPolicyIndex(relays)) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+"""
+txtorcon.torcontrolprotocol.parse_keywords on the payloads it sees at
+bootstrap and on every CONF_CHANGED: ``config/names``,
+``config/defaults``, ``entry-guards`` and ``circuit-status`` replies
+(parsed as get_info() does, with the key as a hint) and a 200-option
+CONF_CHANGED event. Also parses one reply made of 2000 ``key=value``
+lines with 2000 key hints, which used to be quadratic.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/keyword_parsing.py
+"""
+
+import time
+
+from txtorcon.torcontrolprotocol import parse_keywords
+from _corpus import config_names_text, config_defaults_text, entry_guards_text
+from _corpus import circuit_status_text, conf_changed_text
+
+
+def best_of(rounds, func, repeat):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    payloads = [
+        ('config/names', config_names_text(), ['config/names'], True),
+        ('config/defaults', config_defaults_text(), ['config/defaults'], True),
+        ('entry-guards', entry_guards_text(), ['entry-guards'], True),
+        ('circuit-status', circuit_status_text(), ['circuit-status'], True),
+        ('CONF_CHANGED', conf_changed_text(), None, False),
+    ]
+    keys = ['key/{}'.format(i) for i in range(2000)]
+    payloads.append((
+        '2000 keys',
+        '\n'.join('{}={}'.format(key, i) for i, key in enumerate(keys)),
+        keys, True,
+    ))
+    for name, text, hints, multiline in payloads:
+        elapsed = best_of(
+            25,
+            lambda: parse_keywords(text, multiline_values=multiline, key_hints=hints),
+            20,
+        )
+        print("{:16s} {:7.1f} KiB {:9.1f} us".format(name, len(text) / 1024.0, elapsed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
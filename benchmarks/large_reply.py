@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time and peak memory for receiving one ~5 MB GETINFO reply (the
+size of a large ``md/all`` or ``ns/all``) through TorControlProtocol.
+
+Time should grow linearly with reply size and peak memory should be
+a small multiple of the reply itself; the script prints both for a
+few sizes so a regression to quadratic accumulation is obvious.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/large_reply.py
+"""
+
+import time
+import tracemalloc
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from _corpus import ns_all_lines
+
+
+def receive(lines):
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    result = []
+    proto.get_info_raw('md/all').addCallback(result.append)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    proto.lineReceived(b'250+md/all=')
+    for line in lines:
+        proto.lineReceived(line)
+    proto.lineReceived(b'.')
+    proto.lineReceived(b'250 OK')
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert result, "reply never completed"
+    return elapsed, peak, len(result[0])
+
+
+def main():
+    base = [line.encode('ascii') for line in ns_all_lines(7000)]
+    for multiple in (1, 2, 4):
+        lines = base * multiple
+        elapsed, peak, size = receive(lines)
+        print("{:6.2f} MB reply: {:8.1f} ms, peak {:6.2f} MB ({:.1f}x reply)".format(
+            size / 1e6, elapsed * 1000.0, peak / 1e6, peak / float(size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parsing a 7000-relay ``GETINFO ns/all`` reply line by line with the
+MicrodescriptorParser TorState uses, first with a create_relay
+callback that does nothing (the parser on its own) and then through
+a TorState (i.e. including creating the Router objects), as at
+bootstrap or on every NEWCONSENSUS.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/microdesc_parser.py
+"""
+
+import time
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+from txtorcon._microdesc_parser import MicrodescriptorParser
+from _corpus import ns_all_lines
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    lines = ['ns/all='] + ns_all_lines() + ['.', 'OK']
+
+    def parse():
+        parser = MicrodescriptorParser(lambda **kw: None)
+        for line in lines:
+            parser.feed_line(line)
+        parser.done()
+
+    def state():
+        state = TorState(FakeControlProtocol([]), bootstrap=False)
+        for line in lines:
+            state._network_status_parser.feed_line(line)
+        state._network_status_parser.done()
+        assert len(state.routers_by_hash) == 7000
+
+    print("{} lines, 7000 relays:".format(len(lines)))
+    print("  parser only: {:6.1f} ms".format(best_of(15, parse) * 1e3))
+    print("  TorState:    {:6.1f} ms".format(best_of(15, state) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
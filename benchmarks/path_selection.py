@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Choosing 3-hop paths (exiting to port 443) from a 7000-relay
+consensus: the way a caller had to before TorState.select_path,
+filtering TorState.all_routers for each position and picking with
+random.choices weighted by bandwidth, and with a PathSelector (alias
+tables per position, which TorState.select_path builds once per
+consensus) using a seeded random.Random and the default
+SystemRandom. Also times building the PathSelector's tables.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/path_selection.py
+"""
+
+import random
+import time
+
+from txtorcon import TorState
+from txtorcon.pathselect import PathSelector
+from txtorcon.testutil import FakeControlProtocol
+from _corpus import ns_all_lines
+
+PATHS = 2000
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def by_hand(state, rand):
+    routers = state.all_routers
+    exits = [r for r in routers if 'exit' in r.flags and 'fast' in r.flags and r.accepts_port(443)]
+    guards = [r for r in routers if 'guard' in r.flags and 'fast' in r.flags]
+    middles = [r for r in routers if 'fast' in r.flags]
+    path = rand.choices(exits, [r.bandwidth for r in exits])
+    for candidates in (guards, middles):
+        while True:
+            router = rand.choices(candidates, [r.bandwidth for r in candidates])[0]
+            if router not in path:
+                break
+        path.insert(len(path) - 1, router)
+    return path
+
+
+def main():
+    state = TorState(FakeControlProtocol([]), bootstrap=False)
+    state._update_network_status('\n'.join(['ns/all='] + ns_all_lines() + ['.']))
+    rand = random.Random(1234)
+    routers = list(state.routers_by_hash.values())
+
+    def hand(count):
+        for _ in range(count):
+            by_hand(state, rand)
+
+    def selecting(selector):
+        selector.select_path(exit_ports=[443])
+
+        def select():
+            for _ in range(PATHS):
+                selector.select_path(exit_ports=[443])
+        return PATHS / best_of(5, select)
+
+    print("7000 routers, 3-hop paths exiting to port 443:")
+    print("  by hand (filter + random.choices):    {:8.0f} paths/s".format(
+        20 / best_of(3, lambda: hand(20))))
+    print("  PathSelector, random.Random:          {:8.0f} paths/s".format(
+        selecting(PathSelector(routers, rand=rand))))
+    print("  PathSelector, SystemRandom (default): {:8.0f} paths/s".format(
+        selecting(PathSelector(routers))))
+    print("  building the PathSelector's tables:   {:8.2f} ms".format(
+        best_of(5, lambda: PathSelector(routers).select_path(exit_ports=[443])) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""
+How fast does TorControlProtocol frame replies? Feeds a complete
+``GETINFO ns/all`` reply for a 7000-relay consensus through
+lineReceived, then a burst of single-line 650 events.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/protocol_framing.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from _corpus import ns_all_reply
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    return proto
+
+
+def bench_getinfo(lines, rounds):
+    best = None
+    for _ in range(rounds):
+        proto = _protocol()
+        d = proto.get_info_raw('ns/all')
+        result = []
+        d.addCallback(result.append)
+        start = time.perf_counter()
+        for line in lines:
+            proto.lineReceived(line)
+        elapsed = time.perf_counter() - start
+        assert result, "reply never completed"
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_getinfo_incremental(lines, rounds):
+    best = None
+    for _ in range(rounds):
+        proto = _protocol()
+        received = []
+        d = proto.get_info_incremental('ns/all', received.append)
+        result = []
+        d.addCallback(result.append)
+        start = time.perf_counter()
+        for line in lines:
+            proto.lineReceived(line)
+        elapsed = time.perf_counter() - start
+        assert result, "reply never completed"
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_events(count, rounds):
+    proto = _protocol()
+    proto._set_valid_events('CIRC')
+    proto.add_event_listener('CIRC', lambda data: None)
+    proto.lineReceived(b'250 OK')
+    line = b'650 CIRC 1000 EXTENDED $AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~a PURPOSE=GENERAL'
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(count):
+            proto.lineReceived(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    lines = ns_all_reply(7000)
+    t = bench_getinfo(lines, 5)
+    print("GETINFO ns/all, {} lines: {:.1f} ms ({:.0f} lines/s)".format(
+        len(lines), t * 1000.0, len(lines) / t))
+    t = bench_getinfo_incremental(lines, 5)
+    print("incremental GETINFO ns/all, {} lines: {:.1f} ms ({:.0f} lines/s)".format(
+        len(lines), t * 1000.0, len(lines) / t))
+    count = 100000
+    t = bench_events(count, 3)
+    print("{} single-line 650 events: {:.1f} ms ({:.0f} events/s)".format(
+        count, t * 1000.0, count / t))
+
+
+if __name__ == '__main__':
+    main()
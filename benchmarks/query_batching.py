@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Round trips for TorControlProtocol's own bootstrap plus a "polling"
+loop asking for a handful of GETINFO / GETCONF keys each tick, with
+and without batch_queries. Tor is simulated with a fixed round-trip
+time per command, so the times are simulated seconds.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/query_batching.py
+"""
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+
+RTT = 0.005
+ANSWERS = {
+    'signal/names': 'RELOAD NEWNYM',
+    'version': '0.4.8.9',
+    'events/names': 'CIRC STREAM ORCONN',
+}
+INFO_KEYS = ['traffic/read', 'traffic/written', 'uptime', 'net/listeners/socks',
+             'status/bootstrap-phase', 'status/circuit-established']
+CONF_KEYS = ['SocksPort', 'ControlPort', 'MaxCircuitDirtiness', 'UseBridges']
+
+
+class SimulatedTor(proto_helpers.StringTransport):
+
+    def __init__(self, clock):
+        super(SimulatedTor, self).__init__()
+        self.clock = clock
+        self.protocol = None
+        self.commands = 0
+        self.busy_until = 0.0
+
+    def write(self, data):
+        for cmd in data.decode('ascii').split('\r\n'):
+            if not cmd:
+                continue
+            self.commands += 1
+            verb, _, args = cmd.partition(' ')
+            if verb in ('GETINFO', 'GETCONF'):
+                lines = ['250-{}={}'.format(key, ANSWERS.get(key, '1')) for key in args.split()]
+                reply = '\r\n'.join(lines + ['250 OK']) + '\r\n'
+            else:
+                reply = '250 OK\r\n'
+            start = max(self.clock.seconds(), self.busy_until)
+            self.busy_until = start + RTT
+            self.clock.callLater(
+                self.busy_until - self.clock.seconds(),
+                self.protocol.dataReceived, reply.encode('ascii'),
+            )
+
+
+def run(batch, ticks=10):
+    clock = Clock()
+    proto = TorControlProtocol(batch_queries=batch, reactor=clock)
+    proto.connectionMade = lambda: None
+    tor = SimulatedTor(clock)
+    tor.protocol = proto
+    proto.makeConnection(tor)
+
+    def drain():
+        while clock.getDelayedCalls():
+            clock.advance(0.0005)
+
+    proto._bootstrap()
+    drain()
+    startup = (tor.commands, clock.seconds())
+
+    start = clock.seconds()
+    before = tor.commands
+    for _ in range(ticks):
+        d = defer.gatherResults(
+            [proto.get_info(key) for key in INFO_KEYS] +
+            [proto.get_conf(key) for key in CONF_KEYS]
+        )
+        drain()
+        assert d.called
+    polling = (tor.commands - before, clock.seconds() - start)
+    return startup, polling
+
+
+def main():
+    for batch in (False, True):
+        (s_cmds, s_time), (p_cmds, p_time) = run(batch)
+        print("batch_queries={!s:5}: bootstrap {} commands {:.0f} ms; "
+              "10 polls {} commands {:.0f} ms".format(
+                  batch, s_cmds, s_time * 1e3, p_cmds, p_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
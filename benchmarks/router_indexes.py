@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Looking routers up by address (as when attributing connections from
+exit addresses), by /24 network and by flags in a 7000-relay
+TorState: by looking at every Router in all_routers, and with the
+secondary indexes TorState keeps up to date as consensuses arrive
+(routers_at_address, routers_in_network, routers_with_flags).
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/router_indexes.py
+"""
+
+import ipaddress
+import random
+import time
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+from _corpus import ns_all_lines
+
+LOOKUPS = 1000
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    state = TorState(FakeControlProtocol([]), bootstrap=False)
+    state._update_network_status('\n'.join(['ns/all='] + ns_all_lines() + ['.']))
+    rand = random.Random(1234)
+    routers = list(state.all_routers)
+    addresses = [rand.choice(routers).ip for _ in range(LOOKUPS)]
+    networks = [ipaddress.IPv4Network(address + '/24', strict=False) for address in addresses[:100]]
+
+    def scan_address():
+        for address in addresses:
+            [router for router in state.all_routers if router.ip == address]
+
+    def index_address():
+        for address in addresses:
+            state.routers_at_address(address)
+
+    def scan_network():
+        for network in networks:
+            [router for router in state.all_routers if ipaddress.IPv4Address(router.ip) in network]
+
+    def index_network():
+        for network in networks:
+            state.routers_in_network(network)
+
+    def scan_flags():
+        [router for router in state.all_routers if 'exit' in router.flags and 'stable' in router.flags]
+
+    def index_flags():
+        state.routers_with_flags('exit', 'stable')
+
+    print("7000 routers:")
+    print("  by address, every Router: {:9.2f} us/lookup".format(best_of(3, scan_address) / LOOKUPS * 1e6))
+    print("  routers_at_address:       {:9.2f} us/lookup".format(best_of(5, index_address) / LOOKUPS * 1e6))
+    print("  by /24, every Router:     {:9.2f} us/lookup".format(best_of(3, scan_network) / len(networks) * 1e6))
+    print("  routers_in_network:       {:9.2f} us/lookup".format(best_of(5, index_network) / len(networks) * 1e6))
+    print("  Exit+Stable, every Router: {:8.2f} ms".format(best_of(5, scan_flags) * 1e3))
+    print("  routers_with_flags:        {:8.2f} ms".format(best_of(5, index_flags) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory kept per router for a 7000-relay consensus, as measured by
+tracemalloc once parsing is done and only what's still referenced
+remains: for the Router objects on their own, and for a whole
+TorState (the Routers plus routers, routers_by_name,
+routers_by_hash, guards, authorities, all_routers and the
+bookkeeping for diffing the next consensus).
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/router_memory.py
+"""
+
+import gc
+import tracemalloc
+
+from txtorcon import TorState, Router
+from txtorcon.testutil import FakeControlProtocol
+from txtorcon.torstate import _parse_consensus
+from _corpus import ns_all_lines
+
+RELAYS = 7000
+
+
+def retained(build):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    assert kept is not None
+    return size
+
+
+def main():
+    data = '\n'.join(['ns/all='] + ns_all_lines(RELAYS) + ['.'])
+    state = TorState(FakeControlProtocol([]), bootstrap=False)
+
+    def routers():
+        found = []
+        for relay in _parse_consensus(data):
+            router = Router(None)
+            state._update_router(router, relay)
+            found.append(router)
+        return found
+
+    def tor_state():
+        fresh = TorState(FakeControlProtocol([]), bootstrap=False)
+        fresh._update_network_status(data)
+        assert len(fresh.routers_by_hash) == RELAYS
+        return fresh
+
+    print("{} relays, bytes per router:".format(RELAYS))
+    print("  Router objects: {:6.0f}".format(retained(routers) / RELAYS))
+    print("  whole TorState: {:6.0f}".format(retained(tor_state) / RELAYS))
+
+
+if __name__ == '__main__':
+    main()
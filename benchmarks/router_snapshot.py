@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Time to fill a TorState's router table from a parsed ``ns/all``
+reply versus from a snapshot file (see txtorcon.snapshot), plus the
+cost of writing the snapshot and its size. The network transfer of
+``ns/all`` itself is not counted, so the real saving on a cold start
+is larger.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/router_snapshot.py
+"""
+
+import os
+import tempfile
+import time
+
+from txtorcon import TorState
+from txtorcon.testutil import FakeControlProtocol
+from txtorcon.snapshot import load_snapshot, write_snapshot
+
+from _corpus import ns_all_lines
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    lines = ns_all_lines()
+    path = os.path.join(tempfile.mkdtemp(), 'routers')
+
+    def parse():
+        state = TorState(FakeControlProtocol([]), bootstrap=False)
+        for line in lines:
+            state._network_status_parser.feed_line(line)
+        state._network_status_parser.done()
+        return state
+
+    state = parse()
+    routers = list(state.routers_by_hash.values())
+
+    def write():
+        write_snapshot(path, '0.4.8.9', '2024-01-01 00:00:00', routers)
+
+    def load():
+        state = TorState(FakeControlProtocol([]), bootstrap=False)
+        state._add_snapshot_routers(load_snapshot(path))
+        assert len(state.routers_by_hash) == len(routers)
+
+    parse_time = best_of(5, parse)
+    write_time = best_of(5, write)
+    load_time = best_of(5, load)
+    print("{} routers".format(len(routers)))
+    print("  parse ns/all:   {:7.1f} ms".format(parse_time * 1e3))
+    print("  load snapshot:  {:7.1f} ms ({:.1f}x faster)".format(
+        load_time * 1e3, parse_time / load_time))
+    print("  write snapshot: {:7.1f} ms, {} KiB (ns/all text is {} KiB)".format(
+        write_time * 1e3, os.path.getsize(path) // 1024,
+        sum(len(line) + 2 for line in lines) // 1024))
+
+
+if __name__ == '__main__':
+    main()
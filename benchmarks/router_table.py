@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+A bulk question about a 7000-relay consensus -- "the Fast, Stable
+exits in three (of about 60) countries with at least 2 MB/s", and the
+20 of those with the most bandwidth -- answered by looking at each
+Router in TorState.all_routers, and by the RouterTable from
+TorState.router_table() (also timing building the table, which is
+done once per consensus). The table uses NumPy if it's installed and
+plain arrays otherwise; run it both ways to compare.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/router_table.py
+"""
+
+import time
+import zlib
+
+from txtorcon import TorState
+from txtorcon import routertable
+from txtorcon.routertable import RouterTable
+from txtorcon.testutil import FakeControlProtocol
+from _corpus import ns_all_lines
+
+COUNTRIES = ['C{:02d}'.format(i) for i in range(60)]
+WANTED = {'C03', 'C17', 'C42'}
+FLAGS = ['exit', 'fast', 'stable']
+MIN_BANDWIDTH = 2000
+
+
+def country_of(router):
+    return COUNTRIES[zlib.crc32(router.ip.encode('ascii')) % len(COUNTRIES)]
+
+
+def best_of(count, func):
+    best = None
+    for _ in range(count):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    state = TorState(FakeControlProtocol([]), bootstrap=False)
+    state._update_network_status('\n'.join(['ns/all='] + ns_all_lines() + ['.']))
+    countries = dict((router, country_of(router)) for router in state.all_routers)
+    table = RouterTable(state.routers_by_hash.values(), country_of=country_of)
+
+    def scan():
+        return [
+            router for router in state.all_routers
+            if all(flag in router.flags for flag in FLAGS) and
+            countries[router] in WANTED and
+            router.bandwidth >= MIN_BANDWIDTH
+        ]
+
+    def scan_top():
+        return sorted(scan(), key=lambda router: router.bandwidth, reverse=True)[:20]
+
+    assert set(scan()) == set(table.select(FLAGS, WANTED, MIN_BANDWIDTH))
+    print("7000 routers, {} of them matching ({}):".format(
+        len(scan()), "NumPy" if routertable.numpy is not None else "no NumPy"))
+    print("  every Router, filter:                {:7.3f} ms".format(best_of(20, scan) * 1e3))
+    print("  every Router, top 20:                {:7.3f} ms".format(best_of(20, scan_top) * 1e3))
+    print("  RouterTable.select:                  {:7.3f} ms".format(
+        best_of(200, lambda: table.select(FLAGS, WANTED, MIN_BANDWIDTH)) * 1e3))
+    print("  RouterTable.top(20):                 {:7.3f} ms".format(
+        best_of(200, lambda: table.top(20, FLAGS, WANTED, MIN_BANDWIDTH)) * 1e3))
+    print("  RouterTable.select (bandwidth only): {:7.3f} ms".format(
+        best_of(200, lambda: table.select(min_bandwidth=MIN_BANDWIDTH)) * 1e3))
+    print("  building the table:                  {:7.2f} ms".format(
+        best_of(10, lambda: RouterTable(state.routers_by_hash.values(), country_of=country_of)) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
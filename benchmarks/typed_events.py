@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Several listeners on the same high-rate event: each raw listener
+re-splits the text itself, while typed listeners share one decoded
+record.
+
+Run from the top of a checkout::
+
+    PYTHONPATH=. python benchmarks/typed_events.py
+"""
+
+import time
+
+from twisted.test import proto_helpers
+
+from txtorcon import TorControlProtocol
+from txtorcon.util import find_keywords
+
+
+LINE = (
+    b'650 CIRC 1000 EXTENDED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0~eris,'
+    b'$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5~venus BUILD_FLAGS=NEED_CAPACITY '
+    b'PURPOSE=GENERAL TIME_CREATED=2024-01-01T00:00:00.000000'
+)
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    proto._set_valid_events('CIRC')
+    return proto
+
+
+def raw_listener(data):
+    args = data.split()
+    find_keywords(args).get('PURPOSE')
+
+
+def typed_listener(event):
+    event.keywords.get('PURPOSE')
+
+
+def run(listeners, typed, count=50000):
+    proto = _protocol()
+    for _ in range(listeners):
+        proto.add_event_listener(
+            'CIRC',
+            typed_listener if typed else raw_listener,
+            typed=typed,
+        )
+    proto.lineReceived(b'250 OK')
+    start = time.perf_counter()
+    for _ in range(count):
+        proto.lineReceived(LINE)
+    return (time.perf_counter() - start) / count
+
+
+def main():
+    for listeners in (1, 4, 8):
+        raw = run(listeners, False)
+        typed = run(listeners, True)
+        print("{} listeners: raw {:.2f} us/event, typed {:.2f} us/event".format(
+            listeners, raw * 1e6, typed * 1e6))
+
+
+if __name__ == '__main__':
+    main()
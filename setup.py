@@ -46,6 +46,8 @@ setup(
     # "pip install -e .[dev]" will install development requirements
     extras_require=dict(
         dev=open('dev-requirements.txt').readlines(),
+        # vectorized RouterTable queries
+        numpy=['numpy'],
     ),
     classifiers=[
         'Framework :: Twisted',
@@ -0,0 +1,272 @@
+import asyncio
+import base64
+import tempfile
+from binascii import a2b_hex
+from unittest.mock import patch
+
+from twisted.trial import unittest
+
+from txtorcon.torcontrolprotocol import TorProtocolError, TorDisconnectError
+from txtorcon.aiocontrol import AsyncioControlProtocol, build_asyncio_control_connection
+from txtorcon.events import decode_event
+from txtorcon.util import hmac_sha256
+
+
+class FakeTransport(object):
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.written = []
+        self.closed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.protocol.connection_lost(None)
+
+
+class AsyncioControlTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.proto = AsyncioControlProtocol(loop=self.loop)
+        self.transport = FakeTransport(self.proto)
+        self.proto.connection_made(self.transport)
+
+    def tearDown(self):
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+
+        async def cancelled():
+            await asyncio.gather(*pending, return_exceptions=True)
+        self.loop.run_until_complete(cancelled())
+        self.loop.close()
+
+    def start(self, coro):
+        task = self.loop.create_task(coro)
+        self.spin()
+        return task
+
+    def spin(self):
+        # run the loop until nothing is ready
+        for _ in range(5):
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def answer(self, data):
+        self.proto.data_received(data)
+        self.spin()
+
+    def test_get_info(self):
+        task = self.start(self.proto.get_info('version'))
+        self.assertEqual(self.transport.written, [b'GETINFO version\r\n'])
+        self.answer(b'250-version=0.4.8.9\r\n250 OK\r\n')
+        self.assertEqual(task.result(), {'version': '0.4.8.9'})
+
+    def test_pipelined(self):
+        first = self.start(self.proto.get_info_raw('version'))
+        second = self.start(self.proto.get_conf('SocksPort'))
+        self.assertEqual(len(self.transport.written), 2)
+        self.answer(b'250-version=0.4.8.9\r\n250 OK\r\n250 SocksPort=9050\r\n')
+        self.assertEqual(first.result(), 'version=0.4.8.9')
+        self.assertEqual(second.result(), {'SocksPort': '9050'})
+
+    def test_error(self):
+        task = self.start(self.proto.get_info('foo'))
+        self.answer(b'552 Unrecognized key "foo"\r\n')
+        with self.assertRaises(TorProtocolError) as ctx:
+            task.result()
+        self.assertEqual(ctx.exception.code, 552)
+
+    def test_incremental(self):
+        lines = []
+        task = self.start(self.proto.get_info_incremental('ns/all', lines.append))
+        self.answer(b'250+ns/all=\r\nr foo\r\n.\r\n250 OK\r\n')
+        self.assertEqual(task.result(), '')
+        self.assertEqual(lines, ['ns/all=', 'r foo'])
+
+    def test_set_conf(self):
+        self.start(self.proto.set_conf('Nickname', 'foo', 'ContactInfo', 'a b'))
+        self.assertEqual(
+            self.transport.written,
+            [b'SETCONF Nickname=foo ContactInfo="a b"\r\n'],
+        )
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(self.proto.set_conf('Nickname'))
+
+    def test_events(self):
+        self.proto.valid_events = ('CIRC', 'STREAM')
+        got = []
+        typed = []
+        task = self.start(self.proto.add_event_listener('CIRC', got.append))
+        self.start(self.proto.add_event_listener('CIRC', typed.append, typed=True))
+        self.assertEqual(self.transport.written, [b'SETEVENTS CIRC\r\n'])
+        self.answer(b'250 OK\r\n650 CIRC 1 BUILT\r\n650 STREAM 1 NEW 0 x:80\r\n')
+        self.assertIs(task.result(), None)
+        self.assertEqual(got, ['1 BUILT'])
+        self.assertEqual(typed[0].circuit_id, 1)
+
+        self.start(self.proto.remove_event_listener('CIRC', got.append))
+        self.start(self.proto.remove_event_listener('CIRC', typed.append))
+        self.assertEqual(self.transport.written[-1], b'SETEVENTS \r\n')
+        with self.assertRaises(RuntimeError):
+            self.loop.run_until_complete(self.proto.add_event_listener('FOO', got.append))
+
+    def test_typed_events_shared(self):
+        self.proto.valid_events = ('CIRC',)
+        first = []
+        second = []
+        self.start(self.proto.add_event_listener('CIRC', first.append, typed=True))
+        self.start(self.proto.add_event_listener('CIRC', second.append, typed=True))
+        self.answer(b'250 OK\r\n')
+        with patch('txtorcon.aiocontrol.decode_event', wraps=decode_event) as decode:
+            self.answer(b'650 CIRC 1 BUILT\r\n650 CIRC 2 LAUNCHED\r\n')
+        self.assertEqual(decode.call_count, 2)
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertEqual([event.circuit_id for event in first], [1, 2])
+
+    def test_event_listener_error(self):
+        self.proto.valid_events = ('CIRC',)
+        errors = []
+        self.loop.set_exception_handler(lambda loop, context: errors.append(context))
+        got = []
+
+        def broken(text):
+            raise ValueError(text)
+        self.start(self.proto.add_event_listener('CIRC', broken))
+        self.start(self.proto.add_event_listener('CIRC', got.append))
+        self.answer(b'250 OK\r\n650 CIRC 1 BUILT\r\n')
+        self.assertEqual(got, ['1 BUILT'])
+        self.assertIsInstance(errors[0]['exception'], ValueError)
+
+    def test_disconnect(self):
+        task = self.start(self.proto.get_info('version'))
+        done = self.proto.when_disconnected()
+        self.proto.connection_lost(None)
+        self.spin()
+        with self.assertRaises(TorDisconnectError):
+            task.result()
+        self.assertIs(done.result(), None)
+        with self.assertRaises(RuntimeError):
+            self.proto.queue_command('GETINFO version')
+
+    def test_garbage(self):
+        task = self.start(self.proto.get_info('version'))
+        self.answer(b'garbage\r\n')
+        self.assertTrue(self.transport.closed)
+        with self.assertRaises(TorDisconnectError):
+            task.result()
+
+    def test_bootstrap_null_auth(self):
+        task = self.start(self.proto.bootstrap())
+        self.assertEqual(self.transport.written, [b'PROTOCOLINFO 1\r\n'])
+        self.answer(b'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250 OK\r\n')
+        self.assertEqual(self.transport.written[-1], b'AUTHENTICATE\r\n')
+        self.answer(b'250 OK\r\n')
+        self.answer(b'250-version=0.4.8.9\r\n250-events/names=CIRC STREAM\r\n250 OK\r\n')
+        self.answer(b'552 Unrecognized key "signal/names"\r\n')
+        self.assertEqual(self.transport.written[-1], b'USEFEATURE EXTENDED_EVENTS\r\n')
+        self.answer(b'250 OK\r\n')
+        self.assertIs(task.result(), self.proto)
+        self.assertEqual(self.proto.version, '0.4.8.9')
+        self.assertEqual(self.proto.valid_events, ('CIRC', 'STREAM'))
+        self.assertIn('NEWNYM', self.proto.valid_signals)
+
+    def test_safecookie_auth(self):
+        with tempfile.NamedTemporaryFile() as cookietmp:
+            cookie = b'\x07' * 32
+            cookietmp.write(cookie)
+            cookietmp.flush()
+
+            task = self.start(self.proto._authenticate())
+            self.answer(
+                '250-AUTH METHODS=SAFECOOKIE,COOKIE COOKIEFILE="{}"\r\n250 OK\r\n'.format(
+                    cookietmp.name).encode('ascii')
+            )
+            sent = self.transport.written[-1]
+            self.assertTrue(sent.startswith(b'AUTHCHALLENGE SAFECOOKIE '))
+            client_nonce = a2b_hex(sent.split()[-1])
+            server_nonce = b'\x00' * 32
+            server_hash = hmac_sha256(
+                b"Tor safe cookie authentication server-to-controller hash",
+                cookie + client_nonce + server_nonce,
+            )
+            self.answer(
+                b'250 AUTHCHALLENGE SERVERHASH=' + base64.b16encode(server_hash) +
+                b' SERVERNONCE=' + base64.b16encode(server_nonce) + b'\r\n'
+            )
+            self.assertTrue(self.transport.written[-1].startswith(b'AUTHENTICATE '))
+            self.answer(b'250 OK\r\n')
+            self.assertIs(task.result(), None)
+
+    def test_password_auth(self):
+        async def password():
+            return 'foo'
+        self.proto.password_function = password
+        task = self.start(self.proto._authenticate())
+        self.answer(b'250-AUTH METHODS=HASHEDPASSWORD\r\n250 OK\r\n')
+        self.assertEqual(self.transport.written[-1], b'AUTHENTICATE 666f6f\r\n')
+        self.answer(b'250 OK\r\n')
+        self.assertIs(task.result(), None)
+
+    def test_no_auth_possible(self):
+        task = self.start(self.proto._authenticate())
+        self.answer(b'250-AUTH METHODS=HASHEDPASSWORD\r\n250 OK\r\n')
+        with self.assertRaises(RuntimeError):
+            task.result()
+
+    def test_cookie_without_file(self):
+        task = self.start(self.proto._authenticate())
+        self.answer(b'250-AUTH METHODS=COOKIE\r\n250 OK\r\n')
+        with self.assertRaises(RuntimeError):
+            task.result()
+
+
+class FakeTor(asyncio.Protocol):
+    """
+    Answers each command from a table, over a real socket.
+    """
+
+    answers = {
+        b'PROTOCOLINFO 1': b'250-PROTOCOLINFO 1\r\n250-AUTH METHODS=NULL\r\n250 OK\r\n',
+        b'GETINFO version events/names': (
+            b'250-version=0.4.8.9\r\n250-events/names=CIRC\r\n250 OK\r\n'
+        ),
+        b'GETINFO signal/names': b'250-signal/names=NEWNYM\r\n250 OK\r\n',
+    }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.buffer = b''
+
+    def data_received(self, data):
+        self.buffer += data
+        while b'\r\n' in self.buffer:
+            line, self.buffer = self.buffer.split(b'\r\n', 1)
+            self.transport.write(self.answers.get(line, b'250 OK\r\n'))
+
+
+class BuildConnectionTests(unittest.TestCase):
+
+    def test_tcp(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def go():
+            server = await loop.create_server(FakeTor, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                proto = await build_asyncio_control_connection(port=port)
+                self.assertEqual(proto.version, '0.4.8.9')
+                self.assertEqual(proto.valid_signals, ('NEWNYM',))
+                self.assertEqual(await proto.signal('NEWNYM'), 'OK')
+                proto.transport.close()
+                await proto.when_disconnected()
+            finally:
+                server.close()
+                await server.wait_closed()
+        loop.run_until_complete(go())
@@ -0,0 +1,188 @@
+from io import BytesIO
+
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet.task import Clock
+
+from txtorcon import TorControlProtocol, TorProtocolFactory
+from txtorcon.capture import WireCapture, CapturedLine, RECEIVED, SENT
+from txtorcon.capture import parse_capture, load_capture, replay
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    transport = proto_helpers.StringTransport()
+    proto.makeConnection(transport)
+    proto._set_valid_events('CIRC STREAM')
+    return proto, transport
+
+
+class WireCaptureTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_round_trip(self):
+        cap = WireCapture(reactor=self.clock)
+        cap.sent(b'GETINFO version')
+        self.clock.advance(1.5)
+        cap.received(b'250-version=0.4.8.9')
+        cap.received(b'250 OK')
+        self.assertEqual(len(cap), 3)
+
+        f = BytesIO()
+        cap.dump(f)
+        f.seek(0)
+        lines = load_capture(f)
+        self.assertEqual(lines, list(cap))
+        self.assertEqual(
+            lines[1],
+            CapturedLine(1.5, RECEIVED, b'250-version=0.4.8.9'),
+        )
+        self.assertEqual(lines[0].direction, SENT)
+
+    def test_bounded(self):
+        cap = WireCapture(max_bytes=100, reactor=self.clock)
+        for x in range(100):
+            cap.received(b'650 CIRC %d BUILT' % x)
+        self.assertTrue(len(cap.dumps()) <= 100 + 9)
+        self.assertEqual(list(cap)[-1].data, b'650 CIRC 99 BUILT')
+        self.assertEqual(cap.dropped + len(cap), 100)
+
+    def test_huge_line_kept(self):
+        cap = WireCapture(max_bytes=10, reactor=self.clock)
+        cap.received(b'x' * 100)
+        self.assertEqual(len(cap), 1)
+        cap.received(b'y' * 100)
+        self.assertEqual([line.data[:1] for line in cap], [b'y'])
+
+    def test_authenticate_redacted(self):
+        cap = WireCapture(reactor=self.clock)
+        cap.sent(b'AUTHENTICATE 0123456789abcdef')
+        self.assertEqual(list(cap)[0].data, b'AUTHENTICATE')
+
+    def test_clear(self):
+        cap = WireCapture(reactor=self.clock)
+        cap.received(b'650 CIRC 1 BUILT')
+        cap.clear()
+        self.assertEqual(len(cap), 0)
+        self.assertEqual(parse_capture(cap.dumps()), [])
+
+    def test_bad_size(self):
+        with self.assertRaises(ValueError):
+            WireCapture(max_bytes=0, reactor=self.clock)
+
+    def test_parse_errors(self):
+        with self.assertRaises(ValueError):
+            parse_capture(b'something else')
+        with self.assertRaises(ValueError):
+            parse_capture(b'TXTORCAP\x09')
+        cap = WireCapture(reactor=self.clock)
+        cap.received(b'650 CIRC 1 BUILT')
+        data = cap.dumps()
+        for cut in (3, 15):
+            with self.assertRaises(ValueError):
+                parse_capture(data[:-cut])
+
+
+class ProtocolCaptureTests(unittest.TestCase):
+
+    def test_records_both_directions(self):
+        proto, transport = _protocol()
+        cap = proto.start_capture(reactor=Clock())
+        proto.get_info('version')
+        proto.lineReceived(b'250-version=0.4.8.9')
+        proto.lineReceived(b'250 OK')
+        self.assertEqual(
+            [(line.direction, line.data) for line in cap],
+            [
+                (SENT, b'GETINFO version'),
+                (RECEIVED, b'250-version=0.4.8.9'),
+                (RECEIVED, b'250 OK'),
+            ]
+        )
+        self.assertIs(proto.stop_capture(), cap)
+        self.assertIs(proto.capture, None)
+        proto.lineReceived(b'650 CIRC 1 BUILT')
+        self.assertEqual(len(cap), 3)
+
+    def test_factory(self):
+        proto = TorProtocolFactory(capture_bytes=4096).buildProtocol(None)
+        self.assertEqual(proto.capture.max_bytes, 4096)
+        proto = TorProtocolFactory().buildProtocol(None)
+        self.assertIs(proto.capture, None)
+
+
+class ReplayTests(unittest.TestCase):
+
+    def _capture(self):
+        clock = Clock()
+        cap = WireCapture(reactor=clock)
+        # the tail of a reply whose start was discarded
+        cap.received(b'r foo bar')
+        cap.received(b'250 OK')
+        cap.received(b'650 CIRC 1 LAUNCHED')
+        clock.advance(1)
+        cap.sent(b'GETINFO version')
+        cap.received(b'250-version=0.4.8.9')
+        cap.received(b'250 OK')
+        clock.advance(2)
+        cap.received(b'650 CIRC 1 BUILT')
+        return cap
+
+    def test_full_speed(self):
+        proto, transport = _protocol()
+        events = []
+        proto.add_event_listener('CIRC', events.append)
+        proto.lineReceived(b'250 OK')
+        transport.clear()
+
+        d = replay(parse_capture(self._capture().dumps()), proto)
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertEqual(events, ['1 LAUNCHED', '1 BUILT'])
+        self.assertEqual(transport.value(), b'GETINFO version\r\n')
+
+    def test_recorded_speed(self):
+        proto, transport = _protocol()
+        events = []
+        proto.add_event_listener('CIRC', events.append)
+        proto.lineReceived(b'250 OK')
+
+        clock = Clock()
+        d = replay(self._capture(), proto, speed=2.0, reactor=clock)
+        self.assertEqual(events, ['1 LAUNCHED'])
+        clock.advance(0.5)
+        self.assertNoResult(d)
+        clock.advance(1.0)
+        self.assertEqual(events, ['1 LAUNCHED', '1 BUILT'])
+        self.assertEqual(self.successResultOf(d), 4)
+
+    def test_no_send_commands(self):
+        proto, transport = _protocol()
+        got = proto.get_info('version')
+        transport.clear()
+        d = replay(self._capture(), proto, send_commands=False)
+        self.assertEqual(self.successResultOf(d), 4)
+        self.assertEqual(self.successResultOf(got), {'version': '0.4.8.9'})
+        self.assertEqual(transport.value(), b'')
+
+    def test_protocol_error(self):
+        proto, transport = _protocol()
+        d = replay(self._capture(), proto, send_commands=False)
+        self.failureResultOf(d, RuntimeError)
+
+    def test_protocol_error_recorded_speed(self):
+        proto, transport = _protocol()
+        clock = Clock()
+        d = replay(self._capture(), proto, send_commands=False, speed=1.0, reactor=clock)
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.failureResultOf(d, RuntimeError)
+
+    def test_empty(self):
+        proto, transport = _protocol()
+        d = replay([], proto, speed=1.0, reactor=Clock())
+        self.assertEqual(self.successResultOf(d), 0)
+        with self.assertRaises(ValueError):
+            replay([], proto, speed=0)
@@ -20,6 +20,7 @@ from txtorcon.interface import ICircuitListener
 from txtorcon.interface import ICircuitContainer
 from txtorcon.interface import CircuitListenerMixin
 from txtorcon.interface import ITorControlProtocol
+from txtorcon.util import split_event_args
 
 from unittest.mock import Mock
 
@@ -380,6 +381,16 @@ class CircuitTests(unittest.TestCase):
         self.assertEqual(kw['PURPOSE'], 'GENERAL')
         self.assertEqual(kw['REASON'], 'TIMEOUT')
 
+    def test_quoted_flags(self):
+        tor = FakeTorController()
+        circuit = Circuit(tor)
+        circuit.update(split_event_args(
+            '1 LAUNCHED PURPOSE=GENERAL SOCKS_USERNAME="a b" SOCKS_PASSWORD="c"'
+        ))
+        self.assertEqual(circuit.flags['SOCKS_USERNAME'], 'a b')
+        self.assertEqual(circuit.flags['socks_password'], 'c')
+        self.assertEqual(circuit.purpose, 'GENERAL')
+
     def test_close_circuit(self):
         tor = FakeTorController()
         a = FakeRouter('$E11D2B2269CC25E67CA6C9FB5843497539A74FD0', 'a')
@@ -0,0 +1,147 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txtorcon import CircuitBuildTimedOutError
+from txtorcon.circuitbuild import build_circuits, summarize, BuildResult
+from txtorcon.testutil import FakeState
+
+
+def result(build_time):
+    return BuildResult(None, None if build_time is None else object(), None, 1, build_time, ())
+
+
+class SummaryTests(unittest.TestCase):
+
+    def test_summary(self):
+        summary = summarize([result(t) for t in [5, 1, None, 3, 2, 4, None, 6, 7, 8, 9, 10]])
+        self.assertEqual((10, 2), (summary.succeeded, summary.failed))
+        self.assertEqual(10 / 12.0, summary.success_rate)
+        self.assertEqual((5, 10), (summary.p50, summary.p95))
+        self.assertEqual(12, len(summary.results))
+
+    def test_empty(self):
+        summary = summarize([])
+        self.assertEqual((0, 0, 0.0, None, None), summary[1:])
+
+
+class BuildCircuitsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = FakeState()
+        self.results = []
+
+    def build(self, paths, **kw):
+        return build_circuits(
+            self.state, self.clock, paths, result_callback=self.results.append, **kw
+        )
+
+    def test_concurrency(self):
+        d = self.build(['a', 'b', 'c', 'd', 'e'], concurrency=2)
+        self.assertEqual(['a', 'b'], [path for (path, _, _) in self.state.builds])
+        self.state.building()[1].build()
+        self.assertEqual(['a', 'b', 'c'], [path for (path, _, _) in self.state.builds])
+        self.assertEqual(['b'], [r.path for r in self.results])
+        for _ in range(4):
+            self.state.building()[0].build()
+        summary = self.successResultOf(d)
+        # summary results are in the order of the paths
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], [r.path for r in summary.results])
+        self.assertEqual(['b', 'a', 'c', 'd', 'e'], [r.path for r in self.results])
+        self.assertEqual((5, 0, 1.0), summary[1:4])
+
+    def test_generator_paths(self):
+        taken = []
+
+        def paths():
+            for path in 'abc':
+                taken.append(path)
+                yield path
+        self.build(paths(), concurrency=1)
+        self.assertEqual(['a'], taken)
+
+    def test_timings(self):
+        d = self.build(['a'])
+        circuit = self.state.building()[0]
+        self.clock.advance(1)
+        circuit.extend('guard')
+        self.clock.advance(2)
+        circuit.extend('middle')
+        self.clock.advance(3)
+        circuit.extend('exit')
+        circuit.build()
+        result = self.successResultOf(d).results[0]
+        self.assertIs(circuit, result.circuit)
+        self.assertEqual((None, 1, 6), (result.error, result.attempts, result.build_time))
+        self.assertEqual((1, 3, 6), result.hop_times)
+        self.assertEqual([], circuit.listeners)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_timeout_retried(self):
+        d = self.build(['a'], timeout=10, retries=1)
+        first = self.state.building()[0]
+        first.extend('guard')
+        self.clock.advance(10)
+        self.assertEqual(1, first.close_calls)
+        second = self.state.building()[0]
+        self.assertIsNot(first, second)
+        second.build()
+        result = self.successResultOf(d).results[0]
+        self.assertEqual((second, 2), (result.circuit, result.attempts))
+
+    def test_timeout_before_reply(self):
+        self.state.unanswered = []
+        d = self.build(['a'], timeout=10)
+        self.clock.advance(10)
+        result = self.successResultOf(d).results[0]
+        self.assertTrue(result.error.check(CircuitBuildTimedOutError))
+
+        # Tor answers late: the circuit is closed, not leaked
+        late, circuit = self.state.unanswered.pop()
+        late.callback(circuit)
+        self.assertEqual(1, circuit.close_calls)
+        self.assertEqual([], circuit.listeners)
+        circuit.build()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_timeout_then_failed(self):
+        d = self.build(['a'], timeout=10)
+        circuit = self.state.building()[0]
+        self.clock.advance(10)
+        self.assertEqual(1, circuit.close_calls)
+        self.successResultOf(d)
+        # Tor says the circuit failed (or closed) after we gave up
+        circuit.fail(RuntimeError("closed"))
+
+    def test_timeout_reply_failed(self):
+        self.state.unanswered = []
+        d = self.build(['a'], timeout=10)
+        self.clock.advance(10)
+        self.successResultOf(d)
+        late, _ = self.state.unanswered.pop()
+        late.errback(RuntimeError("551 no path"))
+
+    def test_result_callback_error(self):
+        def boom(result):
+            raise RuntimeError("callback failed")
+        d = build_circuits(self.state, self.clock, ['a', 'b'], concurrency=1, result_callback=boom)
+        self.state.building()[0].build()
+        # the second path is still built
+        self.state.building()[0].build()
+        summary = self.successResultOf(d)
+        self.assertEqual(2, summary.succeeded)
+        self.assertEqual(2, len(self.flushLoggedErrors(RuntimeError)))
+
+    def test_failed(self):
+        d = self.build(['a'], timeout=10, retries=1)
+        self.state.building()[0].fail(RuntimeError("one"))
+        self.clock.advance(10)
+        summary = self.successResultOf(d)
+        result = summary.results[0]
+        self.assertEqual((None, 2, None), (result.circuit, result.attempts, result.build_time))
+        self.assertTrue(result.error.check(CircuitBuildTimedOutError))
+        self.assertEqual((0, 1, 0.0, None, None), summary[1:])
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self.build, ['a'], concurrency=0)
+        self.assertRaises(ValueError, self.build, ['a'], retries=-1)
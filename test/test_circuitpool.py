@@ -0,0 +1,244 @@
+from unittest.mock import patch
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from txtorcon import CircuitPool, CircuitClass, TorState
+from txtorcon.testutil import FakeControlProtocol, FakeState
+
+
+class CircuitPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.state = FakeState()
+        self.pool = CircuitPool(self.clock, self.state, {CircuitClass(): 2}, max_age=100)
+
+    def test_nothing_before_start(self):
+        self.assertEqual([], self.state.builds)
+        with self.assertRaises(RuntimeError):
+            self.pool.get()
+
+    def test_unknown_class(self):
+        self.pool.start()
+        with self.assertRaises(ValueError):
+            self.pool.get(CircuitClass(exit_port=443))
+
+    def test_negative_target(self):
+        with self.assertRaises(ValueError):
+            CircuitPool(self.clock, self.state, {CircuitClass(): -1})
+
+    def test_warm(self):
+        self.pool.start()
+        self.assertEqual(2, len(self.state.builds))
+        self.assertEqual(0, self.pool.available())
+        self.state.circuit(0).build()
+        self.state.circuit(1).build()
+        self.assertEqual(2, self.pool.available())
+
+        circuit = self.successResultOf(self.pool.get())
+        self.assertIs(self.state.circuit(0), circuit)
+        # a replacement is on its way
+        self.assertEqual(3, len(self.state.builds))
+        self.assertEqual(1, self.pool.available())
+
+    def test_get_waits(self):
+        self.pool.start()
+        d0 = self.pool.get()
+        d1 = self.pool.get()
+        d2 = self.pool.get()
+        # two to hand out, and two more to keep ready
+        self.assertEqual(5, len(self.state.builds))
+        self.assertNoResult(d0)
+        self.state.circuit(3).build()
+        self.state.circuit(0).build()
+        self.assertIs(self.state.circuit(3), self.successResultOf(d0))
+        self.assertIs(self.state.circuit(0), self.successResultOf(d1))
+        self.assertNoResult(d2)
+        self.assertEqual(0, self.pool.available())
+
+    def test_closed_replaced(self):
+        self.pool.start()
+        self.state.circuit(0).build()
+        self.state.circuit(1).build()
+        self.state.circuit(0).closed()
+        self.assertEqual(1, self.pool.available())
+        self.assertEqual(3, len(self.state.builds))
+        self.state.circuit(2).build()
+        self.assertIs(self.state.circuit(1), self.successResultOf(self.pool.get()))
+
+    def test_handed_out_close_ignored(self):
+        self.pool.start()
+        self.state.circuit(0).build()
+        circuit = self.successResultOf(self.pool.get())
+        circuit.closed()
+        self.assertEqual(3, len(self.state.builds))
+
+    def test_aged_out(self):
+        self.pool.start()
+        self.state.circuit(0).build()
+        self.clock.advance(50)
+        self.state.circuit(1).build()
+        self.clock.advance(51)
+        self.assertEqual(1, self.state.circuit(0).close_calls)
+        self.assertEqual(0, self.state.circuit(1).close_calls)
+        self.assertEqual(1, self.pool.available())
+        self.assertEqual(3, len(self.state.builds))
+
+    def test_handed_out_not_aged(self):
+        self.pool.start()
+        self.state.circuit(0).build()
+        self.successResultOf(self.pool.get())
+        self.clock.advance(200)
+        self.assertEqual(0, self.state.circuit(0).close_calls)
+
+    def test_build_timeout(self):
+        self.pool.start()
+        d = self.pool.get()
+        self.clock.advance(60)
+        self.assertEqual(1, self.state.circuit(0).close_calls)
+        self.failureResultOf(d)
+
+    def test_build_failed_retried(self):
+        self.pool.start()
+        self.state.circuit(0).fail(RuntimeError("nope"))
+        self.assertEqual(2, len(self.state.builds))
+        self.clock.advance(5)
+        self.assertEqual(3, len(self.state.builds))
+
+    def test_build_failed_backoff(self):
+        pool = CircuitPool(self.clock, self.state, {CircuitClass(): 1})
+        pool.start()
+
+        def fail_next():
+            self.state.builds[-1][2].fail(RuntimeError("nope"))
+            retry = pool._retries[CircuitClass()]
+            delay = retry.getTime() - self.clock.seconds()
+            self.clock.advance(delay)
+            return delay
+        self.assertEqual(
+            [5, 10, 20, 40, 80, 160, 300, 300],
+            [fail_next() for _ in range(8)],
+        )
+        # a build succeeding starts the delay again
+        self.state.builds[-1][2].build()
+        self.successResultOf(pool.get())
+        self.assertEqual(5, fail_next())
+
+    def test_build_failed_waiter(self):
+        self.pool.start()
+        d = self.pool.get()
+        self.state.circuit(0).fail(RuntimeError("nope"))
+        self.failureResultOf(d, RuntimeError)
+
+    def test_classes(self):
+        pool = CircuitPool(self.clock, self.state, {
+            CircuitClass(exit_country='de', exit_port=443): 1,
+            CircuitClass(purpose='controller'): 1,
+        })
+        pool.start()
+        self.assertEqual([((443, ), 'de')], self.state.paths)
+        builds = sorted(self.state.builds, key=lambda build: build[2].id)
+        self.assertEqual(['guard', 'middle', 'exit-de'], builds[0][0])
+        self.assertEqual(None, builds[0][1])
+        self.assertEqual((None, 'controller'), builds[1][:2])
+
+    def test_no_path(self):
+        nowhere = CircuitClass(exit_country='zz')
+        pool = CircuitPool(self.clock, self.state, {nowhere: 1})
+        pool.start()
+        d = pool.get(nowhere)
+        # Tor is asked where the relays are first
+        self.assertNoResult(d)
+        self.assertEqual(1, len(self.state.locating))
+        self.state.locating.pop().callback(0)
+        self.failureResultOf(d, ValueError)
+        self.assertEqual([], self.state.builds)
+        # ... and again before each retry
+        self.clock.advance(5)
+        self.assertEqual(1, len(self.state.locating))
+
+    def test_stop(self):
+        self.pool.start()
+        self.state.circuit(0).build()
+        d = self.pool.get()
+        waiting = self.pool.get()
+        self.successResultOf(self.pool.stop())
+        self.assertIs(self.state.circuit(0), self.successResultOf(d))
+        self.failureResultOf(waiting, defer.CancelledError)
+        # builds that finish afterwards are closed, not kept
+        self.state.circuit(1).build()
+        self.assertEqual(1, self.state.circuit(1).close_calls)
+        self.assertEqual(0, self.pool.available())
+        with self.assertRaises(RuntimeError):
+            self.pool.get()
+
+
+class TorStateCircuitPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.protocol = FakeControlProtocol([])
+        self.state = TorState(self.protocol, bootstrap=False, reactor=self.clock)
+        self.state._update_network_status('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Running Stable Valid
+w Bandwidth=518000
+p accept 80,443
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Guard Running Stable Valid
+w Bandwidth=51500
+p reject 1-65535
+r another AHhuQ8zFQJdT8l42Axxc6m6kNwI QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 85.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+p reject 1-65535
+.''')
+        # no local GeoIP database
+        patcher = patch.multiple('txtorcon.util', city=None, country=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.asked = []
+        get_info_raw = self.protocol.get_info_raw
+
+        def asking(*keys):
+            self.asked.append(keys)
+            return get_info_raw(*keys)
+        self.protocol.get_info_raw = asking
+
+    def test_country_from_tor(self):
+        pool = CircuitPool(self.clock, self.state, {CircuitClass(exit_country='de'): 1})
+        pool.start()
+        self.assertEqual(
+            [('ip-to-country/12.45.56.78', 'ip-to-country/84.19.178.6',
+              'ip-to-country/85.19.178.6')],
+            self.asked,
+        )
+        self.protocol.answer_pending(
+            'ip-to-country/12.45.56.78=de\nip-to-country/84.19.178.6=??\n'
+            'ip-to-country/85.19.178.6=??'
+        )
+        self.assertEqual({self.state.routers['fake']}, self.state.routers_in_country('de'))
+        self.assertEqual(1, len(self.protocol.commands))
+        self.assertEqual(
+            self.state.routers['fake'].id_hex[1:],
+            self.protocol.commands[0][0].split()[2].split(',')[-1],
+        )
+
+    def test_country_unknown(self):
+        pool = CircuitPool(self.clock, self.state, {CircuitClass(exit_country='de'): 1})
+        pool.start()
+        self.protocol.answer_pending(
+            'ip-to-country/12.45.56.78=us\nip-to-country/84.19.178.6=??\n'
+            'ip-to-country/85.19.178.6=fr'
+        )
+        # no exit in "de": nothing is built, and the pool waits
+        # before asking Tor again (only about the one it doesn't know)
+        self.assertEqual([], self.protocol.commands)
+        self.clock.advance(5)
+        self.assertEqual([('ip-to-country/84.19.178.6', )], self.asked[1:])
+        self.protocol.answer_pending('ip-to-country/84.19.178.6=??')
+        self.clock.advance(9)
+        self.assertEqual(2, len(self.asked))
+        self.clock.advance(1)
+        self.assertEqual(3, len(self.asked))
@@ -0,0 +1,172 @@
+import base64
+
+from twisted.trial import unittest
+
+from txtorcon.controlcore import ControlCore, parse_protocolinfo, safecookie_response
+from txtorcon.util import hmac_sha256
+
+
+class _Recorder(object):
+
+    def __init__(self):
+        self.items = []
+        self.core = ControlCore(
+            on_reply=lambda code, text: self.items.append(('reply', code, text)),
+            on_event=lambda name, text: self.items.append(('event', name, text)),
+            on_reply_line=lambda text: self.items.append(('line', text)),
+        )
+
+
+class FramingTests(unittest.TestCase):
+
+    def setUp(self):
+        recorder = _Recorder()
+        self.core = recorder.core
+        self.items = recorder.items
+
+    def test_send_command(self):
+        self.assertEqual(self.core.send_command('GETINFO version'), b'GETINFO version\r\n')
+        self.assertEqual(self.core.send_command(b'SIGNAL NEWNYM'), b'SIGNAL NEWNYM\r\n')
+        self.assertEqual(self.core.pending, 2)
+
+    def test_single_line_reply(self):
+        self.core.send_command('SIGNAL NEWNYM')
+        self.core.receive_data(b'250 OK\r\n')
+        self.assertEqual(self.items, [('reply', 250, 'OK')])
+        self.assertEqual(self.core.pending, 0)
+
+    def test_multi_line_reply_in_pieces(self):
+        self.core.send_command('GETINFO version config-file')
+        data = b'250-version=0.4.8.9\r\n250-config-file=/etc/tor/torrc\r\n250 OK\r\n'
+        for index in range(len(data)):
+            self.core.receive_data(data[index:index + 1])
+        self.assertEqual(
+            self.items,
+            [('reply', 250, 'version=0.4.8.9\nconfig-file=/etc/tor/torrc')],
+        )
+
+    def test_data_block(self):
+        self.core.send_command('GETINFO ns/all')
+        self.core.receive_data(
+            b'250+ns/all=\r\nr foo\r\ns Fast\r\n.\r\n250 OK\r\n'
+        )
+        self.assertEqual(self.items, [('reply', 250, 'ns/all=\nr foo\ns Fast')])
+
+    def test_stream_lines(self):
+        self.core.send_command('GETINFO ns/all', stream_lines=True)
+        self.core.receive_data(
+            b'250+ns/all=\r\nr foo\r\n.\r\n250 OK\r\n'
+        )
+        self.assertEqual(
+            self.items,
+            [('line', 'ns/all='), ('line', 'r foo'), ('line', 'OK'), ('reply', 250, '')],
+        )
+
+    def test_stream_lines_error(self):
+        self.core.send_command('GETINFO foo', stream_lines=True)
+        self.core.receive_data(b'552 Unrecognized key "foo"\r\n')
+        self.assertEqual(self.items, [('reply', 552, 'Unrecognized key "foo"')])
+
+    def test_stream_lines_needs_callback(self):
+        core = ControlCore(on_reply=None, on_event=None)
+        with self.assertRaises(ValueError):
+            core.send_command('GETINFO ns/all', stream_lines=True)
+
+    def test_events(self):
+        self.core.send_command('GETINFO version')
+        self.core.receive_data(
+            b'650 CIRC 1 LAUNCHED\r\n'
+            b'250-version=0.4.8.9\r\n'
+            b'250 OK\r\n'
+            b'650-NS\r\n650+\r\nr foo\r\n.\r\n650 OK\r\n'
+        )
+        self.assertEqual(
+            self.items,
+            [
+                ('event', 'CIRC', '1 LAUNCHED'),
+                ('reply', 250, 'version=0.4.8.9'),
+                ('event', 'NS', '\nr foo\nOK'),
+            ]
+        )
+
+    def test_pipelined(self):
+        self.core.send_command('GETINFO version')
+        self.core.send_command('GETINFO foo')
+        self.core.receive_data(b'250-version=0.4.8.9\r\n250 OK\r\n552 Unrecognized key\r\n')
+        self.assertEqual(
+            self.items,
+            [('reply', 250, 'version=0.4.8.9'), ('reply', 552, 'Unrecognized key')],
+        )
+
+    def test_reply_without_command(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            self.core.receive_line(b'250 OK')
+        self.assertIn("didn't issue a command", str(ctx.exception))
+
+    def test_unknown_code(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            self.core.receive_line(b'999 foo')
+        self.assertIn('Unknown code', str(ctx.exception))
+
+    def test_mixed_codes(self):
+        self.core.send_command('GETINFO version')
+        self.core.receive_line(b'250-version=0.4.8.9')
+        with self.assertRaises(RuntimeError) as ctx:
+            self.core.receive_line(b'552 foo')
+        self.assertIn('Unexpected code', str(ctx.exception))
+
+    def test_bad_separator(self):
+        self.core.send_command('GETINFO version')
+        with self.assertRaises(RuntimeError):
+            self.core.receive_line(b'250*foo')
+
+    def test_line_too_long(self):
+        core = ControlCore(on_reply=None, on_event=None, max_line_length=10)
+        with self.assertRaises(RuntimeError):
+            core.receive_data(b'x' * 11)
+        core = ControlCore(on_reply=None, on_event=None, max_line_length=10)
+        with self.assertRaises(RuntimeError):
+            core.receive_data(b'x' * 11 + b'\r\n')
+
+
+class AuthHelperTests(unittest.TestCase):
+
+    def test_protocolinfo(self):
+        methods, cookiefile = parse_protocolinfo(
+            'PROTOCOLINFO 1\n'
+            'AUTH METHODS=COOKIE,SAFECOOKIE COOKIEFILE="/var/run/tor/control\\".authcookie"\n'
+            'VERSION Tor="0.4.8.9"\n'
+        )
+        self.assertEqual(methods, ['COOKIE', 'SAFECOOKIE'])
+        self.assertEqual(cookiefile, '/var/run/tor/control".authcookie')
+
+    def test_protocolinfo_no_cookie(self):
+        self.assertEqual(
+            parse_protocolinfo('AUTH METHODS=NULL\n'),
+            (['NULL'], None),
+        )
+
+    def test_protocolinfo_no_auth(self):
+        with self.assertRaises(RuntimeError):
+            parse_protocolinfo('PROTOCOLINFO 1\nVERSION Tor="0.4.8.9"\n')
+
+    def test_safecookie(self):
+        cookie = b'\x01' * 32
+        client_nonce = b'\x02' * 32
+        server_nonce = b'\x03' * 32
+        server_hash = hmac_sha256(
+            b"Tor safe cookie authentication server-to-controller hash",
+            cookie + client_nonce + server_nonce,
+        )
+        reply = 'AUTHCHALLENGE SERVERHASH={} SERVERNONCE={}'.format(
+            base64.b16encode(server_hash).decode('ascii'),
+            base64.b16encode(server_nonce).decode('ascii'),
+        )
+        expected = base64.b16encode(hmac_sha256(
+            b"Tor safe cookie authentication controller-to-server hash",
+            cookie + client_nonce + server_nonce,
+        ))
+        self.assertEqual(safecookie_response(cookie, client_nonce, reply), expected)
+
+        with self.assertRaises(RuntimeError):
+            safecookie_response(b'\x00' * 32, client_nonce, reply)
@@ -140,7 +140,7 @@ class LaunchTorTests(unittest.TestCase):
             TorProcessProtocol(lambda: None, timeout=42)
         self.assertTrue("Must supply an IReactorTime" in str(ctx.exception))
 
-    def _fake_queue(self, cmd):
+    def _fake_queue(self, cmd, priority=None):
         if cmd.split()[0] == 'PROTOCOLINFO':
             return defer.succeed('AUTH METHODS=NULL')
         elif cmd == 'GETINFO config/names':
@@ -664,7 +664,7 @@ class LaunchTorTests(unittest.TestCase):
                 return defer.succeed(None)
             tpp.add_event_listener = fake_event_listener
 
-            def fake_queue(cmd):
+            def fake_queue(cmd, priority=None):
                 if cmd.split()[0] == 'PROTOCOLINFO':
                     return defer.succeed('AUTH METHODS=NULL')
                 elif cmd == 'GETINFO config/names':
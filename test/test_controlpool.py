@@ -0,0 +1,243 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet import defer, error
+from twisted.python.failure import Failure
+from zope.interface import implementer
+from twisted.internet.interfaces import IStreamClientEndpoint
+
+from txtorcon import TorControlProtocol, TorControlPool, TorState, TorConfig
+from txtorcon import ITorControlProtocol, build_control_pool
+
+
+def _protocol():
+    proto = TorControlProtocol()
+    proto.connectionMade = lambda: None
+    proto.makeConnection(proto_helpers.StringTransport())
+    return proto
+
+
+def _bootstrapped():
+    proto = _protocol()
+    proto.version = '0.4.8.9'
+    proto._set_valid_events(' '.join(['CONF_CHANGED'] + list(TorState.event_map.keys())))
+    proto.post_bootstrap.callback(proto)
+    return proto
+
+
+def _written(proto):
+    data = proto.transport.value()
+    proto.transport.clear()
+    return data
+
+
+class PoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.events = _bootstrapped()
+        self.commands = [_bootstrapped(), _bootstrapped()]
+        self.pool = TorControlPool(self.events, self.commands)
+
+    def test_interface(self):
+        self.assertTrue(ITorControlProtocol.providedBy(self.pool))
+        self.assertIs(self.successResultOf(self.pool.post_bootstrap), self.pool)
+        self.assertEqual(self.pool.version, '0.4.8.9')
+        self.assertIs(self.pool.valid_events, self.events.valid_events)
+
+    def test_no_command_protocols(self):
+        with self.assertRaises(ValueError):
+            TorControlPool(self.events, [])
+
+    def test_least_outstanding(self):
+        self.pool.get_info('a')
+        self.pool.get_info('b')
+        self.pool.get_conf('c')
+        self.assertEqual(_written(self.commands[0]), b'GETINFO a\r\n')
+        self.assertEqual(_written(self.commands[1]), b'GETINFO b\r\n')
+        self.assertEqual(_written(self.events), b'')
+        self.assertEqual(self.pool.outstanding, 3)
+
+        # command 0 got the GETCONF queued behind its GETINFO
+        self.commands[0].dataReceived(b'250 a=1\r\n')
+        self.assertEqual(_written(self.commands[0]), b'GETCONF c\r\n')
+
+        # ...so once command 1 has its reply, it's the least busy
+        self.commands[1].dataReceived(b'250 b=1\r\n')
+        d = self.pool.queue_command('SIGNAL NEWNYM')
+        self.assertEqual(_written(self.commands[0]), b'')
+        self.assertEqual(_written(self.commands[1]), b'SIGNAL NEWNYM\r\n')
+        self.commands[1].dataReceived(b'250 OK\r\n')
+        self.assertEqual(self.successResultOf(d), 'OK')
+
+    def test_events_on_event_connection(self):
+        got = []
+        d = self.pool.add_event_listener('CIRC', got.append)
+        self.assertEqual(_written(self.events), b'SETEVENTS CIRC\r\n')
+        self.events.dataReceived(b'250 OK\r\n')
+        self.successResultOf(d)
+        self.assertEqual(list(self.pool.events.keys()), ['CIRC'])
+
+        self.events.dataReceived(b'650 CIRC 1 BUILT\r\n')
+        self.assertEqual(got, ['1 BUILT'])
+
+        self.pool.queue_command('SETEVENTS CIRC STREAM')
+        self.assertEqual(_written(self.events), b'SETEVENTS CIRC STREAM\r\n')
+        self.events.dataReceived(b'250 OK\r\n')
+        for proto in self.commands:
+            self.assertEqual(_written(proto), b'')
+
+        self.pool.remove_event_listener('CIRC', got.append)
+        self.assertEqual(_written(self.events), b'SETEVENTS \r\n')
+
+    def test_takeownership_on_event_connection(self):
+        self.pool.queue_command('TAKEOWNERSHIP')
+        self.assertEqual(_written(self.events), b'TAKEOWNERSHIP\r\n')
+        for proto in self.commands:
+            self.assertEqual(_written(proto), b'')
+
+    def test_command_connection_lost(self):
+        self.commands[0].connectionLost(Failure(error.ConnectionDone()))
+        self.assertEqual(self.pool.command_protocols, [self.commands[1]])
+        d = self.pool.get_info('a')
+        self.assertEqual(_written(self.commands[1]), b'GETINFO a\r\n')
+        self.assertNoResult(self.pool.when_disconnected())
+
+        # with no command connections left, commands use the event one
+        self.commands[1].connectionLost(Failure(error.ConnectionDone()))
+        self.failureResultOf(d)
+        self.pool.get_info('b')
+        self.assertEqual(_written(self.events), b'GETINFO b\r\n')
+
+    def test_event_connection_lost(self):
+        d = self.pool.when_disconnected()
+        self.events.connectionLost(Failure(error.ConnectionDone()))
+        self.failureResultOf(d)
+
+    def test_is_owned(self):
+        self.pool.is_owned = 1234
+        self.assertEqual(self.pool.is_owned, 1234)
+        self.assertEqual([p.is_owned for p in self.commands], [1234, 1234])
+
+    def test_quit(self):
+        d = self.pool.quit()
+        for proto in self.commands + [self.events]:
+            self.assertEqual(_written(proto), b'QUIT\r\n')
+            proto.dataReceived(b'250 closing connection\r\n')
+        self.successResultOf(d)
+
+
+class PoolBootstrapTests(unittest.TestCase):
+
+    def test_waits_for_all(self):
+        protos = [_protocol() for _ in range(3)]
+        pool = TorControlPool(protos[0], protos[1:])
+        protos[0].post_bootstrap.callback(protos[0])
+        protos[1].post_bootstrap.callback(protos[1])
+        self.assertNoResult(pool.post_bootstrap)
+        protos[2].post_bootstrap.callback(protos[2])
+        self.assertIs(self.successResultOf(pool.post_bootstrap), pool)
+        # the protocols' own results are untouched
+        self.assertIs(self.successResultOf(protos[1].post_bootstrap), protos[1])
+
+    def test_bootstrap_fails(self):
+        protos = [_protocol() for _ in range(2)]
+        pool = TorControlPool(protos[0], protos[1:])
+        protos[1].post_bootstrap.errback(RuntimeError("auth failed"))
+        self.failureResultOf(pool.post_bootstrap, RuntimeError)
+
+    def endpoint(self, protos, fail_at=None):
+        @implementer(IStreamClientEndpoint)
+        class Endpoint(object):
+            attempts = 0
+
+            def connect(self, factory):
+                self.attempts += 1
+                if self.attempts == fail_at:
+                    return defer.fail(error.ConnectionRefusedError())
+                proto = factory.buildProtocol(None)
+                proto.connectionMade = lambda: None
+                proto.makeConnection(proto_helpers.StringTransport())
+                protos.append(proto)
+                return defer.succeed(proto)
+        return Endpoint()
+
+    def test_build_control_pool(self):
+        protos = []
+        d = build_control_pool(self.endpoint(protos), command_connections=3)
+        self.assertEqual(len(protos), 4)
+        for proto in protos:
+            proto.post_bootstrap.callback(proto)
+        pool = self.successResultOf(d)
+        self.assertIs(pool.event_protocol, protos[0])
+        self.assertEqual(pool.command_protocols, protos[1:])
+
+    def test_build_control_pool_connect_fails(self):
+        protos = []
+        d = build_control_pool(self.endpoint(protos, fail_at=2), command_connections=2)
+        self.failureResultOf(d, error.ConnectionRefusedError)
+        self.assertEqual(2, len(protos))
+        for proto in protos:
+            self.assertTrue(proto.transport.disconnecting)
+
+    def test_build_control_pool_bootstrap_fails(self):
+        protos = []
+        d = build_control_pool(self.endpoint(protos), command_connections=2)
+        protos[0].post_bootstrap.callback(protos[0])
+        protos[1].post_bootstrap.errback(RuntimeError("auth failed"))
+        self.failureResultOf(d, RuntimeError)
+        for proto in protos:
+            self.assertTrue(proto.transport.disconnecting)
+
+    def test_build_control_pool_bad_size(self):
+        d = build_control_pool(None, command_connections=0)
+        self.failureResultOf(d, ValueError)
+
+
+class PoolWithStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.events = _bootstrapped()
+        self.commands = [_bootstrapped(), _bootstrapped()]
+        self.pool = TorControlPool(self.events, self.commands)
+
+    def answer(self, reply):
+        """
+        Answers the one command written to any command connection.
+        """
+        written = [(_written(proto), proto) for proto in self.commands]
+        written = [(data, proto) for data, proto in written if data]
+        self.assertEqual(len(written), 1)
+        data, proto = written[0]
+        proto.dataReceived(reply + b'\r\n')
+        return data
+
+    def answer_events(self):
+        """
+        Answers every SETEVENTS on the event connection.
+        """
+        while True:
+            data = _written(self.events)
+            if not data:
+                return
+            self.assertTrue(data.startswith(b'SETEVENTS '))
+            self.events.dataReceived(b'250 OK\r\n')
+
+    def test_torstate_bootstrap(self):
+        state = TorState(self.pool)
+        # the bootstrap queries go to the command connections...
+        self.assertEqual(self.answer(b'250 OK'), b'GETINFO ns/all\r\n')
+        self.assertEqual(self.answer(b'250 circuit-status='), b'GETINFO circuit-status\r\n')
+        self.assertEqual(self.answer(b'250 stream-status='), b'GETINFO stream-status\r\n')
+        self.assertEqual(self.answer(b'250 address-mappings/all='), b'GETINFO address-mappings/all\r\n')
+
+        # ...while the subscriptions are on the event connection
+        self.answer_events()
+        self.assertEqual(self.answer(b'250 entry-guards='), b'GETINFO entry-guards\r\n')
+        self.assertTrue('CIRC' in self.pool.events)
+        self.assertTrue('CIRC' in self.events.events)
+        self.assertNoResult(state.post_bootstrap)
+
+    def test_torconfig(self):
+        config = TorConfig(self.pool)
+        self.answer_events()
+        self.assertEqual(self.answer(b'250 config/names='), b'GETINFO config/names\r\n')
+        self.assertIs(config.protocol, self.pool)
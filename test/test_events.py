@@ -0,0 +1,324 @@
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+from twisted.internet.task import Clock
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+
+from txtorcon import TorControlProtocol
+from txtorcon.events import decode_event
+from txtorcon.events import ControlEvent, CircuitEvent, StreamEvent
+from txtorcon.events import AddrMapEvent, StatusEvent, EventBatch
+
+
+class DecodeTests(unittest.TestCase):
+
+    def test_unknown_event(self):
+        ev = decode_event('GUARD', 'ENTRY $ABCD=foo DOWN')
+        self.assertEqual(type(ev), ControlEvent)
+        self.assertEqual(ev.positional, ('ENTRY', '$ABCD=foo', 'DOWN'))
+        self.assertEqual(dict(ev.keywords), {})
+
+    def test_lazy(self):
+        ev = decode_event('CIRC', '1 BUILT')
+        self.assertIs(ev._positional, None)
+        self.assertEqual(ev.status, 'BUILT')
+        self.assertEqual(ev._positional, ('1', 'BUILT'))
+
+    def test_circuit(self):
+        ev = decode_event(
+            'CIRC',
+            '1000 EXTENDED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,'
+            '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5~venus '
+            'BUILD_FLAGS=NEED_CAPACITY PURPOSE=GENERAL '
+            'SOCKS_USERNAME="a b" TIME_CREATED=2024-01-01T00:00:00.000000'
+        )
+        self.assertTrue(isinstance(ev, CircuitEvent))
+        self.assertEqual(ev.circuit_id, 1000)
+        self.assertEqual(ev.status, 'EXTENDED')
+        self.assertEqual(len(ev.path), 2)
+        self.assertEqual(ev.path[1], '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5~venus')
+        self.assertEqual(ev.purpose, 'GENERAL')
+        self.assertEqual(ev['SOCKS_USERNAME'], 'a b')
+        self.assertEqual(ev.reason, None)
+
+    def test_circuit_no_path(self):
+        ev = decode_event('CIRC', '365 LAUNCHED PURPOSE=GENERAL')
+        self.assertEqual(ev.path, [])
+        self.assertEqual(ev.get('PURPOSE'), 'GENERAL')
+
+    def test_stream(self):
+        ev = decode_event('STREAM', '1234 NEW 0 www.example.com:443 SOURCE_ADDR=127.0.0.1:5432 PURPOSE=USER')
+        self.assertTrue(isinstance(ev, StreamEvent))
+        self.assertEqual(ev.stream_id, 1234)
+        self.assertEqual(ev.circuit_id, 0)
+        self.assertEqual(ev.target_host, 'www.example.com')
+        self.assertEqual(ev.target_port, 443)
+        self.assertEqual(ev['SOURCE_ADDR'], '127.0.0.1:5432')
+
+    def test_bandwidth(self):
+        ev = decode_event('BW', '100 200')
+        self.assertEqual((ev.bytes_read, ev.bytes_written), (100, 200))
+        ev = decode_event('CIRC_BW', 'ID=5 READ=10 WRITTEN=20 TIME=2024-01-01T00:00:00.0')
+        self.assertEqual((ev.circuit_id, ev.bytes_read, ev.bytes_written), (5, 10, 20))
+        ev = decode_event('STREAM_BW', '7 30 40 2024-01-01T00:00:00.0')
+        self.assertEqual((ev.stream_id, ev.bytes_written, ev.bytes_read), (7, 30, 40))
+
+    def test_orconn(self):
+        ev = decode_event('ORCONN', '$AAAA~foo CLOSED REASON=DONE NCIRCS=2')
+        self.assertEqual((ev.target, ev.status, ev.reason), ('$AAAA~foo', 'CLOSED', 'DONE'))
+
+    def test_hs_desc(self):
+        ev = decode_event('HS_DESC', 'RECEIVED abcdef NO_AUTH $AAAA~dir descid REPLICA=1')
+        self.assertEqual(ev.action, 'RECEIVED')
+        self.assertEqual(ev.address, 'abcdef')
+        self.assertEqual(ev.auth_type, 'NO_AUTH')
+        self.assertEqual(ev.hs_dir, '$AAAA~dir')
+        self.assertEqual(ev.descriptor_id, 'descid')
+        self.assertEqual(decode_event('HS_DESC', 'FAILED a NO_AUTH b').descriptor_id, None)
+
+    def test_addrmap_quoted_expiry(self):
+        ev = decode_event(
+            'ADDRMAP',
+            'www.example.com 1.2.3.4 "2024-01-01 12:00:00" '
+            'EXPIRES="2024-01-01 17:00:00" CACHED="NO"'
+        )
+        self.assertTrue(isinstance(ev, AddrMapEvent))
+        self.assertEqual(ev.new_address, '1.2.3.4')
+        self.assertEqual(ev.expiry, '2024-01-01 12:00:00')
+        self.assertEqual(ev.expires, '2024-01-01 17:00:00')
+        self.assertEqual(ev['CACHED'], 'NO')
+
+    def test_status(self):
+        ev = decode_event('STATUS_CLIENT', 'NOTICE BOOTSTRAP PROGRESS=100 TAG=done SUMMARY="Done"')
+        self.assertTrue(isinstance(ev, StatusEvent))
+        self.assertEqual(ev.severity, 'NOTICE')
+        self.assertEqual(ev.action, 'BOOTSTRAP')
+        self.assertEqual(ev['SUMMARY'], 'Done')
+
+    def test_read_only(self):
+        ev = decode_event('CIRC', '1 BUILT PURPOSE=GENERAL')
+        with self.assertRaises(TypeError):
+            ev.keywords['PURPOSE'] = 'foo'
+        with self.assertRaises(AttributeError):
+            ev.something = 'foo'
+
+    def test_cell_stats(self):
+        ev = decode_event(
+            'CELL_STATS',
+            'ID=14 OutboundQueue=19403 OutboundConn=15 '
+            'OutboundAdded=create_fast:1,relay_early:2 '
+            'OutboundRemoved=create_fast:1,relay_early:2 '
+            'OutboundTime=create_fast:0,relay_early:0'
+        )
+        self.assertEqual(ev.circuit_id, 14)
+        self.assertEqual(ev.outbound_added, {'create_fast': 1, 'relay_early': 2})
+        self.assertEqual(ev.inbound_added, {})
+
+    def test_repr(self):
+        self.assertTrue('CIRC' in repr(decode_event('CIRC', '1 BUILT')))
+
+
+class EventBatchTests(unittest.TestCase):
+
+    def _batch(self, name, *lines):
+        return EventBatch(name, [decode_event(name, line) for line in lines], 1.0, 2.0)
+
+    def test_bw(self):
+        batch = self._batch('BW', '100 200', '1 2')
+        self.assertEqual(len(batch), 2)
+        self.assertEqual((batch.bytes_read, batch.bytes_written), (101, 202))
+        self.assertEqual(batch.circuit_bytes, {})
+
+    def test_circ_bw(self):
+        batch = self._batch(
+            'CIRC_BW',
+            'ID=5 READ=10 WRITTEN=20',
+            'ID=6 READ=1 WRITTEN=2',
+            'ID=5 READ=100 WRITTEN=200 TIME=2024-01-01T00:00:00.0',
+        )
+        self.assertEqual(batch.circuit_bytes, {5: (110, 220), 6: (1, 2)})
+        self.assertEqual((batch.bytes_read, batch.bytes_written), (111, 222))
+
+    def test_malformed_skipped(self):
+        batch = self._batch(
+            'CIRC_BW',
+            'ID=5 READ=10 WRITTEN=20',
+            'ID=6 READ=1',
+            'ID=7 READ=x WRITTEN=2',
+            'ID=5 READ=1 WRITTEN=2',
+        )
+        self.assertEqual(2, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(['ID=5 READ=10 WRITTEN=20', 'ID=5 READ=1 WRITTEN=2'], [ev.raw for ev in batch])
+        self.assertEqual(batch.circuit_bytes, {5: (11, 22)})
+        self.assertEqual((batch.bytes_read, batch.bytes_written), (11, 22))
+
+        batch = self._batch('BW', '100 200', '1', '1 2')
+        self.assertEqual(1, len(self.flushLoggedErrors(IndexError)))
+        self.assertEqual((batch.bytes_read, batch.bytes_written), (101, 202))
+
+    def test_stream_bw(self):
+        # written comes first on the wire
+        batch = self._batch('STREAM_BW', '7 30 40', '7 1 2', '8 5 6')
+        self.assertEqual(batch.stream_bytes, {7: (42, 31), 8: (6, 5)})
+
+    def test_cell_stats(self):
+        batch = self._batch(
+            'CELL_STATS',
+            'ID=14 InboundAdded=relay:1 OutboundAdded=relay:2,destroy:1',
+            'ID=14 InboundAdded=relay:3',
+            'InboundQueue=1 InboundConn=2 InboundAdded=relay:99',
+        )
+        self.assertEqual(
+            batch.circuit_cells,
+            {14: {'inbound': {'relay': 4}, 'outbound': {'relay': 2, 'destroy': 1}}},
+        )
+
+    def test_other(self):
+        batch = self._batch('CIRC', '1 BUILT', '2 LAUNCHED')
+        self.assertEqual([ev.circuit_id for ev in batch], [1, 2])
+        self.assertEqual((batch.started, batch.ended), (1.0, 2.0))
+        self.assertTrue('CIRC' in repr(batch))
+
+
+class TypedListenerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol._set_valid_events('CIRC')
+
+    def test_shared_record(self):
+        raw = []
+        typed0 = []
+        typed1 = []
+        self.protocol.add_event_listener('CIRC', raw.append)
+        self.protocol.add_event_listener('CIRC', typed0.append, typed=True)
+        self.protocol.add_event_listener('CIRC', typed1.append, typed=True)
+        self.protocol.lineReceived(b"250 OK")
+
+        self.protocol.lineReceived(b"650 CIRC 1000 EXTENDED moria1,moria2")
+        self.assertEqual(raw, ["1000 EXTENDED moria1,moria2"])
+        self.assertEqual(len(typed0), 1)
+        self.assertIs(typed0[0], typed1[0])
+        self.assertEqual(typed0[0].path, ['moria1', 'moria2'])
+
+    def test_remove_typed(self):
+        typed = []
+        self.protocol.add_event_listener('CIRC', typed.append, typed=True)
+        self.protocol.lineReceived(b"250 OK")
+        self.transport.clear()
+        self.protocol.remove_event_listener('CIRC', typed.append)
+        self.assertEqual(self.transport.value(), b'SETEVENTS \r\n')
+
+    def test_typed_listener_error(self):
+        def boom(event):
+            raise RuntimeError("typed listener failed")
+        self.protocol.add_event_listener('CIRC', boom, typed=True)
+        self.protocol.lineReceived(b"250 OK")
+        self.protocol.lineReceived(b"650 CIRC 1 BUILT")
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+
+
+class BatchedListenerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.protocol._set_valid_events('CIRC_BW BW')
+
+    def _add(self, callback, **kw):
+        self.protocol.add_event_listener('CIRC_BW', callback, reactor=self.clock, **kw)
+        self.protocol.lineReceived(b"250 OK")
+
+    def test_window(self):
+        batches = []
+        self._add(batches.append, window=1.0)
+        self.clock.advance(5)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=10 WRITTEN=20")
+        self.clock.advance(0.5)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=5 WRITTEN=5")
+        self.protocol.lineReceived(b"650 CIRC_BW ID=2 READ=1 WRITTEN=1")
+        self.assertEqual(batches, [])
+
+        self.clock.advance(0.5)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 3)
+        self.assertEqual(batches[0].circuit_bytes, {1: (15, 25), 2: (1, 1)})
+        self.assertEqual((batches[0].started, batches[0].ended), (5.0, 6.0))
+
+        # nothing pending, so no empty batch
+        self.clock.advance(10)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_max_events(self):
+        batches = []
+        self._add(batches.append, max_events=2, window=10)
+        for x in range(5):
+            self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=1")
+        self.assertEqual([len(b) for b in batches], [2, 2])
+        self.clock.advance(10)
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+
+    def test_malformed_event(self):
+        batches = []
+        self._add(batches.append, max_events=3)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=1")
+        self.protocol.lineReceived(b"650 CIRC_BW ID=2 READ=nope WRITTEN=1")
+        self.protocol.lineReceived(b"650 CIRC_BW ID=3 READ=2 WRITTEN=2")
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(1, len(batches))
+        self.assertEqual(batches[0].circuit_bytes, {1: (1, 1), 3: (2, 2)})
+        self.assertEqual(2, len(batches[0]))
+
+    def test_typed_and_raw_alongside(self):
+        batches = []
+        raw = []
+        self._add(batches.append, max_events=1)
+        self.protocol.add_event_listener('CIRC_BW', raw.append)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=2")
+        self.assertEqual(raw, ["ID=1 READ=1 WRITTEN=2"])
+        self.assertEqual(batches[0].bytes_written, 2)
+
+    def test_remove_flushes(self):
+        batches = []
+        self._add(batches.append, window=1.0)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=1")
+        self.transport.clear()
+        self.protocol.remove_event_listener('CIRC_BW', batches.append)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(self.transport.value(), b'SETEVENTS \r\n')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_connection_lost_flushes(self):
+        batches = []
+        self._add(batches.append, window=1.0)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=1")
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_bad_arguments(self):
+        for kw in [dict(window=0), dict(max_events=0)]:
+            with self.assertRaises(ValueError):
+                self.protocol.add_event_listener('BW', print, reactor=self.clock, **kw)
+        # nothing was subscribed
+        self.assertEqual(self.protocol.events, {})
+        self.assertEqual(self.transport.value(), b'')
+
+    def test_listen_twice(self):
+        self._add(print, window=1)
+        with self.assertRaises(ValueError):
+            self._add(print, window=2)
+
+    def test_listener_error(self):
+        def boom(batch):
+            raise RuntimeError("batch listener failed")
+        self._add(boom, max_events=1)
+        self.protocol.lineReceived(b"650 CIRC_BW ID=1 READ=1 WRITTEN=1")
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
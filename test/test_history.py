@@ -0,0 +1,49 @@
+from twisted.trial import unittest
+
+from txtorcon.history import History, CircuitRecord, StreamRecord
+
+
+def circuit(circid, state='CLOSED', reason='FINISHED'):
+    return CircuitRecord(circid, state, reason, 'GENERAL', (), 1.0, 2.0, 3.0)
+
+
+def stream(streamid, state='CLOSED', reason='DONE'):
+    return StreamRecord(streamid, state, reason, 'example.com', 80, None, 1.0, 2.0)
+
+
+class HistoryTests(unittest.TestCase):
+
+    def test_bounded(self):
+        history = History(2)
+        for circid in range(5):
+            history.add_circuit(circuit(circid))
+            history.add_stream(stream(circid))
+        self.assertEqual([3, 4], [record.id for record in history.circuits])
+        self.assertEqual([3, 4], [record.id for record in history.streams])
+
+    def test_counts(self):
+        history = History(1)
+        history.add_circuit(circuit(1))
+        history.add_circuit(circuit(2, 'FAILED', 'TIMEOUT'))
+        history.add_circuit(circuit(3))
+        history.add_stream(stream(1, 'FAILED', 'TIMEOUT'))
+        self.assertEqual(
+            {('CLOSED', 'FINISHED'): 2, ('FAILED', 'TIMEOUT'): 1},
+            dict(history.circuit_counts),
+        )
+        self.assertEqual({('FAILED', 'TIMEOUT'): 1}, dict(history.stream_counts))
+
+    def test_clear(self):
+        history = History(10)
+        history.add_circuit(circuit(1))
+        history.add_stream(stream(1))
+        history.clear()
+        self.assertEqual(0, len(history.circuits))
+        self.assertEqual(0, len(history.streams))
+        self.assertEqual({}, dict(history.circuit_counts))
+        self.assertEqual({}, dict(history.stream_counts))
+
+    def test_records_immutable(self):
+        record = circuit(1)
+        with self.assertRaises(AttributeError):
+            record.state = 'BUILT'
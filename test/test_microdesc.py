@@ -60,6 +60,8 @@ class ParserTests(unittest.TestCase):
 
         self.assertTrue('bandwidth' not in relays[0])
         self.assertTrue('bandwidth' in relays[1])
+        self.assertTrue('policy' not in relays[0])
+        self.assertEqual('accept 43,53,79-81', relays[1]['policy'])
         self.assertTrue('flags' in relays[0])
         self.assertTrue('flags' in relays[1])
         self.assertTrue('FutureProof' in relays[1]['flags'])
@@ -94,3 +96,52 @@ class ParserTests(unittest.TestCase):
 
         self.assertEqual(1, len(relays))
         self.assertEqual(['[2001:0:0:0::0]:4321'], list(relays[0]['ip_v6']))
+
+    def test_ipv6_and_bandwidth(self):
+        relays = []
+
+        def create_relay(**kw):
+            relays.append(kw)
+        m = MicrodescriptorParser(create_relay)
+
+        for line in [
+                'ns/all=',
+                'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 11.11.11.11 443 80',
+                'a [2001::1]:4321',
+                'a [2001::2]:4321',
+                's Fast Running',
+                'w Bandwidth=1234 Unmeasured=1',
+                'p reject 1-65535',
+                '.',
+                'OK',
+        ]:
+            m.feed_line(line)
+        m.done()
+
+        self.assertEqual(1, len(relays))
+        self.assertEqual(['[2001::1]:4321', '[2001::2]:4321'], relays[0]['ip_v6'])
+        self.assertEqual(['Fast', 'Running'], relays[0]['flags'])
+        self.assertEqual('1234', relays[0]['bandwidth'])
+        self.assertEqual('2011-12-12 16:29:16', relays[0]['modified'])
+        self.assertEqual('443', relays[0]['orport'])
+        self.assertEqual('80', relays[0]['dirport'])
+
+    def test_out_of_order(self):
+        m = MicrodescriptorParser(lambda **kw: None)
+        m.feed_line('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 11.11.11.11 443 80')
+        with self.assertRaises(RuntimeError) as ctx:
+            m.feed_line('w Bandwidth=1234')
+        self.assertTrue('Expected "s " ' in str(ctx.exception))
+
+    def test_done_resets(self):
+        relays = []
+
+        def create_relay(**kw):
+            relays.append(kw)
+        m = MicrodescriptorParser(create_relay)
+        # a relay with no "s " line, e.g. the end of a truncated consensus
+        m.feed_line('r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 11.11.11.11 443 80')
+        m.done()
+        m.feed_line('r ekaf foooooooooooooooooooooooooo barbarbarbarbarbarbarbarbar 2011-11-11 16:30:00 22.22.22.22 443 80')
+        m.done()
+        self.assertEqual(['fake', 'ekaf'], [r['nickname'] for r in relays])
@@ -0,0 +1,142 @@
+import random
+from collections import Counter
+
+from twisted.trial import unittest
+
+from txtorcon.pathselect import AliasTable, PathSelector, parse_bandwidth_weights
+from txtorcon.testutil import fake_router
+
+
+class AliasTableTests(unittest.TestCase):
+
+    def test_proportions(self):
+        table = AliasTable([1, 0, 3, 6])
+        rand = random.Random(1234)
+        counts = Counter(table.sample(rand) for _ in range(20000))
+        self.assertEqual(counts[1], 0)
+        self.assertTrue(abs(counts[0] / 20000.0 - 0.1) < 0.02)
+        self.assertTrue(abs(counts[2] / 20000.0 - 0.3) < 0.02)
+        self.assertTrue(abs(counts[3] / 20000.0 - 0.6) < 0.02)
+
+    def test_one(self):
+        table = AliasTable([5])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.sample(random.Random(1)), 0)
+
+    def test_nothing(self):
+        self.assertRaises(ValueError, AliasTable, [])
+        self.assertRaises(ValueError, AliasTable, [0, 0])
+
+
+class PathSelectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.guard = fake_router('guard', '10.1.0.1', 'Fast Guard Running Stable Valid')
+        self.guard2 = fake_router('guard2', '10.2.0.1', 'Fast Guard Running Valid')
+        self.middle = fake_router('middle', '10.3.0.1', 'Fast Running Stable Valid')
+        self.middle2 = fake_router('middle2', '10.4.0.1', 'Fast Running Stable Valid')
+        self.exit = fake_router('exit', '10.5.0.1', 'Exit Fast Running Stable Valid',
+                                policy='accept 80,443')
+        self.exit2 = fake_router('exit2', '10.6.0.1', 'Exit Fast Running Valid',
+                                 policy='accept 22')
+        self.slow = fake_router('slow', '10.7.0.1', 'Guard Running Valid')
+        self.routers = [self.guard, self.guard2, self.middle, self.middle2,
+                        self.exit, self.exit2, self.slow]
+
+    def paths(self, selector, count=200, **kw):
+        return [selector.select_path(**kw) for _ in range(count)]
+
+    def test_positions(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector):
+            self.assertEqual(len(path), 3)
+            self.assertTrue(path[0].has_flag('guard'))
+            self.assertTrue(path[2].has_flag('exit'))
+            self.assertEqual(len(set(path)), 3)
+            self.assertNotIn(self.slow, path)
+
+    def test_length(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        self.assertEqual(len(selector.select_path(2)), 2)
+        self.assertEqual(len(selector.select_path(4)), 4)
+        self.assertRaises(ValueError, selector.select_path, 1)
+
+    def test_exit_ports(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector, exit_ports=[443]):
+            self.assertIs(path[-1], self.exit)
+        for path in self.paths(selector, exit_ports=[22]):
+            self.assertIs(path[-1], self.exit2)
+        self.assertRaises(ValueError, selector.select_path, exit_ports=[22, 443])
+
+    def test_stable(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector, stable=True):
+            self.assertEqual(path, [self.guard, path[1], self.exit])
+            self.assertIn(path[1], [self.middle, self.middle2])
+
+    def test_guards(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector, guards=[self.guard2]):
+            self.assertIs(path[0], self.guard2)
+
+    def test_exits(self):
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector, exits=[self.exit2, self.middle]):
+            self.assertIs(path[-1], self.exit2)
+        self.assertRaises(ValueError, selector.select_path, exit_ports=[443], exits=[self.exit2])
+
+    def test_exit_country(self):
+        asked = []
+
+        def countries(code):
+            asked.append(code)
+            return {'DE': {self.exit2}, 'FR': {self.exit}}.get(code, set())
+        selector = PathSelector(self.routers, countries=countries, rand=random.Random(1))
+        for path in self.paths(selector, exit_country='de'):
+            self.assertIs(path[-1], self.exit2)
+        for path in self.paths(selector, exit_country='FR', exit_ports=[443]):
+            self.assertIs(path[-1], self.exit)
+        self.assertRaises(ValueError, selector.select_path, exit_country='de', exit_ports=[443])
+        for _ in range(2):
+            self.assertRaises(ValueError, selector.select_path, exit_country='us')
+        # each table is built once (even when it's empty)
+        self.assertEqual(['DE', 'FR', 'DE', 'US'], asked)
+
+        self.assertRaises(ValueError, PathSelector(self.routers).select_path, exit_country='de')
+
+    def test_same_subnet(self):
+        self.middle2.ip = '10.3.9.9'
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        for path in self.paths(selector, length=4):
+            self.assertFalse(self.middle in path and self.middle2 in path)
+
+    def test_no_room(self):
+        for router in self.routers:
+            router.ip = '10.9.{}.1'.format(self.routers.index(router))
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        self.assertRaises(RuntimeError, selector.select_path)
+
+    def test_family(self):
+        families = {self.guard.id_hex: {self.exit.id_hex}}
+        selector = PathSelector(
+            self.routers, family=lambda router: families.get(router.id_hex),
+            rand=random.Random(1),
+        )
+        for path in self.paths(selector, exit_ports=[443]):
+            self.assertIs(path[0], self.guard2)
+
+    def test_bandwidth(self):
+        self.guard.bandwidth = 9000
+        selector = PathSelector(self.routers, rand=random.Random(1))
+        guards = Counter(path[0] for path in self.paths(selector, 2000))
+        self.assertTrue(abs(guards[self.guard] / 2000.0 - 0.9) < 0.03)
+
+    def test_bandwidth_weights(self):
+        self.guard.flags = 'Exit Fast Guard Running Stable Valid'
+        weights = parse_bandwidth_weights('bandwidth-weights Wed=10000 Wee=10000 Wgd=0 Wgg=10000 Wmd=0 Wme=0 Wmg=0 Wmm=10000')
+        self.assertEqual(weights['Wgd'], 0)
+        selector = PathSelector(self.routers, bandwidth_weights=weights, rand=random.Random(1))
+        for path in self.paths(selector):
+            self.assertIs(path[0], self.guard2)
+            self.assertIn(path[1], [self.middle, self.middle2])
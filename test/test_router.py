@@ -1,4 +1,5 @@
 import json
+import threading
 from datetime import datetime
 from unittest.mock import Mock
 
@@ -7,7 +8,8 @@ from twisted.internet import defer
 from twisted.python.failure import Failure
 from twisted.web.client import ResponseDone
 
-from txtorcon.router import Router, hexIdFromHash, hashFromHexId
+from txtorcon.router import Router, hexIdFromHash, hashFromHexId, flag_mask
+from txtorcon.router import ExitPolicyIndex, PortRange, parse_port_ranges, port_in_ranges
 
 
 class FakeController(object):
@@ -98,6 +100,73 @@ class RouterTests(unittest.TestCase):
         router.flags = "Exit Fast Named Running V2Dir Valid"
         self.assertEqual(router.name_is_unique, True)
 
+    def test_flag_bits(self):
+        router = Router(object())
+        router.flags = "Valid Guard Fast"
+        self.assertEqual(router.flags, ['fast', 'guard', 'valid'])
+        self.assertEqual(router.flag_bits, flag_mask(['fast', 'guard', 'valid']))
+        self.assertTrue(router.has_flag('guard'))
+        self.assertTrue(router.has_flag('Guard'))
+        self.assertFalse(router.has_flag('exit'))
+
+    def test_assign_flags(self):
+        router = Router(object())
+        router.flags = b"Guard Fast"
+        flags = router.flags
+        flags.append('Named')
+        # a copy: nothing changes until it's assigned back
+        self.assertFalse(router.has_flag('named'))
+        router.flags = flags
+        self.assertEqual(router.flags, ['fast', 'guard', 'named'])
+        self.assertTrue(router.name_is_unique)
+        router.flags = []
+        self.assertEqual((router.flags, router.flag_bits), ([], 0))
+        self.assertFalse(router.name_is_unique)
+
+    def test_unknown_flag(self):
+        router = Router(object())
+        router.flags = ['Running', 'SomeNewFlag']
+        self.assertEqual(router.flags, ['running', 'somenewflag'])
+        self.assertTrue(router.has_flag('somenewflag'))
+        self.assertNotEqual(flag_mask(['SomeNewFlag']), flag_mask(['Running']))
+
+    def test_new_flags_from_threads(self):
+        names = ['ThreadedFlag{}'.format(n) for n in range(50)]
+        masks = []
+
+        def register():
+            masks.append([flag_mask([name]) for name in names])
+        threads = [threading.Thread(target=register) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # every thread got the same, distinct, bit for each flag
+        self.assertEqual(4, len(masks))
+        for found in masks:
+            self.assertEqual(masks[0], found)
+        self.assertEqual(50, len(set(masks[0])))
+        router = Router(object())
+        router.flags = names[:2]
+        self.assertEqual(router.flags, ['threadedflag0', 'threadedflag1'])
+
+    def test_compact(self):
+        routers = []
+        for _ in range(2):
+            router = Router(object())
+            router.update("foo",
+                          "AHhuQ8zFQJdT8l42Axxc6m6kNwI",
+                          "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                          "2011-12-16 15:11:34",
+                          "77.183.225.114",
+                          "24051", "24052")
+            routers.append(router)
+        self.assertFalse(hasattr(routers[0], '__dict__'))
+        self.assertEqual(routers[0].or_port, '24051')
+        self.assertEqual(routers[0].dir_port, '24052')
+        self.assertIs(routers[0]._or_port, routers[1]._or_port)
+        self.assertEqual(routers[0].id_hash, "AHhuQ8zFQJdT8l42Axxc6m6kNwI")
+
     def test_policy_accept(self):
         controller = object()
         router = Router(controller)
@@ -329,3 +398,81 @@ class OnionOOTests(unittest.TestCase):
         self.assertTrue(
             " but got data for " in str(ctx.exception)
         )
+
+
+def _exit(name, policy):
+    router = Router(None)
+    router.name = name
+    if policy is not None:
+        router.policy = policy.split()
+    return router
+
+
+class PolicyTests(unittest.TestCase):
+
+    def test_parse_port_ranges(self):
+        self.assertEqual(list(parse_port_ranges('80')), [80, 80])
+        self.assertEqual(
+            list(parse_port_ranges('6660-6669,22,443,80-81,82,6665-7000')),
+            [22, 22, 80, 82, 443, 443, 6660, 7000],
+        )
+        self.assertEqual(list(parse_port_ranges('1-65535')), [1, 65535])
+        with self.assertRaises(ValueError):
+            parse_port_ranges('http')
+
+    def test_shared_port_ranges(self):
+        one = _exit('one', 'accept 80,443')
+        two = _exit('two', 'reject 80,443')
+        self.assertIs(one.port_ranges, two.port_ranges)
+        self.assertTrue(one.accepts_port(443))
+        self.assertFalse(two.accepts_port(443))
+
+    def test_port_in_ranges(self):
+        ranges = parse_port_ranges('22,80-82,65535')
+        for port in (22, 80, 81, 82, 65535):
+            self.assertTrue(port_in_ranges(port, ranges))
+        for port in (0, 21, 23, 79, 83, 65534):
+            self.assertFalse(port_in_ranges(port, ranges))
+
+    def test_accepted_rejected_ports(self):
+        router = _exit('foo', 'accept 25,128-256')
+        self.assertEqual([str(p) for p in router.accepted_ports], ['25', '128-256'])
+        self.assertIsInstance(router.accepted_ports[1], PortRange)
+        self.assertIs(router.rejected_ports, None)
+        router.policy = 'reject 1-65535'.split()
+        self.assertIs(router.accepted_ports, None)
+        self.assertEqual(len(router.rejected_ports), 1)
+        self.assertFalse(router.accepts_port(443))
+
+    def test_index(self):
+        web = _exit('web', 'accept 80,443')
+        most = _exit('most', 'reject 25,119,135-139')
+        web2 = _exit('web2', 'accept 80,443')
+        none = _exit('none', 'reject 1-65535')
+        index = ExitPolicyIndex([web, most, web2, none, _exit('unknown', None)])
+        self.assertEqual(index.routers, [web, most, web2, none])
+
+        self.assertEqual(index.routers_accepting(80), {web, web2, most})
+        self.assertEqual(index.routers_accepting(22), {most})
+        self.assertEqual(index.routers_accepting(25), set())
+        self.assertEqual(index.routers_accepting(65535), {most})
+        self.assertEqual(index.routers_accepting(443, 22), {most})
+        self.assertEqual(index.routers_accepting(), {web, most, web2, none})
+        self.assertEqual(index.routers_for_bits(index.bits_for_port(443)), {web, web2, most})
+        with self.assertRaises(ValueError):
+            index.bits_for_port(65536)
+
+    def test_index_agrees_with_accepts_port(self):
+        routers = [
+            _exit('a', 'accept 20-23,43,53,79-81,88,110,143,194,220,389,443,464-465'),
+            _exit('b', 'reject 25,119,135-139,445,563,1214,4661-4666,6346-6429'),
+            _exit('c', 'accept 1-65535'),
+            _exit('d', 'reject 1-65535'),
+            _exit('e', 'accept 443,8443'),
+        ]
+        index = ExitPolicyIndex(routers)
+        for port in range(0, 65536, 7):
+            self.assertEqual(
+                index.routers_accepting(port),
+                set(r for r in routers if r.accepts_port(port)),
+            )
@@ -0,0 +1,130 @@
+from unittest.mock import patch
+
+from twisted.trial import unittest
+
+from txtorcon import routertable
+from txtorcon.routertable import RouterTable, known_country
+from txtorcon.testutil import fake_router
+
+
+class _QueryTests(object):
+    """
+    Run against the NumPy columns and against the plain arrays.
+    """
+
+    def setUp(self):
+        self.routers = [
+            fake_router('a', '192.0.2.1', 'Exit Fast Stable Valid', 5000, country='DE'),
+            fake_router('b', '192.0.2.2', 'Fast Stable Valid', 9000, country='DE'),
+            fake_router('c', '198.51.100.7', 'Exit Fast Stable Guard', 7000, country='NL'),
+            fake_router('d', '203.0.113.9', 'Exit Fast', 8000, country='US'),
+            fake_router('e', 'unknown', 'Exit Fast Stable', 100),
+        ]
+        self.table = RouterTable(self.routers)
+
+    def names(self, routers):
+        return [router.name for router in routers]
+
+    def test_columns(self):
+        self.assertEqual(len(self.table), 5)
+        self.assertEqual(list(self.table.bandwidth), [5000, 9000, 7000, 8000, 100])
+        self.assertEqual(self.table.ipv4[0], 0xc0000201)
+        self.assertEqual(self.table.ipv4[4], 0)
+        self.assertEqual(list(self.table.or_port), [9001] * 5)
+        self.assertEqual(list(self.table.dir_port), [0] * 5)
+        self.assertEqual(self.table.flags[3], self.routers[3].flag_bits)
+        self.assertEqual(
+            [self.table.countries[c] for c in self.table.country],
+            ['DE', 'DE', 'NL', 'US', None],
+        )
+
+    def test_select_everything(self):
+        self.assertEqual(self.names(self.table.select()), ['a', 'b', 'c', 'd', 'e'])
+
+    def test_select_flags(self):
+        self.assertEqual(
+            self.names(self.table.select(flags=['exit', 'Stable'])),
+            ['a', 'c', 'e'],
+        )
+        self.assertEqual(self.table.select(flags=['authority']), [])
+
+    def test_select_countries(self):
+        self.assertEqual(self.names(self.table.select(countries=['de', 'US'])), ['a', 'b', 'd'])
+        self.assertEqual(self.table.select(countries=['FR']), [])
+
+    def test_select_everything_at_once(self):
+        found = self.table.select(
+            flags=['Fast', 'Stable'], countries=['DE', 'NL'], min_bandwidth=6000,
+        )
+        self.assertEqual(self.names(found), ['b', 'c'])
+        self.assertIs(found[0], self.routers[1])
+
+    def test_select_network(self):
+        self.assertEqual(self.names(self.table.select(network='192.0.2.0/24')), ['a', 'b'])
+        self.assertEqual(
+            self.names(self.table.select(network='192.0.2.0/24', flags=['exit'])),
+            ['a'],
+        )
+
+    def test_select_by_bandwidth(self):
+        self.assertEqual(
+            self.names(self.table.select(flags=['exit'], by_bandwidth=True)),
+            ['d', 'c', 'a', 'e'],
+        )
+
+    def test_top(self):
+        self.assertEqual(self.names(self.table.top(2)), ['b', 'd'])
+        self.assertEqual(self.names(self.table.top(2, flags=['stable'])), ['b', 'c'])
+        self.assertEqual(self.names(self.table.top(10, countries=['NL'])), ['c'])
+        self.assertEqual(self.table.top(3, countries=['FR']), [])
+
+    def test_top_counts(self):
+        by_bandwidth = ['b', 'd', 'c', 'a', 'e']
+        for count in range(-1, 8):
+            self.assertEqual(
+                self.names(self.table.top(count)),
+                by_bandwidth[:max(count, 0)],
+            )
+        # exactly as many as match, and one fewer
+        self.assertEqual(self.names(self.table.top(3, flags=['stable', 'exit'])), ['c', 'a', 'e'])
+        self.assertEqual(self.names(self.table.top(2, flags=['stable', 'exit'])), ['c', 'a'])
+        self.assertEqual(self.table.top(0, flags=['exit']), [])
+
+    def test_empty(self):
+        table = RouterTable([])
+        self.assertEqual(table.select(flags=['exit']), [])
+        self.assertEqual(table.top(5), [])
+        self.assertEqual(table.top(0), [])
+
+
+class PythonQueryTests(_QueryTests, unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(routertable, 'numpy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super(PythonQueryTests, self).setUp()
+
+
+class NumpyQueryTests(_QueryTests, unittest.TestCase):
+    if routertable.numpy is None:
+        skip = "NumPy isn't installed"
+
+
+class CountryTests(unittest.TestCase):
+
+    def test_known(self):
+        router = fake_router('a', '192.0.2.1', 'Fast', 10, country='SE')
+        self.assertEqual(known_country(router), 'SE')
+
+    def test_unknown_without_geoip(self):
+        router = fake_router('a', '192.0.2.1', 'Fast', 10)
+        with patch('txtorcon.util.city', None), patch('txtorcon.util.country', None):
+            self.assertEqual(known_country(router), None)
+        # and we didn't ask Tor
+        self.assertEqual(router._location, None)
+
+    def test_country_of(self):
+        routers = [fake_router('a', '192.0.2.1', 'Fast', 10), fake_router('b', '192.0.2.2', 'Fast', 10)]
+        table = RouterTable(routers, country_of=lambda router: 'ch' if router.name == 'b' else None)
+        self.assertEqual(table.select(countries=['CH']), [routers[1]])
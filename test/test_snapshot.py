@@ -0,0 +1,260 @@
+import os
+import tempfile
+
+from twisted.trial import unittest
+
+from txtorcon import TorState, RouterListenerMixin
+from txtorcon.testutil import FakeControlProtocol, fake_router
+from txtorcon.snapshot import dumps, parse_snapshot, load_snapshot, write_snapshot
+
+from .test_torstate import ThreadlessReactor
+
+
+CONSENSUS = '\r\n'.join([
+    'ns/all=',
+    'r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 11.11.11.11 443 80',
+    'a [2001:db8::1]:443',
+    's Exit Fast Guard HSDir Named Running Stable V2Dir Valid',
+    'w Bandwidth=518000',
+    'r ekaf foooooooooooooooooooooooooo barbarbarbarbarbarbarbarbar 2011-11-11 16:30:00 22.22.22.22 9001 0',
+    's Fast Running Valid',
+    'w Bandwidth=12',
+    '.',
+])
+
+NEWER_CONSENSUS = '\r\n'.join([
+    'ns/all=',
+    'r ekaf foooooooooooooooooooooooooo barbarbarbarbarbarbarbarbar 2011-11-12 16:30:00 22.22.22.23 9001 0',
+    's Fast Running Stable Valid',
+    'w Bandwidth=13',
+    '.',
+])
+
+VALID_AFTER = 'consensus/valid-after=2011-12-12 17:00:00'
+NEWER_VALID_AFTER = 'consensus/valid-after=2011-12-12 18:00:00'
+
+
+def _bootstrap_answers(consensus=None):
+    answers = [] if consensus is None else [consensus]
+    return answers + [
+        '',  # circuit-status
+        '',  # stream-status
+        '',  # address-mappings/all
+        '',  # entry-guards
+        '',  # process/pid
+    ]
+
+
+class SnapshotFormatTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        routers = [
+            fake_router('fake', '11.11.11.11', 'Guard Fast Valid', 518000,
+                        idhash='YkkmgCNRV1/35OPWDvo7+1bmfoo', ip_v6=['[2001:db8::1]:443']),
+            fake_router('ekaf', '22.22.22.22', '', 12),
+        ]
+        routers[0].policy = 'accept 80,443,6660-6669'.split()
+        snap = parse_snapshot(dumps('0.4.8.9', '2011-12-12 17:00:00', routers))
+        self.assertEqual(snap.tor_version, '0.4.8.9')
+        self.assertEqual(snap.valid_after, '2011-12-12 17:00:00')
+        fake, ekaf = snap.routers
+        self.assertEqual(
+            (fake.name, fake.id_hash, fake.or_hash, fake._modified_unparsed, fake.ip,
+             fake.or_port, fake.dir_port, fake.flags, fake.bandwidth, fake.ip_v6, fake.policy),
+            ('fake', 'YkkmgCNRV1/35OPWDvo7+1bmfoo', 'MAANkj30tnFvmoh7FsjVFr+cmcs',
+             '2011-12-16 15:11:34', '11.11.11.11', '9001', '0', ['fast', 'guard', 'valid'],
+             518000, ['[2001:db8::1]:443'], 'accept 80,443,6660-6669'),
+        )
+        self.assertTrue(fake.from_consensus)
+        self.assertIs(fake.controller, None)
+        self.assertEqual(ekaf.flags, [])
+        self.assertEqual(ekaf.ip_v6, [])
+        self.assertEqual(ekaf.policy, '')
+        self.assertIs(ekaf.port_ranges, None)
+
+    def test_shared_tables(self):
+        routers = [
+            fake_router('relay{}'.format(i), '11.11.11.11', 'Named Running' if i % 2 else 'Fast', 1)
+            for i in range(4)
+        ]
+        for router in routers:
+            router.policy = 'reject 25,6660-6669'.split()
+        snap = parse_snapshot(dumps('0.4.8.9', 'now', routers))
+        self.assertEqual([router.flags for router in snap.routers],
+                         [['fast'], ['named', 'running']] * 2)
+        self.assertEqual([router.name_is_unique for router in snap.routers], [False, True] * 2)
+        self.assertIs(snap.routers[0].port_ranges, snap.routers[3].port_ranges)
+        self.assertFalse(snap.routers[1].accepts_port(6665))
+        self.assertTrue(snap.routers[1].accepts_port(80))
+
+    def test_empty(self):
+        snap = parse_snapshot(dumps('0.4.8.9', '', []))
+        self.assertEqual(snap.routers, [])
+
+    def test_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'routers')
+        write_snapshot(path, '0.4.8.9', 'now', [])
+        self.assertEqual(load_snapshot(path).valid_after, 'now')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['routers'])
+
+    def test_parse_errors(self):
+        with self.assertRaises(ValueError):
+            parse_snapshot(b'something else')
+        with self.assertRaises(ValueError):
+            parse_snapshot(b'TXTORSNP\x09')
+        router = fake_router('fake', '11.11.11.11', '', 1)
+        data = dumps('0.4.8.9', 'now', [router])
+        for cut in (1, 13, len(data) - 20):
+            with self.assertRaises(ValueError):
+                parse_snapshot(data[:-cut])
+        with self.assertRaises(ValueError):
+            parse_snapshot(data + b'\x00')
+
+
+class TorStateSnapshotTests(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'routers')
+
+    def _state(self, answers, reactor=None):
+        protocol = FakeControlProtocol(answers)
+        protocol.version = '0.4.8.9'
+        if reactor is None:
+            reactor = ThreadlessReactor()
+        state = TorState(protocol, snapshot_path=self.path, reactor=reactor)
+        self.assertIs(self.successResultOf(state.post_bootstrap), state)
+        self.successResultOf(state._snapshot_check)
+        return state, protocol
+
+    def test_no_snapshot(self):
+        state, protocol = self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        self.assertEqual(len(state.routers_by_hash), 2)
+
+        snap = load_snapshot(self.path)
+        self.assertEqual(snap.tor_version, '0.4.8.9')
+        self.assertEqual(snap.valid_after, '2011-12-12 17:00:00')
+        self.assertEqual(
+            sorted(router.name for router in snap.routers),
+            ['ekaf', 'fake'],
+        )
+
+    def test_current_snapshot(self):
+        self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+
+        # no ns/all at all this time
+        state, protocol = self._state(_bootstrap_answers() + [VALID_AFTER])
+        self.assertEqual(protocol.answers, [])
+        self.assertEqual(len(state.routers_by_hash), 2)
+        fake = state.routers['fake']
+        self.assertEqual(fake.ip, '11.11.11.11')
+        self.assertEqual(fake.or_port, '443')
+        self.assertEqual(fake.bandwidth, 518000)
+        self.assertEqual(fake.ip_v6, ['[2001:db8::1]:443'])
+        self.assertIn('guard', fake.flags)
+        self.assertIn(fake.id_hex, state.guards)
+        self.assertTrue(fake.from_consensus)
+        self.assertEqual(state.routers['ekaf'].dir_port, '0')
+
+    def test_stale_snapshot(self):
+        self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+
+        state, protocol = self._state(
+            _bootstrap_answers() + [
+                NEWER_VALID_AFTER,
+                NEWER_CONSENSUS,
+                NEWER_VALID_AFTER,  # asked again when saving
+            ]
+        )
+        self.assertEqual(protocol.answers, [])
+        self.assertEqual(list(state.routers_by_name), ['ekaf'])
+        self.assertEqual(state.routers['ekaf'].ip, '22.22.22.23')
+
+        snap = load_snapshot(self.path)
+        self.assertEqual(snap.valid_after, '2011-12-12 18:00:00')
+        self.assertEqual(len(snap.routers), 1)
+
+    def test_stale_snapshot_queued(self):
+        self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+
+        reactor = ThreadlessReactor()
+        protocol = FakeControlProtocol(_bootstrap_answers() + [NEWER_VALID_AFTER])
+        protocol.version = '0.4.8.9'
+        state = TorState(protocol, snapshot_path=self.path, reactor=reactor)
+        self.successResultOf(state.post_bootstrap)
+
+        # a NEWCONSENSUS is being processed when ns/all arrives
+        reactor.held = []
+        state._network_status_event(CONSENSUS.replace('\r\n', '\n').replace('443 80', '443 81'))
+        protocol.answer_pending(NEWER_CONSENSUS)
+        self.successResultOf(state._snapshot_check)
+        self.assertEqual(sorted(state.routers_by_name), ['ekaf', 'fake'])
+        self.assertEqual(state.routers['fake'].dir_port, '80')
+
+        # ... and is installed after it, not overwritten by it
+        held, reactor.held = reactor.held, None
+        held.pop()()
+        self.assertEqual(held, [])
+        self.assertEqual(list(state.routers_by_name), ['ekaf'])
+        self.assertEqual(state.routers['ekaf'].ip, '22.22.22.23')
+
+    def test_written_in_thread(self):
+        reactor = ThreadlessReactor()
+        reactor.held = []
+        protocol = FakeControlProtocol(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        protocol.version = '0.4.8.9'
+        state = TorState(protocol, snapshot_path=self.path, reactor=reactor)
+        self.successResultOf(state.post_bootstrap)
+        self.assertNoResult(state._snapshot_check)
+        self.assertFalse(os.path.exists(self.path))
+
+        # a NEWCONSENSUS isn't installed while the snapshot is written
+        protocol.answers = [NEWER_VALID_AFTER]
+        state._network_status_event(NEWER_CONSENSUS.replace('\r\n', '\n'))
+        write, parse = reactor.held
+        reactor.held = None
+        parse()
+        reactor.advance(0)
+        self.assertEqual(sorted(state.routers_by_name), ['ekaf', 'fake'])
+
+        write()
+        self.successResultOf(state._snapshot_check)
+        self.assertEqual(list(state.routers_by_name), ['ekaf'])
+        self.assertEqual(protocol.answers, [])
+        self.assertEqual(load_snapshot(self.path).valid_after, '2011-12-12 18:00:00')
+
+    def test_same_consensus_unchanged(self):
+        self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        state, protocol = self._state(_bootstrap_answers() + [VALID_AFTER])
+
+        changes = []
+        listener = RouterListenerMixin()
+        listener.router_changed = changes.append
+        state.add_router_listener(listener)
+        protocol.answers = [VALID_AFTER]
+        state._update_network_status(CONSENSUS.replace('\r\n', '\n'))
+        self.assertEqual(changes, [])
+
+    def test_other_tor_version(self):
+        write_snapshot(self.path, '0.3.5.1', '2011-12-12 17:00:00', [])
+        state, protocol = self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        self.assertEqual(len(state.routers_by_hash), 2)
+        self.assertEqual(load_snapshot(self.path).tor_version, '0.4.8.9')
+
+    def test_corrupt_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'TXTORSNP\x01garbage')
+        state, protocol = self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        self.assertEqual(len(state.routers_by_hash), 2)
+        self.assertEqual(len(load_snapshot(self.path).routers), 2)
+
+    def test_write_failure_ignored(self):
+        self.path = os.path.join(self.path, 'missing', 'routers')
+        state, protocol = self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        self.assertEqual(len(state.routers_by_hash), 2)
+
+    def test_new_consensus_saved(self):
+        state, protocol = self._state(_bootstrap_answers(CONSENSUS) + [VALID_AFTER])
+        protocol.answers = [NEWER_VALID_AFTER]
+        state._update_network_status(NEWER_CONSENSUS.replace('\r\n', '\n'))
+        self.assertEqual(protocol.answers, [])
+        self.assertEqual(load_snapshot(self.path).valid_after, '2011-12-12 18:00:00')
@@ -797,6 +797,15 @@ class EventTests(unittest.TestCase):
         self.assertEqual(config.Foo, 'bar')
         self.assertEqual(config.Bar, DEFAULT_VALUE)
 
+    def test_conf_changed_quoted(self):
+        control = FakeControlProtocol([])
+        config = TorConfig(control)
+
+        control.events['CONF_CHANGED']('Nickname="foo"\nContactInfo="a b"\nMyFamily')
+        self.assertEqual(config.Nickname, 'foo')
+        self.assertEqual(config.ContactInfo, 'a b')
+        self.assertEqual(config.MyFamily, DEFAULT_VALUE)
+
     def test_conf_changed_parsed(self):
         '''
         Create a configuration which holds boolean types. These types
@@ -4,10 +4,13 @@ from twisted.python import log, failure
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 from twisted.internet import defer, error
+from twisted.internet.task import Clock
 
 from txtorcon import TorControlProtocol, TorProtocolFactory, TorState
+from txtorcon import TorProtocolError
 from txtorcon import ITorControlProtocol
 from txtorcon.torcontrolprotocol import parse_keywords, DEFAULT_VALUE
+from txtorcon.torcontrolprotocol import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
 from txtorcon.util import hmac_sha256
 
 import functools
@@ -322,50 +325,104 @@ class ProtocolTests(unittest.TestCase):
         assert isinstance(line, bytes)
         self.protocol.dataReceived(line.strip() + b"\r\n")
 
-    def test_statemachine_broadcast_no_code(self):
+    def test_statemachine_broadcast_bare_code(self):
         try:
-            self.protocol._broadcast_response("foo")
+            self.protocol.lineReceived(b"250")
             self.fail()
         except RuntimeError as e:
-            self.assertTrue('No code set yet' in str(e))
+            self.assertTrue("didn't issue a command" in str(e))
 
     def test_statemachine_broadcast_unknown_code(self):
         try:
-            self.protocol.code = 999
-            self.protocol._broadcast_response("foo")
+            self.protocol.lineReceived(b"999 foo")
             self.fail()
         except RuntimeError as e:
             self.assertTrue('Unknown code' in str(e))
 
-    def test_statemachine_is_finish(self):
-        self.assertTrue(not self.protocol._is_finish_line(''))
-        self.assertTrue(self.protocol._is_finish_line('.'))
-        self.assertTrue(self.protocol._is_finish_line('300 '))
-        self.assertTrue(not self.protocol._is_finish_line('250-'))
+    def test_framer_not_a_status_code(self):
+        with self.assertRaises(RuntimeError) as ctx:
+            self.protocol.lineReceived(b'foo')
+        self.assertTrue('Expected a status code' in str(ctx.exception))
 
-    def test_statemachine_singleline(self):
-        self.assertTrue(not self.protocol._is_single_line_response('foo'))
+    def test_framer_bad_separator(self):
+        self.protocol.queue_command("GETINFO foo")
+        with self.assertRaises(RuntimeError) as ctx:
+            self.protocol.lineReceived(b'250*foo')
+        self.assertTrue('Unexpected separator' in str(ctx.exception))
 
-    def test_statemachine_continuation(self):
-        try:
-            self.protocol.code = 250
-            self.protocol._is_continuation_line("123 ")
-            self.fail()
-        except RuntimeError as e:
-            self.assertTrue('Unexpected code' in str(e))
+    def test_framer_continuation_wrong_code(self):
+        self.protocol.queue_command("GETINFO foo")
+        self.protocol.lineReceived(b'250-foo=bar')
+        with self.assertRaises(RuntimeError) as ctx:
+            self.protocol.lineReceived(b'123-baz')
+        self.assertTrue('Unexpected code' in str(ctx.exception))
 
-    def test_statemachine_multiline(self):
-        try:
-            self.protocol.code = 250
-            self.protocol._is_multi_line("123 ")
-            self.fail()
-        except RuntimeError as e:
-            self.assertTrue('Unexpected code' in str(e))
+    def test_framer_final_line_wrong_code(self):
+        self.protocol.queue_command("GETINFO foo")
+        self.protocol.lineReceived(b'250-foo=bar')
+        with self.assertRaises(RuntimeError) as ctx:
+            self.protocol.lineReceived(b'123 ')
+        self.assertTrue('Unexpected code' in str(ctx.exception))
+
+    def test_framer_data_block_verbatim(self):
+        d = self.protocol.get_info_raw("foo")
+        d.addCallback(self.assertEqual, "foo=\n250 not a status\n..dot")
+        self.send(b"250+foo=")
+        self.send(b"250 not a status")
+        self.send(b"..dot")
+        self.send(b".")
+        self.send(b"250 OK")
+        return d
+
+    def test_framer_bare_code(self):
+        d = self.protocol.queue_command("FOO")
+        d.addCallback(self.assertEqual, "")
+        self.protocol.lineReceived(b'250')
+        return d
+
+    def test_framer_bare_code_after_continuation(self):
+        d = self.protocol.get_info_raw("foo")
+        d.addCallback(self.assertEqual, "foo=bar\nbaz\n")
+        self.send(b"250-foo=bar")
+        self.send(b"250-baz")
+        self.protocol.lineReceived(b'250')
+        return d
+
+    def test_large_reply(self):
+        lines = [u"line {}".format(x) for x in range(10000)]
+        d = self.protocol.get_info_raw("foo")
+        d.addCallback(self.assertEqual, u"foo=\n" + u"\n".join(lines))
+        self.send(b"250+foo=")
+        for line in lines:
+            self.protocol.lineReceived(line.encode('ascii'))
+        self.send(b".")
+        self.send(b"250 OK")
+        return d
+
+    def test_framer_event_during_incremental(self):
+        lines = []
+        self.protocol._set_valid_events('CIRC')
+        self.protocol.add_event_listener('CIRC', lambda _: None)
+        self.send(b"250 OK")
+
+        d = self.protocol.get_info_incremental("foo", lines.append)
+        self.send(b"650-CIRC 1000 EXTENDED moria1,moria2")
+        self.send(b"650 EXTRAMAGIC=99")
+        self.send(b"250-foo=bar")
+        self.send(b"250 OK")
+        self.assertEqual(lines, ["foo=bar"])
+        return d
+
+    def test_no_debug_writes(self):
+        writes = []
+        self.protocol.debuglog.write = writes.append
+        self.protocol.queue_command("FOO")
+        self.send(b"250 OK")
+        self.assertEqual(writes, [])
 
     def test_response_with_no_request(self):
         with self.assertRaises(RuntimeError) as ctx:
-            self.protocol.code = 200
-            self.protocol._broadcast_response('200 OK')
+            self.protocol.lineReceived(b'200 OK')
         self.assertTrue(
             "didn't issue a command" in str(ctx.exception)
         )
@@ -1086,6 +1143,491 @@ p accept 43,53,79-81,110,143,194,220,443,953,989-990,993,995,1194,1293,1723,1863
         self.protocol.lineReceived(b"650 OK\r\n")
 
 
+class PipelineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol(max_in_flight=3)
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        assert isinstance(line, bytes)
+        self.protocol.dataReceived(line.strip() + b"\r\n")
+
+    def test_invalid_window(self):
+        with self.assertRaises(ValueError):
+            TorControlProtocol(max_in_flight=0)
+
+    def test_factory_passes_window(self):
+        proto = TorProtocolFactory(max_in_flight=5).buildProtocol(None)
+        self.assertEqual(5, proto.max_in_flight)
+
+    def test_window_limits_writes(self):
+        for x in range(5):
+            self.protocol.queue_command("GETINFO key{}".format(x))
+        self.assertEqual(
+            self.transport.value(),
+            b"GETINFO key0\r\nGETINFO key1\r\nGETINFO key2\r\n",
+        )
+        self.assertEqual(2, len(self.protocol.commands))
+
+        self.transport.clear()
+        self.send(b"250 key0=zero")
+        self.assertEqual(self.transport.value(), b"GETINFO key3\r\n")
+
+    def test_replies_matched_in_order(self):
+        results = []
+        d0 = self.protocol.get_info("a")
+        d1 = self.protocol.get_info_raw("b")
+        d2 = self.protocol.get_conf("c")
+        d0.addCallback(results.append)
+        d1.addCallback(results.append)
+        d2.addCallback(results.append)
+
+        self.send(b"250-a=one")
+        self.send(b"250 OK")
+        self.send(b"650 CIRC 1000 EXTENDED moria1,moria2")
+        self.send(b"250+b=")
+        self.send(b"two")
+        self.send(b".")
+        self.send(b"250 OK")
+        self.send(b"250 c=three")
+
+        self.assertEqual(
+            results,
+            [{'a': 'one'}, 'b=\ntwo', {'c': 'three'}],
+        )
+        self.assertEqual(None, self.protocol.command)
+        self.assertEqual(None, self.protocol.defer)
+
+    def test_error_reply_in_pipeline(self):
+        d0 = self.protocol.get_info_raw("a")
+        d1 = self.protocol.get_info_raw("b")
+        self.send(b'552 Unrecognized key "a"')
+        self.send(b"250 b=two")
+        self.assertFailure(d0, TorProtocolError)
+        d1.addCallback(self.assertEqual, "b=two")
+        return defer.gatherResults([d0, d1])
+
+    def test_raise_window_at_runtime(self):
+        self.protocol.max_in_flight = 1
+        self.protocol.queue_command("ONE")
+        self.protocol.queue_command("TWO")
+        self.protocol.queue_command("THREE")
+        self.assertEqual(self.transport.value(), b"ONE\r\n")
+        self.protocol.max_in_flight = 3
+        self.send(b"250 OK")
+        self.assertEqual(
+            self.transport.value(),
+            b"ONE\r\nTWO\r\nTHREE\r\n",
+        )
+
+    def test_disconnect_errbacks_in_flight(self):
+        failures = []
+        for x in range(5):
+            d = self.protocol.queue_command("CMD{}".format(x))
+            d.addErrback(failures.append)
+        self.protocol.connectionLost(
+            failure.Failure(error.ConnectionLost("gone"))
+        )
+        self.assertEqual(5, len(failures))
+        self.assertEqual(0, len(self.protocol.commands))
+        self.assertEqual(None, self.protocol.command)
+
+
+class PriorityTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+        self.now = 0.0
+        self.protocol._now = lambda: self.now
+
+    def send(self, line):
+        self.protocol.dataReceived(line + b"\r\n")
+
+    def written(self):
+        data = self.transport.value()
+        self.transport.clear()
+        return data
+
+    def test_default_fifo(self):
+        self.protocol.get_info_raw('ns/all')
+        self.protocol.get_conf('SocksPort')
+        self.protocol.queue_command('CLOSECIRCUIT 5')
+        self.protocol.queue_command('EXTENDCIRCUIT 0')
+        self.protocol.get_info_raw('md/all')
+        self.protocol.queue_command('ATTACHSTREAM 1 2')
+        self.protocol.queue_command('SETCIRCUITPURPOSE 6 purpose=controller')
+        self.assertEqual(self.written(), b'GETINFO ns/all\r\n')
+        self.assertEqual(
+            [cmd for _, cmd, _ in self.protocol.commands],
+            [b'GETCONF SocksPort', b'CLOSECIRCUIT 5', b'EXTENDCIRCUIT 0', b'GETINFO md/all',
+             b'ATTACHSTREAM 1 2', b'SETCIRCUITPURPOSE 6 purpose=controller'],
+        )
+
+    def test_attach_jumps_bulk(self):
+        self.protocol.queue_command('GETINFO ns/all', priority=PRIORITY_BULK)
+        self.protocol.queue_command('GETCONF SocksPort', priority=PRIORITY_BULK)
+        self.protocol.queue_command('GETCONF ORPort', priority=PRIORITY_BULK)
+        self.protocol.get_info_raw('version')
+        self.protocol.queue_command('ATTACHSTREAM 1 2', priority=PRIORITY_HIGH)
+        self.assertEqual(self.written(), b'GETINFO ns/all\r\n')
+        self.assertEqual(
+            [cmd for _, cmd, _ in self.protocol.commands],
+            [b'ATTACHSTREAM 1 2', b'GETINFO version', b'GETCONF SocksPort', b'GETCONF ORPort'],
+        )
+
+        self.send(b'250 OK')
+        self.assertEqual(self.written(), b'ATTACHSTREAM 1 2\r\n')
+        self.send(b'250 OK')
+        self.assertEqual(self.written(), b'GETINFO version\r\n')
+
+    def test_query_priority(self):
+        self.protocol.queue_command('SIGNAL NEWNYM')
+        self.protocol.get_info_raw('ns/all', priority=PRIORITY_BULK)
+        self.protocol.get_info_incremental('md/all', lambda line: None, priority=PRIORITY_BULK)
+        self.protocol.get_conf('SocksPort', priority=PRIORITY_BULK)
+        self.protocol.get_conf_raw('ORPort', priority=PRIORITY_BULK)
+        self.protocol.get_info('version', priority=PRIORITY_HIGH)
+        self.assertEqual(
+            [cmd for _, cmd, _ in self.protocol.commands],
+            [b'GETINFO version', b'GETINFO ns/all', b'GETINFO md/all',
+             b'GETCONF SocksPort', b'GETCONF ORPort'],
+        )
+
+    def test_explicit_priority(self):
+        self.protocol.queue_command('SIGNAL NEWNYM')
+        self.protocol.queue_command('GETINFO a', priority=PRIORITY_BULK)
+        self.protocol.queue_command('GETINFO b', priority=PRIORITY_NORMAL)
+        self.protocol.queue_command('ATTACHSTREAM 1 2', priority=PRIORITY_BULK)
+        self.protocol.queue_command('GETINFO c', priority=PRIORITY_HIGH)
+        self.assertEqual(
+            [cmd for _, cmd, _ in self.protocol.commands],
+            [b'GETINFO c', b'GETINFO b', b'GETINFO a', b'ATTACHSTREAM 1 2'],
+        )
+
+    def test_bad_priority(self):
+        with self.assertRaises(ValueError):
+            self.protocol.queue_command('GETINFO a', priority=7)
+
+    def test_wait_stats(self):
+        self.protocol.queue_command('GETINFO ns/all', priority=PRIORITY_BULK)
+        self.protocol.queue_command('GETINFO md/all', priority=PRIORITY_BULK)
+        self.protocol.queue_command('CLOSECIRCUIT 5', priority=PRIORITY_HIGH)
+        self.now = 2.0
+        self.send(b'250 OK')
+        self.now = 3.0
+        self.send(b'250 OK')
+
+        stats = self.protocol.queue_wait_stats()
+        self.assertEqual(
+            stats[PRIORITY_HIGH],
+            {'written': 1, 'mean_wait': 2.0, 'max_wait': 2.0, 'queued': 0},
+        )
+        self.assertEqual(
+            stats[PRIORITY_BULK],
+            {'written': 2, 'mean_wait': 1.5, 'max_wait': 3.0, 'queued': 0},
+        )
+        self.assertEqual(stats[PRIORITY_NORMAL]['written'], 0)
+        self.assertEqual(stats[PRIORITY_NORMAL]['mean_wait'], 0.0)
+
+    def test_disconnect_errbacks_all_lanes(self):
+        failures = []
+        for cmd in ('GETINFO version', 'GETINFO ns/all', 'ATTACHSTREAM 1 0', 'GETCONF a'):
+            self.protocol.queue_command(cmd).addErrback(failures.append)
+        self.protocol.connectionLost(failure.Failure(error.ConnectionLost("gone")))
+        self.assertEqual(4, len(failures))
+        self.assertEqual([], self.protocol.commands)
+
+
+class BatchQueryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.protocol = TorControlProtocol(batch_queries=True, reactor=self.clock)
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        self.protocol.dataReceived(line + b"\r\n")
+
+    def written(self):
+        data = self.transport.value()
+        self.transport.clear()
+        return data
+
+    def test_factory(self):
+        proto = TorProtocolFactory(batch_queries=True).buildProtocol(None)
+        self.assertTrue(proto.batch_queries)
+        self.assertFalse(TorControlProtocol().batch_queries)
+
+    def test_get_info_same_turn(self):
+        d0 = self.protocol.get_info('version', 'process/pid')
+        d1 = self.protocol.get_info_single('version')
+        d2 = self.protocol.get_info('net/listeners/socks')
+        self.assertEqual(self.written(), b'')
+
+        self.clock.advance(0)
+        self.assertEqual(
+            self.written(),
+            b'GETINFO version process/pid net/listeners/socks\r\n',
+        )
+        self.send(b'250-version=0.4.8.9')
+        self.send(b'250-process/pid=1234')
+        self.send(b'250-net/listeners/socks="127.0.0.1:9050"')
+        self.send(b'250 OK')
+        self.assertEqual(
+            self.successResultOf(d0),
+            {'version': '0.4.8.9', 'process/pid': '1234'},
+        )
+        self.assertEqual(self.successResultOf(d1), '0.4.8.9')
+        self.assertEqual(
+            self.successResultOf(d2),
+            {'net/listeners/socks': '127.0.0.1:9050'},
+        )
+
+    def test_get_info_multiline(self):
+        d0 = self.protocol.get_info('config-text')
+        d1 = self.protocol.get_info('version')
+        self.clock.advance(0)
+        self.assertEqual(self.written(), b'GETINFO config-text version\r\n')
+        self.send(b'250+config-text=')
+        self.send(b'SocksPort 9050')
+        self.send(b'ControlPort 9051')
+        self.send(b'.')
+        self.send(b'250-version=0.4.8.9')
+        self.send(b'250 OK')
+        self.assertEqual(
+            self.successResultOf(d0),
+            {'config-text': '\nSocksPort 9050\nControlPort 9051'},
+        )
+        self.assertEqual(self.successResultOf(d1), {'version': '0.4.8.9'})
+
+    def test_next_turn_is_new_batch(self):
+        self.protocol.get_info('a')
+        self.clock.advance(0)
+        self.protocol.get_info('b')
+        self.protocol.get_info('c')
+        self.clock.advance(0)
+        self.assertEqual(self.written(), b'GETINFO a\r\n')
+        self.send(b'250 a=1')
+        self.assertEqual(self.written(), b'GETINFO b c\r\n')
+
+    def test_get_conf(self):
+        d0 = self.protocol.get_conf('SOCKSPORT')
+        d1 = self.protocol.get_conf_single('MyFamily')
+        d2 = self.protocol.get_conf('HiddenServicePort', 'ORPort')
+        self.clock.advance(0)
+        self.assertEqual(
+            self.written(),
+            b'GETCONF SOCKSPORT MyFamily HiddenServicePort ORPort\r\n',
+        )
+        self.send(b'250-SocksPort=9050')
+        self.send(b'250-MyFamily')
+        self.send(b'250-HiddenServicePort=80 127.0.0.1:80')
+        self.send(b'250-HiddenServicePort=443 127.0.0.1:443')
+        self.send(b'250 ORPort=0')
+        self.assertEqual(self.successResultOf(d0), {'SocksPort': '9050'})
+        self.assertEqual(self.successResultOf(d1), DEFAULT_VALUE)
+        self.assertEqual(
+            self.successResultOf(d2),
+            {
+                'HiddenServicePort': ['80 127.0.0.1:80', '443 127.0.0.1:443'],
+                'ORPort': '0',
+            },
+        )
+
+    def test_get_conf_other_names(self):
+        d0 = self.protocol.get_conf('HiddenServiceOptions')
+        d1 = self.protocol.get_conf_single('SocksPort')
+        self.clock.advance(0)
+        self.assertEqual(self.written(), b'GETCONF HiddenServiceOptions SocksPort\r\n')
+        self.send(b'250-HiddenServiceDir=/tmp/hs')
+        self.send(b'250-HiddenServicePort=80 127.0.0.1:80')
+        self.send(b'250 SocksPort=9050')
+
+        # HiddenServiceOptions wasn't in the reply, so each is asked again
+        self.assertEqual(self.written(), b'GETCONF HiddenServiceOptions\r\n')
+        self.send(b'250-HiddenServiceDir=/tmp/hs')
+        self.send(b'250 HiddenServicePort=80 127.0.0.1:80')
+        self.assertEqual(self.written(), b'GETCONF SocksPort\r\n')
+        self.send(b'250 SocksPort=9050')
+
+        self.assertEqual(
+            self.successResultOf(d0),
+            {'HiddenServiceDir': '/tmp/hs', 'HiddenServicePort': '80 127.0.0.1:80'},
+        )
+        self.assertEqual(self.successResultOf(d1), '9050')
+
+    def test_get_conf_other_names_one_caller(self):
+        d = self.protocol.get_conf('HiddenServiceOptions')
+        self.clock.advance(0)
+        self.send(b'250-HiddenServiceDir=/tmp/hs')
+        self.send(b'250 HiddenServicePort=80 127.0.0.1:80')
+        self.assertEqual(self.written(), b'GETCONF HiddenServiceOptions\r\n')
+        self.assertEqual(
+            self.successResultOf(d),
+            {'HiddenServiceDir': '/tmp/hs', 'HiddenServicePort': '80 127.0.0.1:80'},
+        )
+
+    def test_get_conf_same_parser(self):
+        # a default value after a keyword isn't part of its value
+        reply = [b'250-HiddenServicePort=80 127.0.0.1:80', b'250-MyFamily', b'250 ORPort=0']
+        expected = {'HiddenServicePort': '80 127.0.0.1:80', 'MyFamily': DEFAULT_VALUE, 'ORPort': '0'}
+
+        self.protocol.batch_queries = False
+        d0 = self.protocol.get_conf('HiddenServicePort', 'MyFamily', 'ORPort')
+        for line in reply:
+            self.send(line)
+        self.assertEqual(self.successResultOf(d0), expected)
+
+        self.protocol.batch_queries = True
+        d1 = self.protocol.get_conf('HiddenServicePort', 'MyFamily', 'ORPort')
+        self.clock.advance(0)
+        for line in reply:
+            self.send(line)
+        self.assertEqual(self.successResultOf(d1), expected)
+
+    def test_failure_falls_back(self):
+        d0 = self.protocol.get_info('version')
+        d1 = self.protocol.get_info('bogus')
+        self.clock.advance(0)
+        self.assertEqual(self.written(), b'GETINFO version bogus\r\n')
+        self.send(b'552 Unrecognized key "bogus"')
+
+        self.assertEqual(self.written(), b'GETINFO version\r\n')
+        self.send(b'250 version=0.4.8.9')
+        self.assertEqual(self.written(), b'GETINFO bogus\r\n')
+        self.send(b'552 Unrecognized key "bogus"')
+
+        self.assertEqual(self.successResultOf(d0), {'version': '0.4.8.9'})
+        self.failureResultOf(d1, TorProtocolError)
+
+    def test_single_caller_failure(self):
+        d = self.protocol.get_info('bogus')
+        self.clock.advance(0)
+        self.send(b'552 Unrecognized key "bogus"')
+        self.assertEqual(self.written(), b'GETINFO bogus\r\n')
+        self.failureResultOf(d, TorProtocolError)
+
+    def test_bootstrap_one_round_trip(self):
+        self.protocol._bootstrap()
+        self.clock.advance(0)
+        self.assertEqual(
+            self.written(),
+            b'GETINFO signal/names version events/names\r\n',
+        )
+        self.send(b'250-signal/names=RELOAD NEWNYM')
+        self.send(b'250-version=0.4.8.9')
+        self.send(b'250-events/names=CIRC STREAM')
+        self.send(b'250 OK')
+        self.assertEqual(self.written(), b'USEFEATURE EXTENDED_EVENTS\r\n')
+        self.send(b'250 OK')
+        self.assertIs(self.successResultOf(self.protocol.post_bootstrap), self.protocol)
+        self.assertEqual(self.protocol.version, '0.4.8.9')
+        self.assertEqual(sorted(self.protocol.valid_events.keys()), ['CIRC', 'STREAM'])
+
+
+class GetInfoStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.protocol = TorControlProtocol()
+        self.protocol.connectionMade = lambda: None
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def send(self, line):
+        assert isinstance(line, bytes)
+        self.protocol.dataReceived(line.strip() + b"\r\n")
+
+    def _collect(self, stream):
+        async def consume():
+            return [item async for item in stream]
+        return defer.ensureDeferred(consume())
+
+    def test_lines(self):
+        d = self._collect(self.protocol.get_info_stream("ns/all"))
+        self.assertEqual(self.transport.value(), b"GETINFO ns/all\r\n")
+        self.send(b"250+ns/all=")
+        self.send(b"r foo")
+        self.send(b"s Fast")
+        self.send(b".")
+        self.send(b"250 OK")
+        d.addCallback(self.assertEqual, ["r foo", "s Fast"])
+        return d
+
+    def test_single_line_value(self):
+        d = self._collect(self.protocol.get_info_stream("version"))
+        self.send(b"250-version=0.4.8.1")
+        self.send(b"250 OK")
+        d.addCallback(self.assertEqual, ["0.4.8.1"])
+        return d
+
+    def test_batches(self):
+        stream = self.protocol.get_info_stream("ns/all", batch_size=2)
+        d = self._collect(stream)
+        self.send(b"250+ns/all=")
+        for x in range(5):
+            self.send("line{}".format(x).encode('ascii'))
+        self.send(b".")
+        self.send(b"250 OK")
+        d.addCallback(
+            self.assertEqual,
+            [["line0", "line1"], ["line2", "line3"], ["line4"]],
+        )
+        return d
+
+    def test_error(self):
+        d = self._collect(self.protocol.get_info_stream("bogus"))
+        self.send(b'552 Unrecognized key "bogus"')
+        return self.assertFailure(d, TorProtocolError)
+
+    def test_backpressure(self):
+        stream = self.protocol.get_info_stream("ns/all", max_buffered=4)
+        self.send(b"250+ns/all=")
+        for x in range(4):
+            self.send("line{}".format(x).encode('ascii'))
+        self.assertEqual('paused', self.transport.producerState)
+
+        # draining to half the buffer resumes the transport
+        items = []
+        stream.__anext__().addCallback(items.append)
+        self.assertEqual('paused', self.transport.producerState)
+        stream.__anext__().addCallback(items.append)
+        self.assertEqual('producing', self.transport.producerState)
+        self.assertEqual(["line0", "line1"], items)
+
+        self.send(b".")
+        self.send(b"250 OK")
+        d = self._collect(stream)
+        d.addCallback(self.assertEqual, ["line2", "line3"])
+        return d
+
+    def test_aclose(self):
+        stream = self.protocol.get_info_stream("ns/all", max_buffered=2)
+        self.send(b"250+ns/all=")
+        self.send(b"line0")
+        self.send(b"line1")
+        self.assertEqual('paused', self.transport.producerState)
+        stream.aclose()
+        self.assertEqual('producing', self.transport.producerState)
+        self.send(b"line2")
+        self.send(b".")
+        self.send(b"250 OK")
+        d = self._collect(stream)
+        d.addCallback(self.assertEqual, [])
+        return d
+
+    def test_invalid_buffer(self):
+        with self.assertRaises(ValueError):
+            self.protocol.get_info_stream("ns/all", max_buffered=0)
+
+
 class ParseTests(unittest.TestCase):
 
     def setUp(self):
@@ -1171,6 +1713,30 @@ OK
         x = parse_keywords('foo=')
         self.assertEqual(x, {'foo': ''})
 
+    def test_quoted_string_escapes(self):
+        x = parse_keywords(r'DataDirectory="/tmp/a \"b\"\\c"' + '\nNickname="foo"')
+        self.assertEqual(x, {'DataDirectory': '/tmp/a "b"\\c', 'Nickname': 'foo'})
+
+    def test_quoted_string_malformed(self):
+        # not a single QuotedString; just the outer quotes go
+        x = parse_keywords(r'foo="a" \"b"')
+        self.assertEqual(x, {'foo': r'a" \"b'})
+
+    def test_key_hints(self):
+        x = parse_keywords(
+            'config-text=SocksPort 9050\nControlPort=9051\nOK',
+            key_hints=['config-text'],
+        )
+        self.assertEqual(x, {'config-text': 'SocksPort 9050\nControlPort=9051'})
+
+    def test_multiline_keywords_disabled_quoted(self):
+        # until 24.8.0 this was {'Foo': '"c"', ...}, but without the
+        # trailing Bar it was the list below
+        x = parse_keywords('Foo="a b"\nFoo="c"\nBar', multiline_values=False)
+        self.assertEqual(x, {'Foo': ['a b', 'c'], 'Bar': DEFAULT_VALUE})
+        x = parse_keywords('Foo="a b"\nFoo="c"', multiline_values=False)
+        self.assertEqual(x, {'Foo': ['a b', 'c']})
+
     def test_network_status(self):
         self.controller._update_network_status("""ns/all=
 r right2privassy3 ADQ6gCT3DiFHKPDFr3rODBUI8HM JehnjB8l4Js47dyjLCEmE8VJqao 2011-12-02 03:36:40 50.63.8.215 9023 0
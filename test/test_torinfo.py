@@ -313,3 +313,32 @@ foo/* bar
         # not the end of the world if this fails
         self.assertTrue(str(info.version) == "version()")
         self.assertTrue(str(info.foo) == "foo(arg)")
+
+
+class BatchedInfoTests(unittest.TestCase):
+
+    def test_calls_share_one_getinfo(self):
+        from twisted.internet.task import Clock
+        clock = Clock()
+        protocol = TorControlProtocol(batch_queries=True, reactor=clock)
+        protocol.connectionMade = lambda: None
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+
+        info = TorInfo(protocol)
+        info._do_setup('version a doc\nnet/listeners/* a doc')
+        info._setup_complete(None)
+        d0 = info.version()
+        d1 = info.net.listeners('socks')
+        clock.advance(0)
+        self.assertEqual(
+            transport.value(),
+            b'GETINFO version net/listeners/socks\r\n',
+        )
+        protocol.dataReceived(
+            b'250-version=0.4.8.9\r\n'
+            b'250-net/listeners/socks="127.0.0.1:9050"\r\n'
+            b'250 OK\r\n'
+        )
+        self.assertEqual(self.successResultOf(d0), '0.4.8.9')
+        self.assertEqual(self.successResultOf(d1), '127.0.0.1:9050')
@@ -17,17 +17,22 @@ from txtorcon import TorProtocolError
 from txtorcon import TorState
 from txtorcon import Stream
 from txtorcon import Circuit
+from txtorcon import Router
 from txtorcon import build_tor_connection
 from txtorcon import build_local_tor_connection
 from txtorcon import build_timeout_circuit
 from txtorcon import CircuitBuildTimedOutError
+from txtorcon.torcontrolprotocol import PRIORITY_HIGH, PRIORITY_BULK
+from txtorcon.util import NetLocation
 from txtorcon.interface import IStreamAttacher
 from txtorcon.interface import ICircuitListener
 from txtorcon.interface import IStreamListener
 from txtorcon.interface import StreamListenerMixin
 from txtorcon.interface import CircuitListenerMixin
+from txtorcon.interface import RouterListenerMixin
 from txtorcon.circuit import _get_circuit_attacher
 from txtorcon.circuit import _extract_reason
+from txtorcon.log import txtorlog
 
 try:
     from .py3_torstate import TorStatePy3Tests  # noqa
@@ -35,6 +40,28 @@ except SyntaxError:
     pass
 
 
+CONSENSUS_FAKE = '''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+.'''
+
+CONSENSUS_PPRIV = '''ns/all=
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+.'''
+
+CONSENSUS_TWO = '''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Authority Exit Fast Guard Running Stable Valid
+w Bandwidth=543000
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+.'''
+
+
 @implementer(ICircuitListener)
 class CircuitListener(object):
 
@@ -146,6 +173,51 @@ class FakeReactor:
         raise RuntimeError('connectUNIX: ' + str(args))
 
 
+class RouterListener(RouterListenerMixin):
+
+    def __init__(self):
+        self.notes = []
+
+    def router_added(self, router):
+        self.notes.append(('added', router.name))
+
+    def router_removed(self, router):
+        self.notes.append(('removed', router.name))
+
+    def router_changed(self, router):
+        self.notes.append(('changed', router.name))
+
+
+class ThreadlessReactor(task.Clock):
+    """
+    A Clock whose "thread pool" runs each call straight away or, if
+    ``held`` is a list, appends it there to be run later.
+    """
+
+    def __init__(self):
+        super(ThreadlessReactor, self).__init__()
+        self.held = None
+
+    def getThreadPool(self):
+        return self
+
+    def callInThreadWithCallback(self, on_result, func, *args, **kw):
+        def run():
+            try:
+                result = func(*args, **kw)
+            except Exception:
+                on_result(False, Failure())
+            else:
+                on_result(True, result)
+        if self.held is None:
+            run()
+        else:
+            self.held.append(run)
+
+    def callFromThread(self, func, *args, **kw):
+        func(*args, **kw)
+
+
 class FakeCircuit(Circuit):
 
     def __init__(self, id=-999):
@@ -161,7 +233,7 @@ class FakeEndpoint:
         ans = '\r\n'.join(map(lambda k: '%s=' % k, keys.split()))
         return defer.succeed(ans)
 
-    def get_info_incremental(self, key, linecb):
+    def get_info_incremental(self, key, linecb, priority=None):
         linecb('%s=' % key)
         return defer.succeed('')
 
@@ -196,7 +268,7 @@ class FakeEndpointAnswers:
             ans += '%s=%s\r\n' % (k, self.answers.pop())
         return ans[:-2]                 # don't want trailing \r\n
 
-    def get_info_incremental(self, key, linecb):
+    def get_info_incremental(self, key, linecb, priority=None):
         data = self.answers.pop().split('\n')
         if len(data) == 1:
             linecb('{}={}'.format(key, data[0]))
@@ -371,7 +443,8 @@ class StateTests(unittest.TestCase):
 
     def setUp(self):
         self.protocol = TorControlProtocol()
-        self.state = TorState(self.protocol)
+        self.reactor = ThreadlessReactor()
+        self.state = TorState(self.protocol, reactor=self.reactor)
         # avoid spew in trial logs; state prints this by default
         self.state._attacher_error = lambda f: f
         self.protocol.connectionMade = lambda: None
@@ -677,6 +750,33 @@ class StateTests(unittest.TestCase):
         self.assertEqual(len(self.protocol.commands), 3)
         self.assertEqual(self.protocol.commands[2][1], b'ATTACHSTREAM 4 1')
 
+    def test_attach_and_extend_overtake_bulk(self):
+        @implementer(IStreamAttacher)
+        class MyAttacher(object):
+
+            def attach_stream(self, stream, circuits):
+                return None
+
+        self.state.set_attacher(MyAttacher(), FakeReactor(self))
+        self.protocol._set_valid_events('STREAM CIRC NEWCONSENSUS ADDRMAP')
+        self.state._add_events()
+        for ignored in self.state.event_map.items():
+            self.send(b"250 OK")
+
+        # like a TorConfig bootstrapping, or a TorState reading ns/all
+        self.protocol.get_info_raw('config/names', priority=PRIORITY_BULK)
+        self.protocol.get_conf('SocksPort', priority=PRIORITY_BULK)
+        self.protocol.get_conf('ORPort', priority=PRIORITY_BULK)
+        self.protocol.get_info_raw('version')
+
+        self.send(b"650 STREAM 1 NEW 0 www.example.com:443 SOURCE_ADDR=127.0.0.1:54327 PURPOSE=USER")
+        self.state.build_circuit(using_guards=False)
+        self.assertEqual(
+            [cmd for _, cmd, _ in self.protocol.commands],
+            [b'ATTACHSTREAM 1 0', b'EXTENDCIRCUIT 0', b'GETINFO version',
+             b'GETINFO config/names', b'GETCONF SocksPort', b'GETCONF ORPort'],
+        )
+
     def test_attacher_defer(self):
         @implementer(IStreamAttacher)
         class MyAttacher(object):
@@ -846,6 +946,89 @@ class StateTests(unittest.TestCase):
         self.state._circuit_update('365 CLOSED $E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus,$253DFF1838A2B7782BE7735F74E50090D46CA1BC=chomsky PURPOSE=GENERAL REASON=TIMEOUT')
         self.assertTrue(365 not in self.state.circuits)
 
+    def test_circuit_history(self):
+        path = '$E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus'
+        self.reactor.advance(10)
+        self.state._circuit_update('365 LAUNCHED PURPOSE=GENERAL')
+        self.reactor.advance(2)
+        self.state._circuit_update('365 BUILT ' + path + ' PURPOSE=GENERAL')
+        self.reactor.advance(5)
+        self.state._circuit_update('365 CLOSED ' + path + ' PURPOSE=GENERAL REASON=FINISHED')
+
+        self.assertEqual(1, len(self.state.history.circuits))
+        record = self.state.history.circuits[0]
+        self.assertEqual(365, record.id)
+        self.assertEqual('CLOSED', record.state)
+        self.assertEqual('FINISHED', record.reason)
+        self.assertEqual('GENERAL', record.purpose)
+        self.assertEqual(
+            ('$E11D2B2269CC25E67CA6C9FB5843497539A74FD0',
+             '$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5'),
+            record.path,
+        )
+        self.assertEqual((10, 12, 17), (record.launched, record.built, record.closed))
+        self.assertEqual({('CLOSED', 'FINISHED'): 1}, dict(self.state.history.circuit_counts))
+        self.assertEqual({}, self.state._circuit_times)
+
+    def test_circuit_history_failed(self):
+        self.state._circuit_update('365 LAUNCHED PURPOSE=GENERAL')
+        self.state._circuit_update('365 FAILED PURPOSE=GENERAL REASON=TIMEOUT')
+
+        record = self.state.history.circuits[0]
+        self.assertEqual(('FAILED', 'TIMEOUT', None), (record.state, record.reason, record.built))
+        self.assertEqual((), record.path)
+
+    def test_circuit_history_failed_then_closed(self):
+        self.state._circuit_update('365 LAUNCHED PURPOSE=GENERAL')
+        self.state._circuit_update('365 FAILED PURPOSE=GENERAL REASON=TIMEOUT')
+        self.state._circuit_update('365 CLOSED PURPOSE=GENERAL REASON=TIMEOUT')
+
+        self.assertEqual([('FAILED', 'TIMEOUT')], [(r.state, r.reason) for r in self.state.history.circuits])
+        self.assertEqual({('FAILED', 'TIMEOUT'): 1}, dict(self.state.history.circuit_counts))
+        self.assertEqual({}, self.state.circuits)
+        self.assertEqual({}, self.state._circuit_times)
+
+    def test_circuit_history_size(self):
+        self.state = TorState(self.protocol, reactor=self.reactor, history_size=3)
+        for circid in range(10):
+            self.state._circuit_update('%d LAUNCHED PURPOSE=GENERAL' % circid)
+            self.state._circuit_update('%d CLOSED PURPOSE=GENERAL REASON=FINISHED' % circid)
+
+        self.assertEqual([7, 8, 9], [record.id for record in self.state.history.circuits])
+        self.assertEqual(10, self.state.history.circuit_counts[('CLOSED', 'FINISHED')])
+        self.assertEqual({}, self.state.circuits)
+
+    def test_stream_history(self):
+        self.state._circuit_update('186 LAUNCHED PURPOSE=GENERAL')
+        self.reactor.advance(1)
+        self.state._stream_update('1610 NEW 0 1.2.3.4:56')
+        self.reactor.advance(1)
+        self.state._stream_update('1610 SUCCEEDED 186 1.2.3.4:56')
+        self.reactor.advance(1)
+        self.state._stream_update('1610 CLOSED 186 1.2.3.4:56 REASON=DONE')
+
+        self.assertEqual(1, len(self.state.history.streams))
+        record = self.state.history.streams[0]
+        self.assertEqual(1610, record.id)
+        self.assertEqual(('CLOSED', 'DONE'), (record.state, record.reason))
+        self.assertEqual(('1.2.3.4', 56), (record.target_host, record.target_port))
+        self.assertEqual(186, record.circuit_id)
+        self.assertEqual((1, 3), (record.opened, record.closed))
+        self.assertEqual({('CLOSED', 'DONE'): 1}, dict(self.state.history.stream_counts))
+        self.assertEqual({}, self.state._stream_info)
+
+    def test_stream_history_failed_then_closed(self):
+        self.state._stream_update('1610 NEW 0 1.2.3.4:56')
+        self.state._stream_update('1610 FAILED 0 1.2.3.4:56 REASON=TIMEOUT')
+        self.state._stream_update('1610 CLOSED 0 1.2.3.4:56 REASON=TIMEOUT')
+
+        self.assertEqual(1, len(self.state.history.streams))
+        record = self.state.history.streams[0]
+        self.assertEqual(('FAILED', 'TIMEOUT'), (record.state, record.reason))
+        self.assertEqual(('1.2.3.4', 56), (record.target_host, record.target_port))
+        self.assertEqual({('FAILED', 'TIMEOUT'): 1}, dict(self.state.history.stream_counts))
+        self.assertEqual({}, self.state.streams)
+
     def test_circuit_listener(self):
         events = 'CIRC STREAM ORCONN BW DEBUG INFO NOTICE WARN ERR NEWDESC ADDRMAP AUTHDIR_NEWDESCS DESCCHANGED NS STATUS_GENERAL STATUS_CLIENT STATUS_SERVER GUARD STREAM_BW CLIENTS_SEEN NEWCONSENSUS BUILDTIMEOUT_SET'
         self.protocol._set_valid_events(events)
@@ -1064,6 +1247,372 @@ p reject 1-65535
         self.assertTrue('Unnamed' in self.state.routers)
         self.assertTrue('$00126582E505CF596F412D23ABC9E14DD4625C49' in self.state.routers)
 
+    def test_newconsensus_parsed_in_thread(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        fake = self.state.routers['fake']
+        self.reactor.held = []
+
+        self.state._network_status_event(CONSENSUS_TWO)
+        # nothing changes until the parsing "thread" is done
+        self.assertEqual(len(self.reactor.held), 1)
+        self.assertEqual(list(self.state.routers_by_name), ['fake'])
+
+        self.reactor.held.pop()()
+        self.assertEqual(sorted(self.state.routers_by_name), ['PPrivCom012', 'fake'])
+        self.assertIs(self.state.routers['fake'], fake)
+        self.assertEqual(fake.bandwidth, 543000)
+        self.assertIn('authority', fake.flags)
+        self.assertEqual(list(self.state.authorities.values()), [fake])
+        self.assertEqual(len(self.state.guards), 1)
+
+    def test_newconsensus_newest_wins(self):
+        self.reactor.held = []
+        self.state._network_status_event(CONSENSUS_FAKE)
+        self.state._network_status_event(CONSENSUS_TWO)
+        self.state._network_status_event(CONSENSUS_PPRIV)
+        self.assertEqual(len(self.reactor.held), 1)
+
+        self.reactor.held.pop()()
+        self.assertEqual(list(self.state.routers_by_name), ['fake'])
+        # ...and only the last of the other two is parsed next
+        self.assertEqual(len(self.reactor.held), 1)
+        self.reactor.held.pop()()
+        self.assertEqual(list(self.state.routers_by_name), ['PPrivCom012'])
+        self.assertEqual(self.reactor.held, [])
+
+    def test_newconsensus_routers_per_turn(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        with patch('txtorcon.torstate._ROUTERS_PER_TURN', 1):
+            self.state._network_status_event(CONSENSUS_TWO)
+            self.assertEqual(list(self.state.routers_by_name), ['fake'])
+            self.assertEqual(len(self.reactor.getDelayedCalls()), 1)
+            self.reactor.advance(0)
+        self.assertEqual(sorted(self.state.routers_by_name), ['PPrivCom012', 'fake'])
+
+    def test_newconsensus_live_between_turns(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        fake = self.state.routers['fake']
+        moved = CONSENSUS_TWO.replace('12.45.56.78', '12.45.56.79')
+        with patch('txtorcon.torstate._ROUTERS_PER_TURN', 1):
+            self.state._network_status_event(moved)
+            # "fake" has been applied to the new tables, but lookups
+            # and the Router itself are still all the old consensus
+            self.assertEqual((fake.ip, fake.bandwidth), ('12.45.56.78', 518000))
+            self.assertFalse(fake.has_flag('authority'))
+            self.assertEqual(self.state.routers_at_address('12.45.56.78'), {fake})
+            self.assertEqual(self.state.routers_at_address('12.45.56.79'), set())
+            self.assertEqual(self.state.authorities, {})
+            self.reactor.advance(0)
+        self.assertIs(self.state.routers['fake'], fake)
+        self.assertEqual((fake.ip, fake.bandwidth), ('12.45.56.79', 543000))
+        self.assertEqual(self.state.routers_at_address('12.45.56.78'), set())
+        self.assertEqual(self.state.routers_at_address('12.45.56.79'), {fake})
+        self.assertEqual(self.state.authorities, {'fake': fake})
+
+    def test_newconsensus_failed_partway(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        fake = self.state.routers['fake']
+        created = []
+
+        def router(controller):
+            # the scratch Router for "fake" is fine; PPrivCom012 fails
+            created.append(controller)
+            if len(created) > 1:
+                raise RuntimeError("failed")
+            return Router(controller)
+        with patch('txtorcon.torstate.Router', router):
+            self.state._network_status_event(CONSENSUS_TWO.replace('12.45.56.78', '12.45.56.79'))
+        self.assertEqual((fake.ip, fake.bandwidth), ('12.45.56.78', 518000))
+        self.assertEqual(self.state.routers_at_address('12.45.56.78'), {fake})
+
+        # the relay keys weren't replaced, so it's still a change
+        self.state._network_status_event(CONSENSUS_TWO.replace('12.45.56.78', '12.45.56.79'))
+        self.assertEqual(fake.ip, '12.45.56.79')
+
+    def test_newconsensus_invalid(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        messages = []
+        self.patch(txtorlog, 'msg', lambda *args: messages.append(args))
+
+        self.state._network_status_event('r fake\nr fake\n')
+        self.assertIn('Failed to process NEWCONSENSUS', messages[-1][0])
+        self.assertEqual(list(self.state.routers_by_name), ['fake'])
+
+        # ...and the next one is still processed
+        self.state._network_status_event(CONSENSUS_PPRIV)
+        self.assertEqual(list(self.state.routers_by_name), ['PPrivCom012'])
+
+    def test_router_listener(self):
+        listener = RouterListener()
+        self.state.add_router_listener(listener)
+
+        self.state._update_network_status(CONSENSUS_FAKE)
+        self.assertEqual(listener.notes, [('added', 'fake')])
+        fake = self.state.routers['fake']
+
+        self.state._network_status_event(CONSENSUS_TWO)
+        self.assertEqual(listener.notes[1:], [('changed', 'fake'), ('added', 'PPrivCom012')])
+        self.assertIs(self.state.routers['fake'], fake)
+        self.assertEqual(fake.bandwidth, 543000)
+        self.assertEqual(list(self.state.authorities.values()), [fake])
+
+        self.state._network_status_event(CONSENSUS_PPRIV)
+        self.assertEqual(listener.notes[3:], [('removed', 'fake')])
+        self.assertEqual(list(self.state.routers_by_name), ['PPrivCom012'])
+        self.assertNotIn('fake', self.state.routers)
+        self.assertNotIn(fake.id_hex, self.state.routers)
+        self.assertNotIn(fake, self.state.all_routers)
+        self.assertEqual(self.state.guards, {})
+        self.assertEqual(self.state.authorities, {})
+
+        self.state.remove_router_listener(listener)
+        self.state._network_status_event(CONSENSUS_FAKE)
+        self.assertEqual(len(listener.notes), 4)
+
+    def test_unchanged_routers_untouched(self):
+        self.state._update_network_status(CONSENSUS_TWO)
+        listener = RouterListener()
+        self.state.add_router_listener(listener)
+        with patch.object(Router, 'update') as update:
+            self.state._network_status_event(CONSENSUS_TWO)
+        self.assertEqual(update.mock_calls, [])
+        self.assertEqual(listener.notes, [])
+        self.assertEqual(len(self.state.all_routers), 2)
+
+    def test_router_listener_duplicate_names(self):
+        self.state._update_network_status(CONSENSUS_FAKE)
+        self.state._update_network_status(CONSENSUS_FAKE + '''
+r fake YxxmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Fast Running Valid
+.''')
+        self.assertEqual(len(self.state.routers_by_name['fake']), 2)
+        self.assertNotIn('fake', self.state.routers)
+
+        # the other "fake" is gone, so the name is unique again
+        listener = RouterListener()
+        self.state.add_router_listener(listener)
+        self.state._update_network_status(CONSENSUS_FAKE.replace('YkkmgCNRV1', 'YxxmgCNRV1'))
+        self.assertEqual(listener.notes, [('removed', 'fake'), ('changed', 'fake')])
+        self.assertEqual(len(self.state.routers_by_name['fake']), 1)
+        self.assertIs(self.state.routers['fake'], self.state.routers_by_name['fake'][0])
+        self.assertEqual(self.state.routers['fake'].flags[0], 'exit')
+
+    def test_router_listener_error(self):
+        messages = []
+        self.patch(txtorlog, 'msg', lambda *args: messages.append(args))
+
+        class Broken(RouterListenerMixin):
+            def router_added(self, router):
+                raise RuntimeError("oops")
+        listener = RouterListener()
+        self.state.add_router_listener(Broken())
+        self.state.add_router_listener(listener)
+        self.state._network_status_event(CONSENSUS_FAKE)
+        self.assertEqual(listener.notes, [('added', 'fake')])
+        self.assertTrue(any('oops' in str(msg[0]) for msg in messages))
+
+    def test_exits_accepting(self):
+        self.state._update_network_status('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+p accept 80,443
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+p reject 1-65535
+.''')
+        fake = self.state.routers['fake']
+        self.assertEqual(self.state.exits_accepting(443), {fake})
+        self.assertEqual(self.state.exits_accepting(443, 22), set())
+
+        # a changed policy is picked up from the next consensus
+        self.state._network_status_event('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+p reject 25
+.''')
+        self.assertEqual(fake.policy, 'reject 25')
+        self.assertEqual(self.state.exits_accepting(443, 22), {fake})
+        self.assertEqual(self.state.exits_accepting(25), set())
+
+    def test_router_table(self):
+        self.state._update_network_status('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Guard Running Stable Valid
+w Bandwidth=518000
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Running Stable Valid
+w Bandwidth=51500
+.''')
+        fake = self.state.routers['fake']
+        table = self.state.router_table()
+        self.assertIs(self.state.router_table(), table)
+        self.assertEqual(table.select(flags=['exit']), [fake])
+        self.assertEqual(table.top(1, flags=['stable']), [fake])
+
+        # the next consensus gets a new table
+        self.state._network_status_event('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Fast Guard Running Stable Valid
+w Bandwidth=518000
+.''')
+        self.assertIsNot(self.state.router_table(), table)
+        self.assertEqual(self.state.router_table().select(flags=['exit']), [])
+        self.assertEqual(self.state.router_table().select(flags=['fast']), [fake])
+
+    def test_secondary_indexes(self):
+        for line in CONSENSUS_TWO.split('\n'):
+            self.state._network_status_parser.feed_line(line)
+        self.state._network_status_parser.done()
+        fake = self.state.routers['fake']
+        ppriv = self.state.routers['PPrivCom012']
+
+        self.assertEqual(self.state.routers_at_address('12.45.56.78'), {fake})
+        self.assertEqual(self.state.routers_at_address('192.0.2.1'), set())
+        self.assertEqual(self.state.routers_in_network('12.45.0.0/16'), {fake})
+        self.assertEqual(self.state.routers_in_network('12.45.56.0/24'), {fake})
+        self.assertEqual(self.state.routers_in_network('12.45.57.0/24'), set())
+        self.assertEqual(self.state.routers_in_network('0.0.0.0/1'), {fake, ppriv})
+        self.assertEqual(self.state.routers_with_flags('Fast'), {fake, ppriv})
+        self.assertEqual(self.state.routers_with_flags('exit', 'Guard'), {fake})
+        self.assertEqual(self.state.routers_with_flags('BadExit'), set())
+        self.assertEqual(self.state.routers_with_flags(), {fake, ppriv})
+
+        # a new consensus: fake moves and loses Exit, PPrivCom012
+        # goes and another relay (with an IPv6 address) arrives
+        shared = dict((bits, set(routers)) for (bits, routers) in self.state._routers_by_flags.items())
+        shared_sets = dict(self.state._routers_by_flags)
+        self.state._network_status_event('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.99.1 443 80
+s Fast Guard Running Stable Valid
+w Bandwidth=543000
+r another AHhuQ8zFQJdT8l42Axxc6m6kNwI QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 12.45.1.2 9001 0
+a [2001:db8::1]:9001
+s Exit Fast Running Valid
+w Bandwidth=51500
+.''')
+        another = self.state.routers['another']
+        self.assertEqual(self.state.routers_at_address('12.45.56.78'), set())
+        self.assertEqual(self.state.routers_at_address('12.45.99.1'), {fake})
+        self.assertEqual(self.state.routers_at_address('[2001:db8::1]'), {another})
+        self.assertEqual(self.state.routers_at_address('2001:db8:0::1'), {another})
+        self.assertEqual(self.state.routers_in_network('12.45.0.0/16'), {fake, another})
+        self.assertEqual(self.state.routers_in_network('84.19.0.0/16'), set())
+        self.assertEqual(self.state.routers_with_flags('exit'), {another})
+        self.assertEqual(self.state.routers_with_flags('fast'), {fake, another})
+        self.assertEqual(self.state.routers_with_flags('stable'), {fake})
+        self.assertEqual(self.state.routers_with_flags('authority'), set())
+        # the previous consensus's sets weren't changed
+        self.assertEqual(shared_sets, shared)
+
+    def test_changed_router_keeps_location(self):
+        self.state._update_network_status(CONSENSUS_TWO)
+        ppriv = self.state.routers['PPrivCom012']
+        location = NetLocation(None)
+        location.countrycode = 'DE'
+        ppriv._location = location
+        modified = ppriv.modified
+
+        self.state._network_status_event(CONSENSUS_TWO.replace('51500', '51600'))
+        self.assertIs(self.state.routers['PPrivCom012'], ppriv)
+        self.assertEqual(ppriv.bandwidth, 51600)
+        self.assertIs(ppriv._location, location)
+        self.assertIs(ppriv._modified, modified)
+
+        # a new address (or descriptor) forgets what came from the old one
+        self.state._network_status_event(
+            CONSENSUS_TWO.replace('84.19.178.6', '84.19.178.7').replace('08:34:19', '09:34:19')
+        )
+        self.assertEqual(ppriv.ip, '84.19.178.7')
+        self.assertIs(ppriv._location, None)
+        self.assertIs(ppriv._modified, None)
+        self.assertEqual(ppriv.modified.hour, 9)
+
+    def test_country_index(self):
+        self.state._update_network_status(CONSENSUS_TWO)
+        self.assertEqual(self.state.routers_in_country('de'), set())
+
+        def country(router):
+            return {'84.19.178.6': 'de'}.get(router.ip)
+        with patch('txtorcon.torstate.known_country', country):
+            self.state._network_status_event(CONSENSUS_TWO.replace('51500', '51600'))
+        ppriv = self.state.routers['PPrivCom012']
+        self.assertEqual(self.state.routers_in_country('DE'), {ppriv})
+        self.assertEqual(self.state.routers_in_country('de'), {ppriv})
+
+        # a change that isn't of address keeps the country
+        self.state._network_status_event(CONSENSUS_TWO.replace('51500', '51700'))
+        self.assertEqual(self.state.routers_in_country('DE'), {ppriv})
+
+        self.state._network_status_event(CONSENSUS_FAKE)
+        self.assertEqual(self.state.routers_in_country('DE'), set())
+        self.assertEqual(self.state._router_countries, {})
+
+    def test_locate_routers(self):
+        self.state._update_network_status(CONSENSUS_TWO)
+        fake = self.state.routers['fake']
+        ppriv = self.state.routers['PPrivCom012']
+        self.transport.clear()
+        with patch('txtorcon.torstate.known_country', lambda router: None), \
+                patch('txtorcon.torstate._LOCATE_PER_COMMAND', 1):
+            d = self.state.locate_routers()
+            # one GETINFO per address
+            self.assertEqual(self.transport.value(), b'GETINFO ip-to-country/12.45.56.78\r\n')
+            self.send(b"250-ip-to-country/12.45.56.78=??")
+            self.send(b"250 OK")
+            self.assertEqual(self.transport.value().split(b'\r\n')[1], b'GETINFO ip-to-country/84.19.178.6')
+            self.send(b"250-ip-to-country/84.19.178.6=de")
+            self.send(b"250 OK")
+        self.assertEqual(1, self.successResultOf(d))
+        # only asked once
+        self.assertEqual(0, self.successResultOf(self.state.locate_routers([ppriv])))
+        self.assertEqual(self.state.routers_in_country('de'), {ppriv})
+        self.assertEqual(ppriv.location.countrycode, 'DE')
+        self.assertIsNone(fake._location)
+
+    def test_select_path(self):
+        self.state._update_network_status('''ns/all=
+r fake YkkmgCNRV1/35OPWDvo7+1bmfoo tanLV/4ZfzpYQW0xtGFqAa46foo 2011-12-12 16:29:16 12.45.56.78 443 80
+s Exit Fast Running Stable Valid
+w Bandwidth=518000
+p accept 80,443
+r PPrivCom012 2CGDscCeHXeV/y1xFrq1EGqj5g4 QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 84.19.178.6 9001 0
+s Fast Guard Running Stable Valid
+w Bandwidth=51500
+p reject 1-65535
+r another AHhuQ8zFQJdT8l42Axxc6m6kNwI QX7NVLwx7pwCuk6s8sxB4rdaCKI 2011-12-20 08:34:19 85.19.178.6 9001 0
+s Fast Guard Running Valid
+w Bandwidth=51500
+.''')
+        fake = self.state.routers['fake']
+        guard = self.state.routers['PPrivCom012']
+        other = self.state.routers['another']
+        self.assertEqual(self.state.select_path(2, exit_ports=[443], stable=True), [guard, fake])
+        self.assertEqual(self.state.select_path(3)[-1], fake)
+        self.assertRaises(ValueError, self.state.select_path, 2, exit_ports=[22])
+
+        self.state.entry_guards = {other.id_hex: other}
+        self.assertEqual(self.state.select_path(2, using_guards=True), [other, fake])
+
+        self.assertRaises(ValueError, self.state.select_path, 2, exit_country='de')
+        # finding countries means a new selector
+        with patch('txtorcon.torstate.known_country', lambda router: None):
+            self.state.locate_routers([fake])
+        self.send(b"250-ip-to-country/12.45.56.78=de")
+        self.send(b"250 OK")
+        self.assertIs(self.state._path_selector, None)
+        self.assertEqual(self.state.select_path(2, exit_country='de')[-1], fake)
+        self.assertRaises(ValueError, self.state.select_path, 2, exit_country='us')
+
+        # a new consensus, or new weights, mean a new selector
+        selector = self.state._path_selector
+        self.state.bandwidth_weights = {'Wgg': 10000, 'Wgd': 0}
+        self.assertIs(self.state._path_selector, None)
+        self.state.select_path(2)
+        self.assertIsNot(self.state._path_selector, selector)
+
     def test_newconsensus_remove_routers(self):
         """
         router removed from consensus is removed
@@ -1304,6 +1853,29 @@ s Fast Guard Running Stable Valid
         self.state.build_circuit()
         self.assertEqual(self.transport.value(), b'EXTENDCIRCUIT 0\r\n')
 
+    def test_build_circuit_no_routers_purpose(self):
+        self.state.build_circuit(purpose="controller")
+        self.assertEqual(self.transport.value(), b'EXTENDCIRCUIT 0 purpose=controller\r\n')
+
+    def test_build_circuits(self):
+        path = '$E11D2B2269CC25E67CA6C9FB5843497539A74FD0=eris,$50DD343021E509EB3A5A7FD0D8A4F8364AFBDCB5=venus'
+        results = []
+        d = self.state.build_circuits([None, None], concurrency=1, result_callback=results.append)
+        self.assertEqual(self.transport.value(), b'EXTENDCIRCUIT 0\r\n')
+        self.send(b"250 EXTENDED 1234")
+        self.reactor.advance(1)
+        self.state._circuit_update('1234 EXTENDED ' + path.split(',')[0] + ' PURPOSE=GENERAL')
+        self.reactor.advance(2)
+        self.state._circuit_update('1234 BUILT ' + path + ' PURPOSE=GENERAL')
+        self.assertEqual([(1, 3)], [result.hop_times for result in results])
+
+        # the second path only starts once the first is built; it fails
+        self.send(b"250 EXTENDED 1235")
+        self.state._circuit_update('1235 FAILED PURPOSE=GENERAL REASON=TIMEOUT')
+        summary = self.successResultOf(d)
+        self.assertEqual([self.state.circuits[1234], None], [result.circuit for result in summary.results])
+        self.assertEqual((1, 1, 0.5, 3, 3), summary[1:])
+
     def test_build_circuit_unfound_router(self):
         self.state.build_circuit(routers=[b'AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA'], using_guards=False)
         self.assertEqual(self.transport.value(), b'EXTENDCIRCUIT 0 AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\r\n')
@@ -1447,8 +2019,9 @@ s Fast Guard Running Stable Valid
         for x in range(3):
             path.append(FakeRouter("$%040d" % x))
 
-        def fake_queue(cmd):
+        def fake_queue(cmd, priority):
             self.assertTrue(cmd.startswith('EXTENDCIRCUIT 0'))
+            self.assertEqual(priority, PRIORITY_HIGH)
             return defer.succeed("EXTENDED 1234")
 
         queue_command = patch.object(self.protocol, 'queue_command', fake_queue)
@@ -1684,7 +2257,8 @@ class ComposibleListenerTests(unittest.TestCase):
         self.state._stream_update("1234 SUCCEEDED 42")
         self.state._stream_update("1234 DETACHED 0")
         self.state._stream_update("1234 CLOSED 0")
-        self.state._stream_update("1234 FAILED 0")
+        self.state._stream_update("1235 NEW 0 meejah.ca:80")
+        self.state._stream_update("1235 FAILED 0")
 
         self.assertEqual(
             listener_calls,
@@ -1694,6 +2268,7 @@ class ComposibleListenerTests(unittest.TestCase):
                 ("attach", 1234),
                 ("detach", 1234),
                 ("closed", 1234),
-                ("failed", 1234),
+                ("new", 1235),
+                ("failed", 1235),
             ]
         )
@@ -14,6 +14,7 @@ from zope.interface import implementer
 from txtorcon.util import process_from_address
 from txtorcon.util import delete_file_or_tree
 from txtorcon.util import find_keywords
+from txtorcon.util import split_event_args, split_event_keywords, KeywordMap, lower_case_keywords
 from txtorcon.util import find_tor_binary
 from txtorcon.util import maybe_ip_addr
 from txtorcon.util import unescape_quoted_string
@@ -84,6 +85,73 @@ class TestFindKeywords(unittest.TestCase):
         )
 
 
+class TestEventKeywords(unittest.TestCase):
+
+    def test_split_plain(self):
+        self.assertEqual(
+            split_event_args('1 BUILT $AAAA~a,$BBBB=b PURPOSE=GENERAL'),
+            ['1', 'BUILT', '$AAAA~a,$BBBB=b', 'PURPOSE=GENERAL'],
+        )
+
+    def test_split_quoted(self):
+        self.assertEqual(
+            split_event_args(r'1 BUILT SOCKS_USERNAME="a \"b\" c" X=1'),
+            ['1', 'BUILT', r'SOCKS_USERNAME="a \"b\" c"', 'X=1'],
+        )
+
+    def test_split_quoted_spaces(self):
+        self.assertEqual(
+            split_event_args('1 BUILT  SOCKS_USERNAME="a  b" "x y"z X="" Y=1'),
+            ['1', 'BUILT', 'SOCKS_USERNAME="a  b"', '"x y"z', 'X=""', 'Y=1'],
+        )
+
+    def test_split_keywords(self):
+        positional = []
+        keywords = split_event_keywords(
+            split_event_args('1 BUILT $AAAA=a "x y" REASON="a b" 2=two'),
+            positional,
+        )
+        self.assertEqual(keywords, {'REASON': 'a b'})
+        self.assertEqual(positional, ['1', 'BUILT', '$AAAA=a', 'x y', '2=two'])
+
+    def test_keywords(self):
+        kw = KeywordMap.from_args(split_event_args(
+            r'1 BUILT $AAAA=a PURPOSE=GENERAL SOCKS_USERNAME="a \"b\"" EMPTY='
+        ))
+        self.assertEqual(
+            kw,
+            {'PURPOSE': 'GENERAL', 'SOCKS_USERNAME': 'a "b"', 'EMPTY': ''},
+        )
+        self.assertEqual(list(kw), ['PURPOSE', 'SOCKS_USERNAME', 'EMPTY'])
+        self.assertEqual(kw['purpose'], 'GENERAL')
+        self.assertTrue('socks_username' in kw)
+        self.assertEqual(kw.get('reason'), None)
+        self.assertFalse('$AAAA' in kw)
+
+    def test_keywords_any_case(self):
+        kw = KeywordMap({'Reason': 'DONE', 'PURPOSE': 'GENERAL'})
+        self.assertEqual(kw['REASON'], 'DONE')
+        self.assertEqual(kw['reason'], 'DONE')
+        self.assertEqual(kw['Purpose'], 'GENERAL')
+        self.assertTrue('rEASON' in kw)
+        self.assertEqual(list(kw), ['Reason', 'PURPOSE'])
+        self.assertEqual(len(kw), 2)
+        self.assertEqual(
+            kw.as_kwargs(),
+            {'Reason': 'DONE', 'reason': 'DONE', 'PURPOSE': 'GENERAL', 'purpose': 'GENERAL'},
+        )
+
+    def test_keywords_read_only(self):
+        kw = KeywordMap({'REASON': 'DONE'})
+        with self.assertRaises(TypeError):
+            kw['REASON'] = 'MISC'
+        self.assertIn('DONE', repr(kw))
+
+    def test_lower_case_keywords(self):
+        flags = lower_case_keywords(KeywordMap({'REASON': 'DONE'}))
+        self.assertEqual(flags, {'REASON': 'DONE', 'reason': 'DONE'})
+
+
 class FakeGeoIP(object):
     def __init__(self, version=2):
         self.version = version
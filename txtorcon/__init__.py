@@ -7,12 +7,16 @@ from txtorcon.router import Router
 from txtorcon.circuit import Circuit
 from txtorcon.circuit import build_timeout_circuit
 from txtorcon.circuit import CircuitBuildTimedOutError
+from txtorcon.circuitpool import CircuitPool
+from txtorcon.circuitpool import CircuitClass
 from txtorcon.stream import Stream
 from txtorcon.controller import connect
 from txtorcon.torcontrolprotocol import TorControlProtocol
 from txtorcon.torcontrolprotocol import TorProtocolError
 from txtorcon.torcontrolprotocol import TorProtocolFactory
 from txtorcon.torcontrolprotocol import DEFAULT_VALUE
+from txtorcon.controlpool import TorControlPool
+from txtorcon.controlpool import build_control_pool
 from txtorcon.torstate import TorState
 from txtorcon.torstate import build_tor_connection
 from txtorcon.torstate import build_local_tor_connection
@@ -54,7 +58,8 @@ from txtorcon.interface import (
     ITorControlProtocol,
     IStreamListener, IStreamAttacher, StreamListenerMixin,
     ICircuitContainer, ICircuitListener, CircuitListenerMixin,
-    IRouterContainer, IAddrListener, ITor
+    IRouterContainer, IRouterListener, RouterListenerMixin,
+    IAddrListener, ITor
 )
 
 __all__ = [
@@ -64,6 +69,7 @@ __all__ = [
     "Circuit",
     "Stream",
     "TorControlProtocol", "TorProtocolError", "TorProtocolFactory",
+    "TorControlPool", "build_control_pool",
     "TorState", "DEFAULT_VALUE",
     "TorInfo",
     "build_tor_connection", "build_local_tor_connection", "launch_tor",
@@ -91,13 +97,15 @@ __all__ = [
     "get_global_tor",
     "build_timeout_circuit",
     "CircuitBuildTimedOutError",
+    "CircuitPool", "CircuitClass",
 
     "AddrMap",
     "util", "interface",
     "ITorControlProtocol",
     "IStreamListener", "IStreamAttacher", "StreamListenerMixin",
     "ICircuitContainer", "ICircuitListener", "CircuitListenerMixin",
-    "IRouterContainer", "IAddrListener", "IProgressProvider",
+    "IRouterContainer", "IRouterListener", "RouterListenerMixin",
+    "IAddrListener", "IProgressProvider",
 
     "__version__", "__author__", "__contact__",
     "__license__", "__copyright__", "__url__",
@@ -1,112 +1,96 @@
-
-from .util import find_keywords
-
-
-# putting the old parser back in here for now until there's a solution
-# making Automat faster
-from .spaghetti import FSM, State, Transition
+def _ignorable_line(line):
+    line = line.strip()
+    return line in ('.', 'OK', '') or line.startswith('ns/')
+
+
+# for the kind of line (its first two characters) we're waiting for,
+# the kinds of line allowed next and what to wait for after each
+_TRANSITIONS = {
+    'r ': {
+        'r ': 's ',
+    },
+    's ': {
+        's ': 'w ',
+        'a ': 's ',                     # IPv6 addresses
+    },
+    'w ': {
+        'w ': 'p ',
+        'r ': 's ',                     # "w" lines are optional
+    },
+    'p ': {
+        'p ': 'r ',
+        'r ': 's ',                     # "p" lines are optional
+    },
+}
 
 
 class MicrodescriptorParser(object):
     """
     Parsers microdescriptors line by line. New relays are emitted via
     the 'create_relay' callback.
+
+    Each line is dispatched on its first two characters: the
+    ``_TRANSITIONS`` table says which kinds of line may come next
+    ("r " starts a relay, then any "a " lines, then "s " and
+    optionally "w " and "p "), and anything else is an error unless
+    it's one of the lines around the relays in a reply ("ns/all=",
+    ".", "OK" or a blank line).
     """
 
     def __init__(self, create_relay):
         self._create_relay = create_relay
         self._relay_attrs = None
-
-        class die(object):
-            __name__ = 'die'  # FIXME? just to ease spagetti.py:82's pain
-
-            def __init__(self, msg):
-                self.msg = msg
-
-            def __call__(self, *args):
-                raise RuntimeError(self.msg % tuple(args))
-
-        waiting_r = State("waiting_r")
-        waiting_w = State("waiting_w")
-        waiting_p = State("waiting_p")
-        waiting_s = State("waiting_s")
-
-        def ignorable_line(x):
-            x = x.strip()
-            return x in ['.', 'OK', ''] or x.startswith('ns/')
-
-        waiting_r.add_transition(Transition(waiting_r, ignorable_line, None))
-        waiting_r.add_transition(Transition(waiting_s, lambda x: x.startswith('r '), self._router_begin))
-        # FIXME use better method/func than die!!
-        waiting_r.add_transition(Transition(waiting_r, lambda x: not x.startswith('r '), die('Expected "r " while parsing routers not "%s"')))
-
-        waiting_s.add_transition(Transition(waiting_w, lambda x: x.startswith('s '), self._router_flags))
-        waiting_s.add_transition(Transition(waiting_s, lambda x: x.startswith('a '), self._router_address))
-        waiting_s.add_transition(Transition(waiting_r, ignorable_line, None))
-        waiting_s.add_transition(Transition(waiting_r, lambda x: not x.startswith('s ') and not x.startswith('a '), die('Expected "s " while parsing routers not "%s"')))
-        waiting_s.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', None))
-
-        waiting_w.add_transition(Transition(waiting_p, lambda x: x.startswith('w '), self._router_bandwidth))
-        waiting_w.add_transition(Transition(waiting_r, ignorable_line, None))
-        waiting_w.add_transition(Transition(waiting_s, lambda x: x.startswith('r '), self._router_begin))  # "w" lines are optional
-        waiting_w.add_transition(Transition(waiting_r, lambda x: not x.startswith('w '), die('Expected "w " while parsing routers not "%s"')))
-        waiting_w.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', None))
-
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x.startswith('p '), self._router_policy))
-        waiting_p.add_transition(Transition(waiting_r, ignorable_line, None))
-        waiting_p.add_transition(Transition(waiting_s, lambda x: x.startswith('r '), self._router_begin))  # "p" lines are optional
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x[:2] != 'p ', die('Expected "p " while parsing routers not "%s"')))
-        waiting_p.add_transition(Transition(waiting_r, lambda x: x.strip() == '.', None))
-
-        self._machine = FSM([waiting_r, waiting_s, waiting_w, waiting_p])
-        self._relay_attrs = None
+        self._waiting = 'r '
 
     def feed_line(self, line):
         """
         A line has been received.
         """
-        self._machine.process(line)
+        kind = line[:2]
+        try:
+            self._waiting = _TRANSITIONS[self._waiting][kind]
+        except KeyError:
+            if not _ignorable_line(line):
+                raise RuntimeError(
+                    'Expected "%s" while parsing routers not "%s"' % (self._waiting, line)
+                )
+            self._waiting = 'r '
+            return
+
+        if kind == 'r ':
+            if self._relay_attrs is not None:
+                self._create_relay(**self._relay_attrs)
+            args = line.split()
+            self._relay_attrs = {
+                'nickname': args[1],
+                'idhash': args[2],
+                'orhash': args[3],
+                'modified': args[4] + ' ' + args[5],
+                'ip': args[6],
+                'orport': args[7],
+                'dirport': args[8],
+            }
+        elif kind == 's ':
+            self._relay_attrs['flags'] = line[2:].split()
+        elif kind == 'w ':
+            for word in line[2:].split():
+                if word[:10] == 'Bandwidth=':
+                    self._relay_attrs['bandwidth'] = word[10:]
+                    break
+        elif kind == 'a ':
+            try:
+                self._relay_attrs['ip_v6'].extend(line[2:].split())
+            except KeyError:
+                self._relay_attrs['ip_v6'] = line[2:].split()
+        elif kind == 'p ':
+            # exit-policy summary, like "accept 80,443"
+            self._relay_attrs['policy'] = line[2:]
 
     def done(self, *args):
         """
         All lines have been fed.
         """
-        self._maybe_callback_router()
-
-    def _maybe_callback_router(self):
         if self._relay_attrs is not None:
             self._create_relay(**self._relay_attrs)
             self._relay_attrs = None
-
-    def _router_begin(self, data):
-        self._maybe_callback_router()
-        args = data.split()[1:]
-        self._relay_attrs = dict(
-            nickname=args[0],
-            idhash=args[1],
-            orhash=args[2],
-            modified=args[3] + ' ' + args[4],
-            ip=args[5],
-            orport=args[6],
-            dirport=args[7],
-        )
-
-    def _router_flags(self, data):
-        args = data.split()[1:]
-        self._relay_attrs['flags'] = args
-
-    def _router_address(self, data):
-        """only for IPv6 addresses"""
-        args = data.split()[1:]
-        try:
-            self._relay_attrs['ip_v6'].extend(args)
-        except KeyError:
-            self._relay_attrs['ip_v6'] = list(args)
-
-    def _router_bandwidth(self, data):
-        args = data.split()[1:]
-        kw = find_keywords(args)
-        self._relay_attrs['bandwidth'] = kw['Bandwidth']
-
-    def _router_policy(self, data):
-        pass
+        self._waiting = 'r '
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+A Tor control-port client for plain asyncio programs: no Twisted
+reactor needs to be running (or be the asyncio one). It shares its
+reply framing, event demultiplexing and authentication logic with
+:class:`txtorcon.TorControlProtocol` through
+:class:`txtorcon.controlcore.ControlCore`, so the two behave the same
+on the wire; it offers the lower-level commands only (there is no
+``TorState`` or ``TorConfig`` on top).
+
+For example::
+
+    async def main():
+        proto = await build_asyncio_control_connection(port=9051)
+        print(await proto.get_info('version'))
+        await proto.add_event_listener('CIRC', print)
+"""
+
+import os
+import asyncio
+from binascii import b2a_hex, hexlify
+from collections import deque
+
+from txtorcon.controlcore import ControlCore, parse_protocolinfo, safecookie_response
+from txtorcon.events import decode_event
+from txtorcon.torcontrolprotocol import TorProtocolError, TorDisconnectError
+from txtorcon.torcontrolprotocol import parse_keywords
+
+
+async def build_asyncio_control_connection(host='127.0.0.1', port=9051, path=None,
+                                           password_function=None):
+    """
+    Connects to Tor's control port (over TCP, or the Unix socket
+    ``path`` if given), authenticates and bootstraps.
+
+    :param password_function: see :class:`AsyncioControlProtocol`
+
+    :return: a bootstrapped :class:`AsyncioControlProtocol`
+    """
+    loop = asyncio.get_running_loop()
+
+    def factory():
+        return AsyncioControlProtocol(password_function=password_function)
+
+    if path is not None:
+        _, proto = await loop.create_unix_connection(factory, path)
+    else:
+        _, proto = await loop.create_connection(factory, host, port)
+    try:
+        await proto.bootstrap()
+    except Exception:
+        proto.transport.close()
+        raise
+    return proto
+
+
+class AsyncioControlProtocol(asyncio.Protocol):
+    """
+    An :class:`asyncio.Protocol` speaking Tor's control protocol. The
+    commands are coroutines returning what the
+    :class:`txtorcon.TorControlProtocol` methods of the same names
+    give their Deferreds, and raise
+    :class:`txtorcon.TorProtocolError` for error replies (or
+    :class:`txtorcon.TorDisconnectError` if the connection is lost
+    first).
+
+    Commands are written to Tor straight away, so several may be
+    outstanding at once; Tor answers them in order.
+
+    Call :meth:`bootstrap` once connected (or use
+    :func:`build_asyncio_control_connection`).
+    """
+
+    def __init__(self, password_function=None, loop=None):
+        """
+        :param password_function: a zero-argument callable returning
+            the password (or an awaitable of it); only used if Tor
+            doesn't accept COOKIE authentication (or we can't read the
+            cookie).
+
+        :param loop: the event loop (default: the one running when
+            the connection is made)
+        """
+        self.password_function = password_function
+        self._loop = loop
+        self.transport = None
+        self.version = None
+        """Version of Tor we've connected to (after :meth:`bootstrap`)."""
+        self.valid_events = ()
+        """Names of the events Tor knows about (after :meth:`bootstrap`)."""
+        self.valid_signals = ()
+        """Names of the signals Tor accepts (after :meth:`bootstrap`)."""
+
+        self._core = ControlCore(
+            on_reply=self._reply_received,
+            on_event=self._event_received,
+            on_reply_line=self._reply_line_received,
+        )
+        self._waiting = deque()  # (future, line-callback) per command
+        self._listeners = {}     # event name -> list of (callback, typed)
+        self._disconnected = None
+
+    # asyncio.Protocol API
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        self._disconnected = self._loop.create_future()
+
+    def data_received(self, data):
+        try:
+            self._core.receive_data(data)
+        except Exception as e:
+            # Tor sent something we can't frame; nothing after it can
+            # be trusted either
+            self.transport.close()
+            self._fail_waiting(e)
+
+    def connection_lost(self, exc):
+        if not self._disconnected.done():
+            self._disconnected.set_result(exc)
+        self._fail_waiting(exc)
+
+    def _fail_waiting(self, exc):
+        waiting = list(self._waiting)
+        self._waiting.clear()
+        for future, _ in waiting:
+            if not future.done():
+                future.set_exception(
+                    TorDisconnectError(
+                        text="Tor connection terminated",
+                        error=exc,
+                    )
+                )
+
+    def when_disconnected(self):
+        """
+        :return: an awaitable that completes (with the exception that
+            closed the connection, or None) when the connection is
+            lost.
+        """
+        return asyncio.shield(self._disconnected)
+
+    # ControlCore callbacks
+
+    def _reply_received(self, code, text):
+        future, _ = self._waiting.popleft()
+        if future.done():
+            return                  # cancelled
+        if code < 300:
+            future.set_result(text)
+        else:
+            future.set_exception(TorProtocolError(code, text))
+
+    def _reply_line_received(self, text):
+        line_cb = self._waiting[0][1]
+        if text.strip() != 'OK':
+            line_cb(text)
+
+    def _event_received(self, name, text):
+        # one record per event, shared by every typed listener and
+        # only made if there is one
+        event = None
+        for callback, typed in self._listeners.get(name, ()):
+            if typed and event is None:
+                event = decode_event(name, text)
+            try:
+                callback(event if typed else text)
+            except Exception as e:
+                self._loop.call_exception_handler({
+                    'message': "Notifying '{}' for '{}' failed".format(callback, name),
+                    'exception': e,
+                    'protocol': self,
+                })
+
+    # commands
+
+    def queue_command(self, cmd, line_callback=None):
+        """
+        Writes ``cmd`` (``str`` or ``bytes``, without a line-ending)
+        to Tor.
+
+        :param line_callback: if not None, called with each line of
+            the reply as it arrives (and the reply itself is then
+            empty); see :meth:`get_info_incremental`.
+
+        :return: a Future of the reply text
+        """
+        if self.transport is None or self._disconnected.done():
+            raise RuntimeError("Not connected to Tor")
+        future = self._loop.create_future()
+        data = self._core.send_command(cmd, stream_lines=line_callback is not None)
+        self._waiting.append((future, line_callback))
+        self.transport.write(data)
+        return future
+
+    async def get_info_raw(self, *keys):
+        return await self.queue_command('GETINFO %s' % ' '.join(keys))
+
+    async def get_info_incremental(self, key, line_cb):
+        return await self.queue_command('GETINFO %s' % key, line_cb)
+
+    async def get_info(self, *keys):
+        """
+        :return: a dict of the keys asked for (see
+            :meth:`txtorcon.TorControlProtocol.get_info`)
+        """
+        return parse_keywords(await self.get_info_raw(*keys), key_hints=keys)
+
+    async def get_conf_raw(self, *keys):
+        return await self.queue_command('GETCONF %s' % ' '.join(keys))
+
+    async def get_conf(self, *keys):
+        return parse_keywords(await self.get_conf_raw(*keys))
+
+    async def set_conf(self, *args):
+        """
+        See :meth:`txtorcon.TorControlProtocol.set_conf`.
+        """
+        if len(args) % 2:
+            raise RuntimeError("Expected an even number of arguments.")
+        pairs = []
+        for key, value in zip(args[::2], args[1::2]):
+            value = str(value)
+            if ' ' in value:
+                value = '"%s"' % value
+            pairs.append('%s=%s' % (key, value))
+        return await self.queue_command('SETCONF ' + ' '.join(pairs))
+
+    async def signal(self, nm):
+        if nm not in self.valid_signals:
+            raise RuntimeError("Invalid signal " + nm)
+        return await self.queue_command('SIGNAL %s' % nm)
+
+    async def protocolinfo(self):
+        return await self.queue_command('PROTOCOLINFO 1')
+
+    async def authenticate(self, passphrase):
+        if not isinstance(passphrase, bytes):
+            passphrase = passphrase.encode()
+        return await self.queue_command(b'AUTHENTICATE ' + b2a_hex(passphrase))
+
+    async def quit(self):
+        return await self.queue_command('QUIT')
+
+    async def add_event_listener(self, evt, callback, typed=False):
+        """
+        Calls ``callback`` with the text (or, if ``typed``, the
+        :class:`txtorcon.events.ControlEvent`) of every ``evt`` event.
+        Sends ``SETEVENTS`` if this is the first listener for ``evt``.
+        """
+        if evt not in self.valid_events:
+            raise RuntimeError("Unknown event type: " + evt)
+        listeners = self._listeners.setdefault(evt, [])
+        listeners.append((callback, typed))
+        if len(listeners) == 1:
+            try:
+                await self._set_events()
+            except Exception:
+                self._listeners[evt].remove((callback, typed))
+                if not self._listeners[evt]:
+                    del self._listeners[evt]
+                raise
+
+    async def remove_event_listener(self, evt, callback):
+        listeners = self._listeners.get(evt, [])
+        for listener in listeners:
+            if listener[0] == callback:
+                listeners.remove(listener)
+                break
+        else:
+            raise ValueError("{} is not listening for {}".format(callback, evt))
+        if not listeners:
+            del self._listeners[evt]
+            await self._set_events()
+
+    def _set_events(self):
+        return self.queue_command('SETEVENTS %s' % ' '.join(self._listeners))
+
+    # setup
+
+    async def bootstrap(self):
+        """
+        Authenticates and then learns :attr:`version`,
+        :attr:`valid_events` and :attr:`valid_signals`.
+        """
+        await self._authenticate()
+        info = await self.get_info('version', 'events/names')
+        self.version = info['version']
+        self.valid_events = tuple(info['events/names'].split())
+        try:
+            signals = await self.get_info('signal/names')
+            self.valid_signals = tuple(signals['signal/names'].split())
+        except TorProtocolError:
+            self.valid_signals = ("RELOAD", "DUMP", "DEBUG", "NEWNYM",
+                                  "CLEARDNSCACHE")
+        await self.queue_command('USEFEATURE EXTENDED_EVENTS')
+        return self
+
+    async def _authenticate(self):
+        """
+        Picks a method from PROTOCOLINFO the same way
+        :class:`txtorcon.TorControlProtocol` does: SAFECOOKIE, COOKIE,
+        HASHEDPASSWORD (via :attr:`password_function`) then NULL.
+        """
+        methods, cookiefile = parse_protocolinfo(await self.protocolinfo())
+
+        cookie = None
+        if 'SAFECOOKIE' in methods or 'COOKIE' in methods:
+            if cookiefile is None:
+                raise RuntimeError(
+                    "Got 'COOKIE' or 'SAFECOOKIE' method, but no 'COOKIEFILE'"
+                )
+            try:
+                with open(cookiefile, 'rb') as f:
+                    cookie = f.read()
+            except IOError as why:
+                if not (self.password_function and 'HASHEDPASSWORD' in methods):
+                    raise RuntimeError(
+                        "Failed to read COOKIEFILE '{}': {}".format(cookiefile, why)
+                    )
+            if cookie is not None and len(cookie) != 32:
+                raise RuntimeError(
+                    "Expected authentication cookie to be 32 bytes, got %d" % len(cookie)
+                )
+
+        if cookie is not None and 'SAFECOOKIE' in methods:
+            client_nonce = os.urandom(32)
+            reply = await self.queue_command(
+                b'AUTHCHALLENGE SAFECOOKIE ' + hexlify(client_nonce)
+            )
+            response = safecookie_response(cookie, client_nonce, reply)
+            await self.queue_command(b'AUTHENTICATE ' + response)
+        elif cookie is not None:
+            await self.authenticate(cookie)
+        elif self.password_function and 'HASHEDPASSWORD' in methods:
+            password = self.password_function()
+            if asyncio.iscoroutine(password) or isinstance(password, asyncio.Future):
+                password = await password
+            if not password:
+                raise RuntimeError("No password available.")
+            await self.authenticate(password)
+        elif 'NULL' in methods:
+            await self.queue_command('AUTHENTICATE')
+        else:
+            raise RuntimeError(
+                "The Tor I connected to doesn't support SAFECOOKIE nor COOKIE"
+                " authentication (or we can't read the cookie files) and I have"
+                " no password_function specified."
+            )
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""
+A bounded, always-on record of raw control-port traffic, and a
+driver to play such a recording back into a
+:class:`txtorcon.TorControlProtocol`.
+
+Unlike :meth:`txtorcon.TorControlProtocol.start_debug` (which writes
+every line to a file) a :class:`WireCapture` keeps only the most
+recent ``max_bytes`` of traffic, in memory, so it is cheap enough to
+leave turned on; write it out with :meth:`WireCapture.dump` when
+something interesting happens and use :func:`replay` to feed it
+through txtorcon again offline, e.g. under a profiler.
+
+Note that apart from ``AUTHENTICATE`` secrets a capture holds
+everything that went over the connection, including e.g. the private
+keys of onion services created with ``ADD_ONION``; treat dumps
+accordingly.
+
+The format (as written by :meth:`WireCapture.dump`) is the 8-byte
+magic ``TXTORCAP``, a one-byte version (1) and then one record per
+line: a big-endian header of timestamp (double, seconds), direction
+(one byte, see :data:`RECEIVED` and :data:`SENT`) and length (4
+bytes) followed by that many bytes of the line itself, without the
+trailing CRLF.
+"""
+
+import struct
+from collections import deque, namedtuple
+
+from twisted.internet import defer
+
+
+RECEIVED = 0
+"""Direction of a line that Tor sent us."""
+
+SENT = 1
+"""Direction of a command we sent to Tor."""
+
+MAGIC = b'TXTORCAP'
+VERSION = 1
+
+_HEADER = struct.Struct('!dBI')
+
+
+CapturedLine = namedtuple('CapturedLine', ('timestamp', 'direction', 'data'))
+"""One line of a capture: reactor time, direction and the raw bytes."""
+
+
+class WireCapture(object):
+    """
+    A ring-buffer of the raw lines going over one control connection
+    (see :meth:`txtorcon.TorControlProtocol.start_capture`). Each line
+    is packed into its binary record as it arrives; once the records
+    add up to more than ``max_bytes`` the oldest are discarded.
+
+    :ivar dropped: how many lines have been discarded so far
+    """
+
+    def __init__(self, max_bytes=1024 * 1024, reactor=None):
+        """
+        :param max_bytes: the most record data (headers included) to
+            keep. The newest line is always kept, even if it alone is
+            larger than this.
+
+        :param reactor: provides the timestamps (default: the global
+            reactor)
+        """
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be positive")
+        if reactor is None:
+            from twisted.internet import reactor
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._seconds = reactor.seconds
+        self._records = deque()
+        self._size = 0
+
+    def _add(self, direction, data):
+        record = _HEADER.pack(self._seconds(), direction, len(data)) + data
+        records = self._records
+        records.append(record)
+        self._size += len(record)
+        while self._size > self.max_bytes and len(records) > 1:
+            self._size -= len(records.popleft())
+            self.dropped += 1
+
+    def received(self, line):
+        """
+        Record a line from Tor (``bytes``, without the line-ending).
+        """
+        self._add(RECEIVED, line)
+
+    def sent(self, line):
+        """
+        Record a command written to Tor (``bytes``, without the
+        line-ending). The secret in an ``AUTHENTICATE`` command is
+        not recorded.
+        """
+        if line.startswith(b'AUTHENTICATE'):
+            line = b'AUTHENTICATE'
+        self._add(SENT, line)
+
+    def clear(self):
+        self._records.clear()
+        self._size = 0
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        """
+        The lines currently held, oldest first, as
+        :class:`CapturedLine` instances.
+        """
+        header_size = _HEADER.size
+        for record in list(self._records):
+            timestamp, direction, _ = _HEADER.unpack_from(record)
+            yield CapturedLine(timestamp, direction, record[header_size:])
+
+    def dumps(self):
+        """
+        :return: the current contents in the binary capture format
+        """
+        return MAGIC + bytes([VERSION]) + b''.join(self._records)
+
+    def dump(self, f):
+        """
+        Write the current contents, in the binary capture format, to
+        the file-like object ``f`` (which must be opened in binary
+        mode).
+        """
+        f.write(self.dumps())
+
+
+def parse_capture(data):
+    """
+    :param data: ``bytes`` in the format written by
+        :meth:`WireCapture.dump`
+
+    :return: a list of :class:`CapturedLine`, oldest first
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a txtorcon capture")
+    version = data[len(MAGIC)]
+    if version != VERSION:
+        raise ValueError("Unknown capture version {}".format(version))
+
+    lines = []
+    offset = len(MAGIC) + 1
+    header_size = _HEADER.size
+    end = len(data)
+    while offset < end:
+        if offset + header_size > end:
+            raise ValueError("Truncated capture record at byte {}".format(offset))
+        timestamp, direction, length = _HEADER.unpack_from(data, offset)
+        offset += header_size
+        if offset + length > end:
+            raise ValueError("Truncated capture record at byte {}".format(offset))
+        lines.append(CapturedLine(timestamp, direction, data[offset:offset + length]))
+        offset += length
+    return lines
+
+
+def load_capture(f):
+    """
+    Read a capture written by :meth:`WireCapture.dump` from the
+    (binary-mode) file-like object ``f``.
+
+    :return: a list of :class:`CapturedLine`, oldest first
+    """
+    return parse_capture(f.read())
+
+
+def _complete(lines):
+    """
+    Internal helper. A ring-buffer usually starts part-way through
+    some reply; skip received lines until the first command we sent
+    or the start of an event, so that replay starts in a sane state.
+    """
+    lines = list(lines)
+    for index, line in enumerate(lines):
+        if line.direction == SENT:
+            return lines[index:]
+        if line.data[:3] == b'650' and line.data[3:4] in (b' ', b'-', b'+'):
+            return lines[index:]
+    return []
+
+
+def replay(capture, protocol, speed=None, send_commands=True, reactor=None):
+    """
+    Feed a capture back into ``protocol`` (a
+    :class:`txtorcon.TorControlProtocol`, perhaps with a
+    :class:`txtorcon.TorState` attached) as if Tor had just sent it.
+
+    The protocol needs some transport, but needn't be connected to
+    anything; for example::
+
+        proto = TorControlProtocol()
+        proto.connectionMade = lambda: None  # skip authentication
+        proto.makeConnection(proto_helpers.StringTransport())
+        proto._set_valid_events(' '.join(names_of_captured_events))
+        d = replay(load_capture(open('capture.bin', 'rb')), proto)
+
+    Lines at the start of the capture that belong to a reply whose
+    beginning had already been discarded by the ring-buffer are
+    skipped.
+
+    :param capture: a :class:`WireCapture` or a list of
+        :class:`CapturedLine` (e.g. from :func:`load_capture`)
+
+    :param speed: None (the default) feeds every line immediately;
+        otherwise lines are delivered with their recorded spacing
+        divided by ``speed`` (so ``1.0`` is real-time, ``10.0`` ten
+        times as fast).
+
+    :param send_commands: if True (the default) each recorded command
+        is queued on ``protocol`` (with the replies ignored) so that
+        the recorded replies have something to answer. Pass False if
+        whatever is driving ``protocol`` will issue the very same
+        commands itself.
+
+    :param reactor: used to schedule lines when ``speed`` is given
+        (default: the global reactor)
+
+    :return: a Deferred that fires with the number of lines from Tor
+        that were delivered (or errbacks if ``protocol`` failed to
+        handle one of them).
+    """
+    # imported here as torcontrolprotocol itself uses this module
+    from txtorcon.torcontrolprotocol import PRIORITY_NORMAL
+    lines = _complete(capture)
+
+    def deliver(line):
+        if line.direction == SENT:
+            if send_commands:
+                # one lane, so commands go out in the recorded order
+                d = protocol.queue_command(line.data, priority=PRIORITY_NORMAL)
+                d.addErrback(lambda _: None)
+            return 0
+        protocol.lineReceived(line.data)
+        return 1
+
+    if speed is None:
+        try:
+            delivered = sum(deliver(line) for line in lines)
+        except Exception:
+            return defer.fail()
+        return defer.succeed(delivered)
+
+    if speed <= 0:
+        raise ValueError("speed must be positive")
+    if reactor is None:
+        from twisted.internet import reactor
+
+    done = defer.Deferred()
+    if not lines:
+        done.callback(0)
+        return done
+    state = {'index': 0, 'delivered': 0}
+    started = reactor.seconds()
+    first = lines[0].timestamp
+
+    def step():
+        index = state['index']
+        try:
+            # deliver everything that is due, so we don't fall behind
+            # when many lines share a timestamp
+            while index < len(lines):
+                line = lines[index]
+                due = started + (line.timestamp - first) / speed
+                if due > reactor.seconds():
+                    break
+                state['delivered'] += deliver(line)
+                index += 1
+        except Exception:
+            done.errback()
+            return
+        state['index'] = index
+        if index >= len(lines):
+            done.callback(state['delivered'])
+            return
+        due = started + (lines[index].timestamp - first) / speed
+        reactor.callLater(max(0, due - reactor.seconds()), step)
+
+    step()
+    return done
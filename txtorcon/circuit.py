@@ -10,7 +10,7 @@ from twisted.internet.interfaces import IStreamClientEndpoint
 from zope.interface import implementer
 
 from .interface import IRouterContainer, IStreamAttacher
-from txtorcon.util import find_keywords, maybe_ip_addr, SingleObserver
+from txtorcon.util import KeywordMap, lower_case_keywords, maybe_ip_addr, SingleObserver
 
 
 # look like "2014-01-25T02:12:14.593772"
@@ -395,15 +395,13 @@ class Circuit(object):
 
     def _create_flags(self, kw):
         """
-        this clones the kw dict, adding a lower-case version of every
-        key (duplicated in stream.py; put in util?)
+        every key of kw both as it was and in lower-case; a
+        KeywordMap (as from update()) has these already, so isn't
+        copied (see :func:`txtorcon.util.lower_case_keywords`)
         """
-
-        flags = {}
-        for k in kw.keys():
-            flags[k] = kw[k]
-            flags[k.lower()] = kw[k]
-        return flags
+        if isinstance(kw, KeywordMap):
+            return kw.as_kwargs()
+        return lower_case_keywords(kw)
 
     def update(self, args):
         # print "Circuit.update:",args
@@ -417,7 +415,7 @@ class Circuit(object):
                 raise RuntimeError("Update for wrong circuit.")
         self.state = args[1]
 
-        kw = find_keywords(args)
+        kw = KeywordMap.from_args(args)
         self.flags = kw
         if 'PURPOSE' in kw:
             self.purpose = kw['PURPOSE']
@@ -522,7 +520,8 @@ class CircuitBuildTimedOutError(Exception):
     """
 
 
-def build_timeout_circuit(tor_state, reactor, path, timeout, using_guards=False):
+def build_timeout_circuit(tor_state, reactor, path, timeout, using_guards=False,
+                          purpose=None):
     """
     Build a new circuit within a timeout.
 
@@ -530,11 +529,14 @@ def build_timeout_circuit(tor_state, reactor, path, timeout, using_guards=False)
     circuit build result (success or failure) within the `timeout`
     duration.
 
+    :param purpose: passed on to
+        :meth:`txtorcon.TorState.build_circuit`
+
     :returns: a Deferred which fires when the circuit build succeeds (or
         fails to build).
     """
     timed_circuit = []
-    d = tor_state.build_circuit(routers=path, using_guards=using_guards)
+    d = tor_state.build_circuit(routers=path, using_guards=using_guards, purpose=purpose)
 
     def get_circuit(c):
         timed_circuit.append(c)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Building many circuits at once, as relay measurements do: a fixed
+number of builds in flight, each timed out and retried, and the
+results delivered as they complete along with how long each circuit
+(and each hop of it) took. See
+:meth:`txtorcon.TorState.build_circuits`.
+"""
+
+import math
+from collections import namedtuple
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from txtorcon.circuit import CircuitBuildTimedOutError
+from txtorcon.interface import CircuitListenerMixin
+from txtorcon.log import txtorlog
+
+
+BuildResult = namedtuple('BuildResult', (
+    'path', 'circuit', 'error', 'attempts', 'build_time', 'hop_times',
+))
+"""
+How building the circuit for one path went. ``circuit`` is the BUILT
+:class:`txtorcon.Circuit` (or None, and ``error`` is the Failure from
+the last attempt). ``attempts`` counts the EXTENDCIRCUITs sent.
+``build_time`` is the seconds from the successful attempt's
+EXTENDCIRCUIT to BUILT, and ``hop_times`` is, for each hop the last
+attempt reached, the seconds from its EXTENDCIRCUIT until Tor said
+the circuit was extended to that hop.
+"""
+
+BuildSummary = namedtuple('BuildSummary', (
+    'results', 'succeeded', 'failed', 'success_rate', 'p50', 'p95',
+))
+"""
+The :class:`BuildResult` for every path (in the order of the paths),
+how many were built and how many weren't, the fraction built, and
+the median and 95th percentile ``build_time`` of those built (None
+if none were).
+"""
+
+
+def _percentile(ordered, fraction):
+    # "nearest rank"
+    if not ordered:
+        return None
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarize(results):
+    """
+    :param results: :class:`BuildResult` instances
+    :return: a :class:`BuildSummary` of them
+    """
+    results = list(results)
+    times = sorted(result.build_time for result in results if result.circuit is not None)
+    return BuildSummary(
+        results,
+        len(times),
+        len(results) - len(times),
+        len(times) / float(len(results)) if results else 0.0,
+        _percentile(times, 0.50),
+        _percentile(times, 0.95),
+    )
+
+
+class _HopTimer(CircuitListenerMixin):
+    """
+    Notes when a circuit reaches each hop, relative to ``started``.
+    """
+
+    def __init__(self, reactor, started, times):
+        self._reactor = reactor
+        self._started = started
+        self.times = times
+
+    def circuit_extend(self, circuit, router):
+        self.times.append(self._reactor.seconds() - self._started)
+
+
+def _attempt(tor_state, reactor, path, timeout, using_guards, hop_times):
+    """
+    Sends one EXTENDCIRCUIT for ``path``, appending to ``hop_times``
+    as hops are reached.
+
+    :return: a Deferred that fires with (circuit, build time) or
+        errbacks (with CircuitBuildTimedOutError after ``timeout``
+        seconds, having closed the circuit -- or arranged to close
+        it once Tor tells us which it is)
+    """
+    started = reactor.seconds()
+    timer = _HopTimer(reactor, started, hop_times)
+    extending = []
+    timed_out = []
+
+    # cancelling this doesn't touch the EXTENDCIRCUIT, whose reply
+    # we still need if it's late
+    d = defer.Deferred(lambda _: timed_out.append(True))
+    timeout_call = reactor.callLater(timeout, d.cancel)
+
+    def extended(circuit):
+        if timed_out:
+            _close_late(circuit)
+            return
+        extending.append(circuit)
+        # hops Tor told us about before it answered EXTENDCIRCUIT
+        hop_times.extend([reactor.seconds() - started] * len(circuit.path))
+        circuit.listen(timer)
+        circuit.when_built().addBoth(deliver)
+
+    def deliver(result):
+        # after a timeout, d has already been errbacked
+        if d.called:
+            return None
+        if isinstance(result, Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    building = tor_state.build_circuit(routers=path, using_guards=using_guards)
+    building.addCallbacks(extended, deliver)
+
+    def built(circuit):
+        return circuit, reactor.seconds() - started
+
+    def trap_cancel(fail):
+        fail.trap(defer.CancelledError)
+        if extending:
+            closed = extending[0].close()
+        else:
+            closed = defer.succeed(None)
+        closed.addCallback(lambda _: Failure(CircuitBuildTimedOutError("circuit build timed out")))
+        return closed
+
+    def finished(result):
+        if timeout_call.active():
+            timeout_call.cancel()
+        if extending and timer in extending[0].listeners:
+            extending[0].unlisten(timer)
+        return result
+
+    d.addCallback(built)
+    d.addErrback(trap_cancel)
+    d.addBoth(finished)
+    return d
+
+
+def _close_late(circuit):
+    # Tor answered EXTENDCIRCUIT after we'd timed out
+    d = circuit.close()
+    d.addErrback(lambda f: txtorlog.msg("Closing timed-out circuit failed:", f.getErrorMessage()))
+
+
+@defer.inlineCallbacks
+def _build(tor_state, reactor, path, timeout, retries, using_guards):
+    """
+    Builds one circuit, trying up to ``retries`` more times.
+
+    :return: a Deferred that fires with a BuildResult
+    """
+    for attempt in range(1, retries + 2):
+        hop_times = []
+        try:
+            circuit, build_time = yield _attempt(
+                tor_state, reactor, path, timeout, using_guards, hop_times,
+            )
+        except Exception:
+            error = Failure()
+        else:
+            return BuildResult(path, circuit, None, attempt, build_time, tuple(hop_times))
+    return BuildResult(path, None, error, attempt, None, tuple(hop_times))
+
+
+def build_circuits(tor_state, reactor, paths, concurrency=10, timeout=60, retries=0,
+                   using_guards=False, result_callback=None):
+    """
+    See :meth:`txtorcon.TorState.build_circuits`.
+    """
+    if concurrency < 1:
+        raise ValueError("concurrency must be at least 1")
+    if retries < 0:
+        raise ValueError("retries can't be negative")
+    work = enumerate(paths)
+    results = {}
+
+    @defer.inlineCallbacks
+    def worker():
+        # every worker takes the next path from the same iterator
+        for index, path in work:
+            result = yield _build(tor_state, reactor, path, timeout, retries, using_guards)
+            results[index] = result
+            if result_callback is not None:
+                try:
+                    result_callback(result)
+                except Exception:
+                    # the other results still need building
+                    log.err(Failure(), "result_callback failed")
+
+    d = defer.gatherResults(
+        [worker() for _ in range(concurrency)],
+        consumeErrors=True,
+    )
+    d.addCallbacks(
+        lambda _: summarize(results[index] for index in sorted(results)),
+        lambda f: f.value.subFailure,
+    )
+    return d
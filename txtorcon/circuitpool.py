@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+Keeping circuits built ahead of time, so that something wanting a
+fresh circuit (for example, to isolate one request from the others
+with :meth:`txtorcon.Circuit.web_agent` or
+:meth:`txtorcon.Circuit.stream_via`) doesn't have to wait for one to
+be built.
+
+NOTE WELL: a :class:`CircuitPool` with an exit country or port
+chooses its own paths (with :meth:`txtorcon.TorState.select_path`),
+which makes your circuits stand out; with neither, Tor chooses.
+"""
+
+from collections import namedtuple, OrderedDict, deque
+
+from twisted.internet import defer
+
+from txtorcon.circuit import build_timeout_circuit
+from txtorcon.log import txtorlog
+
+
+CircuitClass = namedtuple(
+    'CircuitClass', ('exit_country', 'exit_port', 'purpose'),
+    defaults=(None, None, None),
+)
+"""
+A kind of circuit a :class:`CircuitPool` keeps ready: one whose exit
+is in ``exit_country`` (a country code) and allows ``exit_port``, and
+which Tor builds with ``purpose``. Any of these may be None, for "no
+preference"; ``CircuitClass()`` is any circuit Tor cares to build.
+"""
+
+
+class CircuitPool(object):
+    """
+    Keeps a number of BUILT circuits of each of several
+    :class:`CircuitClass` ready to hand out. A circuit is handed out
+    at most once (and is then the caller's to close), and is replaced
+    by building another; ready circuits that close, or that have
+    been ready for ``max_age`` seconds, are replaced too.
+
+    Nothing is built until :meth:`start` is called.
+    """
+
+    def __init__(self, reactor, state, classes, max_age=600, build_timeout=60,
+                 retry_delay=5, max_retry_delay=300, using_guards=False):
+        """
+        :param reactor: for timeouts and ages
+
+        :param state: the :class:`txtorcon.TorState` to build
+            circuits with
+
+        :param classes: a dict mapping each :class:`CircuitClass` to
+            how many circuits of it to keep ready
+
+        :param max_age: how many seconds a circuit may sit ready
+            before it's closed and replaced (Tor stops using a circuit
+            for new streams after MaxCircuitDirtiness, but a pooled
+            circuit only becomes "dirty" once it is used)
+
+        :param build_timeout: give up on a circuit that hasn't been
+            built after this many seconds (see
+            :func:`txtorcon.build_timeout_circuit`)
+
+        :param retry_delay: after a build fails, wait this many
+            seconds before trying again (unless :meth:`get` needs a
+            circuit sooner); the wait doubles with each failure in a
+            row, up to ``max_retry_delay`` seconds
+
+        :param using_guards: if True, circuits we choose paths for
+            start at one of our entry guards
+        """
+        for circuit_class, count in classes.items():
+            if count < 0:
+                raise ValueError(
+                    "Can't keep {} circuits of {}".format(count, circuit_class)
+                )
+        self._reactor = reactor
+        self._state = state
+        self._targets = dict(classes)
+        self._max_age = max_age
+        self._build_timeout = build_timeout
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._using_guards = using_guards
+        self._running = False
+        # class -> OrderedDict of ready Circuit -> its expiry call,
+        # oldest first
+        self._ready = {circuit_class: OrderedDict() for circuit_class in classes}
+        # class -> how many circuits are being built
+        self._building = {circuit_class: 0 for circuit_class in classes}
+        # class -> deque of Deferreds from get() waiting for a circuit
+        self._waiting = {circuit_class: deque() for circuit_class in classes}
+        # class -> the call to _fill after a failed build
+        self._retries = {}
+        # class -> how many builds in a row have failed
+        self._failures = {}
+        # classes whose exit country we're asking Tor about
+        self._locating = set()
+
+    def start(self):
+        """
+        Starts building circuits (and keeping them built).
+        """
+        self._running = True
+        for circuit_class in self._targets:
+            self._fill(circuit_class)
+
+    def stop(self):
+        """
+        Stops building circuits and closes the ready ones; any
+        :meth:`get` still waiting errbacks with CancelledError.
+
+        :return: a Deferred that fires once Tor has been asked to
+            close every ready circuit
+        """
+        self._running = False
+        for retry in self._retries.values():
+            retry.cancel()
+        self._retries.clear()
+        closing = []
+        for circuit_class, ready in self._ready.items():
+            while ready:
+                circuit, expiry = ready.popitem(last=False)
+                expiry.cancel()
+                closing.append(self._close(circuit))
+            waiting = self._waiting[circuit_class]
+            while waiting:
+                waiting.popleft().errback(defer.CancelledError())
+        return defer.gatherResults(closing)
+
+    def available(self, circuit_class=CircuitClass()):
+        """
+        :return: how many circuits of ``circuit_class`` are ready
+        """
+        return len(self._ready[circuit_class])
+
+    def get(self, circuit_class=CircuitClass()):
+        """
+        Takes a BUILT circuit of ``circuit_class`` out of the pool
+        (and starts building its replacement). When one is ready this
+        is immediate; otherwise it waits for the next one built.
+
+        :return: a Deferred that fires with a
+            :class:`txtorcon.Circuit`, or errbacks if the build it was
+            waiting for failed
+        :raises RuntimeError: if the pool isn't started (or was
+            stopped)
+        """
+        if circuit_class not in self._targets:
+            raise ValueError("Not a class of circuit this pool keeps: {}".format(circuit_class))
+        if not self._running:
+            raise RuntimeError("CircuitPool isn't running")
+        ready = self._ready[circuit_class]
+        if ready:
+            circuit, expiry = ready.popitem(last=False)
+            expiry.cancel()
+            d = defer.succeed(circuit)
+        else:
+            d = defer.Deferred()
+            self._waiting[circuit_class].append(d)
+        self._fill(circuit_class)
+        return d
+
+    def _fill(self, circuit_class, located=False):
+        """
+        Starts enough builds to give every waiting get() a circuit and
+        still leave the target number ready.
+        """
+        retry = self._retries.pop(circuit_class, None)
+        if retry is not None and retry.active():
+            retry.cancel()
+        if not self._running:
+            return
+        if not located and self._locate(circuit_class):
+            return
+        wanted = self._targets[circuit_class] + len(self._waiting[circuit_class])
+        have = len(self._ready[circuit_class]) + self._building[circuit_class]
+        for _ in range(wanted - have):
+            self._build(circuit_class)
+
+    def _locate(self, circuit_class):
+        """
+        If ``circuit_class`` wants an exit country we know of no
+        relays in (as when there's no local GeoIP database), asks Tor
+        where the relays are and fills the class after that; True if
+        the class has to wait for it.
+        """
+        country = circuit_class.exit_country
+        if country is None or self._state.routers_in_country(country):
+            return False
+        if circuit_class not in self._locating:
+            self._locating.add(circuit_class)
+
+            def located(_):
+                self._locating.discard(circuit_class)
+                self._fill(circuit_class, located=True)
+            d = self._state.locate_routers()
+            d.addErrback(lambda f: txtorlog.msg("Locating relays failed:", f.getErrorMessage()))
+            d.addCallback(located)
+        return True
+
+    def _path(self, circuit_class):
+        """
+        The path for a circuit of ``circuit_class``, or None to let
+        Tor choose.
+        """
+        if circuit_class.exit_country is None and circuit_class.exit_port is None:
+            return None
+        ports = () if circuit_class.exit_port is None else (circuit_class.exit_port, )
+        return self._state.select_path(
+            exit_ports=ports,
+            using_guards=self._using_guards,
+            exit_country=circuit_class.exit_country,
+        )
+
+    def _build(self, circuit_class):
+        self._building[circuit_class] += 1
+        try:
+            path = self._path(circuit_class)
+        except Exception:
+            d = defer.fail()
+        else:
+            d = build_timeout_circuit(
+                self._state, self._reactor, path, self._build_timeout,
+                using_guards=self._using_guards, purpose=circuit_class.purpose,
+            )
+        d.addCallbacks(
+            self._built, self._build_failed,
+            callbackArgs=(circuit_class, ), errbackArgs=(circuit_class, ),
+        )
+
+    def _built(self, circuit, circuit_class):
+        self._building[circuit_class] -= 1
+        self._failures.pop(circuit_class, None)
+        if not self._running:
+            self._close(circuit)
+            return
+        waiting = self._waiting[circuit_class]
+        if waiting:
+            waiting.popleft().callback(circuit)
+            return
+        expiry = self._reactor.callLater(self._max_age, self._expire, circuit, circuit_class)
+        self._ready[circuit_class][circuit] = expiry
+        circuit.when_closed().addCallback(self._closed, circuit_class)
+
+    def _build_failed(self, fail, circuit_class):
+        self._building[circuit_class] -= 1
+        txtorlog.msg("Building a circuit for the pool failed:", fail.getErrorMessage())
+        waiting = self._waiting[circuit_class]
+        if waiting:
+            waiting.popleft().errback(fail)
+        failures = self._failures[circuit_class] = self._failures.get(circuit_class, 0) + 1
+        if self._running and circuit_class not in self._retries:
+            delay = min(self._retry_delay * 2 ** min(failures - 1, 16), self._max_retry_delay)
+            self._retries[circuit_class] = self._reactor.callLater(
+                delay, self._fill, circuit_class,
+            )
+
+    def _closed(self, circuit, circuit_class):
+        # a ready circuit closed before anyone took it
+        expiry = self._ready[circuit_class].pop(circuit, None)
+        if expiry is not None:
+            expiry.cancel()
+            self._fill(circuit_class)
+
+    def _expire(self, circuit, circuit_class):
+        if self._ready[circuit_class].pop(circuit, None) is not None:
+            self._close(circuit)
+            self._fill(circuit_class)
+
+    def _close(self, circuit):
+        d = circuit.close()
+        d.addErrback(lambda f: txtorlog.msg("Closing pooled circuit failed:", f.getErrorMessage()))
+        return d
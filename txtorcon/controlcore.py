@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+The Tor control protocol without any I/O. A :class:`ControlCore`
+turns the commands you send into bytes for the wire, and frames the
+bytes Tor sends back into replies, reply lines and events, which it
+hands to the callbacks you give it. It never reads, writes or
+schedules anything itself, so it can be driven by
+:class:`txtorcon.TorControlProtocol` (Twisted),
+:class:`txtorcon.aiocontrol.AsyncioControlProtocol` (asyncio), a
+blocking socket or a benchmark, and all of them frame replies and
+events identically.
+
+Also here are the I/O-free parts of authentication: parsing a
+``PROTOCOLINFO`` reply and answering a ``SAFECOOKIE`` challenge.
+"""
+
+import re
+import base64
+from collections import deque
+
+from txtorcon.util import hmac_sha256, compare_via_hash, unescape_quoted_string
+
+
+MAX_LINE_LENGTH = 2 ** 20
+"""The longest line :meth:`ControlCore.receive_data` accepts. At least
+``GETINFO md/id/X`` for some X exceeds 16384 bytes; Tor's control.c
+defines ``MAX_COMMAND_LINE_LENGTH`` as 1024*1024, so we use that."""
+
+
+# the status codes Tor actually sends, pre-parsed for receive_line
+_STATUS_CODES = {
+    str(code).encode('ascii'): code
+    for code in (250, 251, 451, 500, 510, 511, 512, 513, 514, 515,
+                 550, 551, 552, 553, 554, 555, 650)
+}
+
+
+def _parse_status_code(line):
+    """
+    Internal helper. Returns the status code at the start of a reply
+    line from Tor.
+    """
+    try:
+        return int(line[:3])
+    except ValueError:
+        raise RuntimeError(
+            'Expected a status code at start of "%s"' % line.decode('ascii', 'replace')
+        )
+
+
+_REPLY_FRAMER_DOT = '''digraph framer {
+    IDLE -> IDLE [label="XYZ SP\\nreply done"];
+    IDLE -> REPLY [label="XYZ-"];
+    IDLE -> DATA [label="XYZ+"];
+    REPLY -> REPLY [label="XYZ-"];
+    REPLY -> DATA [label="XYZ+"];
+    REPLY -> IDLE [label="XYZ SP\\nreply done"];
+    DATA -> DATA [label="any line"];
+    DATA -> REPLY [label="."];
+}
+'''
+
+
+class ControlCore(object):
+    """
+    The state of one control connection: which commands are awaiting
+    replies and how far through the current reply we are.
+
+    Tor answers commands strictly in order, so every
+    :meth:`send_command` is matched by exactly one call of
+    ``on_reply``, first-in first-out; ``on_event`` can be called at
+    any time between replies. Commands may be pipelined (i.e. sent
+    before earlier ones have been answered).
+
+    Every reply line starts with a three-digit status code and a
+    separator: '-' (more lines follow), '+' (a data block follows,
+    ended by a line holding a single '.') or ' ' (this is the last
+    line of the reply). Lines inside a data block are passed along
+    verbatim.
+
+    The callbacks are called synchronously from :meth:`receive_data`
+    (or :meth:`receive_line`); an exception from one of them
+    propagates to that caller.
+    """
+
+    def __init__(self, on_reply, on_event, on_reply_line=None,
+                 max_line_length=MAX_LINE_LENGTH):
+        """
+        :param on_reply: called as ``on_reply(code, text)`` with the
+            complete reply to the oldest command awaiting one. ``text``
+            holds the lines after their status codes, joined with
+            newlines (and without a trailing ``OK`` line for 2xx
+            replies); it is empty if the lines were already delivered
+            to ``on_reply_line``.
+
+        :param on_event: called as ``on_event(name, text)`` for each
+            asynchronous (650) event, where ``name`` is e.g. ``CIRC``
+            and ``text`` everything after it.
+
+        :param on_reply_line: called as ``on_reply_line(text)`` with
+            each line (status code and separator removed) of replies
+            to commands sent with ``stream_lines=True``, as they
+            arrive.
+        """
+        self.max_line_length = max_line_length
+        self._on_reply = on_reply
+        self._on_event = on_event
+        self._on_reply_line = on_reply_line
+        self._buffer = b''
+        # one entry per command awaiting its reply: whether to deliver
+        # its lines to on_reply_line
+        self._pending = deque()
+        self._code = None          # status code of the reply in progress
+        self._stream = False       # whether its lines go to on_reply_line
+        self._lines = []           # bytes; joined once the reply is complete
+        self._in_data_block = False
+
+    @property
+    def pending(self):
+        """How many commands have been sent but not yet answered."""
+        return len(self._pending)
+
+    def send_command(self, cmd, stream_lines=False):
+        """
+        :param cmd: the command (``bytes`` or ASCII ``str``) without a
+            line-ending
+
+        :param stream_lines: if True, the lines of this command's
+            reply are delivered one by one to ``on_reply_line`` (and
+            ``on_reply`` gets only the last line of an error reply)
+
+        :return: the ``bytes`` to write to Tor
+        """
+        if not isinstance(cmd, bytes):
+            cmd = cmd.encode('ascii')
+        if stream_lines and self._on_reply_line is None:
+            raise ValueError("stream_lines needs an on_reply_line callback")
+        self._pending.append(stream_lines)
+        return cmd + b'\r\n'
+
+    def receive_data(self, data):
+        """
+        Feed ``bytes`` received from Tor, in chunks of any size.
+        """
+        lines = (self._buffer + data).split(b'\r\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > self.max_line_length:
+            raise RuntimeError(
+                "Line longer than {} bytes from Tor".format(self.max_line_length)
+            )
+        for line in lines:
+            if len(line) > self.max_line_length:
+                raise RuntimeError(
+                    "Line longer than {} bytes from Tor".format(self.max_line_length)
+                )
+            self.receive_line(line)
+
+    def receive_line(self, line):
+        """
+        Feed one complete line (``bytes``, without the line-ending)
+        received from Tor; for transports that split lines already.
+        """
+        if self._in_data_block:
+            if line == b'.':
+                self._in_data_block = False
+            elif self._stream:
+                self._on_reply_line(line.decode('ascii'))
+            else:
+                self._lines.append(line)
+            return
+
+        try:
+            code = _STATUS_CODES[line[:3]]
+        except KeyError:
+            code = _parse_status_code(line)
+        separator = line[3:4]
+        if self._code is None:
+            if code == 650 and separator == b' ':
+                # the common case of a single-line event
+                self._event(line[4:].decode('ascii'))
+                return
+            # the first line of a reply (or multi-line event); lines
+            # from asynchronous (600-level) events never stream
+            self._code = code
+            self._stream = code < 600 and bool(self._pending) and self._pending[0]
+        elif code != self._code:
+            raise RuntimeError(
+                "Unexpected code %d, wanted %d" % (code, self._code)
+            )
+
+        if separator == b'-' or separator == b'+':
+            if separator == b'+':
+                self._in_data_block = True
+            if self._stream:
+                self._on_reply_line(line[4:].decode('ascii'))
+            else:
+                self._lines.append(line[4:])
+        elif separator == b' ' or separator == b'':
+            self._reply_done(line.decode('ascii'))
+        else:
+            raise RuntimeError(
+                'Unexpected separator in reply line "%s"' % line.decode('ascii')
+            )
+
+    def _event(self, text):
+        name = text.split(None, 1)[0]
+        self._on_event(name, text[len(name) + 1:])
+
+    def _collect(self, last_line):
+        """
+        Joins all the lines accumulated for this reply (plus
+        ``last_line``, a str, if it's not None) into one string,
+        emptying the buffer. Joining once at the end keeps large
+        replies (e.g. ns/all, config/names) linear-time.
+        """
+        lines = self._lines
+        self._lines = []
+        if not lines:
+            return '' if last_line is None else last_line
+        if last_line is None:
+            lines.append(b'')
+        else:
+            lines.append(last_line.encode('ascii'))
+        return b'\n'.join(lines).decode('ascii')
+
+    def _reply_done(self, line):
+        "the final line of a reply (or multi-line event)"
+        code = self._code
+        self._code = None
+        if 600 <= code < 700:
+            self._event(self._collect(line[4:] if len(line) > 3 else None))
+            return
+        if not (200 <= code < 300 or 500 <= code < 600):
+            self._lines = []
+            raise RuntimeError(
+                "Unknown code in broadcast response %d." % code
+            )
+        if not self._pending:
+            text = self._collect(line[4:] if len(line) > 3 else None)
+            raise RuntimeError(
+                'Got a response, but didn\'t issue a command: "%s"' % text
+            )
+
+        stream = self._pending.popleft()
+        if len(line) > 3:
+            if code < 300 and stream:
+                self._lines = []
+                self._on_reply_line(line[4:])
+                text = ''
+            else:
+                text = self._collect(line[4:])
+        else:
+            text = self._collect(None)
+        if code < 300 and text.endswith('\nOK'):
+            text = text[:-3]
+        self._on_reply(code, text)
+
+
+def parse_protocolinfo(reply):
+    """
+    :param reply: the text of a ``PROTOCOLINFO 1`` reply
+
+    :return: a 2-tuple of the list of authentication methods Tor
+        accepts (e.g. ``['COOKIE', 'SAFECOOKIE']``) and the (unescaped)
+        cookie file, or None if Tor didn't name one.
+    """
+    methods = None
+    for line in reply.split('\n'):
+        if line[:5] == 'AUTH ':
+            match = re.search(r'METHODS=(\S+)', line)
+            if match:
+                methods = match.group(1).split(',')
+    if not methods:
+        raise RuntimeError(
+            "Didn't find AUTH line in PROTOCOLINFO response."
+        )
+    cookiefile = None
+    match = re.search(r'COOKIEFILE=("(?:[^"\\]|\\.)*")', reply)
+    if match:
+        cookiefile = unescape_quoted_string(match.group(1))
+    return methods, cookiefile
+
+
+def safecookie_response(cookie, client_nonce, reply):
+    """
+    Checks Tor's answer to ``AUTHCHALLENGE SAFECOOKIE`` and computes
+    our half of the exchange.
+
+    :param cookie: the 32 bytes of Tor's cookie file
+
+    :param client_nonce: the ``bytes`` we sent (hex-encoded) in the
+        ``AUTHCHALLENGE``
+
+    :param reply: the text of Tor's reply to it
+
+    :return: the ``bytes`` to send as ``AUTHENTICATE <response>``
+    """
+    kw = dict(
+        word.split('=', 1) for word in reply.split() if '=' in word
+    )
+    server_hash = base64.b16decode(kw['SERVERHASH'])
+    server_nonce = base64.b16decode(kw['SERVERNONCE'])
+    # FIXME put string in global. or something.
+    expected_server_hash = hmac_sha256(
+        b"Tor safe cookie authentication server-to-controller hash",
+        cookie + client_nonce + server_nonce,
+    )
+
+    if not compare_via_hash(expected_server_hash, server_hash):
+        raise RuntimeError(
+            'Server hash not expected; wanted "%s" and got "%s".' %
+            (base64.b16encode(expected_server_hash),
+             base64.b16encode(server_hash))
+        )
+
+    client_hash = hmac_sha256(
+        b"Tor safe cookie authentication controller-to-server hash",
+        cookie + client_nonce + server_nonce
+    )
+    return base64.b16encode(client_hash)
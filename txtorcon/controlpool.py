@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from zope.interface import implementer
+
+from txtorcon.torcontrolprotocol import TorProtocolFactory
+from txtorcon.torcontrolprotocol import PRIORITY_NORMAL
+from txtorcon.interface import ITorControlProtocol
+from txtorcon.util import SingleObserver
+
+
+def _observe(d):
+    """
+    Internal helper. A new Deferred with the result of ``d``, leaving
+    ``d``'s own callback chain (and result) alone.
+    """
+    observer = defer.Deferred()
+
+    def fire(result):
+        if isinstance(result, Failure):
+            observer.errback(result)
+            return None
+        observer.callback(result)
+        return result
+    d.addBoth(fire)
+    return observer
+
+
+@defer.inlineCallbacks
+def build_control_pool(endpoint, command_connections=2,
+                       password_function=lambda: None, max_in_flight=1):
+    """
+    Opens ``command_connections + 1`` authenticated control
+    connections to the Tor at ``endpoint`` and waits for all of them
+    to bootstrap.
+
+    :param endpoint: an IStreamClientEndpoint for Tor's control port
+
+    :param password_function: see :class:`txtorcon.TorProtocolFactory`
+
+    :param max_in_flight: see :class:`txtorcon.TorProtocolFactory`
+
+    :return: a Deferred that fires with a :class:`TorControlPool`, or
+        errbacks (having closed any connections that were made) if a
+        connection couldn't be made or bootstrapped
+    """
+    if command_connections < 1:
+        raise ValueError("Need at least one command connection")
+    factory = TorProtocolFactory(
+        password_function=password_function,
+        max_in_flight=max_in_flight,
+    )
+    results = yield defer.DeferredList(
+        [endpoint.connect(factory) for _ in range(command_connections + 1)],
+        consumeErrors=True,
+    )
+    protocols = [result for (ok, result) in results if ok]
+    for (ok, result) in results:
+        if not ok:
+            _close(protocols)
+            result.raiseException()
+    pool = TorControlPool(protocols[0], protocols[1:])
+    try:
+        yield pool.post_bootstrap
+    except Exception:
+        _close(protocols)
+        raise
+    return pool
+
+
+def _close(protocols):
+    for proto in protocols:
+        proto.transport.loseConnection()
+
+
+@implementer(ITorControlProtocol)
+class TorControlPool(object):
+    """
+    Several control connections to the same Tor, used together as one
+    :class:`txtorcon.interface.ITorControlProtocol` (so you can pass
+    one to :class:`txtorcon.TorState` or :class:`txtorcon.TorConfig`
+    in place of a :class:`txtorcon.TorControlProtocol`).
+
+    Event subscriptions (``SETEVENTS``, i.e.
+    :meth:`add_event_listener`) all live on one dedicated connection,
+    so a flood of events never sits in front of a command's reply.
+    Every other command goes to whichever command connection has the
+    fewest commands outstanding.
+
+    Because different connections answer independently, commands
+    sent through the pool may complete in a different order than they
+    were sent in: if one command depends on another (e.g. a
+    ``GETCONF`` after a ``SETCONF``) wait for the first one's
+    Deferred before sending the second.
+
+    The easiest way to get one is :func:`build_control_pool`.
+    """
+
+    # commands that only make sense on the connection carrying the
+    # event subscriptions (and TAKEOWNERSHIP, since Tor exits when
+    # the connection that sent it closes: that should be the one
+    # that lasts as long as the pool)
+    _EVENT_COMMANDS = (b'SETEVENTS', b'USEFEATURE', b'TAKEOWNERSHIP')
+
+    def __init__(self, event_protocol, command_protocols):
+        """
+        :param event_protocol: the :class:`txtorcon.TorControlProtocol`
+            to subscribe to events on
+
+        :param command_protocols: a list of
+            :class:`txtorcon.TorControlProtocol` instances (connected
+            to the same Tor) to send commands on. None of them need be
+            bootstrapped yet.
+        """
+        if not command_protocols:
+            raise ValueError("Need at least one command protocol")
+        self.event_protocol = event_protocol
+        self.command_protocols = list(command_protocols)
+
+        self.post_bootstrap = defer.Deferred()
+        """Fires with this pool once every connection has
+        bootstrapped (or errbacks if one of them failed to)."""
+
+        self._when_disconnected = SingleObserver()
+
+        everything = [self.event_protocol] + self.command_protocols
+        d = defer.gatherResults(
+            [_observe(proto.post_bootstrap) for proto in everything],
+            consumeErrors=True,
+        )
+        d.addCallbacks(
+            lambda _: self.post_bootstrap.callback(self),
+            lambda f: self.post_bootstrap.errback(f.value.subFailure),
+        )
+
+        for proto in self.command_protocols:
+            proto.when_disconnected().addBoth(self._command_protocol_lost, proto)
+        self.event_protocol.when_disconnected().addBoth(self._event_protocol_gone)
+
+    def _command_protocol_lost(self, reason, proto):
+        # keep going on the others; if this was the last one, commands
+        # go to the event connection (while it lasts)
+        if proto in self.command_protocols:
+            self.command_protocols.remove(proto)
+        return None
+
+    def _event_protocol_gone(self, reason):
+        self._when_disconnected.fire(reason)
+        return None
+
+    def _pick(self):
+        """
+        The command connection with the fewest outstanding commands.
+        """
+        if not self.command_protocols:
+            return self.event_protocol
+        return min(self.command_protocols, key=lambda proto: proto.outstanding)
+
+    # state that is the same on every connection to a Tor
+
+    @property
+    def version(self):
+        return self.event_protocol.version
+
+    @property
+    def valid_events(self):
+        return self.event_protocol.valid_events
+
+    @property
+    def valid_signals(self):
+        return self.event_protocol.valid_signals
+
+    @property
+    def events(self):
+        return self.event_protocol.events
+
+    @property
+    def is_owned(self):
+        return self.event_protocol.is_owned
+
+    @is_owned.setter
+    def is_owned(self, pid):
+        for proto in [self.event_protocol] + self.command_protocols:
+            proto.is_owned = pid
+
+    @property
+    def outstanding(self):
+        return sum(
+            proto.outstanding
+            for proto in [self.event_protocol] + self.command_protocols
+        )
+
+    def when_disconnected(self):
+        """
+        :returns: a Deferred that fires when (if) the event connection
+            is lost; losing a command connection just takes it out of
+            rotation.
+        """
+        return self._when_disconnected.when_fired()
+
+    # events
+
+    def add_event_listener(self, evt, callback, **kw):
+        """
+        See :meth:`txtorcon.TorControlProtocol.add_event_listener`;
+        all subscriptions are made on the event connection.
+        """
+        return self.event_protocol.add_event_listener(evt, callback, **kw)
+
+    def remove_event_listener(self, evt, cb):
+        return self.event_protocol.remove_event_listener(evt, cb)
+
+    # commands
+
+    def queue_command(self, cmd, arg=None, priority=PRIORITY_NORMAL):
+        """
+        See :meth:`txtorcon.TorControlProtocol.queue_command`.
+        """
+        if not isinstance(cmd, bytes):
+            cmd = cmd.encode('ascii')
+        if cmd.split(b' ', 1)[0].upper() in self._EVENT_COMMANDS:
+            proto = self.event_protocol
+        else:
+            proto = self._pick()
+        return proto.queue_command(cmd, arg, priority=priority)
+
+    def get_info_raw(self, *args, priority=PRIORITY_NORMAL):
+        return self._pick().get_info_raw(*args, priority=priority)
+
+    def get_info_incremental(self, key, line_cb, priority=PRIORITY_NORMAL):
+        return self._pick().get_info_incremental(key, line_cb, priority=priority)
+
+    def get_info_stream(self, key, batch_size=None, max_buffered=1024):
+        return self._pick().get_info_stream(key, batch_size, max_buffered)
+
+    def get_info(self, *args, priority=PRIORITY_NORMAL):
+        return self._pick().get_info(*args, priority=priority)
+
+    def get_info_single(self, key):
+        return self._pick().get_info_single(key)
+
+    def get_conf(self, *args, priority=PRIORITY_NORMAL):
+        return self._pick().get_conf(*args, priority=priority)
+
+    def get_conf_single(self, key):
+        return self._pick().get_conf_single(key)
+
+    def get_conf_raw(self, *args, priority=PRIORITY_NORMAL):
+        return self._pick().get_conf_raw(*args, priority=priority)
+
+    def set_conf(self, *args):
+        return self._pick().set_conf(*args)
+
+    def signal(self, nm):
+        return self._pick().signal(nm)
+
+    def protocolinfo(self):
+        return self._pick().protocolinfo()
+
+    def quit(self):
+        """
+        Sends QUIT on every connection.
+        """
+        return defer.gatherResults(
+            [proto.quit() for proto in self.command_protocols + [self.event_protocol]],
+            consumeErrors=True,
+        )
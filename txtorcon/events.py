@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+
+"""
+Typed, parse-once records for asynchronous (650) control-port
+events.
+
+Pass ``typed=True`` to
+:meth:`txtorcon.TorControlProtocol.add_event_listener` and your
+callback receives one of the classes below instead of the raw event
+text. The record is created once per event and shared by every typed
+listener; its fields are only tokenized the first time one of them is
+read, so listeners that look at nothing but ``.name`` pay nothing.
+
+Records are read-only: the ``keywords`` mapping can't be modified, so
+one listener can't change what another sees.
+"""
+
+from types import MappingProxyType
+
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from txtorcon.util import split_event_args, split_event_keywords
+
+
+_EMPTY = MappingProxyType({})
+
+
+class ControlEvent(object):
+    """
+    An event from Tor, as delivered to ``typed=True`` listeners.
+
+    Events without a more specific class below get this one; all of
+    them have the attributes documented here.
+
+    :ivar name: the event name, e.g. ``"CIRC"``
+
+    :ivar raw: the event text exactly as a non-typed listener would
+        receive it (i.e. without the ``650`` and the name)
+    """
+
+    __slots__ = ('name', 'raw', '_positional', '_keywords')
+
+    def __init__(self, name, raw):
+        self.name = name
+        self.raw = raw
+        self._positional = None
+        self._keywords = None
+
+    def _parse(self):
+        positional = []
+        keywords = split_event_keywords(split_event_args(self.raw), positional)
+        self._positional = tuple(positional)
+        self._keywords = MappingProxyType(keywords) if keywords else _EMPTY
+
+    @property
+    def positional(self):
+        """
+        A tuple of the positional (non-keyword) arguments, with any
+        quoting removed.
+        """
+        if self._positional is None:
+            self._parse()
+        return self._positional
+
+    @property
+    def keywords(self):
+        """
+        A read-only mapping of all ``KEY=value`` arguments, with any
+        quoting removed from the values.
+        """
+        if self._keywords is None:
+            self._parse()
+        return self._keywords
+
+    def _arg(self, index, default=None):
+        positional = self.positional
+        if index < len(positional):
+            return positional[index]
+        return default
+
+    def __getitem__(self, key):
+        return self.keywords[key]
+
+    def get(self, key, default=None):
+        """
+        The value of keyword argument ``key`` (or ``default``).
+        """
+        return self.keywords.get(key, default)
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(self.__class__.__name__, self.name, self.raw)
+
+
+class CircuitEvent(ControlEvent):
+    """
+    A ``CIRC`` event: ``CircuitID CircStatus [Path] [keywords]``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def circuit_id(self):
+        return int(self.positional[0])
+
+    @property
+    def status(self):
+        return self.positional[1]
+
+    @property
+    def path(self):
+        """
+        A list of the LongName of every hop so far (possibly empty).
+        """
+        path = self._arg(2)
+        if path is None:
+            return []
+        return path.split(',')
+
+    @property
+    def purpose(self):
+        return self.keywords.get('PURPOSE')
+
+    @property
+    def reason(self):
+        return self.keywords.get('REASON')
+
+
+class StreamEvent(ControlEvent):
+    """
+    A ``STREAM`` event: ``StreamID StreamStatus CircuitID Target
+    [keywords]``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def stream_id(self):
+        return int(self.positional[0])
+
+    @property
+    def status(self):
+        return self.positional[1]
+
+    @property
+    def circuit_id(self):
+        return int(self.positional[2])
+
+    @property
+    def target(self):
+        return self.positional[3]
+
+    @property
+    def target_host(self):
+        target = self.target
+        return target[:target.rfind(':')]
+
+    @property
+    def target_port(self):
+        target = self.target
+        return int(target[target.rfind(':') + 1:])
+
+    @property
+    def reason(self):
+        return self.keywords.get('REASON')
+
+
+class ORConnEvent(ControlEvent):
+    """
+    An ``ORCONN`` event: ``Target ORStatus [keywords]``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def target(self):
+        return self.positional[0]
+
+    @property
+    def status(self):
+        return self.positional[1]
+
+    @property
+    def reason(self):
+        return self.keywords.get('REASON')
+
+
+class BandwidthEvent(ControlEvent):
+    """
+    A ``BW`` event: ``BytesRead BytesWritten [keywords]``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def bytes_read(self):
+        return int(self.positional[0])
+
+    @property
+    def bytes_written(self):
+        return int(self.positional[1])
+
+
+class CircuitBandwidthEvent(ControlEvent):
+    """
+    A ``CIRC_BW`` event; all its arguments are keywords (``ID``,
+    ``READ``, ``WRITTEN`` and, on newer Tors, more).
+    """
+
+    __slots__ = ()
+
+    @property
+    def circuit_id(self):
+        return int(self.keywords['ID'])
+
+    @property
+    def bytes_read(self):
+        return int(self.keywords['READ'])
+
+    @property
+    def bytes_written(self):
+        return int(self.keywords['WRITTEN'])
+
+
+class StreamBandwidthEvent(ControlEvent):
+    """
+    A ``STREAM_BW`` event: ``StreamID BytesWritten BytesRead
+    [Time]`` (note that written comes first).
+    """
+
+    __slots__ = ()
+
+    @property
+    def stream_id(self):
+        return int(self.positional[0])
+
+    @property
+    def bytes_written(self):
+        return int(self.positional[1])
+
+    @property
+    def bytes_read(self):
+        return int(self.positional[2])
+
+
+def _cells_by_type(value):
+    cells = {}
+    if value:
+        for item in value.split(','):
+            cell_type, _, count = item.partition(':')
+            cells[cell_type] = int(count)
+    return cells
+
+
+class CellStatsEvent(ControlEvent):
+    """
+    A ``CELL_STATS`` event; all its arguments are keywords. The
+    ``*_added`` / ``*_removed`` properties are dicts of cell-type to
+    count (e.g. ``{'relay': 12, 'create2': 1}``).
+    ``circuit_id`` is None for circuits we didn't originate.
+    """
+
+    __slots__ = ()
+
+    @property
+    def circuit_id(self):
+        circ_id = self.keywords.get('ID')
+        return None if circ_id is None else int(circ_id)
+
+    @property
+    def inbound_added(self):
+        return _cells_by_type(self.keywords.get('InboundAdded'))
+
+    @property
+    def inbound_removed(self):
+        return _cells_by_type(self.keywords.get('InboundRemoved'))
+
+    @property
+    def outbound_added(self):
+        return _cells_by_type(self.keywords.get('OutboundAdded'))
+
+    @property
+    def outbound_removed(self):
+        return _cells_by_type(self.keywords.get('OutboundRemoved'))
+
+
+class HiddenServiceDescriptorEvent(ControlEvent):
+    """
+    An ``HS_DESC`` event: ``Action HSAddress AuthType HsDir
+    [DescriptorID] [keywords]``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def action(self):
+        return self.positional[0]
+
+    @property
+    def address(self):
+        return self.positional[1]
+
+    @property
+    def auth_type(self):
+        return self.positional[2]
+
+    @property
+    def hs_dir(self):
+        return self.positional[3]
+
+    @property
+    def descriptor_id(self):
+        return self._arg(4)
+
+    @property
+    def reason(self):
+        return self.keywords.get('REASON')
+
+
+class AddrMapEvent(ControlEvent):
+    """
+    An ``ADDRMAP`` event: ``Address NewAddress Expiry [keywords]``.
+    ``expiry`` is local time (or ``"NEVER"``); ``expires`` is the UTC
+    ``EXPIRES=`` keyword if Tor sent one.
+    """
+
+    __slots__ = ()
+
+    @property
+    def address(self):
+        return self.positional[0]
+
+    @property
+    def new_address(self):
+        return self.positional[1]
+
+    @property
+    def expiry(self):
+        return self._arg(2)
+
+    @property
+    def expires(self):
+        return self.keywords.get('EXPIRES')
+
+    @property
+    def error(self):
+        return self.keywords.get('error')
+
+
+class StatusEvent(ControlEvent):
+    """
+    A ``STATUS_GENERAL``, ``STATUS_CLIENT`` or ``STATUS_SERVER``
+    event: ``Severity Action [Arguments]``; the arguments are in
+    ``keywords``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def severity(self):
+        return self.positional[0]
+
+    @property
+    def action(self):
+        return self.positional[1]
+
+
+EVENT_TYPES = {
+    'CIRC': CircuitEvent,
+    'STREAM': StreamEvent,
+    'ORCONN': ORConnEvent,
+    'BW': BandwidthEvent,
+    'CIRC_BW': CircuitBandwidthEvent,
+    'STREAM_BW': StreamBandwidthEvent,
+    'CELL_STATS': CellStatsEvent,
+    'HS_DESC': HiddenServiceDescriptorEvent,
+    'ADDRMAP': AddrMapEvent,
+    'STATUS_GENERAL': StatusEvent,
+    'STATUS_CLIENT': StatusEvent,
+    'STATUS_SERVER': StatusEvent,
+}
+"""event name -> record class; anything else is a plain ControlEvent"""
+
+
+def decode_event(name, data):
+    """
+    :return: the typed record for an event called ``name`` whose text
+        (without the ``650`` and the name) is ``data``. Nothing is
+        parsed until a field is read.
+    """
+    return EVENT_TYPES.get(name, ControlEvent)(name, data)
+
+
+def _add_cells(totals, cells):
+    for cell_type, count in cells.items():
+        totals[cell_type] = totals.get(cell_type, 0) + count
+
+
+class EventBatch(object):
+    """
+    Several events of one kind, delivered together to a listener
+    added with a ``window`` or ``max_events`` (see
+    :meth:`txtorcon.TorControlProtocol.add_event_listener`).
+
+    Byte and cell counters in bandwidth events are summed over the
+    whole batch, so a metrics consumer usually needn't look at the
+    individual ``events`` at all.
+
+    :ivar name: the event name, e.g. ``"CIRC_BW"``
+
+    :ivar events: a list of the typed records (see
+        :func:`decode_event`), oldest first; bandwidth or cell events
+        whose counters couldn't be read are logged and left out
+
+    :ivar started: reactor time when the first event arrived
+
+    :ivar ended: reactor time when the batch was delivered
+
+    :ivar bytes_read: total bytes read over all ``BW``, ``CIRC_BW``
+        or ``STREAM_BW`` events in the batch
+
+    :ivar bytes_written: total bytes written, likewise
+
+    :ivar circuit_bytes: for ``CIRC_BW``, a dict mapping circuit ID to
+        ``(bytes_read, bytes_written)``
+
+    :ivar stream_bytes: for ``STREAM_BW``, a dict mapping stream ID to
+        ``(bytes_read, bytes_written)``
+
+    :ivar circuit_cells: for ``CELL_STATS``, a dict mapping circuit
+        ID to ``{'inbound': {...}, 'outbound': {...}}`` where each
+        inner dict maps a cell-type to the number of cells added to
+        that queue. Events without a circuit ID are not included.
+    """
+
+    __slots__ = (
+        'name', 'events', 'started', 'ended',
+        'bytes_read', 'bytes_written',
+        'circuit_bytes', 'stream_bytes', 'circuit_cells',
+    )
+
+    def __init__(self, name, events, started, ended):
+        self.name = name
+        self.events = events
+        self.started = started
+        self.ended = ended
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.circuit_bytes = {}
+        self.stream_bytes = {}
+        self.circuit_cells = {}
+
+        # the counters are read straight from the raw text of each
+        # event rather than via the (lazy) record fields, so batching
+        # doesn't make every record tokenize itself. An event whose
+        # counters can't be read is logged and left out, and the rest
+        # are still delivered.
+        count = self._COUNTERS.get(name)
+        if count is not None:
+            self.events = []
+            for ev in events:
+                try:
+                    count(self, ev)
+                except Exception:
+                    log.err(Failure(), "Skipping malformed {} event".format(name))
+                    continue
+                self.events.append(ev)
+
+    def _add_bytes(self, totals, ident, read, written):
+        try:
+            prev_read, prev_written = totals[ident]
+        except KeyError:
+            totals[ident] = (read, written)
+        else:
+            totals[ident] = (prev_read + read, prev_written + written)
+        self.bytes_read += read
+        self.bytes_written += written
+
+    # each of these reads everything from an event before adding any
+    # of it, so a malformed event changes nothing
+
+    def _count_bw(self, ev):
+        args = ev.raw.split(None, 2)
+        read, written = int(args[0]), int(args[1])
+        self.bytes_read += read
+        self.bytes_written += written
+
+    def _count_circuit_bytes(self, ev):
+        circ_id = read = written = None
+        for token in ev.raw.split():
+            key, _, value = token.partition('=')
+            if key == 'ID':
+                circ_id = int(value)
+            elif key == 'READ':
+                read = int(value)
+            elif key == 'WRITTEN':
+                written = int(value)
+        if circ_id is None or read is None or written is None:
+            raise ValueError("Malformed CIRC_BW event: {}".format(ev.raw))
+        self._add_bytes(self.circuit_bytes, circ_id, read, written)
+
+    def _count_stream_bytes(self, ev):
+        args = ev.raw.split(None, 3)
+        # note: written comes before read
+        stream_id, written, read = int(args[0]), int(args[1]), int(args[2])
+        self._add_bytes(self.stream_bytes, stream_id, read, written)
+
+    def _count_cells(self, ev):
+        circ_id = ev.circuit_id
+        if circ_id is None:
+            return
+        inbound = ev.inbound_added
+        outbound = ev.outbound_added
+        try:
+            cells = self.circuit_cells[circ_id]
+        except KeyError:
+            cells = self.circuit_cells[circ_id] = {
+                'inbound': {},
+                'outbound': {},
+            }
+        _add_cells(cells['inbound'], inbound)
+        _add_cells(cells['outbound'], outbound)
+
+    _COUNTERS = {
+        'BW': _count_bw,
+        'CIRC_BW': _count_circuit_bytes,
+        'STREAM_BW': _count_stream_bytes,
+        'CELL_STATS': _count_cells,
+    }
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __repr__(self):
+        return '<EventBatch {} events={}>'.format(self.name, len(self.events))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+What :class:`txtorcon.TorState` remembers about circuits and streams
+once they have closed or failed: a record of each of the most recent
+ones (up to a fixed number, so the memory used is bounded however
+long Tor runs) and counts of how every one of them ended.
+
+The records hold only plain values (ids, strings, numbers and tuples
+of them), never the :class:`txtorcon.Circuit` or
+:class:`txtorcon.Stream` instances, so the listeners and Deferreds
+those have are not kept alive. Times are the reactor's
+``seconds()`` when TorState saw the corresponding event.
+"""
+
+from collections import namedtuple, deque, Counter
+
+
+CircuitRecord = namedtuple('CircuitRecord', (
+    'id', 'state', 'reason', 'purpose', 'path', 'launched', 'built', 'closed',
+))
+"""
+A finished circuit. ``state`` is its final state (``"CLOSED"`` or
+``"FAILED"``), ``reason`` is Tor's REASON (and REMOTE_REASON, if
+given; "unknown" if neither was), ``path`` is a tuple of the
+``id_hex`` of each router, and ``launched``, ``built`` and
+``closed`` are when it was first seen, became BUILT (or None, if it
+never did) and ended.
+"""
+
+StreamRecord = namedtuple('StreamRecord', (
+    'id', 'state', 'reason', 'target_host', 'target_port', 'circuit_id', 'opened', 'closed',
+))
+"""
+A finished stream. ``state`` is its final state (``"CLOSED"`` or
+``"FAILED"``), ``reason`` is as for :class:`CircuitRecord`,
+``circuit_id`` is the id of the last circuit it was attached to (or
+None) and ``opened`` and ``closed`` are when it was first seen (None
+if it already existed when TorState bootstrapped) and ended.
+"""
+
+
+class History(object):
+    """
+    The most recent ``size`` :class:`CircuitRecord` and
+    :class:`StreamRecord` instances (oldest first), plus counts of
+    all the records ever added by (state, reason).
+    """
+
+    def __init__(self, size):
+        #: a deque of CircuitRecord
+        self.circuits = deque(maxlen=size)
+        #: a deque of StreamRecord
+        self.streams = deque(maxlen=size)
+        #: a Counter of (state, reason) of every finished circuit
+        self.circuit_counts = Counter()
+        #: a Counter of (state, reason) of every finished stream
+        self.stream_counts = Counter()
+
+    def add_circuit(self, record):
+        self.circuits.append(record)
+        self.circuit_counts[(record.state, record.reason)] += 1
+
+    def add_stream(self, record):
+        self.streams.append(record)
+        self.stream_counts[(record.state, record.reason)] += 1
+
+    def clear(self):
+        """
+        Forgets all the records and counts.
+        """
+        self.circuits.clear()
+        self.streams.clear()
+        self.circuit_counts.clear()
+        self.stream_counts.clear()
@@ -347,6 +347,45 @@ class CircuitListenerMixin(object):
         pass
 
 
+class IRouterListener(Interface):
+    """
+    Notifications about the routers in each new consensus, compared
+    to the one before. They arrive once the new consensus is in
+    place (so :attr:`txtorcon.TorState.routers` etc. already reflect
+    it); see :meth:`txtorcon.TorState.add_router_listener`.
+    """
+
+    def router_added(router):
+        "a router that wasn't in the previous consensus"
+
+    def router_removed(router):
+        "a router that isn't in the new consensus"
+
+    def router_changed(router):
+        """
+        a router whose entry in the consensus is different (a newer
+        descriptor, or new flags, bandwidth, addresses, ...); the
+        :class:`txtorcon.Router` has already been updated.
+        """
+
+
+@implementer(IRouterListener)
+class RouterListenerMixin(object):
+    """
+    Implements all of IRouterListener with no-op methods. Subclass
+    from this if you don't care about most of the notifications.
+    """
+
+    def router_added(self, router):
+        pass
+
+    def router_removed(self, router):
+        pass
+
+    def router_changed(self, router):
+        pass
+
+
 class ITorControlProtocol(Interface):
     """
     This defines the API to the TorController object.
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+Choosing circuit paths the way Tor does: guard, middle and exit hops
+each picked at random in proportion to bandwidth (scaled by the
+consensus "bandwidth-weights" for that position, when known), from
+relays with the right flags, with no two hops the same relay, in the
+same /16 or (if families are known) in the same family.
+
+A :class:`PathSelector` is built for one consensus and keeps an
+:class:`AliasTable` for each position, so picking a hop takes a
+couple of random numbers and a lookup however many relays there are;
+the exits allowing particular ports (or in a particular country) get
+their own (cached) table.
+:meth:`txtorcon.TorState.select_path` keeps one of these for the
+current consensus.
+
+NOTE WELL: using paths you choose yourself rather than letting Tor
+choose them makes your circuits stand out; this is for measurement
+and other advanced uses.
+"""
+
+import random
+import socket
+from array import array
+
+from txtorcon.router import ExitPolicyIndex, flag_mask
+
+# "weights are given as integers out of bwweightscale" (dir-spec)
+_WEIGHT_SCALE = 10000.0
+
+_GUARD = flag_mask(['guard'])
+_EXIT = flag_mask(['exit'])
+_BAD_EXIT = flag_mask(['badexit'])
+_STABLE = flag_mask(['stable'])
+_USABLE = flag_mask(['fast', 'running', 'valid'])
+
+# which bandwidth-weight applies to a relay in each position, by
+# whether it's a guard and whether it's an exit (the "D" weights
+# are for relays that are both)
+_POSITION_WEIGHTS = {
+    'guard': {(True, False): 'Wgg', (True, True): 'Wgd'},
+    'middle': {(False, False): 'Wmm', (True, False): 'Wmg',
+               (False, True): 'Wme', (True, True): 'Wmd'},
+    'exit': {(False, True): 'Wee', (True, True): 'Wed'},
+}
+
+# how many times to re-pick a hop that conflicts with one already in
+# the path before giving up
+_ATTEMPTS = 1000
+
+# how many exit tables (each for a set of ports) to keep
+_EXIT_TABLES = 64
+
+
+def parse_bandwidth_weights(line):
+    """
+    :param line: a consensus "bandwidth-weights" line, like
+        ``"bandwidth-weights Wbd=0 Wbe=0 ... Wmm=10000"``
+    :return: a dict of weight names to ints
+    """
+    weights = {}
+    for item in line.split():
+        if '=' in item:
+            name, value = item.split('=', 1)
+            weights[name] = int(value)
+    return weights
+
+
+class AliasTable(object):
+    """
+    Picks an index at random in proportion to ``weights`` in constant
+    time, using Vose's alias method: index N is kept with probability
+    ``probability[N]``, and otherwise swapped for ``alias[N]``.
+    """
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = float(sum(weights))
+        if count == 0 or total <= 0:
+            raise ValueError("Nothing to choose from")
+
+        scaled = [weight * count / total for weight in weights]
+        self.probability = array('d', [1.0]) * count
+        self.alias = array('L', range(count))
+        small = [index for (index, weight) in enumerate(scaled) if weight < 1.0]
+        large = [index for (index, weight) in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # anything left over is 1.0 but for rounding
+
+    def __len__(self):
+        return len(self.probability)
+
+    def sample(self, rand):
+        """
+        :param rand: a :class:`random.Random` instance
+        :return: an index into the weights
+        """
+        # one random number gives both the column and the coin flip
+        point = rand.random() * len(self.probability)
+        index = int(point)
+        if point - index < self.probability[index]:
+            return index
+        return self.alias[index]
+
+
+def _subnet(ip):
+    try:
+        return int.from_bytes(socket.inet_aton(ip), 'big') >> 16
+    except OSError:
+        return None
+
+
+class _Candidates(object):
+    """
+    The relays that can be in one position, with an AliasTable of
+    their weights.
+    """
+
+    def __init__(self, position, routers, weights):
+        chosen = [(router, weight) for (router, weight) in zip(routers, weights) if weight > 0]
+        if not chosen:
+            raise ValueError("No relays for the {} position".format(position))
+        self.routers = [router for (router, _) in chosen]
+        self.subnets = [_subnet(router.ip) for router in self.routers]
+        self.table = AliasTable([weight for (_, weight) in chosen])
+
+    def pick(self, rand, path, subnets, family, family_of):
+        """
+        Picks a relay that isn't in ``path``, in one of the /16s in
+        ``subnets`` or with an identity in ``family`` (those of the
+        relays in the path and their families), and (if we know
+        families) doesn't list a relay in the path as family.
+        """
+        for _ in range(_ATTEMPTS):
+            index = self.table.sample(rand)
+            router = self.routers[index]
+            subnet = self.subnets[index]
+            if router in path or router.id_hex in family:
+                continue
+            if subnet is not None and subnet in subnets:
+                continue
+            if family_of is not None:
+                if any(other.id_hex in (family_of(router) or ()) for other in path):
+                    continue
+            return router, subnet
+        raise RuntimeError(
+            "Couldn't find a relay that isn't in the same /16 or family as {}".format(
+                ', '.join(router.id_hex for router in path)
+            )
+        )
+
+
+class PathSelector(object):
+    """
+    Chooses paths from ``routers`` (for example, the values of
+    :attr:`txtorcon.TorState.routers_by_hash`). Build a new one for
+    each consensus.
+
+    Every hop must have the Fast, Running and Valid flags; the first
+    must also have Guard and the last Exit (and not BadExit).
+
+    :param routers: the :class:`txtorcon.Router` instances
+    :param bandwidth_weights: a dict like
+        :func:`parse_bandwidth_weights` returns; if None, every
+        position just uses the relays' bandwidths.
+    :param family: a callable returning the identities (``id_hex``)
+        of the relays in a Router's family, or None if families
+        aren't known (``ns/all`` doesn't list them).
+    :param exit_index: an :class:`txtorcon.router.ExitPolicyIndex`
+        of ``routers`` to use for exit ports, rather than building
+        one when one is first needed.
+    :param countries: a callable returning the Routers in a country
+        (given its code, like
+        :meth:`txtorcon.TorState.routers_in_country`), for
+        ``exit_country`` in :meth:`select_path`.
+    :param rand: the :class:`random.Random` instance to use (by
+        default, a :class:`random.SystemRandom`).
+    """
+
+    def __init__(self, routers, bandwidth_weights=None, family=None,
+                 exit_index=None, countries=None, rand=None):
+        self.routers = [
+            router for router in routers
+            if router.flag_bits & _USABLE == _USABLE
+        ]
+        self._weights = bandwidth_weights
+        self._family = family
+        self._exit_index = exit_index
+        self._countries = countries
+        self._random = rand or random.SystemRandom()
+        # (position, stable) -> _Candidates
+        self._candidates = {}
+        # (stable, ports, country) -> _Candidates (or None, if there
+        # are none) for exits allowing ports (and in the country, if
+        # it isn't None)
+        self._exits_by_ports = {}
+
+    def _weighted(self, position, stable, routers):
+        weight_names = _POSITION_WEIGHTS[position]
+        eligible = []
+        weights = []
+        for router in routers:
+            bits = router.flag_bits
+            if stable and not bits & _STABLE:
+                continue
+            kind = (bool(bits & _GUARD), bool(bits & _EXIT) and not bits & _BAD_EXIT)
+            try:
+                name = weight_names[kind]
+            except KeyError:
+                continue
+            if self._weights is None:
+                scale = 1.0
+            else:
+                scale = self._weights.get(name, _WEIGHT_SCALE) / _WEIGHT_SCALE
+            eligible.append(router)
+            weights.append(router.bandwidth * scale)
+        return _Candidates(position, eligible, weights)
+
+    def _position(self, position, stable):
+        try:
+            return self._candidates[(position, stable)]
+        except KeyError:
+            candidates = self._weighted(position, stable, self.routers)
+            self._candidates[(position, stable)] = candidates
+            return candidates
+
+    def _exits(self, stable, ports, country=None):
+        if not ports and country is None:
+            return self._position('exit', stable)
+        key = (stable, ports, country)
+        try:
+            candidates = self._exits_by_ports[key]
+        except KeyError:
+            pass
+        else:
+            if candidates is None:
+                raise ValueError("No relays for the exit position")
+            return candidates
+        routers = self.routers
+        if ports:
+            if self._exit_index is None:
+                self._exit_index = ExitPolicyIndex(self.routers)
+            accepting = self._exit_index.routers_accepting(*ports)
+            routers = [router for router in routers if router in accepting]
+        if country is not None:
+            if self._countries is None:
+                raise ValueError("No way to find the relays in a country")
+            located = self._countries(country)
+            routers = [router for router in routers if router in located]
+        if len(self._exits_by_ports) >= _EXIT_TABLES:
+            self._exits_by_ports.clear()
+        try:
+            candidates = self._weighted('exit', stable, routers)
+        except ValueError:
+            # remembered, too
+            self._exits_by_ports[key] = None
+            raise
+        self._exits_by_ports[key] = candidates
+        return candidates
+
+    def select_path(self, length=3, exit_ports=(), stable=False, guards=None, exits=None,
+                    exit_country=None):
+        """
+        Chooses a path. As Tor does, the exit is chosen first, then
+        the guard and then any middle hops.
+
+        :param length: how many hops (at least 2)
+        :param exit_ports: ports the exit's policy must accept
+        :param stable: if True, every hop must have the Stable flag
+            (as Tor wants for long-lived connections)
+        :param guards: if given, choose the first hop from these
+            Routers (for example, ``TorState.entry_guards.values()``)
+            rather than from every guard
+        :param exits: if given, choose the last hop from those of
+            these Routers that could otherwise be the exit (for
+            example, a list of relays to measure); each call with
+            ``exits`` weighs them all again
+        :param exit_country: if given, a country code: choose the last
+            hop from the relays ``countries`` gives for it. The table
+            of these is kept for later calls.
+
+        :return: a list of ``length`` :class:`txtorcon.Router` instances
+        :raises ValueError: if there are no relays for some position
+        :raises RuntimeError: if no hop could be found that isn't in
+            the same /16 or family as the others
+        """
+        if length < 2:
+            raise ValueError("A path needs at least 2 hops, not {}".format(length))
+        rand = self._random
+        path = []
+        subnets = set()
+        family = set()
+
+        def add(candidates):
+            router, subnet = candidates.pick(rand, path, subnets, family, self._family)
+            path.append(router)
+            subnets.add(subnet)
+            family.add(router.id_hex)
+            if self._family is not None:
+                family.update(self._family(router) or ())
+            return router
+
+        if exit_country is not None:
+            exit_country = exit_country.upper()
+        candidates = self._exits(stable, tuple(sorted(set(exit_ports))), exit_country)
+        if exits is not None:
+            allowed = set(candidates.routers)
+            candidates = self._weighted('exit', stable, [router for router in exits if router in allowed])
+        exit_router = add(candidates)
+        if guards is None:
+            guard = add(self._position('guard', stable))
+        else:
+            guards = [router for router in guards if router.flag_bits & _USABLE == _USABLE]
+            guard = add(self._weighted('guard', stable, guards))
+        middles = [add(self._position('middle', stable)) for _ in range(length - 2)]
+        return [guard] + middles + [exit_router]
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import sys
 import json
+import threading
+from array import array
+from bisect import bisect_right
 from datetime import datetime
 from .util import NetLocation
 from .util import _Version
-from base64 import b64encode, b64decode
-from binascii import b2a_hex, a2b_hex
+from base64 import b64encode
+from binascii import a2b_base64, a2b_hex
 
 from twisted.internet.defer import inlineCallbacks, succeed
 from twisted.python.deprecate import deprecated
@@ -20,7 +24,7 @@ def hexIdFromHash(thehash):
     :param thehash: base64-encoded str
     :return: hex-encoded hash
     """
-    return '$' + b2a_hex(b64decode(thehash + '=')).decode('ascii').upper()
+    return '$' + a2b_base64(thehash + '=').hex().upper()
 
 
 def hashFromHexId(hexid):
@@ -32,6 +36,214 @@ def hashFromHexId(hexid):
     return b64encode(a2b_hex(hexid))[:-1].decode('ascii')
 
 
+def parse_port_ranges(ports):
+    """
+    Parses a list of ports and port ranges like the ones in exit-policy
+    summaries (e.g. ``"22,80,6660-6669"``) into a compact array: the
+    low and high (inclusive) end of each range in turn, sorted, with
+    overlapping or adjacent ranges merged.
+
+    :param ports: comma-separated str
+    :return: an ``array('H')`` of ``[low0, high0, low1, high1, ...]``
+    """
+    ranges = []
+    for port in ports.split(','):
+        low, _, high = port.partition('-')
+        ranges.append((int(low), int(high or low)))
+    ranges.sort()
+    merged = array('H')
+    for (low, high) in ranges:
+        if merged and low <= merged[-1] + 1:
+            merged[-1] = max(merged[-1], high)
+        else:
+            merged.append(low)
+            merged.append(high)
+    return merged
+
+
+def port_in_ranges(port, ranges):
+    """
+    :param ranges: an array from :func:`parse_port_ranges`
+    :return: True if ``port`` is in one of the ``ranges``.
+    """
+    index = bisect_right(ranges, port)
+    # between a low and a high end, or exactly on a high end
+    return index % 2 == 1 or (index > 0 and ranges[index - 1] == port)
+
+
+class ExitPolicyIndex(object):
+    """
+    Which of some routers' exit policies accept each port, for
+    answering "which routers can I exit to port P through?" without
+    looking at each router.
+
+    Each router with a policy gets an ordinal (its position in
+    :attr:`routers`) and the routers accepting a port are a bitset of
+    ordinals: a Python int with bit N set for router N. So the routers
+    accepting several ports (or accepting a port and also in some
+    other bitset) come from ANDing ints. The port space is stored as
+    the sorted starts of the intervals over which the set of
+    accepting routers doesn't change, with the bitset for each.
+    """
+
+    def __init__(self, routers):
+        #: the routers with a policy; bit N is routers[N]
+        self.routers = [router for router in routers if router.port_ranges is not None]
+
+        # routers mostly share a few hundred distinct policies
+        policies = {}
+        for ordinal, router in enumerate(self.routers):
+            key = (router.policy_accepts, router.port_ranges.tobytes())
+            try:
+                policies[key][2] |= 1 << ordinal
+            except KeyError:
+                policies[key] = [router.policy_accepts, router.port_ranges, 1 << ordinal]
+
+        # a policy's routers go in or out of the set at each end of
+        # each of its ranges (and "reject" policies start off in it)
+        current = 0
+        toggles = {}
+        for (accepts, ranges, bits) in policies.values():
+            if not accepts:
+                current ^= bits
+            for index in range(0, len(ranges), 2):
+                low = ranges[index]
+                toggles[low] = toggles.get(low, 0) ^ bits
+                high = ranges[index + 1] + 1
+                if high < 65536:
+                    toggles[high] = toggles.get(high, 0) ^ bits
+
+        self._starts = [0]
+        self._bitsets = [current]
+        for port in sorted(toggles):
+            current ^= toggles[port]
+            if port == 0:
+                self._bitsets[0] = current
+            else:
+                self._starts.append(port)
+                self._bitsets.append(current)
+
+    def bits_for_port(self, port):
+        """
+        :return: the bitset (an int) of the routers accepting ``port``
+        """
+        if not 0 <= port < 65536:
+            raise ValueError("Invalid port {}".format(port))
+        return self._bitsets[bisect_right(self._starts, port) - 1]
+
+    def routers_for_bits(self, bits):
+        """
+        :return: a set of the routers whose bits are set in ``bits``
+        """
+        routers = self.routers
+        found = set()
+        reverse = bin(bits)[:1:-1]      # lowest bit first
+        ordinal = reverse.find('1')
+        while ordinal != -1:
+            found.add(routers[ordinal])
+            ordinal = reverse.find('1', ordinal + 1)
+        return found
+
+    def routers_accepting(self, *ports):
+        """
+        :return: a set of the routers whose policies accept all of
+            ``ports``
+        """
+        bits = (1 << len(self.routers)) - 1
+        for port in ports:
+            bits &= self.bits_for_port(port)
+        return self.routers_for_bits(bits)
+
+
+# the flags dir-spec lists, in the order consensuses give them; any
+# others we see get the next bits (see flag_mask)
+_FLAG_NAMES = [
+    'authority', 'badexit', 'exit', 'fast', 'guard', 'hsdir', 'middleonly',
+    'named', 'noedconsensus', 'running', 'stable', 'staledesc', 'sybil',
+    'unnamed', 'v2dir', 'valid',
+]
+_FLAG_BITS = dict((name, 1 << bit) for bit, name in enumerate(_FLAG_NAMES))
+_FLAG_VIEWS = {}                        # mask -> tuple of flag names
+# held while a new flag (or spelling) is added, since consensuses
+# are compared in a thread (see txtorcon.torstate._relay_key)
+_FLAG_LOCK = threading.Lock()
+
+# most routers use one of a few ports; share the ints
+_PORTS = {}
+# and one of a few hundred exit-policy summaries; share the parsed
+# arrays (which nothing modifies) rather than parsing each again,
+# and the text Router.policy gives for each (by the array's id)
+_PORT_RANGES = {}
+_PORT_RANGES_TEXT = {}
+
+
+def flag_mask(flags):
+    """
+    The bitmask :class:`txtorcon.Router` stores ``flags`` (an iterable
+    of flag names, in any case) as. Flags we haven't seen before are
+    given the next free bit, since Tor may add new ones. Safe to call
+    from any thread.
+    """
+    mask = 0
+    for flag in flags:
+        try:
+            mask |= _FLAG_BITS[flag]
+        except KeyError:
+            mask |= _add_flag(flag)
+    return mask
+
+
+def _add_flag(flag):
+    name = flag.lower()
+    with _FLAG_LOCK:
+        if name not in _FLAG_BITS:
+            # the name goes in first, so anything that sees the bit
+            # can find its name
+            _FLAG_NAMES.append(sys.intern(name))
+            _FLAG_BITS[name] = 1 << (len(_FLAG_NAMES) - 1)
+        # remember this spelling too (Tor capitalizes them)
+        bit = _FLAG_BITS[flag] = _FLAG_BITS[name]
+    return bit
+
+
+def _flag_names(mask):
+    try:
+        return _FLAG_VIEWS[mask]
+    except KeyError:
+        names = tuple(name for (bit, name) in enumerate(_FLAG_NAMES) if mask >> bit & 1)
+        _FLAG_VIEWS[mask] = names
+        return names
+
+
+def _port(port):
+    try:
+        port = int(port)
+    except ValueError:
+        return port
+    return _PORTS.setdefault(port, port)
+
+
+def _port_ranges(ports):
+    try:
+        return _PORT_RANGES[ports]
+    except KeyError:
+        ranges = _PORT_RANGES.setdefault(ports, parse_port_ranges(ports))
+        _PORT_RANGES_TEXT[id(ranges)] = _ports_text(ranges)
+        return ranges
+
+
+def _ports_text(ranges):
+    return ','.join(map(str, _ports(ranges)))
+
+
+def _ports(ranges):
+    ports = []
+    for index in range(0, len(ranges), 2):
+        low, high = ranges[index:index + 2]
+        ports.append(low if low == high else PortRange(low, high))
+    return ports
+
+
 class PortRange:
     """
     Represents a range of ports for Router policies.
@@ -64,18 +276,29 @@ class Router:
     the reject or accept based policies.
     """
 
+    # there are thousands of these per TorState
+    __slots__ = (
+        'controller', 'name', 'name_is_unique', 'id_hex', 'or_hash',
+        'ip', '_ip_v6', '_or_port', '_dir_port', 'flag_bits', '_bandwidth',
+        '_modified_unparsed', '_modified', 'policy_accepts', 'port_ranges',
+        'from_consensus', '_location',
+    )
+
     def __init__(self, controller):
         self.controller = controller
-        self._flags = []
+        #: the flags as a bitmask (see :func:`flag_mask`)
+        self.flag_bits = 0
         self.bandwidth = 0
         self.name_is_unique = False
-        self.accepted_ports = None
-        self.rejected_ports = None
+        # exit policy: whether it accepts (rather than rejects) the
+        # port_ranges, an array from parse_port_ranges
+        self.policy_accepts = None
+        self.port_ranges = None
         self.id_hex = None
         self._location = None
         self.from_consensus = False
         self.ip = 'unknown'
-        self.ip_v6 = []                 # most routers have no IPv6 addresses
+        self._ip_v6 = None              # most routers have no IPv6 addresses
 
     unique_name = property(lambda x: x.name_is_unique and x.name or x.id_hex)
     "has the hex id if this router's name is not unique, or its name otherwise"
@@ -98,22 +321,56 @@ class Router:
         return self._modified
 
     def update(self, name, idhash, orhash, modified, ip, orport, dirport):
-        self.name = name
-        self.id_hash = idhash
+        self.name = sys.intern(name)
         self.or_hash = orhash
         # modified is lazy-parsed, approximately doubling router-parsing time
         self._modified_unparsed = modified
         self._modified = None
         self.ip = ip
-        self.or_port = orport
-        self.dir_port = dirport
+        self._or_port = _port(orport)
+        self._dir_port = _port(dirport)
         self._location = None
 
-        self.id_hex = hexIdFromHash(self.id_hash)
+        # only the hex form is kept (see id_hash)
+        self.id_hex = hexIdFromHash(idhash)
         # for py3, these should be valid (but *not* py2)
         # assert type(idhash) is not bytes
         # assert type(orhash) is not bytes
 
+    @property
+    def id_hash(self):
+        """The base64-encoded identity hash (as in the consensus)."""
+        if self.id_hex is None:
+            return None
+        return hashFromHexId(self.id_hex)
+
+    @property
+    def or_port(self):
+        return str(self._or_port)
+
+    @or_port.setter
+    def or_port(self, port):
+        self._or_port = _port(port)
+
+    @property
+    def dir_port(self):
+        return str(self._dir_port)
+
+    @dir_port.setter
+    def dir_port(self, port):
+        self._dir_port = _port(port)
+
+    @property
+    def ip_v6(self):
+        """A list of this Router's IPv6 addresses (and ports)."""
+        if self._ip_v6 is None:
+            self._ip_v6 = []
+        return self._ip_v6
+
+    @ip_v6.setter
+    def ip_v6(self, addresses):
+        self._ip_v6 = list(addresses) or None
+
     def get_location(self):
         """
         Returns a Deferred that fires with a NetLocation object for this
@@ -159,9 +416,12 @@ class Router:
     def flags(self):
         """
         A list of all the flags for this Router, each one an
-        all-lower-case string.
+        all-lower-case string (in the order consensuses list them;
+        see also :attr:`flag_bits`). This is a new list each time:
+        to change the flags, assign a list (or a space-separated
+        string) of them, which sets :attr:`flag_bits`.
         """
-        return self._flags
+        return list(_flag_names(self.flag_bits))
 
     @flags.setter
     def flags(self, flags):
@@ -173,10 +433,18 @@ class Router:
         There is some current work in Twisted for open-ended constants
         (enums) support however, it seems.
         """
-        if isinstance(flags, (str, bytes)):
+        if isinstance(flags, bytes):
+            flags = flags.decode('ascii')
+        if isinstance(flags, str):
             flags = flags.split()
-        self._flags = [x.lower() for x in flags]
-        self.name_is_unique = 'named' in self._flags
+        self.flag_bits = flag_mask(flags)
+        self.name_is_unique = bool(self.flag_bits & _FLAG_BITS['named'])
+
+    def has_flag(self, flag):
+        """
+        :return: True if this Router has ``flag`` (in any case).
+        """
+        return bool(self.flag_bits & flag_mask((flag,)))
 
     @property
     def bandwidth(self):
@@ -229,12 +497,13 @@ class Router:
         Port policies for this Router.
         :return: a string describing the policy
         """
-        if self.accepted_ports:
-            return 'accept ' + ','.join(map(str, self.accepted_ports))
-        elif self.rejected_ports:
-            return 'reject ' + ','.join(map(str, self.rejected_ports))
-        else:
+        if not self.port_ranges:
             return ''
+        word = 'accept ' if self.policy_accepts else 'reject '
+        try:
+            return word + _PORT_RANGES_TEXT[id(self.port_ranges)]
+        except KeyError:
+            return word + _ports_text(self.port_ranges)
 
     @policy.setter
     def policy(self, args):
@@ -243,44 +512,39 @@ class Router:
         """
 
         word = args[0]
-        if word == 'reject':
-            self.accepted_ports = None
-            self.rejected_ports = []
-            target = self.rejected_ports
-
-        elif word == 'accept':
-            self.accepted_ports = []
-            self.rejected_ports = None
-            target = self.accepted_ports
-
-        else:
+        if word not in ('accept', 'reject'):
             raise RuntimeError("Don't understand policy word \"%s\"" % word)
+        self.port_ranges = _port_ranges(args[1])
+        self.policy_accepts = word == 'accept'
 
-        for port in args[1].split(','):
-            if '-' in port:
-                (a, b) = port.split('-')
-                target.append(PortRange(int(a), int(b)))
-            else:
-                target.append(int(port))
+    @property
+    def accepted_ports(self):
+        """
+        The ports (ints) and PortRanges an "accept" policy lists (or
+        None if the policy rejects ports or isn't set).
+        """
+        if self.policy_accepts:
+            return _ports(self.port_ranges)
+        return None
+
+    @property
+    def rejected_ports(self):
+        """
+        The ports (ints) and PortRanges a "reject" policy lists (or
+        None if the policy accepts ports or isn't set).
+        """
+        if self.policy_accepts is False:
+            return _ports(self.port_ranges)
+        return None
 
     def accepts_port(self, port):
         """
         Query whether this Router will accept the given port.
         """
 
-        if self.rejected_ports is None and self.accepted_ports is None:
+        if self.port_ranges is None:
             raise RuntimeError("policy hasn't been set yet")
-
-        if self.rejected_ports:
-            for x in self.rejected_ports:
-                if port == x:
-                    return False
-            return True
-
-        for x in self.accepted_ports:
-            if port == x:
-                return True
-        return False
+        return port_in_ranges(port, self.port_ranges) == self.policy_accepts
 
     def _set_country(self, c):
         """
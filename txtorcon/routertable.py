@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+"""
+A columnar copy of a set of routers, for asking questions of all of
+them at once ("the Fast, Stable exits in Germany or the Netherlands
+with at least 5 MB/s of bandwidth") without an attribute lookup per
+:class:`txtorcon.Router` per question.
+
+A :class:`RouterTable` keeps one compact array per column (bandwidth,
+the flags bitmask, the IPv4 address as an int, the OR and Dir ports
+and a country) with row N of each describing ``routers[N]``. When
+NumPy is installed the columns are NumPy arrays (sharing memory with
+the :mod:`array` ones) and queries are vectorized; otherwise the
+table groups its rows into bitsets by flags and by country, so a
+query ANDs a few ints and only looks at the rows that are left.
+Either way the answers are lists of the :class:`txtorcon.Router`
+objects themselves.
+
+:meth:`txtorcon.TorState.router_table` keeps one of these for the
+current consensus.
+"""
+
+import heapq
+import ipaddress
+import socket
+from array import array
+
+from txtorcon import util
+from txtorcon.router import flag_mask
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the flags column holds the first 64 flags (see flag_mask)
+_FLAGS_LIMIT = 1 << 64
+
+
+def known_country(router):
+    """
+    The country code of ``router`` if its location has been looked up
+    already (or can be, in a local GeoIP database) without asking Tor;
+    otherwise None.
+    """
+    location = router._location
+    if location is None:
+        if not (util.city or util.country):
+            return None
+        location = util.NetLocation(router.ip)
+    return location.countrycode or None
+
+
+def _ipv4(address):
+    try:
+        return int.from_bytes(socket.inet_aton(address), 'big')
+    except OSError:
+        return 0
+
+
+def _port_number(port):
+    return int(port) if port and port.isdigit() else 0
+
+
+def _rows_in(bits):
+    reverse = bin(bits)[:1:-1]          # lowest bit first
+    rows = []
+    row = reverse.find('1')
+    while row != -1:
+        rows.append(row)
+        row = reverse.find('1', row + 1)
+    return rows
+
+
+class RouterTable(object):
+    """
+    The routers in ``routers`` as columns. This is a snapshot: build
+    a new table when the routers (or what's known about them) change.
+
+    :param routers: the :class:`txtorcon.Router` instances
+    :param country_of: a callable giving the country code of a
+        Router, or None if it isn't known; by default,
+        :func:`known_country`.
+    """
+
+    def __init__(self, routers, country_of=known_country):
+        #: the routers; row N of each column is about routers[N]
+        self.routers = list(routers)
+        #: the country codes (upper case) in the country column, which
+        #: holds indexes into this list (0 for an unknown country)
+        self.countries = [None]
+        self._country_ids = {None: 0}
+
+        bandwidth = array('Q')
+        flags = array('Q')
+        ipv4 = array('L')
+        or_port = array('H')
+        dir_port = array('H')
+        country = array('H')
+        for router in self.routers:
+            bandwidth.append(router.bandwidth or 0)
+            flags.append(router.flag_bits % _FLAGS_LIMIT)
+            ipv4.append(_ipv4(router.ip))
+            or_port.append(_port_number(router.or_port))
+            dir_port.append(_port_number(router.dir_port))
+            country.append(self._country_id(country_of(router)))
+
+        self._vectorized = numpy is not None
+        if self._vectorized:
+            bandwidth, flags, ipv4, or_port, dir_port, country = [
+                numpy.frombuffer(column, dtype=column.typecode)
+                for column in (bandwidth, flags, ipv4, or_port, dir_port, country)
+            ]
+        #: the columns (NumPy arrays if NumPy is installed, otherwise
+        #: :class:`array.array`)
+        self.bandwidth = bandwidth
+        self.flags = flags
+        self.ipv4 = ipv4
+        self.or_port = or_port
+        self.dir_port = dir_port
+        self.country = country
+
+        # for when there's no NumPy: the rows (as a bitset) with each
+        # distinct flags bitmask and in each country; built when needed
+        self._by_flags = None
+        self._by_country = None
+
+    def __len__(self):
+        return len(self.routers)
+
+    def _country_id(self, code):
+        if code:
+            code = code.upper()
+        else:
+            code = None
+        try:
+            return self._country_ids[code]
+        except KeyError:
+            ident = self._country_ids[code] = len(self.countries)
+            self.countries.append(code)
+            return ident
+
+    def select(self, flags=(), countries=None, min_bandwidth=None, network=None,
+               by_bandwidth=False):
+        """
+        The routers matching all of the given criteria.
+
+        :param flags: flag names (in any case) the routers must all have
+        :param countries: country codes (in any case) one of which
+            each router must be in
+        :param min_bandwidth: the least bandwidth a router may have
+        :param network: an IPv4 network (like ``"192.0.2.0/24"``) the
+            routers' addresses must be in
+        :param by_bandwidth: if True, the routers come most bandwidth
+            first; otherwise in table order.
+
+        :return: a list of :class:`txtorcon.Router` instances
+        """
+        rows = self._rows(flags, countries, min_bandwidth, network)
+        if by_bandwidth:
+            rows = self._by_bandwidth(rows, None)
+        return self._routers(rows)
+
+    def top(self, count, flags=(), countries=None, min_bandwidth=None, network=None):
+        """
+        The (at most) ``count`` routers with the most bandwidth of
+        those matching the criteria (as for :meth:`select`), most
+        first. Routers with equal bandwidth come in no particular
+        order.
+
+        :return: a list of :class:`txtorcon.Router` instances
+        """
+        if count <= 0:
+            return []
+        rows = self._rows(flags, countries, min_bandwidth, network)
+        return self._routers(self._by_bandwidth(rows, count))
+
+    def _routers(self, rows):
+        routers = self.routers
+        if self._vectorized:
+            rows = rows.tolist()
+        return [routers[row] for row in rows]
+
+    def _rows(self, flags, countries, min_bandwidth, network):
+        want = flag_mask(flags)
+        if want >= _FLAGS_LIMIT:
+            raise ValueError("Can't query flags {}".format(flags))
+        country_ids = None
+        if countries is not None:
+            country_ids = [
+                self._country_ids[code.upper()]
+                for code in countries
+                if code.upper() in self._country_ids
+            ]
+        netmask = None
+        if network is not None:
+            network = ipaddress.IPv4Network(network)
+            netmask = int(network.netmask)
+            network = int(network.network_address)
+        if not self._vectorized:
+            return self._python_rows(want, country_ids, min_bandwidth, network, netmask)
+
+        matches = numpy.ones(len(self.routers), dtype=bool)
+        if want:
+            matches &= (self.flags & numpy.uint64(want)) == want
+        if country_ids is not None:
+            matches &= numpy.isin(self.country, country_ids)
+        if min_bandwidth is not None:
+            matches &= self.bandwidth >= min_bandwidth
+        if network is not None:
+            matches &= (self.ipv4 & netmask) == network
+        return numpy.flatnonzero(matches)
+
+    def _python_rows(self, want, country_ids, min_bandwidth, network, netmask):
+        bits = None
+        if want:
+            if self._by_flags is None:
+                self._by_flags = self._bitsets(self.flags)
+            bits = 0
+            for (mask, rows) in self._by_flags.items():
+                if mask & want == want:
+                    bits |= rows
+        if country_ids is not None:
+            if self._by_country is None:
+                self._by_country = self._bitsets(self.country)
+            in_countries = 0
+            for ident in country_ids:
+                in_countries |= self._by_country.get(ident, 0)
+            bits = in_countries if bits is None else bits & in_countries
+
+        rows = range(len(self.routers)) if bits is None else _rows_in(bits)
+        if min_bandwidth is not None:
+            bandwidth = self.bandwidth
+            rows = [row for row in rows if bandwidth[row] >= min_bandwidth]
+        if network is not None:
+            ipv4 = self.ipv4
+            rows = [row for row in rows if ipv4[row] & netmask == network]
+        return rows
+
+    @staticmethod
+    def _bitsets(column):
+        # rows are grouped by value first, so there's one OR per row
+        # into a small int and then one per distinct value
+        groups = {}
+        for (row, value) in enumerate(column):
+            try:
+                groups[value].append(row)
+            except KeyError:
+                groups[value] = [row]
+        bitsets = {}
+        for (value, rows) in groups.items():
+            bits = bytearray((len(column) + 8) // 8)
+            for row in rows:
+                bits[row >> 3] |= 1 << (row & 7)
+            bitsets[value] = int.from_bytes(bits, 'little')
+        return bitsets
+
+    def _by_bandwidth(self, rows, count):
+        bandwidth = self.bandwidth
+        if self._vectorized:
+            # argpartition wants 0 <= kth < len(rows); top() has
+            # already dealt with count <= 0
+            if count is not None and count < len(rows):
+                best = numpy.argpartition(bandwidth[rows], len(rows) - count)[len(rows) - count:]
+                best.sort()
+                rows = rows[best]
+            weights = bandwidth[rows].astype(numpy.int64)
+            return rows[numpy.argsort(-weights, kind='stable')]
+        if count is not None:
+            return heapq.nlargest(count, rows, key=bandwidth.__getitem__)
+        return sorted(rows, key=bandwidth.__getitem__, reverse=True)
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""
+A compact on-disk copy of the router table that :class:`txtorcon.TorState`
+builds from ``GETINFO ns/all``, so that a restarted controller can
+have its routers back straight away instead of downloading and parsing
+the whole consensus first (see the ``snapshot_path`` argument to
+:class:`txtorcon.TorState`).
+
+A snapshot is tagged with the version of the Tor it came from and the
+``valid-after`` time of the consensus it was built from, so a caller
+can tell whether it is still current.
+
+The format (as written by :func:`dumps`) is the 8-byte magic
+``TXTORSNP``, a one-byte version (3) and a big-endian header of the
+router count and the lengths of the Tor version and valid-after
+strings (three 4-byte unsigned ints), followed by those two strings.
+Then come the columns, one value per router in the same order, and
+two tables. Each text column (nickname, identity hash, descriptor
+hash, publication time, IPv4 address and IPv6 addresses) and each
+table is a 4-byte length and that many bytes of UTF-8, the values
+separated by newlines. The tables are the flag names (the first
+naming bit 0 of the flags column, and so on) and the distinct
+exit-policy summaries (the first is always empty, for no policy).
+Each number column (OR port, Dir port, bandwidth, flags as a bitmask
+and the index of the exit-policy summary) is the router count of
+4-byte little-endian unsigned ints. Since relays share a few dozen
+sets of flags and a few hundred policies, each of those is only
+parsed once when loading. Nothing in a snapshot is executable,
+unlike a pickle.
+"""
+
+import os
+import sys
+import struct
+from array import array
+from collections import namedtuple
+
+from .router import Router, flag_mask, _FLAG_BITS, _FLAG_NAMES, _port_ranges
+
+
+MAGIC = b'TXTORSNP'
+VERSION = 3
+
+_HEADER = struct.Struct('!III')
+_LENGTH = struct.Struct('!I')
+
+_TEXT_COLUMNS = ('nickname', 'idhash', 'orhash', 'modified', 'ip', 'ip_v6', 'flag_names', 'policies')
+_NUMBER_COLUMNS = ('orport', 'dirport', 'bandwidth', 'flags', 'policy')
+
+# an array typecode whose items are exactly 4 bytes here
+_UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+Snapshot = namedtuple('Snapshot', ('tor_version', 'valid_after', 'routers'))
+"""
+A parsed snapshot. ``routers`` is a list of :class:`txtorcon.Router`
+instances (with no controller).
+"""
+
+
+def _numbers(values):
+    numbers = array(_UINT32, values)
+    if sys.byteorder != 'little':
+        numbers.byteswap()
+    return numbers.tobytes()
+
+
+def dumps(tor_version, valid_after, routers):
+    """
+    :param tor_version: the version string of the Tor the routers came
+        from
+
+    :param valid_after: the ``valid-after`` time (a str, as Tor gives
+        it) of the consensus the routers came from
+
+    :param routers: an iterable of :class:`txtorcon.Router` instances
+
+    :return: ``bytes`` in the snapshot format
+    """
+    columns = dict((name, []) for name in _TEXT_COLUMNS + _NUMBER_COLUMNS)
+    policies = {'': 0}
+    for router in routers:
+        columns['nickname'].append(router.name)
+        columns['idhash'].append(router.id_hash)
+        columns['orhash'].append(router.or_hash)
+        columns['modified'].append(router._modified_unparsed)
+        columns['ip'].append(router.ip)
+        columns['ip_v6'].append(' '.join(router.ip_v6))
+        columns['orport'].append(router._or_port)
+        columns['dirport'].append(router._dir_port)
+        columns['bandwidth'].append(router.bandwidth)
+        columns['flags'].append(router.flag_bits)
+        columns['policy'].append(policies.setdefault(router.policy, len(policies)))
+    flag_bits = max(columns['flags'] or [0]).bit_length()
+    if flag_bits > 32:
+        raise ValueError("Too many flags for a snapshot")
+    columns['flag_names'] = _FLAG_NAMES[:flag_bits]
+    columns['policies'] = sorted(policies, key=policies.get)
+
+    tor_version = tor_version.encode('utf8')
+    valid_after = valid_after.encode('utf8')
+    parts = [
+        MAGIC,
+        bytes([VERSION]),
+        _HEADER.pack(len(columns['idhash']), len(tor_version), len(valid_after)),
+        tor_version,
+        valid_after,
+    ]
+    for name in _TEXT_COLUMNS:
+        text = '\n'.join(columns[name]).encode('utf8')
+        parts.append(_LENGTH.pack(len(text)))
+        parts.append(text)
+    for name in _NUMBER_COLUMNS:
+        parts.append(_numbers(columns[name]))
+    return b''.join(parts)
+
+
+def parse_snapshot(data):
+    """
+    :param data: ``bytes`` in the format written by :func:`dumps`
+
+    :return: a :class:`Snapshot`
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a txtorcon snapshot")
+    version = data[len(MAGIC)]
+    if version != VERSION:
+        raise ValueError("Unknown snapshot version {}".format(version))
+
+    def take(offset, length):
+        if offset + length > len(data):
+            raise ValueError("Truncated snapshot at byte {}".format(offset))
+        return data[offset:offset + length], offset + length
+
+    offset = len(MAGIC) + 1
+    header, offset = take(offset, _HEADER.size)
+    count, version_length, valid_after_length = _HEADER.unpack(header)
+    tor_version, offset = take(offset, version_length)
+    valid_after, offset = take(offset, valid_after_length)
+
+    columns = {}
+    for name in _TEXT_COLUMNS:
+        length, offset = take(offset, _LENGTH.size)
+        text, offset = take(offset, _LENGTH.unpack(length)[0])
+        columns[name] = text.decode('utf8').split('\n')
+    for name in _NUMBER_COLUMNS:
+        raw, offset = take(offset, count * 4)
+        numbers = array(_UINT32)
+        numbers.frombytes(raw)
+        if sys.byteorder != 'little':
+            numbers.byteswap()
+        columns[name] = numbers
+    if offset != len(data):
+        raise ValueError("Trailing data in snapshot at byte {}".format(offset))
+    for name in _TEXT_COLUMNS[:-2]:
+        if not count:
+            columns[name] = []
+        if len(columns[name]) != count:
+            raise ValueError("Snapshot column '{}' has {} values, not {}".format(
+                name, len(columns[name]), count))
+
+    # each distinct set of flags and policy is only parsed once
+    flag_names = columns['flag_names']
+    masks = {}
+    policies = [(None, None)]
+    for policy in columns['policies'][1:]:
+        word, _, ports = policy.partition(' ')
+        if word not in ('accept', 'reject'):
+            raise ValueError("Bad policy in snapshot: {}".format(policy))
+        policies.append((word == 'accept', _port_ranges(ports)))
+
+    routers = []
+    for (nickname, idhash, orhash, modified, ip, ip_v6, orport, dirport, bandwidth, flags, policy) \
+            in zip(*(columns[name] for name in _TEXT_COLUMNS[:-2] + _NUMBER_COLUMNS)):
+        router = Router(None)
+        router.update(nickname, idhash, orhash, modified, ip, orport, dirport)
+        try:
+            router.flag_bits = masks[flags]
+        except KeyError:
+            router.flag_bits = masks[flags] = flag_mask(
+                name for (bit, name) in enumerate(flag_names) if flags >> bit & 1
+            )
+        router.name_is_unique = bool(router.flag_bits & _FLAG_BITS['named'])
+        router.bandwidth = bandwidth
+        if ip_v6:
+            router.ip_v6 = ip_v6.split()
+        try:
+            router.policy_accepts, router.port_ranges = policies[policy]
+        except IndexError:
+            raise ValueError("Bad policy index {} in snapshot".format(policy))
+        router.from_consensus = True
+        routers.append(router)
+    return Snapshot(
+        tor_version.decode('utf8'),
+        valid_after.decode('utf8'),
+        routers,
+    )
+
+
+def write_snapshot(path, tor_version, valid_after, routers):
+    """
+    Write a snapshot (see :func:`dumps`) to the file ``path``. The
+    file is replaced atomically, so a reader never sees half of one.
+    """
+    data = dumps(tor_version, valid_after, routers)
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_snapshot(path):
+    """
+    Read a snapshot written by :func:`write_snapshot`.
+
+    :return: a :class:`Snapshot`
+    """
+    with open(path, 'rb') as f:
+        return parse_snapshot(f.read())
@@ -14,7 +14,7 @@ to attach streams to circuits "by hand"
 from twisted.python import log
 from twisted.internet import defer
 from txtorcon.interface import ICircuitContainer, IStreamListener
-from txtorcon.util import find_keywords, maybe_ip_addr
+from txtorcon.util import KeywordMap, lower_case_keywords, maybe_ip_addr
 
 
 class Stream:
@@ -151,15 +151,13 @@ class Stream:
 
     def _create_flags(self, kw):
         """
-        this clones the kw dict, adding a lower-case version of every key
-        (duplicated in circuit.py; consider putting in util?)
+        every key of kw both as it was and in lower-case; a
+        KeywordMap (as from update()) has these already, so isn't
+        copied (see :func:`txtorcon.util.lower_case_keywords`)
         """
-
-        flags = {}
-        for k in kw.keys():
-            flags[k] = kw[k]
-            flags[k.lower()] = flags[k]
-        return flags
+        if isinstance(kw, KeywordMap):
+            return kw.as_kwargs()
+        return lower_case_keywords(kw)
 
     def update(self, args):
         if self.id is None:
@@ -168,7 +166,7 @@ class Stream:
             if self.id != int(args[0]):
                 raise RuntimeError("Update for wrong stream.")
 
-        kw = find_keywords(args)
+        kw = KeywordMap.from_args(args)
         self.flags = kw
 
         if 'SOURCE_ADDR' in kw:
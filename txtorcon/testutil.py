@@ -1,8 +1,13 @@
+import base64
+
 from twisted.internet import defer
+from twisted.python.failure import Failure
 
 from zope.interface import implementer
 
 from txtorcon.interface import ITorControlProtocol
+from txtorcon.router import Router
+from txtorcon.util import NetLocation, SingleObserver
 
 
 @implementer(ITorControlProtocol)
@@ -34,7 +39,7 @@ class FakeControlProtocol(object):
         # XXX can we get rud of 'commands' and just use pending?
         self.commands = []
 
-    def queue_command(self, cmd):
+    def queue_command(self, cmd, arg=None, priority=None):
         if len(self.answers) == 0:
             d = defer.Deferred()
             self.pending.append(d)
@@ -68,7 +73,7 @@ class FakeControlProtocol(object):
         a = self.answers.pop()
         return defer.succeed(a)
 
-    def get_info_raw(self, info):
+    def get_info_raw(self, *info, priority=None):
         if len(self.answers) == 0:
             d = defer.Deferred()
             self.pending.append(d)
@@ -79,13 +84,13 @@ class FakeControlProtocol(object):
         return d
 
     @defer.inlineCallbacks
-    def get_info_incremental(self, info, cb):
+    def get_info_incremental(self, info, cb, priority=None):
         text = yield self.get_info_raw(info)
         for line in text.split('\r\n'):
             cb(line)
         return ''  # FIXME uh....what's up at torstate.py:350?
 
-    def get_conf(self, info):
+    def get_conf(self, info, priority=None):
         if len(self.answers) == 0:
             d = defer.Deferred()
             self.pending.append(d)
@@ -112,3 +117,124 @@ class FakeControlProtocol(object):
 
     def remove_event_listener(self, nm, cb):
         del self.events[nm]
+
+
+def fake_router(name, ip='127.0.0.1', flags='', bandwidth=1000, idhash=None,
+                country=None, policy=None, ip_v6=()):
+    """
+    A :class:`txtorcon.Router` (with no controller) as if from the
+    consensus. Unless ``idhash`` is given, the identity comes from
+    ``name`` so that routers with different names are different
+    relays. ``country`` makes its location already known.
+    """
+    if idhash is None:
+        idhash = base64.b64encode(name.encode('ascii').ljust(20, b'\0')[:20])
+        idhash = idhash.decode('ascii').rstrip('=')
+    router = Router(None)
+    router.update(name, idhash, "MAANkj30tnFvmoh7FsjVFr+cmcs",
+                  "2011-12-16 15:11:34", ip, "9001", "0")
+    router.flags = flags
+    router.bandwidth = bandwidth
+    if policy is not None:
+        router.policy = policy.split()
+    router.ip_v6.extend(ip_v6)
+    if country is not None:
+        router._location = NetLocation(None)
+        router._location.countrycode = country
+    return router
+
+
+class FakeCircuit(object):
+    """
+    Stands in for a :class:`txtorcon.Circuit` Tor is building; call
+    :meth:`build`, :meth:`fail` or :meth:`closed` to have Tor's
+    answer arrive.
+    """
+
+    def __init__(self, circid):
+        self.id = circid
+        self.state = 'LAUNCHED'
+        self.path = []
+        self.listeners = []
+        self._when_built = SingleObserver()
+        self._when_closed = SingleObserver()
+        self.close_calls = 0
+
+    def listen(self, listener):
+        self.listeners.append(listener)
+
+    def unlisten(self, listener):
+        self.listeners.remove(listener)
+
+    def when_built(self):
+        return self._when_built.when_fired()
+
+    def when_closed(self):
+        return self._when_closed.when_fired()
+
+    def extend(self, router):
+        self.path.append(router)
+        for listener in self.listeners:
+            listener.circuit_extend(self, router)
+
+    def build(self):
+        self.state = 'BUILT'
+        self._when_built.fire(self)
+
+    def fail(self, error):
+        self.state = 'FAILED'
+        self._when_built.fire(Failure(error))
+
+    def closed(self):
+        self.state = 'CLOSED'
+        self._when_closed.fire(self)
+
+    def close(self, **kw):
+        self.close_calls += 1
+        self.state = 'CLOSED'
+        return defer.succeed(None)
+
+
+class FakeState(object):
+    """
+    Stands in for a :class:`txtorcon.TorState` that circuits are
+    built from: each ``build_circuit`` makes a :class:`FakeCircuit`
+    and records ``(routers, purpose, circuit)`` in ``builds``.
+    """
+
+    def __init__(self):
+        self.builds = []
+        self.paths = []
+        self.locating = []
+        #: if a list, Deferreds (and their circuits) for
+        #: EXTENDCIRCUITs Tor hasn't answered yet
+        self.unanswered = None
+
+    def build_circuit(self, routers=None, using_guards=True, purpose=None):
+        circuit = FakeCircuit(len(self.builds) + 1)
+        self.builds.append((routers, purpose, circuit))
+        if self.unanswered is not None:
+            d = defer.Deferred()
+            self.unanswered.append((d, circuit))
+            return d
+        return defer.succeed(circuit)
+
+    def select_path(self, exit_ports=(), using_guards=False, exit_country=None):
+        if exit_country == 'zz':
+            raise ValueError("No relays for the exit position")
+        self.paths.append((exit_ports, exit_country))
+        return ['guard', 'middle', 'exit-{}'.format(exit_country)]
+
+    def routers_in_country(self, code):
+        return set() if code == 'zz' else {'exit-{}'.format(code)}
+
+    def locate_routers(self):
+        d = defer.Deferred()
+        self.locating.append(d)
+        return d
+
+    def circuit(self, index):
+        return self.builds[index][2]
+
+    def building(self):
+        return [circuit for (_, _, circuit) in self.builds if circuit.state == 'LAUNCHED']
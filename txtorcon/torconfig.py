@@ -19,6 +19,7 @@ from twisted.internet.endpoints import TCP4ClientEndpoint, UNIXClientEndpoint
 
 from txtorcon.torcontrolprotocol import parse_keywords, DEFAULT_VALUE
 from txtorcon.torcontrolprotocol import TorProtocolError
+from txtorcon.torcontrolprotocol import PRIORITY_BULK
 from txtorcon.interface import ITorControlProtocol
 from txtorcon.util import find_keywords
 from .onion import IOnionClient, FilesystemOnionService, FilesystemAuthenticatedOnionService
@@ -873,7 +874,9 @@ class TorConfig:
                 "Can't listen for CONF_CHANGED event; won't stay up-to-date "
                 "with other clients.")
             d = defer.succeed(None)
-        d.addCallback(lambda _: self.protocol.get_info_raw("config/names"))
+        # reading every option is slow and nothing waits on it, so
+        # it goes in the bulk lane of the command queue
+        d.addCallback(lambda _: self.protocol.get_info_raw("config/names", priority=PRIORITY_BULK))
         d.addCallback(self._do_setup)
         d.addCallback(self.do_post_bootstrap)
         d.addErrback(self.do_post_errback)
@@ -989,7 +992,7 @@ class TorConfig:
     @defer.inlineCallbacks
     def _get_defaults(self):
         try:
-            defaults_raw = yield self.protocol.get_info_raw("config/defaults")
+            defaults_raw = yield self.protocol.get_info_raw("config/defaults", priority=PRIORITY_BULK)
             defaults = {}
             for line in defaults_raw.split('\n')[1:]:
                 k, v = line.split(' ', 1)
@@ -1020,7 +1023,7 @@ class TorConfig:
             if name == 'HiddenServiceOptions':
                 # set up the "special-case" hidden service stuff
                 servicelines = yield self.protocol.get_conf_raw(
-                    'HiddenServiceOptions')
+                    'HiddenServiceOptions', priority=PRIORITY_BULK)
                 self._setup_hidden_services(servicelines)
                 continue
 
@@ -1033,7 +1036,7 @@ class TorConfig:
                 rn = self._find_real_name(name[:-5])
                 self.parsers[rn] = String()  # not Port() because options etc
                 self.list_parsers.add(rn)
-                v = yield self.protocol.get_conf(name[:-5])
+                v = yield self.protocol.get_conf(name[:-5], priority=PRIORITY_BULK)
                 v = v[name[:-5]]
 
                 initial = []
@@ -1069,7 +1072,7 @@ class TorConfig:
                     inst = cls()
             if not inst:
                 raise RuntimeError("Don't have a parser for: " + value)
-            v = yield self.protocol.get_conf(name)
+            v = yield self.protocol.get_conf(name, priority=PRIORITY_BULK)
             v = v[name]
 
             rn = self._find_real_name(name)
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
-import re
-import base64
+import time
+from collections import deque
 from binascii import b2a_hex, hexlify
 from warnings import warn
 
@@ -15,17 +15,30 @@ from twisted.python.failure import Failure
 
 from zope.interface import implementer
 
-from txtorcon.util import hmac_sha256, compare_via_hash, unescape_quoted_string
+from txtorcon.util import unescape_quoted_string
 from txtorcon.log import txtorlog
 
 from txtorcon.interface import ITorControlProtocol
-from .spaghetti import FSM, State, Transition
+from txtorcon.events import decode_event, EventBatch
+from txtorcon.capture import WireCapture
+from txtorcon.controlcore import ControlCore
+from txtorcon.controlcore import parse_protocolinfo, safecookie_response
+from txtorcon.controlcore import MAX_LINE_LENGTH, _REPLY_FRAMER_DOT
 from .util import maybe_coroutine
 from .util import SingleObserver
 
 
 DEFAULT_VALUE = 'DEFAULT'
 
+# command queue priorities; lower numbers are written to Tor first
+# (everything is PRIORITY_NORMAL unless the caller says otherwise:
+# TorState attaches streams and extends circuits at PRIORITY_HIGH,
+# and fetches ns/all, like TorConfig its GETCONF sweep, at
+# PRIORITY_BULK)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
 
 class TorProtocolError(RuntimeError):
     """
@@ -72,7 +85,8 @@ class TorProtocolFactory(object):
     you should supply a password callback.
     """
 
-    def __init__(self, password_function=lambda: None):
+    def __init__(self, password_function=lambda: None, max_in_flight=1,
+                 capture_bytes=None, batch_queries=False):
         """
         Builds protocols to talk to a Tor client on the specified
         address. For example::
@@ -89,8 +103,24 @@ class TorProtocolFactory(object):
            password (or a Deferred). By default, it returns None. This
            is only queried if the Tor we connect to doesn't support
            (or hasn't enabled) COOKIE authentication.
+
+        :param max_in_flight:
+           Passed on to every :class:`TorControlProtocol` we build; see
+           :attr:`TorControlProtocol.max_in_flight`.
+
+        :param capture_bytes:
+           If not None, every protocol we build starts a
+           :class:`txtorcon.capture.WireCapture` of this size; see
+           :meth:`TorControlProtocol.start_capture`.
+
+        :param batch_queries:
+           Passed on to every :class:`TorControlProtocol` we build; see
+           :attr:`TorControlProtocol.batch_queries`.
         """
         self.password_function = password_function
+        self.max_in_flight = max_in_flight
+        self.capture_bytes = capture_bytes
+        self.batch_queries = batch_queries
 
     def doStart(self):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
@@ -100,8 +130,14 @@ class TorProtocolFactory(object):
 
     def buildProtocol(self, addr):
         ":api:`twisted.internet.interfaces.IProtocolFactory` API"
-        proto = TorControlProtocol(self.password_function)
+        proto = TorControlProtocol(
+            self.password_function,
+            max_in_flight=self.max_in_flight,
+            batch_queries=self.batch_queries,
+        )
         proto.factory = self
+        if self.capture_bytes is not None:
+            proto.start_capture(self.capture_bytes)
         return proto
 
 
@@ -113,102 +149,411 @@ class Event(object):
     This allows you to listen for such an event; see
     TorController.add_event The callbacks will be called every time
     the event in question is received.
+
+    Callbacks added with ``typed=True`` receive a
+    :class:`txtorcon.events.ControlEvent` instead of the raw text;
+    it is decoded once per event and shared between all of them.
+    Batched listeners (see :class:`_EventCoalescer`) get the same
+    records, a batch at a time.
     """
     def __init__(self, name):
         self.name = name
         self.callbacks = []
+        self.typed_callbacks = []
+        self.coalescers = {}
 
-    def listen(self, cb):
-        self.callbacks.append(cb)
+    def listen(self, cb, typed=False):
+        if typed:
+            self.typed_callbacks.append(cb)
+        else:
+            self.callbacks.append(cb)
+
+    def listen_batched(self, cb, window=None, max_events=None, reactor=None):
+        if cb in self.coalescers:
+            raise ValueError(
+                "{} is already a batched listener for {}".format(cb, self.name)
+            )
+        self.coalescers[cb] = _EventCoalescer(self, cb, window, max_events, reactor)
 
     def unlisten(self, cb):
-        self.callbacks.remove(cb)
+        coalescer = self.coalescers.pop(cb, None)
+        if coalescer is not None:
+            coalescer.flush()
+            return
+        try:
+            self.callbacks.remove(cb)
+        except ValueError:
+            self.typed_callbacks.remove(cb)
+
+    def has_listeners(self):
+        return bool(self.callbacks or self.typed_callbacks or self.coalescers)
+
+    def flush(self):
+        """
+        Deliver any partial batches to batched listeners now.
+        """
+        for coalescer in list(self.coalescers.values()):
+            coalescer.flush()
 
     def got_update(self, data):
         for cb in self.callbacks:
-            try:
-                cb(data)
-            except Exception as e:
-                log.err(Failure())
-                log.err(
-                    "Notifying '{callback}' for '{name}' failed: {e}".format(
-                        callback=cb,
-                        name=self.name,
-                        e=e,
-                    )
+            self._notify(cb, data)
+        if self.typed_callbacks or self.coalescers:
+            event = decode_event(self.name, data)
+            for cb in self.typed_callbacks:
+                self._notify(cb, event)
+            for coalescer in list(self.coalescers.values()):
+                coalescer.add(event)
+
+    def _notify(self, cb, arg):
+        try:
+            cb(arg)
+        except Exception as e:
+            log.err(Failure())
+            log.err(
+                "Notifying '{callback}' for '{name}' failed: {e}".format(
+                    callback=cb,
+                    name=self.name,
+                    e=e,
                 )
+            )
+
+
+class _EventCoalescer(object):
+    """
+    Internal helper. Collects the typed records for one batched
+    listener of an :class:`Event` and hands them over as a single
+    :class:`txtorcon.events.EventBatch` once ``max_events`` have
+    arrived or ``window`` seconds after the first one, whichever is
+    sooner.
+    """
+
+    def __init__(self, event, callback, window, max_events, reactor):
+        if window is None and max_events is None:
+            raise ValueError("Need at least one of window or max_events")
+        if window is not None and window <= 0:
+            raise ValueError("window must be positive")
+        if max_events is not None and max_events < 1:
+            raise ValueError("max_events must be at least 1")
+        if reactor is None:
+            from twisted.internet import reactor
+        self._event = event
+        self._callback = callback
+        self._window = window
+        self._max_events = max_events
+        self._reactor = reactor
+        self._pending = []
+        self._started = None
+        self._timer = None
+
+    def add(self, event):
+        pending = self._pending
+        if not pending:
+            self._started = self._reactor.seconds()
+            if self._window is not None:
+                self._timer = self._reactor.callLater(self._window, self._window_ended)
+        pending.append(event)
+        if self._max_events is not None and len(pending) >= self._max_events:
+            self.flush()
+
+    def _window_ended(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending = self._pending
+        started = self._started
+        self._pending = []
+        self._started = None
+        try:
+            batch = EventBatch(self._event.name, pending, started, self._reactor.seconds())
+        except Exception:
+            log.err(Failure(), "Failed to summarize {} events".format(self._event.name))
+            return
+        self._event._notify(self._callback, batch)
+
+
+class _GetInfoStream(object):
+    """
+    Internal helper. The asynchronous iterator returned by
+    :meth:`TorControlProtocol.get_info_stream`.
+
+    Lines are buffered until the consumer asks for them; once
+    ``max_buffered`` items are waiting we pause the control
+    connection's transport and resume it when the consumer has
+    drained the buffer to half that.
+    """
+
+    def __init__(self, protocol, key, batch_size, max_buffered):
+        self._protocol = protocol
+        self._prefix = key + '='
+        self._first = True
+        self._batch_size = batch_size
+        self._batch = []
+        self._max_buffered = max_buffered
+        self._buffer = deque()
+        self._waiting = None
+        self._paused = False
+        self._closed = False
+        self._finished = False
+        self._error = None
+
+        d = protocol.queue_command('GETINFO %s' % key, self._got_line)
+        d.addCallbacks(self._done, self._failed)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        if self._buffer:
+            item = self._buffer.popleft()
+            if self._paused and len(self._buffer) <= self._max_buffered // 2:
+                self._resume()
+            return defer.succeed(item)
+        if self._error is not None:
+            return defer.fail(self._error)
+        if self._finished or self._closed:
+            return defer.fail(StopAsyncIteration())
+        self._waiting = defer.Deferred()
+        return self._waiting
+
+    def aclose(self):
+        """
+        Stop iterating early. Any further lines of the reply are
+        discarded (the command itself still has to complete) and the
+        transport is resumed if we had paused it.
+        """
+        self._closed = True
+        self._buffer.clear()
+        self._batch = []
+        self._resume()
+        self._wake(Failure(StopAsyncIteration()))
+        return defer.succeed(None)
+
+    def _got_line(self, line):
+        if self._closed or line.strip() == 'OK':
+            return
+        if self._first:
+            self._first = False
+            if line.startswith(self._prefix):
+                line = line[len(self._prefix):]
+                if not line:
+                    return
+        if self._batch_size is None:
+            self._push(line)
+        else:
+            self._batch.append(line)
+            if len(self._batch) >= self._batch_size:
+                batch, self._batch = self._batch, []
+                self._push(batch)
+
+    def _push(self, item):
+        if self._waiting is not None:
+            self._wake(item)
+            return
+        self._buffer.append(item)
+        if not self._paused and len(self._buffer) >= self._max_buffered:
+            self._paused = True
+            self._protocol.transport.pauseProducing()
+
+    def _wake(self, result):
+        d, self._waiting = self._waiting, None
+        if d is not None:
+            d.callback(result)
+
+    def _resume(self):
+        if self._paused:
+            self._paused = False
+            self._protocol.transport.resumeProducing()
+
+    def _done(self, _):
+        if self._batch and not self._closed:
+            batch, self._batch = self._batch, []
+            self._push(batch)
+        self._finished = True
+        self._resume()
+        if self._waiting is not None:
+            self._wake(Failure(StopAsyncIteration()))
+
+    def _failed(self, fail):
+        self._error = fail
+        self._resume()
+        if self._waiting is not None:
+            self._wake(fail)
 
 
 def unquote(word):
-    if len(word) == 0:
+    """
+    Removes the quotes around ``word``, if it has any. A double-quoted
+    word is a control-spec QuotedString, so backslash escapes inside
+    it (e.g. ``\\"`` and ``\\\\``) are decoded too.
+    """
+    if len(word) < 2:
         return word
     if word[0] == '"' and word[-1] == '"':
+        if '\\' in word:
+            try:
+                return unescape_quoted_string(word)
+            except ValueError:
+                pass
         return word[1:-1]
     elif word[0] == "'" and word[-1] == "'":
         return word[1:-1]
     return word
 
 
+def _add_keyword(rtn, key, value):
+    """
+    Internal helper for :func:`parse_keywords`: a key seen more than
+    once gets a list of its values.
+    """
+    if key in rtn:
+        if isinstance(rtn[key], list):
+            rtn[key].append(value)
+        else:
+            rtn[key] = [rtn[key], value]
+    else:
+        rtn[key] = value
+
+
 def parse_keywords(lines, multiline_values=True, key_hints=None):
     """
     Utility method to parse name=value pairs (GETINFO etc). Takes a
     string with newline-separated lines and expects at most one = sign
     per line. Accumulates multi-line values.
 
+    Quoted values are unquoted (see :func:`unquote`). This makes one
+    pass over ``lines``: the lines of a multi-line value are joined
+    once the value is complete.
+
     :param multiline_values:
         The default is True which allows for multi-line values until a
         line with the next = sign on it. So: '''Foo=bar\nBar'''
         produces one key, 'Foo', with value 'bar\nBar' -- set to
         False, there would be two keys: 'Foo' with value 'bar' and
-        'Bar' with value DEFAULT_VALUE.
+        'Bar' with value DEFAULT_VALUE. Either way a value is unquoted,
+        and a key given more than once gets a list of its values (in
+        txtorcon 24.8.0 and earlier, with False a value followed by a
+        line without = was left quoted and replaced any earlier
+        values of its key).
+
+    :param key_hints:
+        If given, only these keys start a new value; a line like
+        'foo=bar' is otherwise part of the previous key's (multi-line)
+        value.
     """
 
+    if key_hints:
+        key_hints = frozenset(key_hints)
     rtn = {}
     key = None
-    value = ''
-    # FIXME could use some refactoring to reduce code duplication!
+    value = []                  # the lines of key's value so far
     for line in lines.split('\n'):
-        if line.strip() == 'OK':
+        if 'OK' in line and line.strip() == 'OK':
             continue
 
-        sp = line.split('=', 1)
-        found_key = ('=' in line and ' ' not in sp[0])
-        if found_key and key_hints and sp[0] not in key_hints:
-            found_key = False
-        if found_key:
+        name, equals, rest = line.partition('=')
+        if equals and ' ' not in name and (not key_hints or name in key_hints):
             if key:
-                if key in rtn:
-                    if isinstance(rtn[key], list):
-                        rtn[key].append(unquote(value))
-                    else:
-                        rtn[key] = [rtn[key], unquote(value)]
-                else:
-                    rtn[key] = unquote(value)
-            (key, value) = line.split('=', 1)
+                _add_keyword(rtn, key, unquote('\n'.join(value)))
+            key = name
+            value = [rest]
 
-        else:
-            if key is None:
-                rtn[line.strip()] = DEFAULT_VALUE
+        elif key is None:
+            rtn[line.strip()] = DEFAULT_VALUE
 
-            elif multiline_values is False:
-                rtn[key] = value
-                rtn[line.strip()] = DEFAULT_VALUE
-                key = None
-                value = ''
+        elif multiline_values is False:
+            if key:
+                _add_keyword(rtn, key, unquote('\n'.join(value)))
+            rtn[line.strip()] = DEFAULT_VALUE
+            key = None
+            value = []
 
-            else:
-                value = value + '\n' + line
-    if key:
-        if key in rtn:
-            if isinstance(rtn[key], list):
-                rtn[key].append(unquote(value))
-            else:
-                rtn[key] = [rtn[key], unquote(value)]
         else:
-            rtn[key] = unquote(value)
+            value.append(line)
+    if key:
+        _add_keyword(rtn, key, unquote('\n'.join(value)))
+    return rtn
+
+
+def _parse_conf_reply(reply):
+    """
+    Internal helper. Parses a GETCONF reply (one ``key=value`` or,
+    for default values, bare ``key`` per line) into a dict like
+    :func:`parse_keywords` would for a single key.
+    """
+    rtn = {}
+    for line in reply.split('\n'):
+        if not line or line.strip() == 'OK':
+            continue
+        key, equals, value = line.partition('=')
+        _add_keyword(rtn, key, unquote(value) if equals else DEFAULT_VALUE)
     return rtn
 
 
+class _QueryBatch(object):
+    """
+    Internal helper. The GETINFO (or GETCONF) keys asked for during
+    one reactor turn, and who asked for which (see
+    :attr:`TorControlProtocol.batch_queries`).
+    """
+
+    def __init__(self, verb, priority):
+        self.verb = verb
+        self.priority = priority
+        self.keys = []
+        self._seen = set()
+        self.callers = []
+
+    def add(self, keys):
+        for key in keys:
+            if key not in self._seen:
+                self._seen.add(key)
+                self.keys.append(key)
+        d = defer.Deferred()
+        self.callers.append((keys, d))
+        return d
+
+    def got_reply(self, reply):
+        """
+        Gives each caller its keys from the merged ``reply``.
+
+        :return: False (having called nobody back) if a GETCONF key
+            was answered under some other name, so the reply can't be
+            shared out
+        """
+        if self.verb == 'GETINFO':
+            values = parse_keywords(reply, key_hints=self.keys)
+            for keys, d in self.callers:
+                d.callback({key: values[key] for key in keys if key in values})
+            return True
+
+        # Tor answers GETCONF with its own spelling of each key
+        # (e.g. SocksPort for SOCKSPORT), or even with other keys
+        # entirely (e.g. HiddenServiceDir and HiddenServicePort for
+        # HiddenServiceOptions)
+        values = _parse_conf_reply(reply)
+        if len(self.callers) == 1:
+            self.callers[0][1].callback(values)
+            return True
+        answered = set(key.lower() for key in values)
+        if any(key.lower() not in answered for key in self.keys):
+            return False
+        for keys, d in self.callers:
+            wanted = set(key.lower() for key in keys)
+            d.callback({
+                key: value
+                for key, value in values.items()
+                if key.lower() in wanted
+            })
+        return True
+
+
 @implementer(ITorControlProtocol)
 class TorControlProtocol(LineOnlyReceiver):
     """
@@ -228,21 +573,54 @@ class TorControlProtocol(LineOnlyReceiver):
     :class:`txtorcon.TorState`, which is also the place to go if you
     wish to add your own stream or circuit listeners.
     """
-    # override Twisted's LineOnlyReceiver maximum line-length. At
-    # least "GETINFO md/id/X" for some Xse exceeds 16384 (2**14, the
-    # default) and thus causes the control connection to
-    # fail. control.c defines MAX_COMMAND_LINE_LENGTH as 1024*1024 so
-    # we use that
-    MAX_LENGTH = 2 ** 20
+    # override Twisted's LineOnlyReceiver maximum line-length; see
+    # txtorcon.controlcore.MAX_LINE_LENGTH
+    MAX_LENGTH = MAX_LINE_LENGTH
 
-    def __init__(self, password_function=None):
+    def __init__(self, password_function=None, max_in_flight=1,
+                 batch_queries=False, reactor=None):
         """
         :param password_function:
             A zero-argument callable which returns a password (or
             Deferred). It is only called if the Tor doesn't have
             COOKIE authentication turned on. Tor's default is COOKIE.
+
+        :param max_in_flight:
+            How many commands may be written to Tor before we have
+            received their replies. The default of 1 waits for each
+            reply before issuing the next command. See
+            :attr:`max_in_flight`.
+
+        :param batch_queries:
+            See :attr:`batch_queries`.
+
+        :param reactor:
+            Used to find the end of a reactor turn when batching
+            queries (default: the global reactor).
         """
 
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1")
+        self.max_in_flight = max_in_flight
+        """How many commands we will write to Tor before receiving
+        their replies. Tor answers control commands strictly in order,
+        so replies are matched to commands first-in, first-out. It is
+        safe to change this at any time; raising it takes effect the
+        next time a command is queued or a reply arrives."""
+
+        self.batch_queries = batch_queries
+        """If True, :meth:`get_info`, :meth:`get_info_single`,
+        :meth:`get_conf` and :meth:`get_conf_single` calls made
+        during the same reactor turn are merged into a single GETINFO
+        (or GETCONF) with all their keys; each caller still gets just
+        the keys it asked for. If the merged command fails (e.g.
+        because one key is unknown) each call is retried on its own
+        so that only the bad one fails; so is a GETCONF where Tor
+        answers a key under other names (e.g. HiddenServiceOptions)."""
+
+        self._reactor = reactor
+        self._batches = {}  # ('GETINFO' or 'GETCONF', priority) -> _QueryBatch
+
         self.password_function = password_function
         """If set, a callable to query for a password to use for
         authentication to Tor (default is to use COOKIE, however). May
@@ -303,57 +681,33 @@ class TorControlProtocol(LineOnlyReceiver):
 
         # variables related to the state machine
         self.defer = None        # Deferred we returned for the current command
-        self.response = ''
-        self.code = None
         self.command = None      # currently processing this command
-        self.commands = []       # queued commands
-
-        # Here we build up the state machine. Mostly it's pretty
-        # simply, confounded by the fact that 600's (notify) can come
-        # at any time AND can be multi-line itself. Luckily, these
-        # can't be nested, nor can the responses be interleaved.
-
-        idle = State("IDLE")
-        recv = State("RECV")
-        recvmulti = State("RECV_PLUS")
-        recvnotify = State("NOTIFY_MULTILINE")
-
-        idle.add_transition(Transition(idle,
-                                       self._is_single_line_response,
-                                       self._broadcast_response))
-        idle.add_transition(Transition(recvmulti,
-                                       self._is_multi_line,
-                                       self._start_command))
-        idle.add_transition(Transition(recv,
-                                       self._is_continuation_line,
-                                       self._start_command))
-
-        recv.add_transition(Transition(recvmulti,
-                                       self._is_multi_line,
-                                       self._accumulate_response))
-        recv.add_transition(Transition(recv,
-                                       self._is_continuation_line,
-                                       self._accumulate_response))
-        recv.add_transition(Transition(idle,
-                                       self._is_finish_line,
-                                       self._broadcast_response))
-
-        recvmulti.add_transition(Transition(recv,
-                                            self._is_end_line,
-                                            lambda x: None))
-        recvmulti.add_transition(Transition(recvmulti,
-                                            self._is_not_end_line,
-                                            self._accumulate_multi_response))
-
-        self.fsm = FSM([recvnotify, idle, recvmulti, recv])
-        self.state_idle = idle
-        # hand-set initial state default start state is first in the
-        # list; the above looks nice in dotty though
-        self.fsm.state = idle
+        self._in_flight = deque()  # written to Tor, awaiting a reply
+
+        # queued commands: one FIFO "lane" per priority, each entry
+        # is ((d, cmd, arg), time-queued)
+        self._queues = (deque(), deque(), deque())
+        self._wait_stats = [[0, 0.0, 0.0] for _ in self._queues]
+        self._now = time.monotonic
+
+        # Replies and events are framed by the I/O-free ControlCore;
+        # lineReceived hands each line to it and it calls back with
+        # whole replies, reply lines (see get_info_incremental) and
+        # events.
+        self._core = ControlCore(
+            on_reply=self._reply_received,
+            on_event=self._handle_notify,
+            on_reply_line=self._reply_line_received,
+        )
         self.stop_debug()
 
+        self.capture = None
+        """If not None, the :class:`txtorcon.capture.WireCapture`
+        recording this connection; see :meth:`start_capture`."""
+
     def start_debug(self):
         self.debuglog = open('txtorcon-debug.log', 'wb')
+        self._debugging = True
 
     def stop_debug(self):
         def noop(*args, **kw):
@@ -363,22 +717,50 @@ class TorControlProtocol(LineOnlyReceiver):
             write = noop
             flush = noop
         self.debuglog = NullLog()
+        self._debugging = False
+
+    def start_capture(self, max_bytes=1024 * 1024, reactor=None):
+        """
+        Start keeping the most recent ``max_bytes`` of raw traffic
+        on this connection in memory (replacing any existing capture).
+        Unlike :meth:`start_debug` this is bounded and does no I/O, so
+        it may be left on; dump it with
+        :meth:`txtorcon.capture.WireCapture.dump` and feed it back
+        through txtorcon with :func:`txtorcon.capture.replay`.
+
+        :return: the new :class:`txtorcon.capture.WireCapture`
+            (also available as :attr:`capture`)
+        """
+        self.capture = WireCapture(max_bytes, reactor=reactor)
+        return self.capture
+
+    def stop_capture(self):
+        """
+        Stop recording traffic.
+
+        :return: the capture that was running (or None)
+        """
+        capture, self.capture = self.capture, None
+        return capture
 
     def graphviz_data(self):
-        return self.fsm.dotty()
+        """
+        A GraphViz "dot" description of the reply framer (see
+        :class:`txtorcon.controlcore.ControlCore`).
+        """
+        return _REPLY_FRAMER_DOT
 
-    # see end of file for all the state machine matcher and
-    # transition methods.
+    # see end of file for the reply-framing methods.
 
-    def get_info_raw(self, *args):
+    def get_info_raw(self, *args, priority=PRIORITY_NORMAL):
         """
         Mostly for internal use; gives you the raw string back from the
         GETINFO command. See :meth:`getinfo
         <txtorcon.TorControlProtocol.get_info>`
         """
-        return self.queue_command('GETINFO %s' % ' '.join(args))
+        return self.queue_command('GETINFO %s' % ' '.join(args), priority=priority)
 
-    def get_info_incremental(self, key, line_cb):
+    def get_info_incremental(self, key, line_cb, priority=PRIORITY_NORMAL):
         """
         Mostly for internal use; calls GETINFO for a single key and
         calls line_cb with each line received, as it is received.
@@ -389,12 +771,45 @@ class TorControlProtocol(LineOnlyReceiver):
         def strip_ok_and_call(line):
             if line.strip() != 'OK':
                 line_cb(line)
-        return self.queue_command('GETINFO %s' % key, strip_ok_and_call)
+        return self.queue_command('GETINFO %s' % key, strip_ok_and_call, priority=priority)
+
+    def get_info_stream(self, key, batch_size=None, max_buffered=1024):
+        """
+        Calls GETINFO for a single key, returning an asynchronous
+        iterator over the lines of the value as they arrive. For
+        example, from an ``async def`` function run via
+        ``ensureDeferred``::
+
+            async for line in proto.get_info_stream('ns/all'):
+                await store(line)
+
+        The leading ``key=`` and the trailing ``OK`` are stripped.
+
+        If the consumer falls behind, at most about ``max_buffered``
+        items are held in memory: beyond that the control
+        connection's transport is paused (via ``pauseProducing``),
+        which also holds back other replies and events until the
+        consumer catches up. If you stop iterating early, call
+        ``aclose()`` on the iterator so the transport is not left
+        paused.
+
+        :param batch_size: if not None, yield lists of up to this many
+            lines instead of single lines.
+
+        :param max_buffered: how many items (lines, or batches) to
+            buffer before pausing the transport.
+
+        An error reply from Tor (e.g. an unknown key) is raised from
+        the iteration.
+        """
+        if max_buffered < 1:
+            raise ValueError("max_buffered must be at least 1")
+        return _GetInfoStream(self, key, batch_size, max_buffered)
 
     # The following methods are the main TorController API and
     # probably the most interesting for users.
 
-    def get_info(self, *args):
+    def get_info(self, *args, priority=PRIORITY_NORMAL):
         """
         Uses GETINFO to obtain informatoin from Tor.
 
@@ -406,12 +821,17 @@ class TorControlProtocol(LineOnlyReceiver):
             .. todo:: make some way to automagically obtain valid
                 keys, either from running Tor or parsing control-spec
 
+        :param priority: the command queue lane to use (see
+            :meth:`queue_command`)
+
         :return:
             a ``Deferred`` which will callback with a dict containing
             the keys you asked for. If you want to avoid the parsing
             into a dict, you can use get_info_raw instead.
         """
-        d = self.get_info_raw(*args)
+        if self.batch_queries:
+            return self._batched('GETINFO', args, priority)
+        d = self.get_info_raw(*args, priority=priority)
         d.addCallback(parse_keywords, key_hints=args)
         return d
 
@@ -427,12 +847,11 @@ class TorControlProtocol(LineOnlyReceiver):
             a ``Deferred`` which will callback with the value for that
             key (a string).
         """
-        d = self.get_info_raw(key)
-        d.addCallback(parse_keywords, key_hints=[key])
+        d = self.get_info(key)
         d.addCallback(lambda values: values[key])
         return d
 
-    def get_conf(self, *args):
+    def get_conf(self, *args, priority=PRIORITY_NORMAL):
         """
         Uses GETCONF to obtain configuration values from Tor.
 
@@ -440,6 +859,9 @@ class TorControlProtocol(LineOnlyReceiver):
             get all valid configuraiton names, you can call:
             ``get_info('config/names')``
 
+        :param priority: the command queue lane to use (see
+            :meth:`queue_command`)
+
         :return: a Deferred which callbacks with one or many
             configuration values (depends on what you asked for). See
             control-spec for valid keys (you can also use TorConfig which
@@ -455,8 +877,12 @@ class TorControlProtocol(LineOnlyReceiver):
         otherwise.
         """
 
-        d = self.queue_command('GETCONF %s' % ' '.join(args))
-        d.addCallback(parse_keywords).addErrback(log.err)
+        if self.batch_queries:
+            d = self._batched('GETCONF', args, priority)
+        else:
+            d = self.queue_command('GETCONF %s' % ' '.join(args), priority=priority)
+            d.addCallback(_parse_conf_reply)
+        d.addErrback(log.err)
         return d
 
     def get_conf_single(self, key):
@@ -477,8 +903,7 @@ class TorControlProtocol(LineOnlyReceiver):
         value case, or an empty string otherwise.
         """
 
-        d = self.queue_command('GETCONF {}'.format(key))
-        d.addCallback(parse_keywords).addErrback(log.err)
+        d = self.get_conf(key)
         # d.addCallback(lambda kw: kw[key])  # extract key we asked for initially
         # ...but, the key can have a different string-name because Tor
         # will return *it's* representation (e.g. can ask for
@@ -486,12 +911,12 @@ class TorControlProtocol(LineOnlyReceiver):
         d.addCallback(lambda kw: list(kw.values())[0])
         return d
 
-    def get_conf_raw(self, *args):
+    def get_conf_raw(self, *args, priority=PRIORITY_NORMAL):
         """
         Same as get_conf, except that the results are not parsed into a dict
         """
 
-        return self.queue_command('GETCONF %s' % ' '.join(args))
+        return self.queue_command('GETCONF %s' % ' '.join(args), priority=priority)
 
     def set_conf(self, *args):
         """
@@ -534,7 +959,8 @@ class TorControlProtocol(LineOnlyReceiver):
         return self.queue_command('SIGNAL %s' % nm)
 
     # XXX FIXME this should have been async all along :/
-    def add_event_listener(self, evt, callback):
+    def add_event_listener(self, evt, callback, typed=False,
+                           window=None, max_events=None, reactor=None):
         """
         Add a listener to an Event object. This may be called multiple
         times for the same event. If it's the first listener, a new
@@ -548,6 +974,32 @@ class TorControlProtocol(LineOnlyReceiver):
              which receives the text collected for the event from the
              tor control protocol.
 
+        :param typed: if True, the callback instead receives a
+             :class:`txtorcon.events.ControlEvent` (or the subclass
+             for this kind of event, e.g.
+             :class:`txtorcon.events.CircuitEvent`). The record is
+             decoded once per event and shared with every other typed
+             listener, so fields aren't re-parsed by each of them.
+
+        :param window: if given, events are collected for up to this
+             many seconds (starting with the first one) and the
+             callback receives them all at once as a
+             :class:`txtorcon.events.EventBatch`, with any byte and
+             cell counters already summed per circuit / stream. This
+             is meant for high-rate events like ``BW``, ``CIRC_BW``,
+             ``STREAM_BW`` and ``CELL_STATS``.
+
+        :param max_events: if given, a batch is delivered as soon as
+             it holds this many events (can be combined with
+             ``window``).
+
+        :param reactor: the reactor to use for ``window`` timing
+             (default: the global one)
+
+        A partial batch is delivered when the listener is removed or
+        the connection to Tor is lost. A callback can only be added
+        once as a batched listener for each event.
+
         For more information on the events supported, see
         `control-spec section 4.1
         <https://gitweb.torproject.org/torspec.git/tree/control-spec.txt#n1260>`_
@@ -572,13 +1024,14 @@ class TorControlProtocol(LineOnlyReceiver):
             except KeyError:
                 raise RuntimeError("Unknown event type: " + evt)
 
+        if window is None and max_events is None:
+            evt.listen(callback, typed=typed)
+        else:
+            evt.listen_batched(callback, window, max_events, reactor)
         if evt.name not in self.events:
             self.events[evt.name] = evt
-            d = self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
-        else:
-            d = defer.succeed(None)
-        evt.listen(callback)
-        return d
+            return self.queue_command('SETEVENTS %s' % ' '.join(self.events.keys()))
+        return defer.succeed(None)
 
     # XXX this should have been async all along
     def remove_event_listener(self, evt, cb):
@@ -601,7 +1054,7 @@ class TorControlProtocol(LineOnlyReceiver):
                 raise RuntimeError("Unknown event type: " + evt)
 
         evt.unlisten(cb)
-        if len(evt.callbacks) == 0:
+        if not evt.has_listeners():
             # note there's a slight window here for an event of this
             # type to come in before the SETEVENTS succeeds; see
             # _handle_notify which explicitly ignore this case.
@@ -642,22 +1095,76 @@ class TorControlProtocol(LineOnlyReceiver):
         """
         return self.queue_command('QUIT')
 
-    def queue_command(self, cmd, arg=None):
+    def queue_command(self, cmd, arg=None, priority=PRIORITY_NORMAL):
         """
         returns a Deferred which will fire with the response data when
         we get it
 
         Note that basically every request is ultimately funelled
         through this command.
+
+        :param priority: which lane of the command queue to use:
+            ``PRIORITY_HIGH``, ``PRIORITY_NORMAL`` or ``PRIORITY_BULK``
+            (from this module). Queued commands are written to Tor
+            highest-priority first and in order within a priority;
+            a command that has already been written isn't affected.
+            Every command is normal priority (so they're all written
+            in the order they were queued) unless its caller chooses
+            otherwise: for example, ``PRIORITY_HIGH`` for an
+            ``ATTACHSTREAM`` a stream is waiting on, or
+            ``PRIORITY_BULK`` for a ``GETINFO md/all`` nothing is in
+            a hurry for. A command queued at another priority may
+            reach Tor before or after ones queued earlier, so only do
+            that for commands that don't depend on them.
         """
 
         if not isinstance(cmd, bytes):
             cmd = cmd.encode('ascii')
+        if priority not in (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK):
+            raise ValueError("Unknown command priority {}".format(priority))
         d = defer.Deferred()
-        self.commands.append((d, cmd, arg))
+        self._queues[priority].append(((d, cmd, arg), self._now()))
         self._maybe_issue_command()
         return d
 
+    @property
+    def commands(self):
+        """
+        A list of the commands queued but not yet written to Tor, in
+        the order they will be written, as ``(Deferred, command,
+        line-callback)`` tuples.
+        """
+        return [command for queue in self._queues for command, _ in queue]
+
+    @property
+    def outstanding(self):
+        """
+        How many commands are queued or written to Tor and still
+        awaiting a reply.
+        """
+        return len(self._in_flight) + sum(len(queue) for queue in self._queues)
+
+    def queue_wait_stats(self):
+        """
+        How long commands have waited in the queue (that is, before
+        being written to Tor; see :meth:`queue_command`).
+
+        :return: a dict mapping each priority (``PRIORITY_HIGH`` etc)
+            to a dict with the number of commands ``written`` so far,
+            their ``mean_wait`` and ``max_wait`` in seconds and the
+            number still ``queued``.
+        """
+        stats = {}
+        for priority, queue in enumerate(self._queues):
+            written, total, longest = self._wait_stats[priority]
+            stats[priority] = {
+                'written': written,
+                'mean_wait': total / written if written else 0.0,
+                'max_wait': longest,
+                'queued': len(queue),
+            }
+        return stats
+
     def when_disconnected(self):
         """
         :returns: a Deferred that fires when (if) we disconnect from our
@@ -665,6 +1172,53 @@ class TorControlProtocol(LineOnlyReceiver):
         """
         return self._when_disconnected.when_fired()
 
+    def _batched(self, verb, keys, priority):
+        """
+        Internal helper. Adds ``keys`` to this reactor turn's batch of
+        ``verb`` (GETINFO or GETCONF) queries at ``priority``; see
+        :attr:`batch_queries`.
+        """
+        batch = self._batches.get((verb, priority))
+        if batch is None:
+            batch = self._batches[(verb, priority)] = _QueryBatch(verb, priority)
+            reactor = self._reactor
+            if reactor is None:
+                from twisted.internet import reactor
+            reactor.callLater(0, self._flush_batch, verb, priority)
+        return batch.add(keys)
+
+    def _flush_batch(self, verb, priority):
+        batch = self._batches.pop((verb, priority))
+        d = self.queue_command('%s %s' % (verb, ' '.join(batch.keys)), priority=priority)
+        d.addCallbacks(
+            self._batch_answered, self._batch_failed,
+            callbackArgs=(batch,), errbackArgs=(batch,),
+        )
+
+    def _batch_answered(self, reply, batch):
+        if not batch.got_reply(reply):
+            self._query_each(batch)
+
+    def _batch_failed(self, fail, batch):
+        if len(batch.callers) == 1:
+            batch.callers[0][1].errback(fail)
+            return
+        # find out which caller(s) the error belongs to
+        self._query_each(batch)
+
+    def _query_each(self, batch):
+        """
+        Internal helper. Asks again for each caller's keys on their
+        own, when a batch's reply can't be shared out.
+        """
+        for keys, d in batch.callers:
+            cmd = self.queue_command('%s %s' % (batch.verb, ' '.join(keys)), priority=batch.priority)
+            if batch.verb == 'GETINFO':
+                cmd.addCallback(parse_keywords, key_hints=keys)
+            else:
+                cmd.addCallback(_parse_conf_reply)
+            cmd.chainDeferred(d)
+
     # the remaining methods are internal API implementations,
     # callbacks and state-tracking methods -- you shouldn't have any
     # need to call them.
@@ -672,11 +1226,31 @@ class TorControlProtocol(LineOnlyReceiver):
     def lineReceived(self, line):
         """
         :api:`twisted.protocols.basic.LineOnlyReceiver` API
+
+        Each line is framed by our
+        :class:`txtorcon.controlcore.ControlCore`, which calls back
+        :meth:`_reply_received`, :meth:`_reply_line_received` or
+        :meth:`_handle_notify` as replies and events complete.
         """
 
-        self.debuglog.write(line + b'\n')
-        self.debuglog.flush()
-        self.fsm.process(line.decode('ascii'))
+        if self._debugging:
+            self.debuglog.write(line + b'\n')
+            self.debuglog.flush()
+        if self.capture is not None:
+            self.capture.received(line)
+        self._core.receive_line(line)
+
+    def _reply_received(self, code, text):
+        "ControlCore callback: the reply to the oldest in-flight command"
+        if code < 300:
+            self.defer.callback(text)
+        else:
+            self.defer.errback(TorProtocolError(code, text))
+        self._finish_command()
+
+    def _reply_line_received(self, text):
+        "ControlCore callback: a line for the current command's line-callback"
+        self.command[2](text)
 
     def connectionMade(self):
         "Protocol API"
@@ -714,7 +1288,14 @@ class TorControlProtocol(LineOnlyReceiver):
                 self.on_disconnect.errback(reason)
         self.on_disconnect = None
 
-        outstanding = [self.command] + self.commands if self.command else self.commands
+        # nothing more is coming, so hand over any partial batches
+        for evt in list(self.events.values()):
+            evt.flush()
+
+        outstanding = list(self._in_flight) + self.commands
+        self._in_flight.clear()
+        for queue in self._queues:
+            queue.clear()
         self.command = None
         self.defer = None
         for d, cmd, cmd_arg in outstanding:
@@ -730,16 +1311,17 @@ class TorControlProtocol(LineOnlyReceiver):
                 )
         return None
 
-    def _handle_notify(self, code, rest):
+    def _handle_notify(self, name, text):
         """
         Internal method to deal with 600-level responses.
         """
 
-        firstline = rest[:rest.find('\n')]
-        args = firstline.split()
-        name = args[0]
-        if name in self.events:
-            self.events[name].got_update(rest[len(name) + 1:])
+        try:
+            event = self.events[name]
+        except KeyError:
+            event = None
+        if event is not None:
+            event.got_update(text)
             return
         # not considering this an error, as there's a slight window
         # after remove_event_listener is called (so the handler is
@@ -747,29 +1329,62 @@ class TorControlProtocol(LineOnlyReceiver):
 
     def _maybe_issue_command(self):
         """
-        If there's at least one command queued and we're not currently
-        processing a command, this will issue the next one on the
-        wire.
+        If there's at least one command queued and we have fewer than
+        :attr:`max_in_flight` commands awaiting replies, this will
+        issue queued commands on the wire (highest priority first)
+        until the window is full.
         """
-        if self.command:
-            return
-
-        if len(self.commands):
-            self.command = self.commands.pop(0)
-            (d, cmd, cmd_arg) = self.command
-
-            if self._when_disconnected.already_fired(d):
+        while len(self._in_flight) < self.max_in_flight:
+            for priority, queue in enumerate(self._queues):
+                if queue:
+                    break
+            else:
                 return
+            command, queued_at = queue.popleft()
+            (d, cmd, cmd_arg) = command
 
-            self.defer = d
-
-            self.debuglog.write(cmd + b'\n')
-            self.debuglog.flush()
-
-            data = cmd + b'\r\n'
+            if self._when_disconnected.already_fired(d):
+                continue
+
+            waited = self._now() - queued_at
+            stats = self._wait_stats[priority]
+            stats[0] += 1
+            stats[1] += waited
+            if waited > stats[2]:
+                stats[2] = waited
+
+            self._in_flight.append(command)
+            if self.command is None:
+                # replies arrive in order, so the oldest command
+                # in-flight is the one the next reply belongs to
+                self.command = command
+                self.defer = d
+
+            if self._debugging:
+                self.debuglog.write(cmd + b'\n')
+                self.debuglog.flush()
+            if self.capture is not None:
+                self.capture.sent(cmd)
+
+            data = self._core.send_command(cmd, stream_lines=cmd_arg is not None)
             txtorlog.msg("cmd: {}".format(data.strip()))
             self.transport.write(data)
 
+    def _finish_command(self):
+        """
+        The reply for the oldest in-flight command has been delivered;
+        the next in-flight command (if any) becomes current.
+        """
+        if self._in_flight:
+            self._in_flight.popleft()
+        if self._in_flight:
+            self.command = self._in_flight[0]
+            self.defer = self.command[0]
+        else:
+            self.command = None
+            self.defer = None
+        self._maybe_issue_command()
+
     def _auth_failed(self, fail):
         """
         Errback if authentication fails.
@@ -786,28 +1401,9 @@ class TorControlProtocol(LineOnlyReceiver):
         """
         if self._cookie_data is None:
             raise RuntimeError("Cookie data not read.")
-        kw = parse_keywords(reply.replace(' ', '\n'))
-
-        server_hash = base64.b16decode(kw['SERVERHASH'])
-        server_nonce = base64.b16decode(kw['SERVERNONCE'])
-        # FIXME put string in global. or something.
-        expected_server_hash = hmac_sha256(
-            b"Tor safe cookie authentication server-to-controller hash",
-            self._cookie_data + self.client_nonce + server_nonce,
+        client_hash_hex = safecookie_response(
+            self._cookie_data, self.client_nonce, reply,
         )
-
-        if not compare_via_hash(expected_server_hash, server_hash):
-            raise RuntimeError(
-                'Server hash not expected; wanted "%s" and got "%s".' %
-                (base64.b16encode(expected_server_hash),
-                 base64.b16encode(server_hash))
-            )
-
-        client_hash = hmac_sha256(
-            b"Tor safe cookie authentication controller-to-server hash",
-            self._cookie_data + self.client_nonce + server_nonce
-        )
-        client_hash_hex = base64.b16encode(client_hash)
         return self.queue_command(b'AUTHENTICATE ' + client_hash_hex)
 
     def _read_cookie(self, cookiefile):
@@ -828,23 +1424,11 @@ class TorControlProtocol(LineOnlyReceiver):
         Callback on PROTOCOLINFO to actually authenticate once we know
         what's supported.
         """
-        methods = None
         cookie_auth = False
-        for line in protoinfo.split('\n'):
-            if line[:5] == 'AUTH ':
-                kw = parse_keywords(line[5:].replace(' ', '\n'))
-                methods = kw['METHODS'].split(',')
-        if not methods:
-            raise RuntimeError(
-                "Didn't find AUTH line in PROTOCOLINFO response."
-            )
+        methods, cookiefile = parse_protocolinfo(protoinfo)
 
         if 'SAFECOOKIE' in methods or 'COOKIE' in methods:
-            cookiefile_match = re.search(r'COOKIEFILE=("(?:[^"\\]|\\.)*")',
-                                         protoinfo)
-            if cookiefile_match:
-                cookiefile = cookiefile_match.group(1)
-                cookiefile = unescape_quoted_string(cookiefile)
+            if cookiefile is not None:
                 try:
                     self._read_cookie(cookiefile)
                     cookie_auth = True
@@ -928,17 +1512,23 @@ class TorControlProtocol(LineOnlyReceiver):
         callback.
         """
 
+        # ask for everything at once (so these can be pipelined, or
+        # batched into one GETINFO); the order of replies doesn't change
+        signals_d = self.get_info('signal/names')
+        version_d = self.get_info('version')
+        events_d = self.get_info('events/names')
+
         try:
-            self.valid_signals = yield self.get_info('signal/names')
+            self.valid_signals = yield signals_d
             self.valid_signals = self.valid_signals['signal/names']
         except TorProtocolError:
             self.valid_signals = ["RELOAD", "DUMP", "DEBUG", "NEWNYM",
                                   "CLEARDNSCACHE"]
 
-        self.version = yield self.get_info('version')
+        self.version = yield version_d
         self.version = self.version['version']
         txtorlog.msg("Connected to a Tor with VERSION", self.version)
-        eventnames = yield self.get_info('events/names')
+        eventnames = yield events_d
         eventnames = eventnames['events/names']
         self._set_valid_events(eventnames)
 
@@ -946,126 +1536,3 @@ class TorControlProtocol(LineOnlyReceiver):
 
         self.post_bootstrap.callback(self)
         return self
-
-    # State Machine transitions and matchers. See the __init__ method
-    # for a way to output a GraphViz dot diagram of the machine.
-
-    def _is_end_line(self, line):
-        "for FSM"
-        return line.strip() == '.'
-
-    def _is_not_end_line(self, line):
-        "for FSM"
-        return not self._is_end_line(line)
-
-    def _is_single_line_response(self, line):
-        "for FSM"
-        try:
-            code = int(line[:3])
-        except Exception:
-            return False
-
-        sl = len(line) > 3 and line[3] == ' '
-        # print "single line?",line,sl
-        if sl:
-            self.code = code
-            return True
-        return False
-
-    def _start_command(self, line):
-        "for FSM"
-        # print "startCommand",self.code,line
-        self.code = int(line[:3])
-        # print "startCommand:",self.code
-        if self.command and self.command[2] is not None:
-            self.command[2](line[4:])
-        else:
-            self.response = line[4:] + '\n'
-        return None
-
-    def _is_continuation_line(self, line):
-        "for FSM"
-        code = int(line[:3])
-        if self.code and self.code != code:
-            raise RuntimeError("Unexpected code %d, wanted %d" % (code,
-                                                                  self.code))
-        return line[3] == '-'
-
-    def _is_multi_line(self, line):
-        "for FSM"
-        code = int(line[:3])
-        if self.code and self.code != code:
-            raise RuntimeError("Unexpected code %d, wanted %d" % (code,
-                                                                  self.code))
-        return line[3] == '+'
-
-    def _accumulate_multi_response(self, line):
-        "for FSM"
-        if self.command and self.command[2] is not None:
-            self.command[2](line)
-
-        else:
-            self.response += (line + '\n')
-        return None
-
-    def _accumulate_response(self, line):
-        "for FSM"
-        if self.command and self.command[2] is not None:
-            self.command[2](line[4:])
-
-        else:
-            self.response += (line[4:] + '\n')
-        return None
-
-    def _is_finish_line(self, line):
-        "for FSM"
-        # print "isFinish",line
-        if len(line) < 1:
-            return False
-        if line[0] == '.':
-            return True
-        if len(line) > 3 and line[3] == ' ':
-            return True
-        return False
-
-    def _broadcast_response(self, line):
-        "for FSM"
-        if len(line) > 3:
-            if self.code >= 200 and self.code < 300 and \
-               self.command and self.command[2] is not None:
-                self.command[2](line[4:])
-                resp = ''
-
-            else:
-                resp = self.response + line[4:]
-        else:
-            resp = self.response
-        self.response = ''
-        if self.code is None:
-            raise RuntimeError("No code set yet in broadcast response.")
-        elif self.code >= 200 and self.code < 300:
-            if self.defer is None:
-                raise RuntimeError(
-                    'Got a response, but didn\'t issue a command: "%s"' % resp
-                )
-            if resp.endswith('\nOK'):
-                resp = resp[:-3]
-            self.defer.callback(resp)
-        elif self.code >= 500 and self.code < 600:
-            err = TorProtocolError(self.code, resp)
-            self.defer.errback(err)
-        elif self.code >= 600 and self.code < 700:
-            self._handle_notify(self.code, resp)
-            self.code = None
-            return
-        else:
-            raise RuntimeError(
-                "Unknown code in broadcast response %d." % self.code
-            )
-
-        # note: we don't do this for 600-level responses
-        self.command = None
-        self.code = None
-        self.defer = None
-        self._maybe_issue_command()
-        return None
@@ -99,6 +99,11 @@ class ConfigMethod(object):
             # sometimes keyname= is followed by a newline, so final .strip()
             return arg.strip()[len(key) + 1:].strip()
 
+        if getattr(self.proto, 'batch_queries', False):
+            # lets calls made together share one GETINFO
+            d = self.proto.get_info_single(req)
+            d.addCallback(lambda value: value.strip())
+            return d
         d = self.proto.get_info_raw(req)
         d.addCallback(functools.partial(stripper, req))
         return d
@@ -2,13 +2,16 @@
 
 import os
 import stat
+import ipaddress
 import warnings
+from itertools import islice
 try:
     from collections.abc import Callable
 except ImportError:
     from collections import Callable
 
 from twisted.internet import defer
+from twisted.internet import threads
 from twisted.python.failure import Failure
 from twisted.internet.endpoints import TCP4ClientEndpoint
 from twisted.internet.endpoints import UNIXClientEndpoint
@@ -19,23 +22,246 @@ from zope.interface import implementer
 from txtorcon.torcontrolprotocol import TorProtocolFactory
 from txtorcon.stream import Stream
 from txtorcon.circuit import Circuit, _extract_reason
-from txtorcon.router import Router, hashFromHexId
+from txtorcon.router import Router, ExitPolicyIndex, hashFromHexId, flag_mask
 from txtorcon.addrmap import AddrMap
 from txtorcon.torcontrolprotocol import parse_keywords
 from txtorcon.log import txtorlog
 from txtorcon.torcontrolprotocol import TorProtocolError
+from txtorcon.torcontrolprotocol import PRIORITY_HIGH, PRIORITY_BULK
 
 from txtorcon.interface import ITorControlProtocol
 from txtorcon.interface import IRouterContainer
 from txtorcon.interface import ICircuitListener
 from txtorcon.interface import ICircuitContainer
 from txtorcon.interface import IStreamListener
+from txtorcon.interface import IRouterListener
 from txtorcon.interface import IStreamAttacher
 from txtorcon.interface import StreamListenerMixin
 from txtorcon.interface import CircuitListenerMixin
 from ._microdesc_parser import MicrodescriptorParser
 from .router import hexIdFromHash
 from .util import maybe_coroutine
+from .util import NetLocation
+from .util import split_event_args
+from .snapshot import load_snapshot, write_snapshot
+from .routertable import RouterTable, known_country
+from .pathselect import PathSelector, _subnet
+from .history import History, CircuitRecord, StreamRecord
+from .circuitbuild import build_circuits
+
+
+#: how many routers to create (or update) from a NEWCONSENSUS before
+#: letting the reactor run again
+_ROUTERS_PER_TURN = 500
+
+#: how many addresses locate_routers asks Tor about in one GETINFO
+_LOCATE_PER_COMMAND = 500
+
+
+# the Router attributes _update_router sets (everything but the
+# controller)
+# what _install_routers copies onto a changed Router; the rest are
+# ours, or lookups cached from what the consensus says
+_CONSENSUS_SLOTS = tuple(
+    name for name in Router.__slots__
+    if name not in ('controller', '_location', '_modified')
+)
+
+
+def _parse_consensus(data):
+    """
+    Internal helper. The keyword arguments for each relay in the
+    network-status text ``data`` (what MicrodescriptorParser passes
+    to ``create_relay``). Touches nothing else, so is safe to run in
+    a thread.
+    """
+    relays = []
+    parser = MicrodescriptorParser(lambda **kw: relays.append(kw))
+    for line in data.split('\n'):
+        parser.feed_line(line)
+    parser.done()
+    return relays
+
+
+def _relay_key(relay):
+    """
+    Internal helper. What we compare between consensuses to decide
+    whether a relay (keyword arguments as from _parse_consensus, or
+    a snapshot) has changed: its descriptor's publication time plus
+    everything else the consensus says about it.
+    """
+    return (
+        relay['modified'],
+        relay['nickname'],
+        relay['orhash'],
+        relay['ip'],
+        str(relay['orport']),
+        str(relay['dirport']),
+        flag_mask(relay.get('flags', ())),
+        int(relay.get('bandwidth', 0)),
+        ' '.join(relay.get('ip_v6', ())),
+        relay.get('policy', ''),
+    )
+
+
+def _router_key(router):
+    """
+    Internal helper. The _relay_key of the relay ``router`` was built
+    from (for a Router loaded from a snapshot).
+    """
+    return (
+        router._modified_unparsed,
+        router.name,
+        router.or_hash,
+        router.ip,
+        router.or_port,
+        router.dir_port,
+        router.flag_bits,
+        router.bandwidth,
+        ' '.join(router._ip_v6 or ()),
+        router.policy,
+    )
+
+
+def _diff_consensus(previous, relays):
+    """
+    Internal helper. Compares ``relays`` (from _parse_consensus) with
+    ``previous`` (the _relay_key of each relay in the consensus
+    before, by identity hash). Safe to run in a thread.
+
+    :return: a tuple of the new identity-hash -> _relay_key dict, the
+        relays that are new, the relays that have changed and the
+        identity hashes of the relays that are gone.
+    """
+    keys = {}
+    added = []
+    changed = []
+    for relay in relays:
+        idhash = relay['idhash']
+        if idhash in keys:
+            continue                    # listed twice; keep the first
+        key = keys[idhash] = _relay_key(relay)
+        try:
+            if previous[idhash] != key:
+                changed.append(relay)
+        except KeyError:
+            added.append(relay)
+    removed = [idhash for idhash in previous if idhash not in keys]
+    return keys, added, changed, removed
+
+
+def _index_keys(router, country):
+    """
+    Internal helper. The (index, key) pairs under which ``router``
+    belongs in TorState's secondary indexes, given the country it
+    was indexed under (or None).
+    """
+    keys = [('_routers_by_address', router.ip), ('_routers_by_flags', router.flag_bits)]
+    for address in router._ip_v6 or ():
+        # like "[2001:db8::1]:9001"
+        keys.append(('_routers_by_address', address[1:address.rfind(']')]))
+    subnet = _subnet(router.ip)
+    if subnet is not None:
+        keys.append(('_routers_by_subnet', subnet))
+    if country is not None:
+        keys.append(('_routers_by_country', country))
+    return keys
+
+
+# indexes whose values are tuples (they're mostly of one router)
+# rather than sets
+_TUPLE_INDEXES = ('_routers_by_address', '_routers_by_subnet')
+
+
+def _reindex(tables, router, old_keys, new_keys, copied=None):
+    """
+    Internal helper. Moves ``router`` in the secondary indexes of
+    ``tables`` (a TorState or _RouterTables) from the _index_keys
+    ``old_keys`` to ``new_keys``. If ``copied`` isn't None the sets
+    in the indexes are shared with the previous tables, so each is
+    copied the first time it changes and its (index, key) added to
+    ``copied``.
+    """
+    if old_keys:
+        old_keys = set(old_keys)
+        new_keys = set(new_keys)
+        old_keys, new_keys = old_keys - new_keys, new_keys - old_keys
+    for (name, key) in old_keys:
+        index = getattr(tables, name)
+        if name in _TUPLE_INDEXES:
+            routers = tuple(r for r in index[key] if r is not router)
+            if routers:
+                index[key] = routers
+                continue
+        else:
+            routers = _writable_set(index, name, key, copied)
+            routers.discard(router)
+            if routers:
+                continue
+        del index[key]
+    for (name, key) in new_keys:
+        index = getattr(tables, name)
+        if name in _TUPLE_INDEXES:
+            index[key] = index.get(key, ()) + (router,)
+        else:
+            _writable_set(index, name, key, copied).add(router)
+
+
+def _writable_set(index, name, key, copied):
+    try:
+        routers = index[key]
+    except KeyError:
+        routers = index[key] = set()
+    else:
+        if copied is None or (name, key) in copied:
+            return routers
+        routers = index[key] = set(routers)
+    if copied is not None:
+        copied.add((name, key))
+    return routers
+
+
+class _RouterTables(object):
+    """
+    Internal helper. A new set of TorState's router lookup tables,
+    starting as shallow copies of ``current``'s (if given), changed
+    for a new consensus and then swapped in all at once (see
+    TorState._install_routers). The lists in ``routers_by_name`` are
+    shared with ``current`` so are replaced, never changed in place,
+    and the sets in the secondary indexes are copied before they're
+    changed (see _reindex).
+    """
+
+    def __init__(self, current=None):
+        if current is None:
+            self.routers = {}
+            self.routers_by_name = {}
+            self.routers_by_hash = {}
+            self.guards = {}
+            self.authorities = {}
+            self.all_routers = set()
+            self._routers_by_address = {}
+            self._routers_by_subnet = {}
+            self._routers_by_flags = {}
+            self._routers_by_country = {}
+            self._router_countries = {}
+        else:
+            self.routers = dict(current.routers)
+            self.routers_by_name = dict(current.routers_by_name)
+            self.routers_by_hash = dict(current.routers_by_hash)
+            self.guards = dict(current.guards)
+            self.authorities = dict(current.authorities)
+            self.all_routers = set(current.all_routers)
+            self._routers_by_address = dict(current._routers_by_address)
+            self._routers_by_subnet = dict(current._routers_by_subnet)
+            self._routers_by_flags = dict(current._routers_by_flags)
+            self._routers_by_country = dict(current._routers_by_country)
+            self._router_countries = dict(current._router_countries)
+        #: the (index, key) of each index set copied so far
+        self.copied = set()
+        #: (live Router, Router with its new attributes) for each
+        #: changed relay, applied when the tables are swapped in
+        self.updates = []
 
 
 def _build_state(proto):
@@ -210,7 +436,31 @@ class TorState(object):
         state = TorState(protocol, bootstrap=True)
         return state.post_bootstrap
 
-    def __init__(self, protocol, bootstrap=True):
+    def __init__(self, protocol, bootstrap=True, snapshot_path=None, reactor=None,
+                 history_size=1000):
+        """
+        :param snapshot_path: if not None, a file in which to keep a
+            snapshot of the router table (see
+            :mod:`txtorcon.snapshot`). When bootstrapping, if the
+            file holds a snapshot from the same version of Tor the
+            routers are loaded from it instead of from ``GETINFO
+            ns/all``; once bootstrapped, the snapshot is checked
+            against Tor's current consensus in the background (and
+            the routers refreshed if it was out of date). The file is
+            rewritten whenever the routers are.
+
+        :param reactor: NEWCONSENSUS events are parsed in a thread
+            from this reactor's pool, and the new routers created a
+            few hundred per reactor turn (default: the global
+            reactor).
+
+        :param history_size: how many records of finished circuits,
+            and of finished streams, to keep in :attr:`history` (a
+            :class:`txtorcon.history.History`).
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
         self.protocol = ITorControlProtocol(protocol)
         # fixme could use protocol.on_disconnect to re-connect; see issue #3
 
@@ -236,12 +486,19 @@ class TorState(object):
         #: keys on id (integer)
         self.streams = {}
 
+        #: records of recently-finished circuits and streams
+        self.history = History(history_size)
+        #: when each circuit we know of was first seen and became
+        #: BUILT, and when each stream was first seen and the last
+        #: circuit it was attached to, for the history
+        self._circuit_times = {}
+        self._stream_info = {}
+
         #: list of unique routers
         self.all_routers = set()
 
         #: keys by hexid (string) and by unique names
         self.routers = {}
-        self._old_routers = {}
 
         #: keys on name, value always list (many duplicate "Unnamed"
         #: routers, for example)
@@ -250,6 +507,16 @@ class TorState(object):
         #: keys by hexid (string)
         self.routers_by_hash = {}
 
+        #: secondary indexes of the routers: by IPv4 and IPv6
+        #: address and by /16 (an int) to tuples, and by flag_bits
+        #: and by country code (for routers whose country was known
+        #: when they were indexed; see _router_countries) to sets
+        self._routers_by_address = {}
+        self._routers_by_subnet = {}
+        self._routers_by_flags = {}
+        self._routers_by_country = {}
+        self._router_countries = {}
+
         #: potentially-usable as entry guards, I think? (any router
         #: with 'Guard' flag)
         self.guards = {}
@@ -268,38 +535,57 @@ class TorState(object):
 
         self._network_status_parser = MicrodescriptorParser(self._create_router)
 
+        #: what each relay in the consensus said last time, by
+        #: identity hash (see _relay_key)
+        self._relay_keys = {}
+
+        #: ExitPolicyIndex of routers_by_hash, built when needed
+        self._exit_index = None
+        #: RouterTable of routers_by_hash, built when needed
+        self._router_table = None
+        #: PathSelector of routers_by_hash, built when needed
+        self._path_selector = None
+        self._bandwidth_weights = None
+
+        #: IRouterListener providers; see add_router_listener
+        self.router_listeners = []
+
+        #: the newest NEWCONSENSUS text we haven't processed yet, and
+        #: whether we're processing one already
+        self._pending_consensus = None
+        self._processing_consensus = False
+
+        self._snapshot_path = snapshot_path
+        #: when using a snapshot, fires once it has been checked
+        #: against (and if need be, refreshed from) Tor's consensus
+        self._snapshot_check = None
+        #: held while a snapshot is written (in a thread), so no
+        #: consensus is installed meanwhile; see _write_snapshot
+        self._snapshot_lock = defer.DeferredLock()
+
         self.post_bootstrap = defer.Deferred()
         if bootstrap:
             self.protocol.post_bootstrap.addCallback(self._bootstrap)
             self.protocol.post_bootstrap.addErrback(self.post_bootstrap.errback)
 
     def _create_router(self, **kw):
-        id_hex = hexIdFromHash(kw['idhash'])
-        try:
-            router = self._old_routers[id_hex]
-        except KeyError:
-            router = Router(self.protocol)
+        router = Router(self.protocol)
+        self._update_router(router, kw)
+        self._add_router(router, kw['idhash'], _relay_key(kw))
 
-        self.routers[id_hex] = router
-        router.from_consensus = True
-        router.update(
-            kw['nickname'],
-            kw['idhash'],
-            kw['orhash'],
-            kw['modified'],
-            kw['ip'],
-            kw['orport'],
-            kw['dirport'],
-        )
-        router.flags = kw.get('flags', [])
-        if 'bandwidth' in kw:
-            router.bandwidth = kw['bandwidth']
-        if 'ip_v6' in kw:
-            router.ip_v6.extend(kw['ip_v6'])
+    def _add_router(self, router, idhash, key):
+        """
+        Internal helper. Adds ``router`` (whose identity hash is
+        ``idhash`` and _relay_key ``key``) to all our tables.
+        """
+        self._exit_index = None
+        self._router_table = None
+        self._path_selector = None
+        self._relay_keys[idhash] = key
 
-        if 'guard' in router.flags:
+        if router.has_flag('guard'):
             self.guards[router.id_hex] = router
-        if 'authority' in router.flags:
+        if router.has_flag('authority'):
             self.authorities[router.name] = router
 
         if router.name in self.routers:
@@ -317,6 +603,42 @@ class TorState(object):
         self.routers[router.id_hex] = router
         self.routers_by_hash[router.id_hex] = router
         self.all_routers.add(router)
+        _reindex(self, router, (), _index_keys(router, self._index_country(self, router)))
+
+    def _index_country(self, tables, router):
+        """
+        Internal helper. Records (in ``tables``) and returns the
+        country ``router`` is indexed under: the one its location
+        gives, if that's known without asking Tor.
+        """
+        country = known_country(router)
+        if country is None:
+            tables._router_countries.pop(router.id_hex, None)
+        else:
+            country = tables._router_countries[router.id_hex] = country.upper()
+        return country
+
+    def _update_router(self, router, kw):
+        """
+        Internal helper. Sets everything the consensus says about a
+        relay (``kw``, as from MicrodescriptorParser) on ``router``.
+        """
+        router.from_consensus = True
+        router.update(
+            kw['nickname'],
+            kw['idhash'],
+            kw['orhash'],
+            kw['modified'],
+            kw['ip'],
+            kw['orport'],
+            kw['dirport'],
+        )
+        router.flags = kw.get('flags', [])
+        if 'bandwidth' in kw:
+            router.bandwidth = kw['bandwidth']
+        router.ip_v6 = list(kw.get('ip_v6', ()))
+        if kw.get('policy'):
+            router.policy = kw['policy'].split()
 
     @defer.inlineCallbacks
     def _bootstrap(self, arg=None):
@@ -328,11 +650,19 @@ class TorState(object):
         # look out! we're depending on get_info_incremental returning
         # *lines*, which isn't documented -- but will be true because
         # TorControlProtocol is a LineReceiver...
-        yield self.protocol.get_info_incremental(
-            'ns/all',
-            self._network_status_parser.feed_line,
-        )
-        self._network_status_parser.done()
+        snapshot = self._load_snapshot()
+        if snapshot is None:
+            yield self.protocol.get_info_incremental(
+                'ns/all',
+                self._network_status_parser.feed_line,
+                priority=PRIORITY_BULK,
+            )
+            self._network_status_parser.done()
+        else:
+            self._add_snapshot_routers(snapshot)
+        # remove any names we added that turned out to have dups
+        for name in [k for (k, v) in self.routers.items() if v is None]:
+            del self.routers[name]
 
         # update list of existing circuits
         cs = yield self.protocol.get_info_raw('circuit-status')
@@ -396,6 +726,96 @@ class TorState(object):
         self.post_bootstrap.callback(self)
         self.post_boostrap = None
 
+        if self._snapshot_path is not None:
+            self._snapshot_check = self._check_snapshot(snapshot)
+
+    def _add_snapshot_routers(self, snapshot):
+        for router in snapshot.routers:
+            router.controller = self.protocol
+            self._add_router(router, router.id_hash, _router_key(router))
+
+    def _load_snapshot(self):
+        """
+        The snapshot to bootstrap from, or None if there isn't a
+        usable one.
+        """
+        if self._snapshot_path is None:
+            return None
+        try:
+            snapshot = load_snapshot(self._snapshot_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            txtorlog.msg("Ignoring snapshot {}: {}".format(self._snapshot_path, e))
+            return None
+        if snapshot.tor_version != getattr(self.protocol, 'version', None):
+            txtorlog.msg("Ignoring snapshot from Tor {}".format(snapshot.tor_version))
+            return None
+        return snapshot
+
+    @defer.inlineCallbacks
+    def _consensus_valid_after(self):
+        key = 'consensus/valid-after'
+        raw = yield self.protocol.get_info_raw(key)
+        return parse_keywords(raw)[key]
+
+    def _check_snapshot(self, snapshot):
+        """
+        Internal helper. Compare the snapshot we bootstrapped from (if
+        any) with Tor's current consensus, re-reading ``ns/all`` if
+        it is stale. That goes through the same queue as NEWCONSENSUS
+        events (and saves a new snapshot once installed), so it can't
+        overwrite or be overwritten by one that's being processed.
+        """
+        @defer.inlineCallbacks
+        def check():
+            valid_after = yield self._consensus_valid_after()
+            if snapshot is None:
+                yield self._write_snapshot(valid_after)
+            elif snapshot.valid_after != valid_after:
+                txtorlog.msg("Snapshot is from", snapshot.valid_after, "refreshing routers")
+                lines = []
+                yield self.protocol.get_info_incremental('ns/all', lines.append, priority=PRIORITY_BULK)
+                # any NEWCONSENSUS that arrived before this reply is
+                # no newer than it, so it's fine to take its place
+                self._network_status_event('\n'.join(lines))
+        d = check()
+        d.addErrback(self._snapshot_error)
+        return d
+
+    def _save_snapshot(self):
+        d = self._consensus_valid_after()
+        d.addCallback(self._write_snapshot)
+        d.addErrback(self._snapshot_error)
+        return d
+
+    def _write_snapshot(self, valid_after):
+        """
+        Internal helper. Writes the routers from the consensus to the
+        snapshot in a thread from the reactor's pool, holding
+        _snapshot_lock so that _process_consensus doesn't change them
+        meanwhile. Returns a Deferred that fires when it's written.
+        """
+        def write():
+            routers = [
+                router for router in self.routers_by_hash.values()
+                if router.from_consensus
+            ]
+            d = threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                write_snapshot, self._snapshot_path, self.protocol.version, valid_after, routers,
+            )
+            d.addCallback(lambda _: txtorlog.msg(
+                "Wrote snapshot of {} routers to {}".format(len(routers), self._snapshot_path)))
+            return d
+        return self._snapshot_lock.run(write)
+
+    def _snapshot_error(self, fail):
+        # a snapshot is only ever an optimization
+        txtorlog.msg("Failed to update snapshot {}: {}".format(
+            self._snapshot_path, fail.getErrorMessage()))
+        return None
+
     # XXX this should be hidden as _undo_attacher
     def undo_attacher(self):
         """
@@ -657,6 +1077,207 @@ class TorState(object):
             stream.listen(listen)
         self.stream_listeners.append(listen)
 
+    def exits_accepting(self, *ports):
+        """
+        The routers whose exit-policy summaries (from the consensus)
+        accept all of ``ports``; found with an index that is built
+        the first time it's needed after each new consensus, so this
+        doesn't look at every router.
+
+        :return: a set of :class:`txtorcon.Router` instances
+        """
+        return self._exit_policy_index().routers_accepting(*ports)
+
+    def routers_at_address(self, address):
+        """
+        :param address: an IPv4 or IPv6 address (the latter with or
+            without brackets)
+        :return: a set of the :class:`txtorcon.Router` instances
+            with that address (usually one)
+        """
+        if address.startswith('['):
+            address = address[1:-1]
+        if ':' in address:
+            address = ipaddress.IPv6Address(address).compressed
+        return set(self._routers_by_address.get(address, ()))
+
+    def routers_in_network(self, network):
+        """
+        :param network: an IPv4 network, like ``"192.0.2.0/24"`` (or
+            an :class:`ipaddress.IPv4Network`)
+        :return: a set of the :class:`txtorcon.Router` instances whose
+            IPv4 addresses are in ``network``
+        """
+        network = ipaddress.IPv4Network(network)
+        first = int(network.network_address)
+        last = int(network.broadcast_address)
+        found = set()
+        for subnet in range(first >> 16, (last >> 16) + 1):
+            found.update(self._routers_by_subnet.get(subnet, ()))
+        if network.prefixlen > 16:
+            found = set(
+                router for router in found
+                if ipaddress.IPv4Address(router.ip) in network
+            )
+        return found
+
+    def routers_in_country(self, code):
+        """
+        :param code: a country code, like ``"DE"`` (in any case)
+        :return: a set of the :class:`txtorcon.Router` instances in
+            that country, of those whose country was known (from a
+            local GeoIP database, or by having been looked up) when
+            they last appeared in a consensus
+        """
+        return set(self._routers_by_country.get(code.upper(), ()))
+
+    @defer.inlineCallbacks
+    def locate_routers(self, routers=None):
+        """
+        Asks Tor (with ``GETINFO ip-to-country``) for the countries of
+        those of ``routers`` (default: all of them) whose country
+        isn't known, so that :meth:`routers_in_country` (and
+        ``exit_country`` in :meth:`select_path`) can find them without
+        a local GeoIP database. Countries found while a new consensus
+        is being processed are forgotten once it's installed (except
+        by the Routers themselves).
+
+        :return: a Deferred that fires with how many routers' countries
+            were found
+        """
+        if routers is None:
+            routers = self.routers_by_hash.values()
+        by_ip = {}
+        for router in routers:
+            if router.id_hex in self._router_countries or router.ip == 'unknown':
+                continue
+            if known_country(router) is None:
+                by_ip.setdefault(router.ip, []).append(router)
+        addresses = list(by_ip)
+        located = {}
+        for start in range(0, len(addresses), _LOCATE_PER_COMMAND):
+            keys = ['ip-to-country/' + ip for ip in addresses[start:start + _LOCATE_PER_COMMAND]]
+            raw = yield self.protocol.get_info_raw(*keys)
+            for (key, code) in parse_keywords(raw).items():
+                code = code.strip().upper()
+                if code == '??' or not key.startswith('ip-to-country/'):
+                    continue
+                for router in by_ip.get(key[len('ip-to-country/'):], ()):
+                    location = router._location
+                    if location is None:
+                        location = router._location = NetLocation(router.ip)
+                    location.countrycode = code
+                    located.setdefault(code, []).append(router)
+
+        # the sets may be shared with tables a NEWCONSENSUS is being
+        # applied to, so are replaced rather than changed
+        by_country = dict(self._routers_by_country)
+        countries = dict(self._router_countries)
+        for (code, found) in located.items():
+            by_country[code] = set(by_country.get(code, ())).union(found)
+            for router in found:
+                countries[router.id_hex] = code
+        self._routers_by_country = by_country
+        self._router_countries = countries
+        self._router_table = None
+        self._path_selector = None
+        return sum(len(found) for found in located.values())
+
+    def routers_with_flags(self, *flags):
+        """
+        :param flags: flag names (in any case), like ``"Exit"``
+        :return: a set of the :class:`txtorcon.Router` instances with
+            all of ``flags``
+        """
+        want = flag_mask(flags)
+        found = set()
+        for (bits, routers) in self._routers_by_flags.items():
+            if bits & want == want:
+                found.update(routers)
+        return found
+
+    def router_table(self):
+        """
+        The current routers as a
+        :class:`txtorcon.routertable.RouterTable`, for filtering and
+        ranking them by flags, country, bandwidth or address without
+        looking at each :class:`txtorcon.Router`. It is built the
+        first time it's needed after each new consensus, with the
+        countries of the routers whose locations are already known.
+        """
+        if self._router_table is None:
+            self._router_table = RouterTable(self.routers_by_hash.values())
+        return self._router_table
+
+    @property
+    def bandwidth_weights(self):
+        """
+        The consensus "bandwidth-weights" (a dict like
+        :func:`txtorcon.pathselect.parse_bandwidth_weights` returns)
+        for :meth:`select_path` to use, or None (the default) to
+        weight relays by bandwidth alone; ``ns/all`` doesn't include
+        them, so set this if you have them.
+        """
+        return self._bandwidth_weights
+
+    @bandwidth_weights.setter
+    def bandwidth_weights(self, weights):
+        self._bandwidth_weights = weights
+        self._path_selector = None
+
+    def select_path(self, length=3, exit_ports=(), stable=False, using_guards=False,
+                    exit_country=None):
+        """
+        Chooses a path the way Tor would, suitable for
+        :meth:`build_circuit`: each hop is picked at random in
+        proportion to its bandwidth (see :attr:`bandwidth_weights`)
+        from relays with the right flags, with no two hops in the
+        same /16. This uses a
+        :class:`txtorcon.pathselect.PathSelector` that is built the
+        first time it's needed after each new consensus, after which
+        each path takes a few microseconds.
+
+        :param length: how many hops (at least 2)
+        :param exit_ports: ports the exit's policy must accept
+        :param stable: if True, every hop must have the Stable flag
+        :param using_guards: if True, the first hop is one of
+            :attr:`entry_guards` rather than any guard
+        :param exit_country: if given, a country code; the exit is
+            one of :meth:`routers_in_country`
+
+        :return: a list of :class:`txtorcon.Router` instances
+        """
+        if self._path_selector is None:
+            self._path_selector = PathSelector(
+                self.routers_by_hash.values(),
+                bandwidth_weights=self._bandwidth_weights,
+                exit_index=self._exit_policy_index(),
+                countries=self.routers_in_country,
+            )
+        guards = None
+        if using_guards:
+            guards = list(self.entry_guards.values())
+        return self._path_selector.select_path(
+            length, exit_ports, stable, guards, exit_country=exit_country,
+        )
+
+    def _exit_policy_index(self):
+        if self._exit_index is None:
+            self._exit_index = ExitPolicyIndex(self.routers_by_hash.values())
+        return self._exit_index
+
+    def add_router_listener(self, irouterlistener):
+        """
+        Adds a new :class:`txtorcon.interface.IRouterListener`, told
+        about the routers added, removed or changed by each new
+        consensus (but not about the ones we bootstrap with).
+        """
+        listener = IRouterListener(irouterlistener)
+        self.router_listeners.append(listener)
+
+    def remove_router_listener(self, irouterlistener):
+        self.router_listeners.remove(IRouterListener(irouterlistener))
+
     def _find_circuit_after_extend(self, x):
         ex, circ_id = x.split()
         if ex != 'EXTENDED':
@@ -679,6 +1300,9 @@ class TorState(object):
         :param using_guards: A warning is issued if the first router
             isn't in self.entry_guards.
 
+        :param purpose: if not None, the circuit's purpose (like
+            ``"general"`` or ``"controller"``)
+
         :return:
             A Deferred that will callback with a Circuit instance
             (with the .id member being valid, and probably nothing
@@ -708,12 +1332,45 @@ class TorState(object):
                 else:
                     cmd += router.id_hex[1:]
 
-            if purpose is not None:
-                cmd += " purpose={}".format(purpose)
-        d = self.protocol.queue_command(cmd)
+        if purpose is not None:
+            cmd += " purpose={}".format(purpose)
+        # a stream (or a circuit pool) is often waiting on it
+        d = self.protocol.queue_command(cmd, priority=PRIORITY_HIGH)
         d.addCallback(self._find_circuit_after_extend)
         return d
 
+    def build_circuits(self, paths, concurrency=10, timeout=60, retries=0,
+                       using_guards=False, result_callback=None):
+        """
+        Builds a circuit for each of ``paths``, keeping
+        ``concurrency`` EXTENDCIRCUITs in flight at once, timing each
+        build and each hop of it (from CIRC events).
+
+        :param paths: an iterable of paths, as for
+            :meth:`build_circuit` (None lets Tor choose); it is only
+            consumed as builds start, so it may be a generator
+        :param concurrency: how many circuits to build at once
+        :param timeout: how many seconds to wait for each circuit to
+            be BUILT before closing it (see
+            :func:`txtorcon.build_timeout_circuit`)
+        :param retries: how many more times to try a path that timed
+            out or failed
+        :param using_guards: as for :meth:`build_circuit`
+        :param result_callback: if not None, called with a
+            :class:`txtorcon.circuitbuild.BuildResult` as each path
+            is done with. Close the circuits you're finished with
+            (and those you don't want at all).
+
+        :return: a Deferred that fires with a
+            :class:`txtorcon.circuitbuild.BuildSummary` once every
+            path is done with
+        """
+        return build_circuits(
+            self, self._reactor, paths,
+            concurrency=concurrency, timeout=timeout, retries=retries,
+            using_guards=using_guards, result_callback=result_callback,
+        )
+
     DO_NOT_ATTACH = object()
 
     # @defer.inlineCallbacks  (this method is async, be nice to mark it ...)
@@ -760,7 +1417,8 @@ class TorState(object):
             if circ is None or circ is TorState.DO_NOT_ATTACH:
                 # tell Tor to do what it likes
                 return self.protocol.queue_command(
-                    u"ATTACHSTREAM {} 0".format(stream.id).encode("ascii")
+                    u"ATTACHSTREAM {} 0".format(stream.id).encode("ascii"),
+                    priority=PRIORITY_HIGH,
                 )
 
             else:
@@ -781,7 +1439,8 @@ class TorState(object):
                     )
                 # we've got a valid Circuit instance; issue the command
                 return self.protocol.queue_command(
-                    u"ATTACHSTREAM {} {}".format(stream.id, circ.id).encode("ascii")
+                    u"ATTACHSTREAM {} {}".format(stream.id, circ.id).encode("ascii"),
+                    priority=PRIORITY_HIGH,
                 )
 
         circ_d.addCallback(issue_stream_attach)
@@ -832,32 +1491,229 @@ class TorState(object):
 
     def _update_network_status(self, data):
         """
-        Used internally as a callback for updating Router information
-        from NEWCONSENSUS events.
+        Used internally to bring the Router information up to date
+        with ``data`` (the text of a consensus) right away; see
+        _network_status_event for NEWCONSENSUS events.
         """
 
         # XXX why are we ever getting this with 0 data?
         if len(data):
-            self._old_routers = self.routers
-            self.routers = dict()
-            self.all_routers = set()
-            self.routers_by_hash = dict()
-            self.routers_by_name = dict()
-            for line in data.split('\n'):
-                self._network_status_parser.feed_line(line)
-            self._network_status_parser.done()
+            diff = _diff_consensus(self._relay_keys, _parse_consensus(data))
+            tables = _RouterTables(self)
+            notes = []
+            for _ in self._apply_consensus(tables, diff, notes):
+                pass
+            self._install_routers(tables, diff[0], notes)
+
+    def _network_status_event(self, data):
+        """
+        Used internally as a callback for NEWCONSENSUS events. The
+        text is parsed and compared with the previous consensus in a
+        thread from the reactor's pool; then only the relays that
+        were added, removed or changed are applied to copies of our
+        tables, a chunk at a time, so the reactor is never held up
+        for long. Until the copies are swapped in, lookups see the
+        previous consensus. If more consensuses arrive meanwhile,
+        only the newest of them is processed next.
+        """
+        self._pending_consensus = data
+        if not self._processing_consensus:
+            self._process_consensus()
 
-        txtorlog.msg(len(self.routers_by_name), "named routers found.")
-        # remove any names we added that turned out to have dups
-        remove_keys = set()
-        for (k, v) in self.routers.items():
-            if v is None:
-                txtorlog.msg(len(self.routers_by_name[k]), "dups:", k)
-                remove_keys.add(k)
-        for k in remove_keys:
-            del self.routers[k]
+    @defer.inlineCallbacks
+    def _process_consensus(self):
+        self._processing_consensus = True
+        try:
+            while self._pending_consensus is not None:
+                data, self._pending_consensus = self._pending_consensus, None
+                # XXX why are we ever getting this with 0 data?
+                if not len(data):
+                    continue
+                try:
+                    diff = yield threads.deferToThreadPool(
+                        self._reactor, self._reactor.getThreadPool(),
+                        lambda: _diff_consensus(self._relay_keys, _parse_consensus(data)),
+                    )
+                    tables, notes = yield self._apply_consensus_gradually(diff)
+                except Exception as e:
+                    txtorlog.msg("Failed to process NEWCONSENSUS: {}".format(e))
+                    continue
+                # not while a snapshot of the routers is being written
+                yield self._snapshot_lock.acquire()
+                try:
+                    self._install_routers(tables, diff[0], notes)
+                finally:
+                    self._snapshot_lock.release()
+        finally:
+            self._processing_consensus = False
+
+    def _apply_consensus_gradually(self, diff):
+        """
+        Internal helper. A Deferred that fires with new _RouterTables
+        and the notifications for ``diff`` (from _diff_consensus),
+        applying _ROUTERS_PER_TURN relays per reactor turn.
+        """
+        tables = _RouterTables(self)
+        notes = []
+        steps = self._apply_consensus(tables, diff, notes)
+        done = defer.Deferred()
+
+        def apply_some():
+            applied = 0
+            try:
+                for _ in islice(steps, _ROUTERS_PER_TURN):
+                    applied += 1
+            except Exception:
+                done.errback()
+                return
+            if applied < _ROUTERS_PER_TURN:
+                done.callback((tables, notes))
+            else:
+                self._reactor.callLater(0, apply_some)
+        apply_some()
+        return done
+
+    def _apply_consensus(self, tables, diff, notes):
+        """
+        Internal helper. Applies ``diff`` (from _diff_consensus) to
+        ``tables`` one relay at a time, yielding after each, and
+        appends a (listener method name, Router) pair to ``notes``
+        for each. Nothing live is touched: the new attributes of each
+        Router that changed are put on a scratch Router, and copied
+        onto the real one by _install_routers.
+        """
+        _, added, changed, removed = diff
+        names = set()                   # whose entry in .routers to re-check
+
+        for idhash in removed:
+            router = tables.routers_by_hash.pop(hexIdFromHash(idhash))
+            tables.routers.pop(router.id_hex, None)
+            tables.guards.pop(router.id_hex, None)
+            if tables.authorities.get(router.name) is router:
+                del tables.authorities[router.name]
+            tables.all_routers.discard(router)
+            _reindex(
+                tables, router,
+                _index_keys(router, tables._router_countries.pop(router.id_hex, None)), (),
+                tables.copied,
+            )
+            self._remove_name(tables, router)
+            names.add(router.name)
+            notes.append(('router_removed', router))
+            yield
+
+        for relay in changed:
+            router = tables.routers_by_hash[hexIdFromHash(relay['idhash'])]
+            if tables.authorities.get(router.name) is router:
+                del tables.authorities[router.name]
+            old_country = tables._router_countries.get(router.id_hex)
+            updated = Router(self.protocol)
+            self._update_router(updated, relay)
+            tables.updates.append((router, updated))
+            country = self._index_country(tables, updated)
+            if country is None and updated.ip == router.ip and old_country is not None:
+                # updating forgets the location; it's still there
+                country = tables._router_countries[router.id_hex] = old_country
+            _reindex(
+                tables, router,
+                _index_keys(router, old_country), _index_keys(updated, country),
+                tables.copied,
+            )
+            if updated.name != router.name:
+                self._remove_name(tables, router)
+                tables.routers_by_name[updated.name] = tables.routers_by_name.get(updated.name, []) + [router]
+                names.update((router.name, updated.name))
+            if updated.has_flag('guard'):
+                tables.guards[router.id_hex] = router
+            else:
+                tables.guards.pop(router.id_hex, None)
+            if updated.has_flag('authority'):
+                tables.authorities[updated.name] = router
+            notes.append(('router_changed', router))
+            yield
 
+        for relay in added:
+            router = Router(self.protocol)
+            self._update_router(router, relay)
+            tables.routers[router.id_hex] = router
+            tables.routers_by_hash[router.id_hex] = router
+            tables.all_routers.add(router)
+            _reindex(
+                tables, router, (),
+                _index_keys(router, self._index_country(tables, router)),
+                tables.copied,
+            )
+            tables.routers_by_name[router.name] = tables.routers_by_name.get(router.name, []) + [router]
+            names.add(router.name)
+            if router.has_flag('guard'):
+                tables.guards[router.id_hex] = router
+            if router.has_flag('authority'):
+                tables.authorities[router.name] = router
+            notes.append(('router_added', router))
+            yield
+
+        # a name is only a key in .routers if exactly one router has it
+        for name in names:
+            same_name = tables.routers_by_name.get(name, ())
+            if len(same_name) == 1:
+                tables.routers[name] = same_name[0]
+            else:
+                tables.routers.pop(name, None)
+
+    def _remove_name(self, tables, router, name=None):
+        if name is None:
+            name = router.name
+        others = [r for r in tables.routers_by_name.get(name, ()) if r is not router]
+        if others:
+            tables.routers_by_name[name] = others
+        else:
+            tables.routers_by_name.pop(name, None)
+
+    def _install_routers(self, tables, relay_keys, notes):
+        """
+        Internal helper. Makes ``tables`` (a _RouterTables) our
+        routers, replacing all the previous ones (and updating the
+        Routers that changed) at once, and then tells our
+        IRouterListeners about the ``notes`` (from _apply_consensus).
+        """
+        for (router, updated) in tables.updates:
+            # keep the (possibly looked-up) location and parsed time
+            # unless what they came from has changed
+            if updated.ip != router.ip:
+                router._location = None
+            if updated._modified_unparsed != router._modified_unparsed:
+                router._modified = None
+            for name in _CONSENSUS_SLOTS:
+                setattr(router, name, getattr(updated, name))
+        self.routers = tables.routers
+        self.routers_by_name = tables.routers_by_name
+        self.routers_by_hash = tables.routers_by_hash
+        self.guards = tables.guards
+        self.authorities = tables.authorities
+        self.all_routers = tables.all_routers
+        self._routers_by_address = tables._routers_by_address
+        self._routers_by_subnet = tables._routers_by_subnet
+        self._routers_by_flags = tables._routers_by_flags
+        self._routers_by_country = tables._routers_by_country
+        self._router_countries = tables._router_countries
+        self._relay_keys = relay_keys
+        self._exit_index = None
+        self._router_table = None
+        self._path_selector = None
+
+        txtorlog.msg(len(self.routers_by_name), "named routers found.")
         txtorlog.msg(len(self.guards), "GUARDs")
+        txtorlog.msg(len(notes), "routers added, removed or changed.")
+
+        for (method, router) in notes:
+            for listener in self.router_listeners:
+                try:
+                    getattr(listener, method)(router)
+                except Exception as e:
+                    txtorlog.msg("Router listener {} failed: {}".format(listener, e))
+
+        if self._snapshot_path is not None:
+            self._save_snapshot()
 
     def _maybe_create_circuit(self, circ_id):
         if circ_id not in self.circuits:
@@ -877,9 +1733,15 @@ class TorState(object):
         """
 
         # print("circuit_update", line)
-        args = line.split()
+        args = split_event_args(line)
         circ_id = int(args[0])
 
+        # Tor follows FAILED with CLOSED for the same circuit; by
+        # then we've already destroyed (and recorded) it, so don't
+        # make a new one just to close it again
+        if circ_id not in self.circuits and args[1] in ('CLOSED', 'FAILED'):
+            return
+
         c = self._maybe_create_circuit(circ_id)
         c.update(args)
 
@@ -893,12 +1755,16 @@ class TorState(object):
             # this happens if there are no active streams
             return
 
-        args = line.split()
+        args = split_event_args(line)
         assert len(args) >= 3
 
         stream_id = int(args[0])
         wasnew = False
         if stream_id not in self.streams:
+            # as with circuits, a stream that already finished may
+            # be announced as FAILED and then CLOSED
+            if args[1] in ('CLOSED', 'FAILED'):
+                return
             stream = self.stream_factory(self, self.addrmap)
             self.streams[stream_id] = stream
             stream.listen(self)
@@ -921,7 +1787,7 @@ class TorState(object):
     event_map = {
         'STREAM': '_stream_update',
         'CIRC': '_circuit_update',
-        'NEWCONSENSUS': '_update_network_status',
+        'NEWCONSENSUS': '_network_status_event',
         'ADDRMAP': '_addr_map',
     }
 
@@ -973,6 +1839,7 @@ class TorState(object):
     def stream_new(self, stream):
         "IStreamListener: a new stream has been created"
         txtorlog.msg("stream_new", stream)
+        self._stream_info[stream.id] = [self._reactor.seconds(), None]
 
     def stream_succeeded(self, stream):
         "IStreamListener: stream has succeeded"
@@ -986,6 +1853,8 @@ class TorState(object):
         """
         txtorlog.msg("stream_attach", stream.id,
                      stream.target_host, " -> ", circuit)
+        if circuit is not None:
+            self._stream_info.setdefault(stream.id, [None, None])[1] = circuit.id
 
     def stream_detach(self, stream, **kw):
         """
@@ -1000,6 +1869,7 @@ class TorState(object):
         """
 
         txtorlog.msg("stream_closed", stream.id)
+        self._record_stream(stream, kw)
         del self.streams[stream.id]
 
     def stream_failed(self, stream, **kw):
@@ -1009,14 +1879,26 @@ class TorState(object):
         """
 
         txtorlog.msg("stream_failed", stream.id)
+        self._record_stream(stream, kw)
         del self.streams[stream.id]
 
+    def _record_stream(self, stream, kw):
+        if stream.id not in self.streams:
+            return
+        opened, circuit_id = self._stream_info.pop(stream.id, (None, None))
+        self.history.add_stream(StreamRecord(
+            stream.id, stream.state, _extract_reason(kw),
+            stream.target_host, stream.target_port, circuit_id,
+            opened, self._reactor.seconds(),
+        ))
+
     # implement ICircuitListener
 
     def circuit_launched(self, circuit):
         "ICircuitListener API"
         txtorlog.msg("circuit_launched", circuit)
         self.circuits[circuit.id] = circuit
+        self._circuit_times.setdefault(circuit.id, [self._reactor.seconds(), None])
 
     def circuit_extend(self, circuit, router):
         "ICircuitListener API"
@@ -1029,11 +1911,13 @@ class TorState(object):
             "->".join("%s.%s" % (x.name, x.location.countrycode) for x in circuit.path),
             circuit.streams
         )
+        self._circuit_times.setdefault(circuit.id, [None, None])[1] = self._reactor.seconds()
 
     def circuit_new(self, circuit):
         "ICircuitListener API"
         txtorlog.msg("circuit_new:", circuit.id)
         self.circuits[circuit.id] = circuit
+        self._circuit_times.setdefault(circuit.id, [self._reactor.seconds(), None])
 
     def circuit_destroy(self, circuit):
         "Used by circuit_closed and circuit_failed (below)"
@@ -1043,9 +1927,20 @@ class TorState(object):
         )
         del self.circuits[circuit.id]
 
+    def _record_circuit(self, circuit, kw):
+        if circuit.id not in self.circuits:
+            return
+        launched, built = self._circuit_times.pop(circuit.id, (None, None))
+        self.history.add_circuit(CircuitRecord(
+            circuit.id, circuit.state, _extract_reason(kw), circuit.purpose,
+            tuple(router.id_hex for router in circuit.path),
+            launched, built, self._reactor.seconds(),
+        ))
+
     def circuit_closed(self, circuit, **kw):
         "ICircuitListener API"
         txtorlog.msg("circuit_closed", circuit)
+        self._record_circuit(circuit, kw)
         circuit._when_built.fire(
             Failure(
                 CircuitBuildClosedError(_extract_reason(kw))
@@ -1056,6 +1951,7 @@ class TorState(object):
     def circuit_failed(self, circuit, **kw):
         "ICircuitListener API"
         txtorlog.msg("circuit_failed", circuit, str(kw))
+        self._record_circuit(circuit, kw)
         circuit._when_built.fire(
             Failure(
                 CircuitBuildFailedError(_extract_reason(kw))
@@ -9,6 +9,7 @@ import shutil
 import subprocess
 import ipaddress
 import re
+from collections.abc import Mapping
 
 from twisted.internet import defer
 from twisted.internet.interfaces import IProtocolFactory
@@ -151,7 +152,8 @@ def maybe_ip_addr(addr):
 def find_keywords(args, key_filter=lambda x: not x.startswith("$")):
     """
     This splits up strings like name=value, foo=bar into a dict. Does NOT deal
-    with quotes in value (e.g. key="value with space" will not work
+    with quotes in value (e.g. key="value with space" will not work; see
+    :func:`split_event_args` and :class:`KeywordMap` for that)
 
     By default, note that it takes OUT any key which starts with $ (i.e. a
     single dollar sign) since for many use-cases the way Tor encodes nodes
@@ -168,6 +170,159 @@ def find_keywords(args, key_filter=lambda x: not x.startswith("$")):
     return dict(x.split('=', 1) for x in filtered)
 
 
+# a token is a run of non-space characters and/or QuotedStrings, so
+# that e.g. SOCKS_USERNAME="a b" or "2024-01-01 12:00:00" stay whole
+_EVENT_TOKEN = re.compile(r'(?:[^\s"]+|"[^"\\]*(?:\\.[^"\\]*)*")+')
+
+
+def split_event_args(line):
+    """
+    Splits the arguments of an event (or a ``circuit-status`` /
+    ``stream-status`` line) on spaces like ``line.split()`` does,
+    except that a QuotedString (e.g. ``SOCKS_USERNAME="a b"``) is
+    never split.
+    """
+    if '"' not in line:
+        return line.split()
+    if '\\' in line:
+        # escaped quotes need the (slower) regular expression
+        return _EVENT_TOKEN.findall(line)
+    # a word with an odd number of quotes opens (or closes) a
+    # QuotedString; the words in between are glued back together
+    args = []
+    quoted = None
+    for word in line.split(' '):
+        if quoted is not None:
+            quoted.append(word)
+            if word.count('"') % 2:
+                args.append(' '.join(quoted))
+                quoted = None
+        elif '"' in word and word.count('"') % 2:
+            quoted = [word]
+        elif word:
+            args.append(word)
+    if quoted is not None:
+        args.append(' '.join(quoted))
+    return args
+
+
+def _unquote_value(value):
+    """
+    Internal helper. Decodes ``value`` if it is a QuotedString (or
+    at least looks like one).
+    """
+    if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+        if '\\' not in value:
+            return value[1:-1]
+        try:
+            return unescape_quoted_string(value)
+        except ValueError:
+            return value[1:-1]
+    return value
+
+
+def split_event_keywords(args, positional=None):
+    """
+    :param args: an event's arguments, as split by
+        :func:`split_event_args`
+
+    :param positional: if not None, a list to append all the other
+        (non-keyword) arguments to
+
+    :return: a dict of the ``KEY=value`` arguments, with QuotedString
+        values unquoted (as are the positional arguments). Router
+        names like ``$hash=name`` aren't keywords.
+    """
+    keywords = {}
+    for arg in args:
+        if '=' in arg:
+            key, _, value = arg.partition('=')
+            if key.isidentifier():
+                keywords[key] = _unquote_value(value) if '"' in value else value
+                continue
+        if positional is not None:
+            positional.append(_unquote_value(arg) if '"' in arg else arg)
+    return keywords
+
+
+class KeywordMap(Mapping):
+    """
+    The ``KEY=value`` arguments of a Tor event as a read-only
+    mapping. Keys are looked up case-insensitively (so ``m['reason']``
+    finds ``REASON``), but iterate as Tor sent them. Values that were
+    QuotedStrings are unquoted.
+
+    See :meth:`from_args`; :class:`txtorcon.Circuit` and
+    :class:`txtorcon.Stream` keep one of these as their ``flags``.
+    """
+
+    __slots__ = ('_keys', '_keywords')
+
+    def __init__(self, keywords=None):
+        self._index(dict(keywords) if keywords else {})
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        :param args: an event's arguments, as split by
+            :func:`split_event_args`
+
+        :return: a KeywordMap of the ``KEY=value`` ones (see
+            :func:`split_event_keywords`)
+        """
+        rtn = object.__new__(cls)
+        rtn._index(split_event_keywords(args))
+        return rtn
+
+    def _index(self, keywords):
+        # every key is stored as sent and in lower-case, so a lookup
+        # is one or two dict hits and as_kwargs() needs no copy
+        self._keys = keys = tuple(keywords)
+        for key in keys:
+            if not key.islower():
+                keywords[key.lower()] = keywords[key]
+        self._keywords = keywords
+
+    def as_kwargs(self):
+        """
+        :return: a dict of every key both as it was and in lower-case
+            (see :func:`lower_case_keywords`), e.g. to pass as
+            ``**kwargs`` to the ``circuit_closed`` or ``stream_failed``
+            listener methods. It must not be modified.
+        """
+        return self._keywords
+
+    def __getitem__(self, key):
+        try:
+            return self._keywords[key]
+        except KeyError:
+            return self._keywords[key.lower()]
+
+    def __contains__(self, key):
+        return key in self._keywords or key.lower() in self._keywords
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'KeywordMap({!r})'.format(dict(self.items()))
+
+
+def lower_case_keywords(kw):
+    """
+    :return: a new dict of the mapping ``kw`` with every key both as
+        it was and in lower-case, e.g. to pass as ``**kwargs`` to the
+        ``circuit_closed`` or ``stream_failed`` listener methods.
+    """
+    flags = dict(kw)
+    for key in kw:
+        flags[key.lower()] = flags[key]
+    return flags
+
+
 def delete_file_or_tree(*args):
     """
     For every path in args, try to delete it as a file or a directory